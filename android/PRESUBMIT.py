@@ -91,7 +91,9 @@ def CommonChecks(input_api, output_api):
           unit_tests=[
               J('.', 'list_class_verification_failures_test.py'),
               J('.', 'convert_dex_profile_tests.py'),
+              J('.', 'python_action_worker_test.py'),
               J('gyp', 'compile_java_tests.py'),
+              J('gyp', 'compile_resources_test.py'),
               J('gyp', 'create_unwind_table_tests.py'),
               J('gyp', 'dex_test.py'),
               J('gyp', 'extract_unwind_tables_tests.py'),
@@ -101,9 +103,12 @@ def CommonChecks(input_api, output_api):
               J('gyp', 'java_cpp_strings_tests.py'),
               J('gyp', 'java_google_api_keys_tests.py'),
               J('gyp', 'util', 'build_utils_test.py'),
+              J('gyp', 'util', 'dep_utils_test.py'),
               J('gyp', 'util', 'manifest_utils_test.py'),
               J('gyp', 'util', 'md5_check_test.py'),
+              J('gyp', 'util', 'parallel_test.py'),
               J('gyp', 'util', 'resource_utils_test.py'),
+              J('incremental_install', 'installer_test.py'),
               J('pylib', 'base', 'output_manager_test_case.py'),
               J('pylib', 'constants', 'host_paths_unittest.py'),
               J('pylib', 'gtest', 'gtest_test_instance_test.py'),
@@ -129,6 +134,7 @@ def CommonChecks(input_api, output_api):
               J('pylib', 'utils', 'device_dependencies_test.py'),
               J('pylib', 'utils', 'dexdump_test.py'),
               J('pylib', 'utils', 'gold_utils_test.py'),
+              J('pylib', 'utils', 'test_durations_test.py'),
               J('pylib', 'utils', 'test_filter_test.py'),
           ],
           env=pylib_test_env))
@@ -13,6 +13,7 @@ import json
 import logging
 import os
 import posixpath
+import queue
 import random
 import re
 import shlex
@@ -21,6 +22,7 @@ import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import zipfile
 
 import adb_command_line
@@ -46,6 +48,7 @@ with devil_env.SysPath(
 from incremental_install import installer
 from pylib import constants
 from pylib.symbols import deobfuscator
+from pylib.symbols import stack_symbolizer
 from pylib.utils import simpleperf
 from pylib.utils import app_bundle_utils
 
@@ -55,6 +58,9 @@ with devil_env.SysPath(
 
 BASE_MODULE = 'base'
 
+# Maximum number of logcat lines read ahead of the ones being printed.
+_LOGCAT_QUEUE_SIZE = 10000
+
 
 def _Colorize(text, style=''):
   return (style
@@ -687,6 +693,9 @@ class _LogcatProcessor:
       self._stack_script_context = stack_script_context
       self._print_func = print_func
       self._crash_lines_buffer = None
+      # A long-lived stack.py process that stacks are piped through. Started
+      # on the first stack, since creating its staging dir can be slow.
+      self._symbolizer_pool = None
 
     def _FlushLines(self):
       """Prints queued lines after sending them through stack.py."""
@@ -695,19 +704,21 @@ class _LogcatProcessor:
 
       crash_lines = self._crash_lines_buffer
       self._crash_lines_buffer = None
-      with tempfile.NamedTemporaryFile(mode='w') as f:
-        f.writelines(x[0].message + '\n' for x in crash_lines)
-        f.flush()
-        proc = self._stack_script_context.Popen(
-            input_file=f.name, stdout=subprocess.PIPE)
-        lines = proc.communicate()[0].splitlines()
+      if self._symbolizer_pool is None:
+        self._symbolizer_pool = stack_symbolizer.StackScriptSymbolizerPool(
+            self._stack_script_context.GetCommand(pass_through=True))
+      lines = self._symbolizer_pool.TransformLines(
+          [x[0].message for x in crash_lines])
 
       for i, line in enumerate(lines):
         parsed_line, dim = crash_lines[min(i, len(crash_lines) - 1)]
-        d = parsed_line._asdict()
-        d['message'] = line
-        parsed_line = _LogcatProcessor.ParsedLine(**d)
-        self._print_func(parsed_line, dim)
+        self._print_func(parsed_line._replace(message=line), dim)
+
+    def Close(self):
+      self._FlushLines()
+      if self._symbolizer_pool:
+        self._symbolizer_pool.Close()
+        self._symbolizer_pool = None
 
     def AddLine(self, parsed_line, dim):
       # Assume all lines from DEBUG are stacks.
@@ -772,9 +783,11 @@ class _LogcatProcessor:
       self._exit_on_match = None
     self._found_exit_match = False
     if stack_script_context:
-      self._print_func = _LogcatProcessor.NativeStackSymbolizer(
-          stack_script_context, self._PrintParsedLine).AddLine
+      self._stack_symbolizer = _LogcatProcessor.NativeStackSymbolizer(
+          stack_script_context, self._PrintParsedLine)
+      self._print_func = self._stack_symbolizer.AddLine
     else:
+      self._stack_symbolizer = None
       self._print_func = self._PrintParsedLine
     # Process ID for the app's main process (with no :name suffix).
     self._primary_pid = None
@@ -846,6 +859,24 @@ class _LogcatProcessor:
     return style
 
   def _ParseLine(self, line):
+    # Fast path for well-formed lines. A single str.split() is faster than an
+    # equivalent regex.
+    tokens = line.split(None, 6)
+    if len(tokens) != 7:
+      return self._ParseMalformedLine(line)
+    date, invokation_time, pid, tid, priority, tag, message = tokens
+    if not pid.isdecimal() or not tid.isdecimal():
+      return self._ParseMalformedLine(line)
+    # Parsing "GCoreFlp:" vs "Auth    :", we only want tag to contain the word,
+    # and we don't want to keep the colon for the message.
+    if tag[-1] == ':':
+      tag = tag[:-1]
+    elif len(message) > 2:
+      message = message[2:]
+    return self.ParsedLine(date, invokation_time, int(pid), int(tid), priority,
+                           tag, message)
+
+  def _ParseMalformedLine(self, line):
     tokens = line.split(None, 6)
 
     def consume_token_or_default(default):
@@ -923,6 +954,11 @@ class _LogcatProcessor:
   def FoundExitMatch(self):
     return self._found_exit_match
 
+  def Close(self):
+    """Prints any buffered stack, and stops the stack symbolizer."""
+    if self._stack_symbolizer:
+      self._stack_symbolizer.Close()
+
   def ProcessLine(self, line):
     if not line or line.startswith('------'):
       return
@@ -971,13 +1007,89 @@ class _LogcatProcessor:
         self._initial_buffered_lines.append((log, not owned_pid))
 
 
+class _LogcatPipeline:
+  """Reads lines on a background thread, so that slow processing of earlier
+  lines (e.g. symbolization) does not stall reading from adb.
+
+  Args:
+    lines: An iterable of lines, e.g. from AdbWrapper.Logcat().
+    queue_size: Maximum number of lines to read ahead of the ones processed.
+    drop_when_behind: Whether to drop new lines while the queue is full, rather
+      than wait for it to drain. Dropped lines are reported in the output.
+  """
+  _END = object()
+
+  def __init__(self,
+               lines,
+               queue_size=_LOGCAT_QUEUE_SIZE,
+               drop_when_behind=False):
+    self._lines = lines
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._drop_when_behind = drop_when_behind
+    self._num_dropped = 0
+    self._error = None
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._ReadLines,
+                                    name='logcat-reader',
+                                    daemon=True)
+
+  def _ReadLines(self):
+    try:
+      for line in self._lines:
+        if self._stopped.is_set():
+          break
+        if not self._drop_when_behind:
+          self._queue.put(line)
+          continue
+        try:
+          self._queue.put_nowait(line)
+        except queue.Full:
+          self._num_dropped += 1
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
+    finally:
+      self._queue.put(self._END)
+
+  def __iter__(self):
+    self._thread.start()
+    num_reported = 0
+    while True:
+      line = self._queue.get()
+      if line is self._END:
+        break
+      num_dropped = self._num_dropped
+      if num_dropped > num_reported:
+        sys.stdout.write(
+            _Colorize('[{} logcat lines dropped]'.format(num_dropped -
+                                                         num_reported),
+                      colorama.Fore.RED) + '\n')
+        num_reported = num_dropped
+      yield line
+    if self._error:
+      raise self._error
+
+  @property
+  def num_dropped(self):
+    return self._num_dropped
+
+  def Stop(self):
+    self._stopped.set()
+    # Unblock the reader if it is waiting on a full queue.
+    while True:
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        break
+
+
 def _RunLogcat(device,
                package_name,
                stack_script_context,
                deobfuscate,
                verbose,
                exit_on_match=None,
-               extra_package_names=None):
+               extra_package_names=None,
+               drop_when_behind=False):
   logcat_processor = _LogcatProcessor(device,
                                       package_name,
                                       stack_script_context,
@@ -986,18 +1098,24 @@ def _RunLogcat(device,
                                       exit_on_match=exit_on_match,
                                       extra_package_names=extra_package_names)
   device.RunShellCommand(['log', logcat_processor.nonce])
-  for line in device.adb.Logcat(logcat_format='threadtime'):
-    try:
-      logcat_processor.ProcessLine(line)
-      if logcat_processor.FoundExitMatch():
-        return
-    except:
-      sys.stderr.write('Failed to process line: ' + line + '\n')
-      # Skip stack trace for the common case of the adb server being
-      # restarted.
-      if 'unexpected EOF' in line:
-        sys.exit(1)
-      raise
+  pipeline = _LogcatPipeline(device.adb.Logcat(logcat_format='threadtime'),
+                             drop_when_behind=drop_when_behind)
+  try:
+    for line in pipeline:
+      try:
+        logcat_processor.ProcessLine(line)
+        if logcat_processor.FoundExitMatch():
+          return
+      except:
+        sys.stderr.write('Failed to process line: ' + line + '\n')
+        # Skip stack trace for the common case of the adb server being
+        # restarted.
+        if 'unexpected EOF' in line:
+          sys.exit(1)
+        raise
+  finally:
+    pipeline.Stop()
+    logcat_processor.Close()
 
 
 def _GetPackageProcesses(device, package_name):
@@ -1124,7 +1242,14 @@ class _StackScriptContext:
       shutil.rmtree(self._staging_dir)
       self._staging_dir = None
 
-  def Popen(self, input_file=None, **kwargs):
+  def GetCommand(self, input_file=None, pass_through=False):
+    """Returns the stack.py command line.
+
+    Args:
+      input_file: File to decode. If not specified, stdin is processed.
+      pass_through: Whether to decode stdin line by line, printing lines that
+        are not part of a stack unchanged. Used for long-lived processes.
+    """
     if self._staging_dir is None:
       self._CreateStaging()
     stack_script = os.path.join(
@@ -1136,8 +1261,14 @@ class _StackScriptContext:
     ]
     if self._quiet:
       cmd.append('--quiet')
-    if input_file:
+    if pass_through:
+      cmd += ['--pass-through', '--flush', '-']
+    elif input_file:
       cmd.append(input_file)
+    return cmd
+
+  def Popen(self, input_file=None, **kwargs):
+    cmd = self.GetCommand(input_file)
     logging.info('Running: %s', shlex.join(cmd))
     return subprocess.Popen(cmd, universal_newlines=True, **kwargs)
 
@@ -1815,7 +1946,8 @@ To disable filtering, (but keep coloring), use --verbose.
                  deobfuscate,
                  bool(self.args.verbose_count),
                  self.args.exit_on_match,
-                 extra_package_names=extra_package_names)
+                 extra_package_names=extra_package_names,
+                 drop_when_behind=self.args.drop_when_behind)
     except KeyboardInterrupt:
       pass  # Don't show stack trace upon Ctrl-C
     finally:
@@ -1834,6 +1966,10 @@ To disable filtering, (but keep coloring), use --verbose.
           help='Path to ProGuard map (enables deobfuscation)')
     group.add_argument('--exit-on-match',
                        help='Exits logcat when a message matches this regex.')
+    group.add_argument('--drop-when-behind',
+                       action='store_true',
+                       help='When output falls behind logcat, drop new lines '
+                       'rather than wait for output to catch up.')
 
 
 class _PsCommand(_Command):
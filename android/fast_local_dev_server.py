@@ -7,6 +7,9 @@
 from __future__ import annotations
 
 import argparse
+import functools
+import heapq
+import itertools
 import json
 import os
 import queue
@@ -15,11 +18,23 @@ import socket
 import subprocess
 import sys
 import threading
+import time
 from typing import Callable, Dict, List, Optional, Tuple
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'gyp'))
 from util import server_utils
 
+# Expected durations in seconds for tasks that have not been run before, by
+# target name suffix. Long poles are started first.
+_DEFAULT_DURATIONS = (
+    ('__lint', 120.0),
+    ('__errorprone', 60.0),
+)
+_DEFAULT_DURATION = 10.0
+
+# Rough memory use of a task. Most tasks run a JVM.
+_TASK_MEMORY_KB = 2 * 1024 * 1024
+
 
 def log(msg: str, *, end: str = ''):
   # Shrink the message (leaving a 2-char prefix and use the rest of the room
@@ -80,29 +95,171 @@ class TaskStats:
               f'{cls._completed_tasks}/{cls._total_tasks}')
 
 
+class TaskEvents:
+  """Class to stream task lifecycle events to subscribed connections.
+
+  Each event is sent as one line of JSON. Every subscriber has its own writer
+  thread so that a slow subscriber cannot hold up tasks."""
+  _subscribers: List[_EventSubscriber] = []
+  _lock = threading.Lock()
+
+  @classmethod
+  def subscribe(cls, conn: socket.socket, get_tasks: Callable[[], List[Task]]):
+    """Streams events to |conn|, starting with one for each task in progress.
+
+    A 'synced' event marks the end of the events for tasks in progress."""
+    subscriber = _EventSubscriber(conn)
+    with cls._lock:
+      for task in get_tasks():
+        if task.finished:
+          continue
+        subscriber.send(task.event('started' if task.started else 'queued'))
+      subscriber.send({'event': 'synced', 'time': time.time()})
+      cls._subscribers.append(subscriber)
+
+  @classmethod
+  def publish(cls, event: Dict):
+    with cls._lock:
+      cls._subscribers = [s for s in cls._subscribers if s.send(event)]
+
+  @classmethod
+  def close(cls):
+    with cls._lock:
+      for subscriber in cls._subscribers:
+        subscriber.close()
+      cls._subscribers = []
+
+
+class _EventSubscriber:
+  """A connection that TaskEvents streams events to."""
+
+  def __init__(self, conn: socket.socket):
+    self._conn = conn
+    self._queue: queue.SimpleQueue[Optional[bytes]] = queue.SimpleQueue()
+    self._closed = False
+    self._thread = threading.Thread(target=self._write_events, daemon=True)
+    self._thread.start()
+
+  def send(self, event: Dict) -> bool:
+    """Queues |event| to be sent. Returns False once the connection closed."""
+    if self._closed:
+      return False
+    self._queue.put(json.dumps(event).encode('utf8') + b'\n')
+    return True
+
+  def close(self):
+    self._queue.put(None)
+
+  def _write_events(self):
+    with self._conn:
+      while True:
+        data = self._queue.get()
+        if data is None:
+          break
+        try:
+          self._conn.sendall(data)
+        except OSError:
+          break
+    self._closed = True
+
+
 class TaskManager:
-  """Class to encapsulate a threadsafe queue and handle deactivating it."""
+  """Class to encapsulate a threadsafe task queue and handle deactivating it.
+
+  Queued tasks are started longest-expected-duration first so that long poles
+  (e.g. lint and errorprone) are not left until the end. The expected duration
+  of a task is how long the task with the same name last took to run. New tasks
+  are started only while there is spare CPU and memory.
+  """
 
   def __init__(self):
-    self._queue: queue.SimpleQueue[Task] = queue.SimpleQueue()
+    self._lock = threading.Lock()
+    # Heap of (-expected duration, insertion order, task).
+    self._queue: List[Tuple[float, int, Task]] = []
+    self._counter = itertools.count()
+    # The most recently added task for each stamp file.
+    self._tasks: Dict[Tuple[str, str], Task] = {}
+    # Duration in seconds of the last successful run of each task name.
+    self._durations: Dict[str, float] = {}
+    self._num_started = 0
+    self._total_wait_time = 0.0
+    self._max_wait_time = 0.0
+    self._num_run = 0
+    self._total_run_time = 0.0
     self._deactivated = False
 
   def add_task(self, task: Task):
+    """Queues |task|, dropping any task that it supersedes."""
     assert not self._deactivated
     TaskStats.add_task()
-    self._queue.put(task)
+    with self._lock:
+      existing_task = self._tasks.get(task.key)
+      self._tasks[task.key] = task
+      if existing_task:
+        # Drop it from the queue if it has not been started yet.
+        self._queue = [e for e in self._queue if e[2] is not existing_task]
+        heapq.heapify(self._queue)
+      task.queued_time = time.monotonic()
+      heapq.heappush(self._queue,
+                     (-self._expected_duration(task), next(self._counter), task))
     log(f'QUEUED {task.name}')
+    TaskEvents.publish(task.event('queued'))
+    if existing_task:
+      # Done outside of _lock since this waits for the task to finish, which
+      # calls _on_task_complete.
+      existing_task.terminate(replaced=True)
     self._maybe_start_tasks()
 
   def deactivate(self):
+    """Terminates all tasks, both queued and running."""
     self._deactivated = True
-    while not self._queue.empty():
-      try:
-        task = self._queue.get_nowait()
-      except queue.Empty:
-        return
+    with self._lock:
+      tasks = list(self._tasks.values())
+      self._queue = []
+    for task in tasks:
       task.terminate()
 
+  def tasks(self) -> List[Task]:
+    """Returns the latest task for each stamp file that is not yet done."""
+    with self._lock:
+      return list(self._tasks.values())
+
+  def stats(self) -> Dict:
+    """Returns stats about queued, running and completed tasks."""
+    now = time.monotonic()
+    with self._lock:
+      queued = sorted(self._queue)
+      return {
+          'queue_depth':
+          len(queued),
+          'queued': [{
+              'name': t.name,
+              'expected_duration': -d,
+              'wait_time': now - t.queued_time,
+          } for d, _, t in queued],
+          'num_started':
+          self._num_started,
+          'mean_wait_time':
+          self._total_wait_time / max(self._num_started, 1),
+          'max_wait_time':
+          self._max_wait_time,
+          'num_run':
+          self._num_run,
+          'mean_run_time':
+          self._total_run_time / max(self._num_run, 1),
+          'durations':
+          dict(self._durations),
+      }
+
+  def _expected_duration(self, task: Task) -> float:
+    duration = self._durations.get(task.name)
+    if duration is not None:
+      return duration
+    for suffix, duration in _DEFAULT_DURATIONS:
+      if task.name.endswith(suffix):
+        return duration
+    return _DEFAULT_DURATION
+
   @staticmethod
   def _num_running_processes():
     with open('/proc/stat') as f:
@@ -112,6 +269,36 @@ class TaskManager:
     assert False, 'Could not read /proc/stat'
     return 0
 
+  @staticmethod
+  def _available_memory_kb():
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1])
+    assert False, 'Could not read /proc/meminfo'
+    return 0
+
+  def _pop_task(self) -> Optional[Task]:
+    with self._lock:
+      if not self._queue:
+        return None
+      task = heapq.heappop(self._queue)[2]
+      wait_time = time.monotonic() - task.queued_time
+      self._num_started += 1
+      self._total_wait_time += wait_time
+      self._max_wait_time = max(self._max_wait_time, wait_time)
+      return task
+
+  def _on_task_complete(self, task: Task):
+    with self._lock:
+      if task.run_time is not None:
+        self._num_run += 1
+        self._total_run_time += task.run_time
+        self._durations[task.name] = task.run_time
+      if self._tasks.get(task.key) is task:
+        del self._tasks[task.key]
+    self._maybe_start_tasks()
+
   def _maybe_start_tasks(self):
     if self._deactivated:
       return
@@ -119,20 +306,24 @@ class TaskManager:
     # processes will not cause new tasks to be started while the overall load is
     # heavy.
     cur_load = max(self._num_running_processes(), os.getloadavg()[0])
+    available_memory_kb = self._available_memory_kb()
     num_started = 0
     # Always start a task if we don't have any running, so that all tasks are
-    # eventually finished. Try starting up tasks when the overall load is light.
-    # Limit to at most 2 new tasks to prevent ramping up too fast. There is a
-    # chance where multiple threads call _maybe_start_tasks and each gets to
-    # spawn up to 2 new tasks, but since the only downside is some build tasks
-    # get worked on earlier rather than later, it is not worth mitigating.
-    while num_started < 2 and (TaskStats.no_running_processes()
-                               or num_started + cur_load < os.cpu_count()):
-      try:
-        next_task = self._queue.get_nowait()
-      except queue.Empty:
+    # eventually finished. Try starting up tasks when the overall load is light
+    # and there is enough memory for another task. Limit to at most 2 new tasks
+    # to prevent ramping up too fast. There is a chance where multiple threads
+    # call _maybe_start_tasks and each gets to spawn up to 2 new tasks, but
+    # since the only downside is some build tasks get worked on earlier rather
+    # than later, it is not worth mitigating.
+    while num_started < 2 and (TaskStats.no_running_processes() or
+                               (num_started + cur_load < os.cpu_count()
+                                and available_memory_kb -
+                                num_started * _TASK_MEMORY_KB >= _TASK_MEMORY_KB)):
+      next_task = self._pop_task()
+      if not next_task:
         return
-      num_started += next_task.start(self._maybe_start_tasks)
+      num_started += next_task.start(
+          functools.partial(self._on_task_complete, next_task))
 
 
 # TODO(wnwen): Break this into Request (encapsulating what ninja sends) and Task
@@ -152,10 +343,33 @@ class Task:
     self._proc: Optional[subprocess.Popen] = None
     self._thread: Optional[threading.Thread] = None
     self._return_code: Optional[int] = None
+    self._start_time: Optional[float] = None
+    # Set by TaskManager when the task is queued.
+    self.queued_time = 0.0
+    # Set once the task has run to completion without being terminated.
+    self.run_time: Optional[float] = None
+    # Set once the task has run or been terminated.
+    self.finished = False
+
+  @property
+  def started(self):
+    return self._proc is not None
+
+  def event(self, event_type: str, **kwargs) -> Dict:
+    """Returns a TaskEvents event about this task."""
+    return {
+        'event': event_type,
+        'time': time.time(),
+        'name': self.name,
+        'cwd': self.cwd,
+        'stamp_file': self.stamp_file,
+        **kwargs,
+    }
 
   @property
   def key(self):
-    return (self.cwd, self.name)
+    # A task supersedes any earlier task that writes the same stamp file.
+    return (self.cwd, self.stamp_file)
 
   def start(self, on_complete_callback: Callable[[], None]) -> int:
     """Starts the task if it has not already been terminated.
@@ -176,6 +390,7 @@ class Task:
       # TODO(wnwen): Use ionice to reduce resource consumption.
       TaskStats.add_process()
       log(f'STARTING {self.name}')
+      self._start_time = time.monotonic()
       # This use of preexec_fn is sufficiently simple, just one os.nice call.
       # pylint: disable=subprocess-popen-preexec-fn
       self._proc = subprocess.Popen(
@@ -187,6 +402,8 @@ class Task:
           text=True,
           preexec_fn=lambda: os.nice(19),
       )
+      # Publish before the thread can publish that the task finished.
+      TaskEvents.publish(self.event('started'))
       self._thread = threading.Thread(
           target=self._complete_when_process_finishes,
           args=(on_complete_callback, ))
@@ -221,6 +438,9 @@ class Task:
     # constructed with text=True.
     stdout: str = self._proc.communicate()[0]
     self._return_code = self._proc.returncode
+    with self._lock:
+      if not self._terminated:
+        self.run_time = time.monotonic() - self._start_time
     TaskStats.remove_process()
     self._complete(stdout)
     on_complete_callback()
@@ -231,17 +451,21 @@ class Task:
     This method should only be run once per task. Avoid modifying the task so
     that this method does not need locking."""
 
+    self.finished = True
     TaskStats.complete_task()
     delete_stamp = False
     if self._terminated:
+      status = 'replaced' if self._replaced else 'terminated'
       log(f'TERMINATED {self.name}')
       # When tasks are replaced, avoid deleting the stamp file, context:
       # https://issuetracker.google.com/301961827.
       if not self._replaced:
         delete_stamp = True
     else:
+      status = 'success'
       log(f'FINISHED {self.name}')
       if stdout or self._return_code != 0:
+        status = 'failed'
         delete_stamp = True
         # An extra new line is needed since we want to preserve the previous
         # _log line. Use a single print so that it is threadsafe.
@@ -255,6 +479,12 @@ class Task:
             stdout,
         ]))
 
+    TaskEvents.publish(
+        self.event('finished',
+                   status=status,
+                   exit_code=self._return_code,
+                   duration=self.run_time))
+
     if delete_stamp:
       # Force ninja to consider failed targets as dirty.
       try:
@@ -269,6 +499,11 @@ class Task:
 
 
 def _listen_for_request_data(sock: socket.socket):
+  """Yields (connection, message) for each message sent to the server.
+
+  Senders shut down their end of the connection once the message is sent. The
+  connection stays open until the next message is requested so that a reply
+  can be sent."""
   while True:
     conn = sock.accept()[0]
     received = []
@@ -278,45 +513,123 @@ def _listen_for_request_data(sock: socket.socket):
         if not data:
           break
         received.append(data)
-    if received:
-      yield json.loads(b''.join(received))
+      if received:
+        yield conn, json.loads(b''.join(received))
 
 
 def _process_requests(sock: socket.socket):
-  # Since dicts in python can contain anything, explicitly type tasks to help
-  # make static type checking more useful.
-  tasks: Dict[Tuple[str, str], Task] = {}
   task_manager = TaskManager()
   try:
     log('READY... Remember to set android_static_analysis="build_server" in '
         'args.gn files')
-    for data in _listen_for_request_data(sock):
-      task = Task(name=data['name'],
-                  cwd=data['cwd'],
-                  cmd=data['cmd'],
-                  stamp_file=data['stamp_file'])
-      existing_task = tasks.get(task.key)
-      if existing_task:
-        existing_task.terminate(replaced=True)
-      tasks[task.key] = task
-      task_manager.add_task(task)
+    for conn, data in _listen_for_request_data(sock):
+      message_type = data.get('message_type', server_utils.ADD_TASK)
+      if message_type == server_utils.QUERY_STATS:
+        try:
+          conn.sendall(json.dumps(task_manager.stats()).encode('utf8'))
+        except OSError:
+          pass
+        continue
+      if message_type == server_utils.STREAM_EVENTS:
+        # Keep the connection open after this loop iteration closes it.
+        TaskEvents.subscribe(conn.dup(), task_manager.tasks)
+        continue
+      task_manager.add_task(
+          Task(name=data['name'],
+               cwd=data['cwd'],
+               cmd=data['cmd'],
+               stamp_file=data['stamp_file']))
   except KeyboardInterrupt:
     log('STOPPING SERVER...', end='\n')
-    # Gracefully shut down the task manager, terminating all queued tasks.
+    # Gracefully shut down the task manager, terminating all queued and running
+    # tasks.
     task_manager.deactivate()
-    # Terminate all currently running tasks.
-    for task in tasks.values():
-      task.terminate()
+    TaskEvents.close()
     log('STOPPED', end='\n')
 
 
+def _print_stats():
+  with socket.socket(socket.AF_UNIX) as sock:
+    try:
+      sock.connect(server_utils.SOCKET_ADDRESS)
+    except socket.error:
+      print('Build server is not running.')
+      return 1
+    sock.sendall(
+        json.dumps({
+            'message_type': server_utils.QUERY_STATS
+        }).encode('utf8'))
+    sock.shutdown(socket.SHUT_WR)
+    received = []
+    while True:
+      data = sock.recv(4096)
+      if not data:
+        break
+      received.append(data)
+  stats = json.loads(b''.join(received))
+  print(json.dumps(stats, indent=2, sort_keys=True))
+  return 0
+
+
+def _watch(wait_for: List[str]):
+  """Prints task events, or waits until tasks for |wait_for| are done."""
+  waiting = {os.path.abspath(p) for p in wait_for}
+  pending = set()
+  synced = False
+  failed = False
+  try:
+    for event in server_utils.StreamEvents():
+      if not waiting:
+        print(json.dumps(event), flush=True)
+        continue
+      if event['event'] == 'synced':
+        synced = True
+      else:
+        stamp = os.path.join(event['cwd'], event['stamp_file'])
+        if stamp not in waiting:
+          continue
+        if event['event'] != 'finished':
+          pending.add(stamp)
+        elif event['status'] != 'replaced':
+          # Replaced tasks are followed by the task that replaced them.
+          pending.discard(stamp)
+          if event['status'] != 'success':
+            failed = True
+            print(f'FAILED: {event["name"]}')
+      if synced and not pending:
+        break
+  except socket.error:
+    print('Build server is not running.')
+    return 1
+  return 1 if failed else 0
+
+
 def main():
   parser = argparse.ArgumentParser(description=__doc__)
   parser.add_argument(
       '--fail-if-not-running',
       action='store_true',
       help='Used by GN to fail fast if the build server is not running.')
+  parser.add_argument('--print-stats',
+                      action='store_true',
+                      help='Print stats from the running build server about '
+                      'queued and completed tasks.')
+  parser.add_argument('--watch',
+                      action='store_true',
+                      help='Print task events from the running build server '
+                      'as newline-delimited JSON.')
+  parser.add_argument('--wait-for',
+                      action='append',
+                      default=[],
+                      metavar='STAMP_FILE',
+                      help='Wait until the running build server has no queued '
+                      'or running task for this stamp file. Exits non-zero if '
+                      'one fails. Can be repeated.')
   args = parser.parse_args()
+  if args.print_stats:
+    return _print_stats()
+  if args.watch or args.wait_for:
+    return _watch(args.wait_for)
   if args.fail_if_not_running:
     with socket.socket(socket.AF_UNIX) as sock:
       try:
@@ -107,6 +107,12 @@ def _ParseArgs(args):
       '--best-compression',
       action='store_true',
       help='Use zip -9 rather than zip -1')
+  parser.add_argument(
+      '--compression-threads',
+      type=int,
+      default=1,
+      help='Number of threads to compress assets and native libraries on. '
+      'The output is the same regardless of this value.')
   parser.add_argument(
       '--library-always-compress',
       action='append',
@@ -220,28 +226,25 @@ def _GetAssetsToAdd(path_tuples,
   return assets_to_add
 
 
-def _AddFiles(apk, details):
+def _AddFiles(apk, details, num_workers=None):
   """Adds files to the apk.
 
   Args:
-    apk: path to APK to add to.
+    apk: HermeticZipWriter for the APK to add to.
     details: A list of file detail tuples (src_path, apk_path, compress,
     alignment) representing what and how files are added to the APK.
+    num_workers: Number of threads to compress files on.
   """
-  for apk_path, src_path, compress, alignment in details:
+  apk_paths = set()
+  for apk_path, _, _, _ in details:
     # This check is only relevant for assets, but it should not matter if it is
     # checked for the whole list of files.
-    try:
-      apk.getinfo(apk_path)
+    if apk_path in apk or apk_path in apk_paths:
       # Should never happen since write_build_config.py handles merging.
       raise Exception(
           'Multiple targets specified the asset path: %s' % apk_path)
-    except KeyError:
-      zip_helpers.add_to_zip_hermetic(apk,
-                                      apk_path,
-                                      src_path=src_path,
-                                      compress=compress,
-                                      alignment=alignment)
+    apk_paths.add(apk_path)
+  apk.add_files(details, num_workers=num_workers)
 
 
 def _GetAbiAlignment(android_abi):
@@ -413,21 +416,30 @@ def main(args):
   with action_helpers.atomic_output(options.output_apk,
                                     only_if_changed=False) as f:
     with zipfile.ZipFile(options.resource_apk) as resource_apk, \
-         zipfile.ZipFile(f, 'w') as out_apk:
+         zipfile.ZipFile(f, 'w') as out_zip:
+      out_apk = zip_helpers.HermeticZipWriter(out_zip)
 
       def add_to_zip(zip_path, data, compress=True, alignment=4):
-        zip_helpers.add_to_zip_hermetic(
-            out_apk,
-            zip_path,
-            data=data,
-            compress=compress,
-            alignment=0 if compress and not fast_align else alignment)
+        out_apk.add(zip_path,
+                    data=data,
+                    compress=compress,
+                    alignment=0 if compress and not fast_align else alignment)
+
+      def copy_from_zip(src_zip, zipinfo, zip_path, compress=True,
+                        alignment=4):
+        # Only stored entries are copied as-is. Deflated ones are recompressed
+        # so that the zlib level chosen above applies to them.
+        out_apk.copy(zip_path,
+                     src_zip,
+                     zipinfo,
+                     compress=compress,
+                     alignment=0 if compress and not fast_align else alignment)
 
       def copy_resource(zipinfo, out_dir=''):
-        add_to_zip(
-            out_dir + zipinfo.filename,
-            resource_apk.read(zipinfo.filename),
-            compress=zipinfo.compress_type != zipfile.ZIP_STORED)
+        copy_from_zip(resource_apk,
+                      zipinfo,
+                      out_dir + zipinfo.filename,
+                      compress=zipinfo.compress_type != zipfile.ZIP_STORED)
 
       # Make assets come before resources in order to maintain the same file
       # ordering as GYP / aapt. http://crbug.com/561862
@@ -440,7 +452,7 @@ def main(args):
 
       # 2. Assets
       logging.debug('Adding assets/')
-      _AddFiles(out_apk, assets_to_add)
+      _AddFiles(out_apk, assets_to_add, options.compression_threads)
 
       # 3. DEX and META-INF/services/
       logging.debug('Adding classes.dex')
@@ -455,7 +467,8 @@ def main(args):
           else:
             with zipfile.ZipFile(dex_file_obj) as dex_zip:
               # Add META-INF/services.
-              for name in sorted(dex_zip.namelist()):
+              for info in sorted(dex_zip.infolist(), key=lambda i: i.filename):
+                name = info.filename
                 if name.startswith('META-INF/services/'):
                   # proguard.py does not bundle these files (dex.py does)
                   # because R8 optimizes all ServiceLoader calls.
@@ -463,19 +476,21 @@ def main(args):
                     raise Exception(
                         f'Expected no META-INF/services, but found: {name}' +
                         f'in {options.dex_file}')
-                  add_to_zip(apk_root_dir + name,
-                             dex_zip.read(name),
-                             compress=False)
+                  copy_from_zip(dex_zip,
+                                info,
+                                apk_root_dir + name,
+                                compress=False)
               # Add classes.dex.
-              for name in dex_zip.namelist():
-                if name.endswith('.dex'):
-                  add_to_zip(apk_dex_dir + name,
-                             dex_zip.read(name),
-                             compress=not options.uncompress_dex)
+              for info in dex_zip.infolist():
+                if info.filename.endswith('.dex'):
+                  copy_from_zip(dex_zip,
+                                info,
+                                apk_dex_dir + info.filename,
+                                compress=not options.uncompress_dex)
 
       # 4. Native libraries.
       logging.debug('Adding lib/')
-      _AddFiles(out_apk, libs_to_add)
+      _AddFiles(out_apk, libs_to_add, options.compression_threads)
 
       # Add a placeholder lib if the APK should be multi ABI but is missing libs
       # for one of the ABIs.
@@ -520,7 +535,9 @@ def main(args):
       logging.debug('Adding Java resources')
       for java_resource in options.java_resources:
         with zipfile.ZipFile(java_resource, 'r') as java_resource_jar:
-          for apk_path in sorted(java_resource_jar.namelist()):
+          for info in sorted(java_resource_jar.infolist(),
+                             key=lambda i: i.filename):
+            apk_path = info.filename
             apk_path_lower = apk_path.lower()
 
             if apk_path_lower.startswith('meta-inf/'):
@@ -530,8 +547,7 @@ def main(args):
             if apk_path_lower.endswith('.class'):
               continue
 
-            add_to_zip(apk_root_dir + apk_path,
-                       java_resource_jar.read(apk_path))
+            copy_from_zip(java_resource_jar, info, apk_root_dir + apk_path)
 
     if options.format == 'apk' and options.key_path:
       zipalign_path = None if fast_align else options.zipalign_path
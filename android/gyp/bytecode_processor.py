@@ -204,6 +204,8 @@ def _DisambiguateMissingDeps(
     potential_class_entries = dep_utils.DisambiguateDeps(
         potential_class_entries)
     deps_to_add_programatically.add(potential_class_entries[0].target)
+  if class_lookup_index:
+    class_lookup_index.close()
   return deps_to_add_programatically
 
 
@@ -15,6 +15,7 @@ This will crunch images with aapt2.
 import argparse
 import collections
 import contextlib
+import fcntl
 import filecmp
 import hashlib
 import logging
@@ -37,6 +38,15 @@ import action_helpers  # build_utils adds //build to sys.path.
 import zip_helpers
 
 
+# When the aapt2 compile cache grows beyond this size, the least recently used
+# entries are removed until it is below _AAPT2_COMPILE_CACHE_TRIM_BYTES.
+_AAPT2_COMPILE_CACHE_MAX_BYTES = 2 * 2**30
+_AAPT2_COMPILE_CACHE_TRIM_BYTES = int(0.8 * _AAPT2_COMPILE_CACHE_MAX_BYTES)
+# Subdirectories of the aapt2 compile cache for locks and resources being
+# compiled. Cached partials are directly within it.
+_AAPT2_COMPILE_CACHE_LOCKS_DIR = 'locks'
+_AAPT2_COMPILE_CACHE_STAGING_DIR = 'staging'
+
 # Pngs that we shouldn't convert to webp. Please add rationale when updating.
 _PNG_WEBP_EXCLUSION_PATTERN = re.compile('|'.join([
     # Android requires pngs for 9-patch images.
@@ -169,6 +179,10 @@ def _ParseArgs(args):
                           help='Path to the cwebp binary.')
   input_opts.add_argument(
       '--webp-cache-dir', help='The directory to store webp image cache.')
+  input_opts.add_argument(
+      '--aapt2-compile-cache-dir',
+      help='The directory to store compiled resource partials in, for reuse '
+      'by other targets with the same dependencies.')
   input_opts.add_argument(
       '--is-bundle-module',
       action='store_true',
@@ -544,18 +558,64 @@ def _RemoveImageExtensions(directory, path_info):
             os.path.relpath(path_no_extension, directory))
 
 
-def _CompileSingleDep(index, dep_subdir, keep_predicate, aapt2_path,
-                      partials_dir):
-  unique_name = '{}_{}'.format(index, os.path.basename(dep_subdir))
-  partial_path = os.path.join(partials_dir, '{}.zip'.format(unique_name))
+def _ComputeDirectorySha1(root_dir):
+  """Returns a hash of the paths and contents of the files in |root_dir|."""
+  sha1 = hashlib.sha1()
+  for path in sorted(_IterFiles(root_dir)):
+    sha1.update(os.path.relpath(path, root_dir).encode('utf-8'))
+    sha1.update(_ComputeSha1(path).encode('utf-8'))
+  return sha1.hexdigest()
+
+
+def _LinkFromAapt2CompileCache(cache_path, partial_path):
+  try:
+    os.link(cache_path, partial_path)
+  except FileNotFoundError:
+    # Not cached, or evicted by a concurrent run.
+    return False
+  except OSError:
+    # E.g. when the cache is on a different filesystem.
+    shutil.copyfile(cache_path, partial_path)
+  # Mark the entry as recently used.
+  os.utime(cache_path)
+  return True
+
+
+def _LinkOrCopy(src, dst):
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+
 
+@contextlib.contextmanager
+def _LockAapt2CompileCacheKey(cache_dir, cache_key):
+  """Prevents concurrent runs from compiling the same key at once.
+
+  Keys share 256 lock files, which are never removed, so that a run cannot
+  lock a file that another run is removing.
+  """
+  lock_path = os.path.join(cache_dir, _AAPT2_COMPILE_CACHE_LOCKS_DIR,
+                           cache_key[:2])
+  with open(lock_path, 'a') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    yield
+
+
+def _CompileDir(aapt2_path, res_dir, partial_path, filter_patterns,
+                path_in_output):
+  """Compiles |res_dir| with aapt2.
+
+  Paths under |res_dir| that aapt2 prints are shown relative to
+  |path_in_output| instead.
+  """
   compile_command = [
       aapt2_path,
       'compile',
       # TODO(wnwen): Turn this on once aapt2 forces 9-patch to be crunched.
       # '--no-crunch',
       '--dir',
-      dep_subdir,
+      res_dir,
       '-o',
       partial_path
   ]
@@ -566,21 +626,71 @@ def _CompileSingleDep(index, dep_subdir, keep_predicate, aapt2_path,
   build_utils.CheckOutput(
       compile_command,
       stderr_filter=lambda output: build_utils.FilterLines(
-          output, r'ignoring configuration .* for (styleable|attribute)'))
+          output, r'ignoring configuration .* for (styleable|attribute)'
+      ).replace(res_dir, path_in_output))
 
   # Filtering these files is expensive, so only apply filters to the partials
   # that have been explicitly targeted.
+  keep_predicate = _CreateValuesKeepPredicate(filter_patterns)
   if keep_predicate:
-    logging.debug('Applying .arsc filtering to %s', dep_subdir)
+    logging.debug('Applying .arsc filtering to %s', path_in_output)
     protoresources.StripUnwantedResources(partial_path, keep_predicate)
-  return partial_path
 
 
-def _CreateValuesKeepPredicate(exclusion_rules, dep_subdir):
-  patterns = [
+def _CompileSingleDep(index, dep_subdir, filter_patterns, aapt2_path,
+                      partials_dir, aapt2_version, cache_dir):
+  unique_name = '{}_{}'.format(index, os.path.basename(dep_subdir))
+  partial_path = os.path.join(partials_dir, '{}.zip'.format(unique_name))
+
+  if not cache_dir:
+    _CompileDir(aapt2_path, dep_subdir, partial_path, filter_patterns,
+                dep_subdir)
+    return partial_path, False
+
+  # The set of inputs that will appear in the cache key.
+  key_parts = [_ComputeDirectorySha1(dep_subdir), aapt2_version
+               ] + filter_patterns
+  cache_key = hashlib.sha1('\0'.join(key_parts).encode('utf-8')).hexdigest()
+  cache_path = os.path.join(cache_dir, cache_key + '.zip')
+  if _LinkFromAapt2CompileCache(cache_path, partial_path):
+    return partial_path, True
+
+  with _LockAapt2CompileCacheKey(cache_dir, cache_key):
+    # Another run may have compiled it while this one waited for the lock.
+    if _LinkFromAapt2CompileCache(cache_path, partial_path):
+      return partial_path, True
+
+    # Partials embed the paths of the resources they were compiled from
+    # (crbug.com/939984), and |dep_subdir| differs between targets. Compile
+    # from a path that depends only on the cache key so that the partial is
+    # the same whichever target adds it to the cache.
+    staging_dir = os.path.join(cache_dir, _AAPT2_COMPILE_CACHE_STAGING_DIR,
+                               cache_key)
+    # Left behind by an interrupted run.
+    build_utils.DeleteDirectory(staging_dir)
+    shutil.copytree(dep_subdir, staging_dir, copy_function=_LinkOrCopy)
+    try:
+      _CompileDir(aapt2_path, staging_dir, partial_path, filter_patterns,
+                  dep_subdir)
+    finally:
+      shutil.rmtree(staging_dir)
+
+    try:
+      os.link(partial_path, cache_path)
+    except OSError:
+      # E.g. when the cache is on a different filesystem.
+      pass
+  return partial_path, False
+
+
+def _GetValuesFilterPatterns(exclusion_rules, dep_subdir):
+  return [
       x[1] for x in exclusion_rules
       if build_utils.MatchesGlob(dep_subdir, [x[0]])
   ]
+
+
+def _CreateValuesKeepPredicate(patterns):
   if not patterns:
     return None
 
@@ -588,22 +698,73 @@ def _CreateValuesKeepPredicate(exclusion_rules, dep_subdir):
   return lambda x: not any(r.search(x) for r in regexes)
 
 
+def _TrimAapt2CompileCache(cache_dir):
+  """Removes the least recently used partials once the cache is too large."""
+  entries = []
+  total_size = 0
+  with os.scandir(cache_dir) as it:
+    for entry in it:
+      if not entry.is_file():
+        continue
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, entry.path))
+      total_size += stat.st_size
+  if total_size <= _AAPT2_COMPILE_CACHE_MAX_BYTES:
+    return
+
+  entries.sort()
+  num_removed = 0
+  for _, size, path in entries:
+    if total_size <= _AAPT2_COMPILE_CACHE_TRIM_BYTES:
+      break
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      # Removed by a concurrent run.
+      pass
+    total_size -= size
+    num_removed += 1
+  logging.debug('Removed %d partials from aapt2 compile cache', num_removed)
+
+
 def _CompileDeps(aapt2_path, dep_subdirs, dep_subdir_overlay_set, temp_dir,
-                 exclusion_rules):
+                 exclusion_rules, cache_dir):
   partials_dir = os.path.join(temp_dir, 'partials')
   build_utils.MakeDirectory(partials_dir)
 
+  aapt2_version = None
+  if cache_dir:
+    build_utils.MakeDirectory(
+        os.path.join(cache_dir, _AAPT2_COMPILE_CACHE_LOCKS_DIR))
+    build_utils.MakeDirectory(
+        os.path.join(cache_dir, _AAPT2_COMPILE_CACHE_STAGING_DIR))
+    aapt2_version = subprocess.check_output([aapt2_path, 'version'],
+                                            text=True).strip()
+
   job_params = [(i, dep_subdir,
-                 _CreateValuesKeepPredicate(exclusion_rules, dep_subdir))
+                 _GetValuesFilterPatterns(exclusion_rules, dep_subdir))
                 for i, dep_subdir in enumerate(dep_subdirs)]
 
-  # Filtering is slow, so ensure jobs with keep_predicate are started first.
+  # Filtering is slow, so ensure jobs with filters are started first.
   job_params.sort(key=lambda x: not x[2])
-  partials = list(
+  results = list(
       parallel.BulkForkAndCall(_CompileSingleDep,
                                job_params,
                                aapt2_path=aapt2_path,
-                               partials_dir=partials_dir))
+                               partials_dir=partials_dir,
+                               aapt2_version=aapt2_version,
+                               cache_dir=cache_dir))
+  partials = [partial for partial, _ in results]
+
+  if cache_dir:
+    total_cache_hits = sum(int(cache_hit) for _, cache_hit in results)
+    logging.debug('aapt2 compile cache: hits=%d misses=%d', total_cache_hits,
+                  len(results) - total_cache_hits)
+    if total_cache_hits < len(results):
+      _TrimAapt2CompileCache(cache_dir)
 
   partials_cmd = list()
   for i, partial in enumerate(partials):
@@ -741,7 +902,7 @@ def _PackageApk(options, build):
   exclusion_rules = [x.split(':', 1) for x in options.values_filter_rules]
   partials = _CompileDeps(options.aapt2_path, dep_subdirs,
                           dep_subdir_overlay_set, build.temp_dir,
-                          exclusion_rules)
+                          exclusion_rules, options.aapt2_compile_cache_dir)
 
   link_command = [
       options.aapt2_path,
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import textwrap
+import unittest
+import zipfile
+
+import compile_resources
+
+# Stands in for aapt2. Like real partials, the ones it compiles embed the
+# absolute paths of the resources they were compiled from.
+_FAKE_AAPT2 = textwrap.dedent(f"""\
+    #!{sys.executable}
+    import os, sys, zipfile
+    if sys.argv[1] == 'version':
+      print('Android Asset Packaging Tool (aapt) 2.19-fake')
+      sys.exit(0)
+    res_dir = sys.argv[sys.argv.index('--dir') + 1]
+    output = sys.argv[sys.argv.index('-o') + 1]
+    with zipfile.ZipFile(output, 'w') as z:
+      for root, _, files in sorted(os.walk(res_dir)):
+        for name in sorted(files):
+          path = os.path.join(root, name)
+          with open(path) as f:
+            data = os.path.abspath(path) + '\\n' + f.read()
+          info = zipfile.ZipInfo(os.path.relpath(path, res_dir).replace(
+              os.sep, '_') + '.flat')
+          z.writestr(info, data)
+    """)
+
+
+class CompileResourcesTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp_dir = tempfile.mkdtemp()
+    self._aapt2_path = os.path.join(self._tmp_dir, 'aapt2')
+    with open(self._aapt2_path, 'w') as f:
+      f.write(_FAKE_AAPT2)
+    os.chmod(self._aapt2_path, stat.S_IRWXU)
+    self._cache_dir = os.path.join(self._tmp_dir, 'cache')
+
+  def tearDown(self):
+    shutil.rmtree(self._tmp_dir)
+
+  def _CompileTarget(self, target_name, cache_dir):
+    """Compiles the same dependency resources as a target would."""
+    temp_dir = os.path.join(self._tmp_dir, target_name)
+    dep_subdir = os.path.join(temp_dir, 'deps', 'gen_foo_java_resources.zip')
+    os.makedirs(os.path.join(dep_subdir, 'values'))
+    with open(os.path.join(dep_subdir, 'values', 'strings.xml'), 'w') as f:
+      f.write('<resources><string name="foo">Foo</string></resources>')
+    compile_resources._CompileDeps(self._aapt2_path, [dep_subdir], set(),
+                                   temp_dir, [], cache_dir)
+    partials_dir = os.path.join(temp_dir, 'partials')
+    (partial_name, ) = os.listdir(partials_dir)
+    with open(os.path.join(partials_dir, partial_name), 'rb') as f:
+      return f.read()
+
+  def testCachedPartialsIndependentOfTarget(self):
+    with self.assertLogs(level='DEBUG') as logs:
+      first = self._CompileTarget('first', self._cache_dir)
+      # Compiled from the cache.
+      second = self._CompileTarget('second', self._cache_dir)
+    cache_logs = [l for l in logs.output if 'aapt2 compile cache: ' in l]
+    self.assertEqual([
+        'DEBUG:root:aapt2 compile cache: hits=0 misses=1',
+        'DEBUG:root:aapt2 compile cache: hits=1 misses=0',
+    ], cache_logs)
+    shutil.rmtree(self._cache_dir)
+    # Compiled afresh, by a different target.
+    third = self._CompileTarget('third', self._cache_dir)
+
+    self.assertEqual(first, second)
+    self.assertEqual(first, third)
+    self.assertEqual([
+        compile_resources._AAPT2_COMPILE_CACHE_LOCKS_DIR,
+        compile_resources._AAPT2_COMPILE_CACHE_STAGING_DIR
+    ], sorted(e for e in os.listdir(self._cache_dir) if '.' not in e))
+    self.assertEqual(
+        [],
+        os.listdir(
+            os.path.join(self._cache_dir,
+                         compile_resources._AAPT2_COMPILE_CACHE_STAGING_DIR)))
+
+  def testUncachedPartialsCompiledInPlace(self):
+    first = self._CompileTarget('first', None)
+    second = self._CompileTarget('second', None)
+
+    self.assertIn(b'first', first)
+    self.assertIn(b'second', second)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -10,19 +10,28 @@ import collections
 import enum
 import json
 import logging
+import mmap
+import os
 import re
 import struct
 import subprocess
 import sys
+import tempfile
 from typing import (Dict, Iterable, List, NamedTuple, Sequence, TextIO, Tuple,
                     Union)
 
 from util import build_utils
+from util import parallel
 
 _STACK_CFI_INIT_REGEX = re.compile(
     r'^STACK CFI INIT ([0-9a-f]+) ([0-9a-f]+) (.+)$')
 _STACK_CFI_REGEX = re.compile(r'^STACK CFI ([0-9a-f]+) (.+)$')
 
+# The symbol file is parsed in chunks of at least this many bytes. Chunks are
+# several times smaller than the share of a process for large symbol files, so
+# that uneven chunks are balanced across processes.
+_SYMBOL_FILE_CHUNK_SIZE = 16 * 1024 * 1024
+
 
 class AddressCfi(NamedTuple):
   """Record representing CFI for an address within a function.
@@ -80,20 +89,12 @@ def FilterToNonTombstoneCfi(stream: TextIO) -> Iterable[str]:
       yield line
 
 
-def ReadFunctionCfi(stream: TextIO) -> Iterable[FunctionCfi]:
-  """Generates FunctionCfi records from the stream.
-
-  Args:
-      stream: A file object.
-
-  Returns:
-      An iterable over FunctionCfi corresponding to the non-tombstone STACK CFI
-      lines in the stream.
-  """
+def _ParseFunctionCfi(lines: Iterable[str]) -> Iterable[FunctionCfi]:
+  """Generates FunctionCfi records from non-tombstone STACK CFI lines."""
   current_function_address = None
   current_function_size = None
   current_function_address_cfi = []
-  for line in FilterToNonTombstoneCfi(stream):
+  for line in lines:
     cfi_init_match = _STACK_CFI_INIT_REGEX.search(line)
     if cfi_init_match:
       # Function CFI with address 0 are tombstone entries per
@@ -115,9 +116,60 @@ def ReadFunctionCfi(stream: TextIO) -> Iterable[FunctionCfi]:
       current_function_address_cfi.append(
           AddressCfi(int(cfi_match.group(1), 16), cfi_match.group(2)))
 
-  assert current_function_address is not None
-  assert current_function_size is not None
-  yield FunctionCfi(current_function_size, tuple(current_function_address_cfi))
+  if (current_function_address is not None
+      and current_function_size is not None):
+    yield FunctionCfi(current_function_size,
+                      tuple(current_function_address_cfi))
+
+
+def ReadFunctionCfi(stream: TextIO) -> Iterable[FunctionCfi]:
+  """Generates FunctionCfi records from the stream.
+
+  Args:
+      stream: A file object.
+
+  Returns:
+      An iterable over FunctionCfi corresponding to the non-tombstone STACK CFI
+      lines in the stream.
+  """
+  has_function_cfi = False
+  for function_cfi in _ParseFunctionCfi(FilterToNonTombstoneCfi(stream)):
+    has_function_cfi = True
+    yield function_cfi
+  assert has_function_cfi
+
+
+def SplitSymbolFile(symbols: Union[bytes, mmap.mmap],
+                    chunk_size: int) -> List[Tuple[int, int]]:
+  """Splits the STACK CFI records of a symbol file into chunks.
+
+  Chunks start at a STACK CFI INIT line, so that each chunk holds the CFI of
+  whole functions and can be parsed independently of the others. Anything
+  before the first STACK CFI INIT line is left out.
+
+  Args:
+    symbols: The contents of a breakpad symbol file.
+    chunk_size: The minimum size of a chunk in bytes. The last chunk may be
+      smaller.
+
+  Returns:
+    A list of (start, end) byte offsets, in file order.
+  """
+  if symbols[:len(b'STACK CFI INIT ')] == b'STACK CFI INIT ':
+    start = 0
+  else:
+    start = symbols.find(b'\nSTACK CFI INIT ')
+    if start == -1:
+      return []
+    start += 1
+
+  chunks: List[Tuple[int, int]] = []
+  while start < len(symbols):
+    end = symbols.find(b'\nSTACK CFI INIT ', start + chunk_size)
+    end = len(symbols) if end == -1 else end + 1
+    chunks.append((start, end))
+    start = end
+  return chunks
 
 
 def EncodeAsBytes(*values: int) -> bytes:
@@ -479,7 +531,8 @@ def EncodeUnwindInstructionTable(complete_instruction_sequences: Iterable[bytes]
   Args:
     complete_instruction_sequences: An iterable of encoded unwind instruction
       sequences. The sequences represent the series of unwind instructions to
-      execute corresponding to offsets within each function.
+      execute corresponding to offsets within each function. Sequences are
+      counted as they are read, so only distinct sequences are held in memory.
 
   Returns:
     A tuple containing:
@@ -492,9 +545,8 @@ def EncodeUnwindInstructionTable(complete_instruction_sequences: Iterable[bytes]
   # which means smaller number uses fewer bytes to represent, we should sort
   # the unwind instruction table by number of references from the function
   # offset table in order to minimize the size of the function offset table.
-  ref_counts: Dict[bytes, int] = collections.defaultdict(int)
-  for sequence in complete_instruction_sequences:
-    ref_counts[sequence] += 1
+  ref_counts: Dict[bytes, int] = collections.Counter(
+      complete_instruction_sequences)
 
   def ComputeScore(sequence):
     """ Score for each sequence is computed as  ref_count / size_of_sequence.
@@ -635,6 +687,32 @@ def EncodeFunctionUnwinds(function_unwinds: Iterable[FunctionUnwind],
     by ascending address.
   """
 
+  sorted_function_unwinds: List[FunctionUnwind] = sorted(
+      function_unwinds, key=lambda function_unwind: function_unwind.address)
+  return _FillFunctionUnwindGaps(
+      ((unwind.address, unwind.size,
+        EncodeAddressUnwinds(unwind.address_unwinds))
+       for unwind in sorted_function_unwinds), len(sorted_function_unwinds),
+      text_section_start_address)
+
+
+def _FillFunctionUnwindGaps(
+    sorted_function_unwinds: Iterable[Tuple[int, int, Tuple[
+        EncodedAddressUnwind, ...]]], num_functions: int,
+    text_section_start_address: int) -> Iterable[EncodedFunctionUnwind]:
+  """Implements `EncodeFunctionUnwinds` for functions sorted by address.
+
+  Args:
+    sorted_function_unwinds: An iterable of (address, size, encoded address
+      unwinds), ordered by ascending address.
+    num_functions: The number of functions in `sorted_function_unwinds`.
+    text_section_start_address: The address of .text section in ELF file.
+
+  Returns:
+    The encoded function unwind states with no gaps between functions, ordered
+    by ascending address.
+  """
+
   def GetPageNumber(address: int) -> int:
     """Calculates the page number.
 
@@ -652,22 +730,20 @@ def EncodeFunctionUnwinds(function_unwinds: Iterable[FunctionUnwind],
     """
     return ((address - text_section_start_address) >> 1) & 0xffff
 
-  sorted_function_unwinds: List[FunctionUnwind] = sorted(
-      function_unwinds, key=lambda function_unwind: function_unwind.address)
-
-  if sorted_function_unwinds[0].address > text_section_start_address:
-    yield EncodedFunctionUnwind(page_number=0,
-                                page_offset=0,
-                                address_unwinds=REFUSE_TO_UNWIND)
-
-  prev_func_end_address: int = sorted_function_unwinds[0].address
-
+  prev_func_end_address = None
   gaps = 0
-  for unwind in sorted_function_unwinds:
-    assert prev_func_end_address <= unwind.address, (
+  for address, size, address_unwinds in sorted_function_unwinds:
+    if prev_func_end_address is None:
+      if address > text_section_start_address:
+        yield EncodedFunctionUnwind(page_number=0,
+                                    page_offset=0,
+                                    address_unwinds=REFUSE_TO_UNWIND)
+      prev_func_end_address = address
+
+    assert prev_func_end_address <= address, (
         'Detected overlap between functions.')
 
-    if prev_func_end_address < unwind.address:
+    if prev_func_end_address < address:
       # Gaps between functions are typically filled by regions of thunks which
       # do not alter the stack pointer. Filling these gaps with TRIVIAL_UNWIND
       # is the appropriate unwind strategy.
@@ -676,19 +752,96 @@ def EncodeFunctionUnwinds(function_unwinds: Iterable[FunctionUnwind],
                                   GetPageOffset(prev_func_end_address),
                                   TRIVIAL_UNWIND)
 
-    yield EncodedFunctionUnwind(GetPageNumber(unwind.address),
-                                GetPageOffset(unwind.address),
-                                EncodeAddressUnwinds(unwind.address_unwinds))
+    yield EncodedFunctionUnwind(GetPageNumber(address), GetPageOffset(address),
+                                address_unwinds)
 
-    prev_func_end_address = unwind.address + unwind.size
+    prev_func_end_address = address + size
 
+  assert prev_func_end_address is not None, 'No function unwinds.'
   if GetPageOffset(prev_func_end_address) != 0:
     yield EncodedFunctionUnwind(GetPageNumber(prev_func_end_address),
                                 GetPageOffset(prev_func_end_address),
                                 REFUSE_TO_UNWIND)
 
   logging.info('%d/%d gaps between functions filled with trivial unwind.', gaps,
-               len(sorted_function_unwinds))
+               num_functions)
+
+
+def _GenerateChunkUnwinds(
+    start: int, end: int, symbols: mmap.mmap,
+    parsers: Tuple[UnwindInstructionsParser, ...]
+) -> List[Tuple[int, int, Tuple[EncodedAddressUnwind, ...]]]:
+  """Parses and encodes the unwinds of a chunk of a symbol file.
+
+  Runs in a forked process, which shares the memory map of the symbol file.
+
+  Returns:
+    A list of (address, size, encoded address unwinds) in file order.
+  """
+  lines = symbols[start:end].decode('ascii').splitlines()
+  # Identical unwinds are common. Sharing the tuples lets pickle send each one
+  # to the parent process once per chunk.
+  encoded_unwinds: Dict[Tuple[EncodedAddressUnwind, ...],
+                        Tuple[EncodedAddressUnwind, ...]] = {}
+  ret = []
+  for unwind in GenerateUnwinds(
+      _ParseFunctionCfi(FilterToNonTombstoneCfi(lines)), parsers):
+    address_unwinds = EncodeAddressUnwinds(unwind.address_unwinds)
+    address_unwinds = encoded_unwinds.setdefault(address_unwinds,
+                                                 address_unwinds)
+    ret.append((unwind.address, unwind.size, address_unwinds))
+  return ret
+
+
+def GenerateEncodedFunctionUnwinds(
+    symbol_file_path: str, text_section_start_address: int,
+    parsers: Tuple[UnwindInstructionsParser, ...]
+) -> Iterable[EncodedFunctionUnwind]:
+  """Generates the encoded unwind states for all functions in a symbol file.
+
+  Equivalent to `EncodeFunctionUnwinds(GenerateUnwinds(ReadFunctionCfi(...)))`,
+  but parses and encodes chunks of the memory mapped symbol file in parallel.
+  Results are merged in file order, so the output does not depend on the
+  number of processes.
+
+  Args:
+    symbol_file_path: Path to a breakpad symbol file.
+    text_section_start_address: The address of .text section in ELF file.
+    parsers: Available parsers to try on CFI address data.
+
+  Returns:
+    The encoded function unwind states with no gaps between functions, ordered
+    by ascending address.
+  """
+  assert os.path.getsize(symbol_file_path), 'Empty symbol file.'
+  with open(symbol_file_path, 'rb') as f:
+    symbols = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    chunks = SplitSymbolFile(symbols, _SYMBOL_FILE_CHUNK_SIZE)
+    logging.info('Parsing %d bytes of symbols in %d chunks.', len(symbols),
+                 len(chunks))
+    # Identical unwinds from different chunks arrive as separate objects, so
+    # they are deduplicated while merging.
+    encoded_unwinds: Dict[Tuple[EncodedAddressUnwind, ...],
+                          Tuple[EncodedAddressUnwind, ...]] = {}
+    function_unwinds: List[Tuple[int, int, Tuple[EncodedAddressUnwind,
+                                                  ...]]] = []
+    for chunk_unwinds in parallel.BulkForkAndCall(_GenerateChunkUnwinds,
+                                                  chunks,
+                                                  symbols=symbols,
+                                                  parsers=parsers):
+      for address, size, address_unwinds in chunk_unwinds:
+        function_unwinds.append(
+            (address, size,
+             encoded_unwinds.setdefault(address_unwinds, address_unwinds)))
+  finally:
+    symbols.close()
+
+  # The sort is stable, so the merge order above keeps the output
+  # deterministic.
+  function_unwinds.sort(key=lambda function_unwind: function_unwind[0])
+  return _FillFunctionUnwindGaps(function_unwinds, len(function_unwinds),
+                                 text_section_start_address)
 
 
 def EncodeFunctionOffsetTable(
@@ -991,23 +1144,29 @@ def GenerateUnwindTables(
     - The function offset table as bytes.
     - The unwind instruction table as bytes.
   """
-  encoded_function_unwinds: List[EncodedFunctionUnwind] = list(
-      encoded_function_unwinds_iterable)
-  complete_instruction_sequences: List[bytes] = []
-  encoded_address_unwind_sequences: List[Tuple[EncodedAddressUnwind, ...]] = []
-
-  for encoded_function_unwind in encoded_function_unwinds:
-    encoded_address_unwind_sequences.append(
+  # Identical address unwind sequences are stored once. The function offset
+  # table only references each distinct sequence, in order of first use.
+  address_unwind_sequences: Dict[Tuple[EncodedAddressUnwind, ...],
+                                 Tuple[EncodedAddressUnwind, ...]] = {}
+  encoded_function_unwinds: List[EncodedFunctionUnwind] = []
+  for encoded_function_unwind in encoded_function_unwinds_iterable:
+    address_unwinds = address_unwind_sequences.setdefault(
+        encoded_function_unwind.address_unwinds,
         encoded_function_unwind.address_unwinds)
-    for address_unwind in encoded_function_unwind.address_unwinds:
-      complete_instruction_sequences.append(
-          address_unwind.complete_instruction_sequence)
-
+    if address_unwinds is not encoded_function_unwind.address_unwinds:
+      encoded_function_unwind = encoded_function_unwind._replace(
+          address_unwinds=address_unwinds)
+    encoded_function_unwinds.append(encoded_function_unwind)
+
+  complete_instruction_sequences: Iterable[bytes] = (
+      address_unwind.complete_instruction_sequence
+      for encoded_function_unwind in encoded_function_unwinds
+      for address_unwind in encoded_function_unwind.address_unwinds)
   unwind_instruction_table, unwind_instruction_table_offsets = (
       EncodeUnwindInstructionTable(complete_instruction_sequences))
 
   function_offset_table, function_offset_table_offsets = (
-      EncodeFunctionOffsetTable(encoded_address_unwind_sequences,
+      EncodeFunctionOffsetTable(address_unwind_sequences,
                                 unwind_instruction_table_offsets))
 
   page_table, function_table = EncodePageTableAndFunctionTable(
@@ -1066,25 +1225,30 @@ def main():
                       metavar='FILE')
 
   args = parser.parse_args()
-  proc = subprocess.Popen(['./' + args.dump_syms_path, args.input_path, '-v'],
-                          stdout=subprocess.PIPE,
-                          encoding='ascii')
-
-  function_cfis = ReadFunctionCfi(proc.stdout)
-  function_unwinds = GenerateUnwinds(function_cfis, parsers=ALL_PARSERS)
-  encoded_function_unwinds = EncodeFunctionUnwinds(
-      function_unwinds,
-      ReadTextSectionStartAddress(args.readobj_path, args.input_path))
-  (page_table, function_table, function_offset_table,
-   unwind_instruction_table) = GenerateUnwindTables(encoded_function_unwinds)
+  # The symbols are written to a file, rather than read from a pipe, so that
+  # they can be memory mapped and parsed in parallel. Symbol files can be
+  # several gigabytes in size, so the file is kept next to the output rather
+  # than in a tmpfs.
+  with tempfile.NamedTemporaryFile(
+      dir=os.path.dirname(args.output_path) or '.',
+      suffix='.sym') as symbol_file:
+    proc = subprocess.run(['./' + args.dump_syms_path, args.input_path, '-v'],
+                          stdout=symbol_file,
+                          check=False)
+    if proc.returncode:
+      logging.critical('dump_syms exited with return code %d', proc.returncode)
+      sys.exit(proc.returncode)
+
+    encoded_function_unwinds = GenerateEncodedFunctionUnwinds(
+        symbol_file.name,
+        ReadTextSectionStartAddress(args.readobj_path, args.input_path),
+        parsers=ALL_PARSERS)
+    (page_table, function_table, function_offset_table,
+     unwind_instruction_table) = GenerateUnwindTables(encoded_function_unwinds)
   unwind_info: bytes = EncodeUnwindInfo(page_table, function_table,
                                         function_offset_table,
                                         unwind_instruction_table)
 
-  if proc.wait():
-    logging.critical('dump_syms exited with return code %d', proc.returncode)
-    sys.exit(proc.returncode)
-
   with open(args.output_path, 'wb') as f:
     f.write(unwind_info)
 
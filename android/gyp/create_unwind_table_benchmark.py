@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Measures how fast create_unwind_table.py turns CFI into unwind tables.
+
+Generates a synthetic breakpad symbol file, then builds unwind tables from it
+both by streaming it through a single process and by parsing it in parallel.
+Each build runs in its own process, so that peak RSS is reported separately.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import create_unwind_table
+
+# CFI rows seen in real arm32 symbol files, as (address offset, instructions).
+_FUNCTION_CFI_TEMPLATES = (
+    ((2, '.cfa: sp 8 + .ra: .cfa -4 + ^ r7: .cfa -8 + ^'), ),
+    (
+        (2, '.cfa: sp 16 + .ra: .cfa -4 + ^ r4: .cfa -16 + ^ '
+         'r5: .cfa -12 + ^ r7: .cfa -8 + ^'),
+        (4, '.cfa: r7 8 +'),
+    ),
+    (
+        (2, '.cfa: sp 24 + .ra: .cfa -4 + ^ r4: .cfa -24 + ^ '
+         'r5: .cfa -20 + ^ r6: .cfa -16 + ^ r7: .cfa -12 + ^ '
+         'r8: .cfa -8 + ^'),
+        (6, '.cfa: sp 40 +'),
+        (10, '.cfa: sp 56 + unnamed_register264: .cfa -32 + ^ '
+         'unnamed_register265: .cfa -24 + ^'),
+    ),
+    ((4, '.cfa: sp 12 + .ra: .cfa -4 + ^ r4: .cfa -12 + ^ r5: .cfa -8 + ^'),
+     (8, '.cfa: sp 32 +')),
+)
+
+
+def _WriteSymbolFile(path, num_functions, seed):
+  """Writes a symbol file with |num_functions| functions of STACK CFI."""
+  rng = random.Random(seed)
+  address = 0x100000
+  with open(path, 'w') as f:
+    f.write('MODULE Linux arm 0123456789ABCDEF0 libchrome.so\n')
+    for i in range(num_functions):
+      size = rng.randrange(16, 2048, 2)
+      if i % 100 == 0:
+        # Tombstone records for dead code.
+        f.write('STACK CFI INIT 0 %x .cfa: sp 0 + .ra: lr\n' % size)
+        f.write('STACK CFI 2 .cfa: sp 8 + .ra: .cfa -4 + ^\n')
+      f.write('STACK CFI INIT %x %x .cfa: sp 0 + .ra: lr\n' % (address, size))
+      for offset, instructions in rng.choice(_FUNCTION_CFI_TEMPLATES):
+        f.write('STACK CFI %x %s\n' % (address + offset, instructions))
+      # Leave gaps between some functions, like thunks do.
+      address += size + rng.choice((0, 0, 0, 8))
+
+
+def _BuildUnwindInfo(symbol_file_path, mode):
+  """Builds unwind info from the symbol file with |mode| in this process."""
+  text_section_start_address = 0x100000
+  parsers = create_unwind_table.ALL_PARSERS
+  if mode == 'serial':
+    with open(symbol_file_path) as f:
+      encoded_function_unwinds = list(
+          create_unwind_table.EncodeFunctionUnwinds(
+              create_unwind_table.GenerateUnwinds(
+                  create_unwind_table.ReadFunctionCfi(f), parsers),
+              text_section_start_address))
+  else:
+    encoded_function_unwinds = (
+        create_unwind_table.GenerateEncodedFunctionUnwinds(
+            symbol_file_path, text_section_start_address, parsers))
+  return create_unwind_table.EncodeUnwindInfo(
+      *create_unwind_table.GenerateUnwindTables(encoded_function_unwinds))
+
+
+def _RunChild(args):
+  start = time.time()
+  unwind_info = _BuildUnwindInfo(args.symbol_file, args.child)
+  elapsed = time.time() - start
+  with open(args.output, 'wb') as f:
+    f.write(unwind_info)
+  # ru_maxrss is in kilobytes on Linux.
+  json.dump(
+      {
+          'wall_time': elapsed,
+          'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+          'max_child_rss_kb':
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+      }, sys.stdout)
+  return 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--num-functions',
+                      type=int,
+                      default=1000000,
+                      help='Number of functions in the synthetic symbol '
+                      'file.')
+  parser.add_argument('--symbol-file',
+                      help='Use this symbol file rather than generating one.')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+  parser.add_argument('--child',
+                      choices=('serial', 'parallel'),
+                      help=argparse.SUPPRESS)
+  parser.add_argument('--output', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    return _RunChild(args)
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    symbol_file = args.symbol_file
+    if not symbol_file:
+      symbol_file = os.path.join(tmp_dir, 'libchrome.so.sym')
+      _WriteSymbolFile(symbol_file, args.num_functions, args.seed)
+    print('Symbol file: {:.1f} MiB'.format(
+        os.path.getsize(symbol_file) / 2**20))
+
+    outputs = {}
+    for mode in ('serial', 'parallel'):
+      outputs[mode] = os.path.join(tmp_dir, mode)
+      stdout = subprocess.check_output([
+          sys.executable, __file__, '--child', mode, '--symbol-file',
+          symbol_file, '--output', outputs[mode]
+      ])
+      stats = json.loads(stdout)
+      print('{:>8}: {:.2f}s, peak RSS {:.1f} MiB (largest worker '
+            '{:.1f} MiB)'.format(mode, stats['wall_time'],
+                                 stats['max_rss_kb'] / 1024,
+                                 stats['max_child_rss_kb'] / 1024))
+
+    with open(outputs['serial'], 'rb') as f:
+      serial_output = f.read()
+    with open(outputs['parallel'], 'rb') as f:
+      parallel_output = f.read()
+    if serial_output != parallel_output:
+      print('Unwind info differs between serial and parallel builds.')
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
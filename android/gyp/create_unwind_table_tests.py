@@ -9,22 +9,25 @@ arm builds.
 """
 
 import io
+import os
 import struct
+import tempfile
 
 import unittest
 import unittest.mock
 import re
 
 from create_unwind_table import (
-    AddressCfi, AddressUnwind, FilterToNonTombstoneCfi, FunctionCfi,
-    FunctionUnwind, EncodeAddressUnwind, EncodeAddressUnwinds,
+    ALL_PARSERS, AddressCfi, AddressUnwind, FilterToNonTombstoneCfi,
+    FunctionCfi, FunctionUnwind, EncodeAddressUnwind, EncodeAddressUnwinds,
     EncodedAddressUnwind, EncodeAsBytes, EncodeFunctionOffsetTable,
     EncodedFunctionUnwind, EncodeFunctionUnwinds, EncodeStackPointerUpdate,
     EncodePop, EncodePageTableAndFunctionTable, EncodeUnwindInfo,
-    EncodeUnwindInstructionTable, GenerateUnwinds, GenerateUnwindTables,
-    NullParser, ParseAddressCfi, PushOrSubSpParser, ReadFunctionCfi,
-    REFUSE_TO_UNWIND, StoreSpParser, TRIVIAL_UNWIND, Uleb128Encode,
-    UnwindInstructionsParser, UnwindType, VPushParser)
+    EncodeUnwindInstructionTable, GenerateEncodedFunctionUnwinds,
+    GenerateUnwinds, GenerateUnwindTables, NullParser, ParseAddressCfi,
+    PushOrSubSpParser, ReadFunctionCfi, REFUSE_TO_UNWIND, SplitSymbolFile,
+    StoreSpParser, TRIVIAL_UNWIND, Uleb128Encode, UnwindInstructionsParser,
+    UnwindType, VPushParser)
 
 
 class _TestReadFunctionCfi(unittest.TestCase):
@@ -101,6 +104,40 @@ class _TestReadFunctionCfi(unittest.TestCase):
         )),
     ], list(ReadFunctionCfi(f)))
 
+  def testReadFunctionCfiNoFunctionsAsserts(self):
+    f = io.StringIO('MODULE Linux arm 0123456789ABCDEF0 libchrome.so\n')
+
+    self.assertRaises(AssertionError, lambda: list(ReadFunctionCfi(f)))
+
+
+class _TestSplitSymbolFile(unittest.TestCase):
+  def testSplitAtFunctionBoundaries(self):
+    symbols = (b'MODULE Linux arm 0123456789ABCDEF0 libchrome.so\n'
+               b'STACK CFI INIT 10 4 .cfa: sp 0 + .ra: lr\n'
+               b'STACK CFI 12 .cfa: sp 8 +\n'
+               b'STACK CFI INIT 20 4 .cfa: sp 0 + .ra: lr\n'
+               b'STACK CFI INIT 30 4 .cfa: sp 0 + .ra: lr\n')
+    first = symbols.index(b'STACK CFI INIT 10 ')
+    second = symbols.index(b'STACK CFI INIT 20 ')
+    third = symbols.index(b'STACK CFI INIT 30 ')
+
+    self.assertEqual([(first, second), (second, third),
+                      (third, len(symbols))], SplitSymbolFile(symbols, 1))
+    self.assertEqual([(first, third), (third, len(symbols))],
+                     SplitSymbolFile(symbols, second - first + 1))
+    self.assertEqual([(first, len(symbols))],
+                     SplitSymbolFile(symbols, len(symbols)))
+
+  def testSplitFromFileStart(self):
+    symbols = b'STACK CFI INIT 10 4 .cfa: sp 0 + .ra: lr\n'
+
+    self.assertEqual([(0, len(symbols))], SplitSymbolFile(symbols, 1))
+
+  def testNoStackCfi(self):
+    self.assertEqual([],
+                     SplitSymbolFile(b'MODULE Linux arm 0123 libchrome.so\n',
+                                     1))
+
 
 class _TestEncodeAsBytes(unittest.TestCase):
   def testOutOfBounds(self):
@@ -1180,3 +1217,38 @@ class _TestGenerateUnwindTables(unittest.TestCase):
 
     self.assertEqual(4 * 4, len(page_table))
     self.assertEqual((0, 2, 3, 3), struct.unpack('4I', page_table))
+
+
+class _TestGenerateEncodedFunctionUnwinds(unittest.TestCase):
+  def testMatchesSerialEncoding(self):
+    input_lines = [
+        'MODULE Linux arm 0123456789ABCDEF0 libchrome.so',
+        'STACK CFI INIT 1000 20 .cfa: sp 0 + .ra: lr',
+        'STACK CFI 1002 .cfa: sp 8 + .ra: .cfa -4 + ^ r7: .cfa -8 + ^',
+        'STACK CFI 1004 .cfa: r7 8 +',
+        'STACK CFI INIT 0 10 .cfa: sp 0 + .ra: lr',  # Tombstone function.
+        'STACK CFI 2 .cfa: sp 8 + .ra: .cfa -4 + ^ r7: .cfa -8 + ^',
+        'STACK CFI INIT 1040 8 .cfa: sp 0 + .ra: lr',
+        'STACK CFI 1042 .cfa: sp 8 + .ra: .cfa -4 + ^ r7: .cfa -8 + ^',
+        'STACK CFI INIT 1020 20 .cfa: sp 0 + .ra: lr',
+        'STACK CFI 1022 .cfa: sp 8 + .ra: .cfa -4 + ^ r7: .cfa -8 + ^',
+    ]
+    contents = ''.join(line + '\n' for line in input_lines)
+
+    expected = list(
+        EncodeFunctionUnwinds(
+            GenerateUnwinds(ReadFunctionCfi(io.StringIO(contents)),
+                            ALL_PARSERS), 0x1000))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      symbol_file_path = os.path.join(tmp_dir, 'libchrome.so.sym')
+      with open(symbol_file_path, 'w') as f:
+        f.write(contents)
+      for chunk_size in (1, len(contents)):
+        with unittest.mock.patch('create_unwind_table._SYMBOL_FILE_CHUNK_SIZE',
+                                 chunk_size):
+          self.assertEqual(
+              expected,
+              list(
+                  GenerateEncodedFunctionUnwinds(symbol_file_path, 0x1000,
+                                                 ALL_PARSERS)))
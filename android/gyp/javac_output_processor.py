@@ -72,6 +72,9 @@ class JavacOutputProcessor:
     lines = self._ElaborateLinesForUnknownSymbol(iter(lines))
     for line in lines:
       yield self._ApplyColors(line)
+    if self._class_lookup_index:
+      self._class_lookup_index.close()
+      self._class_lookup_index = None
     if self._suggested_targets_list:
 
       def yellow(text):
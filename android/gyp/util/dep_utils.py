@@ -7,13 +7,15 @@ from __future__ import annotations
 import collections
 
 import dataclasses
+import hashlib
 import json
 import logging
 import os
 import pathlib
+import sqlite3
 import subprocess
 import sys
-from typing import Dict, Iterator, List, Set
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 from util import jar_utils
 
@@ -23,6 +25,11 @@ sys.path.append(str(_SRC_PATH / 'build/android'))
 # Import list_java_targets so that the dependency is found by print_python_deps.
 import list_java_targets
 
+# Relative to the output directory.
+_INDEX_PATH = 'obj/java_class_lookup_index.sqlite'
+# Bump when the schema or what is stored changes.
+_INDEX_VERSION = 1
+
 
 @dataclasses.dataclass(frozen=True)
 class ClassEntry:
@@ -72,40 +79,48 @@ class BuildConfig:
         yield from dep_build_config.all_dependent_configs(path_to_configs)
 
 
+@dataclasses.dataclass
+class _BuildConfigUpdate:
+  """A change to the stored copy of a build config."""
+  relpath: str
+  config_stat: str
+  # The new row of the build_configs table, or None if only config_stat
+  # changed.
+  row: Optional[Tuple] = None
+  full_class_names: Set[str] = dataclasses.field(default_factory=set)
+
+
 class ClassLookupIndex:
   """A map from full Java class to its build targets.
 
-  A class might be in multiple targets if it's bytecode rewritten."""
+  A class might be in multiple targets if it's bytecode rewritten.
+
+  The index is stored in an sqlite database within the output directory. Only
+  build configs that changed since the index was last used are re-read.
+  """
   def __init__(self, build_output_dir: pathlib.Path, should_build: bool):
     self._abs_build_output_dir = build_output_dir.resolve().absolute()
     self._should_build = should_build
-    self._class_index = self._index_root()
+    self._db = self._open_index()
+    self._update_index(self._list_java_targets())
 
   def match(self, search_string: str) -> List[ClassEntry]:
     """Get class/target entries where the class matches search_string"""
     # Priority 1: Exact full matches
-    if search_string in self._class_index:
-      return self._entries_for(search_string)
+    matches = self._query('full_class_name = ?', search_string)
+    if matches:
+      return matches
 
     # Priority 2: Match full class name (any case), if it's a class name
-    matches = []
     lower_search_string = search_string.lower()
     if '.' not in lower_search_string:
-      for full_class_name in self._class_index:
-        package_and_class = full_class_name.rsplit('.', 1)
-        if len(package_and_class) < 2:
-          continue
-        class_name = package_and_class[1]
-        class_lower = class_name.lower()
-        if class_lower == lower_search_string:
-          matches.extend(self._entries_for(full_class_name))
+      matches = self._query('class_name_lower = ?', lower_search_string)
       if matches:
         return matches
 
     # Priority 3: Match anything
-    for full_class_name in self._class_index:
-      if lower_search_string in full_class_name.lower():
-        matches.extend(self._entries_for(full_class_name))
+    matches = self._query('instr(full_class_name_lower, ?) > 0',
+                          lower_search_string)
 
     # Priority 4: Match parent class when no matches and it's an inner class.
     if not matches:
@@ -117,11 +132,42 @@ class ClassLookupIndex:
 
     return matches
 
-  def _entries_for(self, class_name) -> List[ClassEntry]:
-    return sorted(self._class_index[class_name])
+  def _query(self, condition: str, value: str) -> List[ClassEntry]:
+    """Returns entries matching |condition|, grouped by class."""
+    rows = self._db.execute(
+        'SELECT full_class_name, target, preferred_dep FROM class_entries '
+        f'WHERE {condition} ORDER BY full_class_name', (value, ))
+    entries_by_class: Dict[str, List[ClassEntry]] = collections.defaultdict(
+        list)
+    for full_class_name, target, preferred_dep in rows:
+      entries_by_class[full_class_name].append(
+          ClassEntry(full_class_name=full_class_name,
+                     target=target,
+                     preferred_dep=bool(preferred_dep)))
+    matches = []
+    for entries in entries_by_class.values():
+      matches.extend(sorted(entries))
+    return matches
 
-  def _index_root(self) -> Dict[str, Set[ClassEntry]]:
-    """Create the class to target index."""
+  def _open_index(self) -> sqlite3.Connection:
+    index_path = self._abs_build_output_dir / _INDEX_PATH
+    if index_path.parent.is_dir():
+      db = None
+      try:
+        db = sqlite3.connect(str(index_path), timeout=60)
+        if db.execute('PRAGMA user_version').fetchone()[0] != _INDEX_VERSION:
+          _create_tables(db)
+        return db
+      except sqlite3.Error as e:
+        logging.warning('Not using %s: %s', index_path, e)
+        if db:
+          db.close()
+    db = sqlite3.connect(':memory:')
+    _create_tables(db)
+    return db
+
+  def _list_java_targets(self) -> List[Tuple[str, str]]:
+    """Returns (target_name, build_config_path) for all java targets."""
     logging.debug('Running list_java_targets.py...')
     list_java_targets_command = [
         'build/android/list_java_targets.py', '--gn-labels',
@@ -138,44 +184,151 @@ class ClassLookupIndex:
                                            check=True)
     logging.debug('... done.')
 
-    # Parse output of list_java_targets.py into BuildConfig objects.
-    path_to_build_config: Dict[str, BuildConfig] = {}
-    target_lines = list_java_targets_run.stdout.splitlines()
-    for target_line in target_lines:
+    targets = []
+    for target_line in list_java_targets_run.stdout.splitlines():
       # Skip empty lines
       if not target_line:
         continue
 
       target_line_parts = target_line.split(': ')
       assert len(target_line_parts) == 2, target_line_parts
-      target_name, build_config_path = target_line_parts
-
+      targets.append(tuple(target_line_parts))
+    return targets
+
+  def close(self):
+    """Closes the index. match() may not be called afterwards."""
+    self._db.close()
+
+  def _update_index(self, targets: List[Tuple[str, str]]):
+    """Re-reads build configs that changed and rebuilds the class index.
+
+    Build configs and their inputs are read before taking the write lock, so
+    that concurrent updates (e.g. from parallel compile_java.py actions) do not
+    wait on each other while parsing.
+    """
+    stored_configs = {
+        row[0]: row
+        for row in self._db.execute(
+            'SELECT relpath, target_name, config_stat, config_md5, '
+            'input_paths, input_stat FROM build_configs')
+    }
+    updates = []
+    seen_relpaths = set()
+    for target_name, build_config_path in targets:
       if not os.path.exists(build_config_path):
         assert not self._should_build
         continue
-
-      with open(build_config_path) as build_config_contents:
-        build_config_json: Dict = json.load(build_config_contents)
-      deps_info = build_config_json['deps_info']
-
-      # Checking the library type here instead of in list_java_targets.py avoids
-      # reading each .build_config file twice.
-      if deps_info['type'] not in ('java_library', 'group'):
-        continue
-
       relpath = os.path.relpath(build_config_path, self._abs_build_output_dir)
-      preferred_dep = bool(deps_info.get('preferred_dep'))
-      is_group = bool(deps_info.get('type') == 'group')
-      dependent_config_paths = deps_info.get('deps_configs', [])
+      seen_relpaths.add(relpath)
+      update = self._read_build_config(target_name, build_config_path, relpath,
+                                       stored_configs.get(relpath))
+      if update:
+        updates.append(update)
+    if not updates and stored_configs.keys() <= seen_relpaths:
+      return
+
+    with self._db:
+      # Hold the write lock throughout so that concurrent updates are not
+      # interleaved.
+      self._db.execute('BEGIN IMMEDIATE')
+      current_configs = {
+          row[0]: row[1:]
+          for row in self._db.execute(
+              'SELECT relpath, config_stat, config_md5, input_stat '
+              'FROM build_configs')
+      }
+      changed = False
+      for update in updates:
+        current_config = current_configs.get(update.relpath)
+        # Another process may have stored the same update in the meantime.
+        if update.row is None:
+          if current_config and current_config[0] == update.config_stat:
+            continue
+          self._db.execute(
+              'UPDATE build_configs SET config_stat = ? WHERE relpath = ?',
+              (update.config_stat, update.relpath))
+        else:
+          if current_config == (update.row[2], update.row[3], update.row[5]):
+            continue
+          self._delete_build_config(update.relpath)
+          self._db.execute(
+              'INSERT INTO build_configs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+              update.row)
+          self._db.executemany(
+              'INSERT INTO config_classes VALUES (?, ?)',
+              ((update.relpath, c) for c in update.full_class_names))
+          changed = True
+
+      removed_relpaths = current_configs.keys() - seen_relpaths
+      for relpath in removed_relpaths:
+        self._delete_build_config(relpath)
+      if changed or removed_relpaths:
+        self._rebuild_class_entries()
+
+  def _read_build_config(self, target_name: str, build_config_path: str,
+                         relpath: str,
+                         stored_row) -> Optional[_BuildConfigUpdate]:
+    """Returns how to update the stored build config, or None if unchanged."""
+    config_stat = _stat_key([build_config_path])
+    inputs_unchanged = False
+    if stored_row:
+      (_, stored_target_name, stored_config_stat, stored_md5, input_paths,
+       input_stat) = stored_row
+      inputs_unchanged = (stored_target_name == target_name
+                          and _stat_key(json.loads(input_paths)) == input_stat)
+      if inputs_unchanged and stored_config_stat == config_stat:
+        return None
+
+    with open(build_config_path, 'rb') as f:
+      contents = f.read()
+    config_md5 = hashlib.md5(contents).hexdigest()
+    if inputs_unchanged and stored_md5 == config_md5:
+      # E.g. the build config was re-written with the same contents.
+      return _BuildConfigUpdate(relpath=relpath, config_stat=config_stat)
+
+    deps_info = json.loads(contents)['deps_info']
+    # Checking the library type here instead of in list_java_targets.py avoids
+    # reading each .build_config file twice.
+    is_java = deps_info['type'] in ('java_library', 'group')
+    input_paths = []
+    full_class_names = set()
+    if is_java:
+      input_paths = self._input_paths_for_build_config(deps_info)
       full_class_names = self._compute_full_class_names_for_build_config(
           deps_info)
-      build_config = BuildConfig(relpath=relpath,
-                                 target_name=target_name,
-                                 is_group=is_group,
-                                 preferred_dep=preferred_dep,
-                                 dependent_config_paths=dependent_config_paths,
-                                 full_class_names=full_class_names)
-      path_to_build_config[relpath] = build_config
+
+    return _BuildConfigUpdate(
+        relpath=relpath,
+        config_stat=config_stat,
+        row=(relpath, target_name, config_stat, config_md5,
+             json.dumps(input_paths), _stat_key(input_paths), is_java,
+             deps_info.get('type') == 'group',
+             bool(deps_info.get('preferred_dep')),
+             json.dumps(deps_info.get('deps_configs', []))),
+        full_class_names=full_class_names)
+
+  def _delete_build_config(self, relpath: str):
+    self._db.execute('DELETE FROM build_configs WHERE relpath = ?', (relpath, ))
+    self._db.execute('DELETE FROM config_classes WHERE relpath = ?',
+                     (relpath, ))
+
+  def _rebuild_class_entries(self):
+    """Recomputes the class_entries table from stored build configs."""
+    path_to_build_config: Dict[str, BuildConfig] = {}
+    for (relpath, target_name, is_group, preferred_dep,
+         dependent_config_paths) in self._db.execute(
+             'SELECT relpath, target_name, is_group, preferred_dep, deps '
+             'FROM build_configs WHERE is_java'):
+      path_to_build_config[relpath] = BuildConfig(
+          relpath=relpath,
+          target_name=target_name,
+          is_group=bool(is_group),
+          preferred_dep=bool(preferred_dep),
+          dependent_config_paths=json.loads(dependent_config_paths),
+          full_class_names=set())
+    for relpath, full_class_name in self._db.execute(
+        'SELECT relpath, full_class_name FROM config_classes'):
+      path_to_build_config[relpath].full_class_names.add(full_class_name)
 
     # From GN's perspective, depending on a java group is the same as depending
     # on all of its deps directly, since groups are collapsed in
@@ -189,15 +342,22 @@ class ClassLookupIndex:
           build_config.full_class_names.update(
               dep_build_config.full_class_names)
 
-    class_index = collections.defaultdict(set)
-    for build_config in path_to_build_config.values():
-      for full_class_name in build_config.full_class_names:
-        class_index[full_class_name].add(
-            ClassEntry(full_class_name=full_class_name,
-                       target=build_config.target_name,
-                       preferred_dep=build_config.preferred_dep))
-
-    return class_index
+    self._db.execute('DELETE FROM class_entries')
+    self._db.executemany(
+        'INSERT INTO class_entries VALUES (?, ?, ?, ?, ?)',
+        ((full_class_name, full_class_name.rsplit('.', 1)[-1].lower(),
+          full_class_name.lower(), build_config.target_name,
+          build_config.preferred_dep)
+         for build_config in path_to_build_config.values()
+         for full_class_name in build_config.full_class_names))
+
+  def _input_paths_for_build_config(self, deps_info: Dict) -> List[str]:
+    """Returns the paths that the build config's classes are read from."""
+    return [
+        str(self._abs_build_output_dir / deps_info[key])
+        for key in ('target_sources_file', 'unprocessed_jar_path')
+        if deps_info.get(key)
+    ]
 
   def _compute_full_class_names_for_build_config(self,
                                                  deps_info: Dict) -> Set[str]:
@@ -236,6 +396,63 @@ class ClassLookupIndex:
     return full_class_names
 
 
+def _create_tables(db: sqlite3.Connection):
+  """Creates the tables that store a ClassLookupIndex, unless they exist.
+
+  Safe to call from concurrent processes: the version is checked while holding
+  the write lock, and tables are only dropped when they hold an index of
+  another version.
+  """
+  with db:
+    db.execute('BEGIN IMMEDIATE')
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version == _INDEX_VERSION:
+      return
+    if version:
+      for table in ('build_configs', 'config_classes', 'class_entries'):
+        db.execute(f'DROP TABLE IF EXISTS {table}')
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS build_configs (
+            relpath TEXT PRIMARY KEY,
+            target_name TEXT,
+            config_stat TEXT,
+            config_md5 TEXT,
+            input_paths TEXT,
+            input_stat TEXT,
+            is_java INTEGER,
+            is_group INTEGER,
+            preferred_dep INTEGER,
+            deps TEXT)""")
+    db.execute('CREATE TABLE IF NOT EXISTS config_classes '
+               '(relpath TEXT, full_class_name TEXT)')
+    db.execute('CREATE INDEX IF NOT EXISTS config_classes_relpath '
+               'ON config_classes (relpath)')
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS class_entries (
+            full_class_name TEXT,
+            class_name_lower TEXT,
+            full_class_name_lower TEXT,
+            target TEXT,
+            preferred_dep INTEGER)""")
+    db.execute('CREATE INDEX IF NOT EXISTS class_entries_full_class_name '
+               'ON class_entries (full_class_name)')
+    db.execute('CREATE INDEX IF NOT EXISTS class_entries_class_name_lower '
+               'ON class_entries (class_name_lower)')
+    db.execute(f'PRAGMA user_version = {_INDEX_VERSION}')
+
+
+def _stat_key(paths: List[str]) -> str:
+  """Returns a string that changes when any of |paths| is modified."""
+  parts = []
+  for path in paths:
+    try:
+      st = os.stat(path)
+      parts.append(f'{st.st_mtime_ns}:{st.st_size}')
+    except FileNotFoundError:
+      parts.append('-')
+  return ','.join(parts)
+
+
 def GnTargetToBuildFilePath(gn_target: str):
   """Returns the relative BUILD.gn file path for this target from src root."""
   assert gn_target.startswith('//'), f'Relative {gn_target} name not supported.'
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from util import dep_utils
+
+
+class ClassLookupIndexTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self._output_dir = pathlib.Path(self._tmp_dir.name)
+    (self._output_dir / 'obj').mkdir()
+    self._targets = []
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _AddTarget(self, name, sources, target_type='java_library', deps=()):
+    config_path = self._output_dir / f'{name}.build_config.json'
+    sources_path = f'{name}.sources'
+    (self._output_dir / sources_path).write_text(''.join(s + '\n'
+                                                         for s in sources))
+    config_path.write_text(
+        json.dumps({
+            'deps_info': {
+                'type': target_type,
+                'target_sources_file': sources_path,
+                'deps_configs': [f'{d}.build_config.json' for d in deps],
+            }
+        }))
+    self._targets.append((f'//foo:{name}', str(config_path)))
+
+  def _CreateIndex(self):
+    with mock.patch.object(dep_utils.ClassLookupIndex,
+                           '_list_java_targets',
+                           return_value=self._targets):
+      index = dep_utils.ClassLookupIndex(self._output_dir, should_build=False)
+    self.addCleanup(index.close)
+    return index
+
+  def _ConnectToIndex(self):
+    db = sqlite3.connect(str(self._output_dir / dep_utils._INDEX_PATH),
+                         timeout=0)
+    self.addCleanup(db.close)
+    return db
+
+  def testMatch(self):
+    self._AddTarget('a_java', ['java/src/org/chromium/foo/FooBar.java'])
+    self._AddTarget('b_java', ['java/src/org/chromium/bar/Bar.java'])
+    self._AddTarget('group_java', [], target_type='group', deps=['b_java'])
+    index = self._CreateIndex()
+
+    def targets(search_string):
+      return [e.target for e in index.match(search_string)]
+
+    self.assertEqual(['//foo:a_java'], targets('org.chromium.foo.FooBar'))
+    self.assertEqual(['//foo:a_java'], targets('foobar'))
+    self.assertEqual(['//foo:b_java', '//foo:group_java'], targets('bar'))
+    self.assertEqual(['//foo:a_java'], targets('org.chromium.foo.FooBar.Inner'))
+    self.assertEqual([], targets('Baz'))
+
+  def testIncrementalUpdate(self):
+    self._AddTarget('a_java', ['java/src/org/chromium/foo/Foo.java'])
+    self._AddTarget('b_java', ['java/src/org/chromium/bar/Bar.java'])
+    self._CreateIndex()
+
+    compute = (
+        dep_utils.ClassLookupIndex._compute_full_class_names_for_build_config)
+    with mock.patch.object(dep_utils.ClassLookupIndex,
+                           '_compute_full_class_names_for_build_config',
+                           autospec=True,
+                           side_effect=compute) as mock_compute:
+      index = self._CreateIndex()
+      self.assertEqual(0, mock_compute.call_count)
+      self.assertEqual(1, len(index.match('Foo')))
+
+      self._targets = []
+      self._AddTarget('a_java', ['java/src/org/chromium/foo/Foo2.java'])
+      index = self._CreateIndex()
+      self.assertEqual(1, mock_compute.call_count)
+      self.assertEqual(['org.chromium.foo.Foo2'],
+                       [e.full_class_name for e in index.match('chromium')])
+
+  def testParsesWithoutWriteLock(self):
+    self._AddTarget('a_java', ['java/src/org/chromium/foo/Foo.java'])
+    self._CreateIndex()
+    self._targets = []
+    self._AddTarget('a_java', ['java/src/org/chromium/foo/Foo2.java'])
+
+    compute = (
+        dep_utils.ClassLookupIndex._compute_full_class_names_for_build_config)
+
+    def compute_while_writing(*args):
+      # Fails unless the database is unlocked.
+      db = self._ConnectToIndex()
+      with db:
+        db.execute('BEGIN IMMEDIATE')
+      return compute(*args)
+
+    with mock.patch.object(dep_utils.ClassLookupIndex,
+                           '_compute_full_class_names_for_build_config',
+                           autospec=True,
+                           side_effect=compute_while_writing):
+      index = self._CreateIndex()
+    self.assertEqual(['org.chromium.foo.Foo2'],
+                     [e.full_class_name for e in index.match('chromium')])
+
+  def testCreateTablesKeepsCurrentIndex(self):
+    self._AddTarget('a_java', ['java/src/org/chromium/foo/Foo.java'])
+    self._CreateIndex()
+    db = self._ConnectToIndex()
+    dep_utils._create_tables(db)
+    self.assertEqual(
+        1,
+        db.execute('SELECT COUNT(*) FROM class_entries').fetchone()[0])
+
+    # Indices of other versions are replaced.
+    with db:
+      db.execute(f'PRAGMA user_version = {dep_utils._INDEX_VERSION + 1}')
+    dep_utils._create_tables(db)
+    self.assertEqual(
+        0,
+        db.execute('SELECT COUNT(*) FROM class_entries').fetchone()[0])
+    self.assertEqual(dep_utils._INDEX_VERSION,
+                     db.execute('PRAGMA user_version').fetchone()[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,12 +3,17 @@
 # found in the LICENSE file.
 
 
+import concurrent.futures
 import difflib
 import hashlib
 import itertools
 import json
 import os
+import posixpath
+import struct
 import sys
+import tempfile
+import time
 import zipfile
 
 from util import build_utils
@@ -21,6 +26,37 @@ PRINT_EXPLANATIONS = int(os.environ.get('PRINT_BUILD_EXPLANATIONS', 0))
 # An escape hatch that causes all targets to be rebuilt.
 _FORCE_REBUILD = int(os.environ.get('FORCE_REBUILD', 0))
 
+# Directory of the digest cache shared by all md5_check actions. Actions run
+# from the output directory, so the default lives alongside other caches in
+# obj/. Set to an empty string to disable.
+_CACHE_DIR = os.environ.get('MD5_CHECK_CACHE_DIR', 'obj/md5-check-cache')
+# The cache is trimmed back under this size (least-recently-used first).
+_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# How often (at most) an action will check whether the cache needs trimming.
+_CACHE_TRIM_INTERVAL_SECS = 60 * 60
+# Files modified this recently are not cached, since a second write within the
+# filesystem's timestamp granularity would not change their key.
+_CACHE_RACY_SECS = 2
+# Used as the tag of large files when the digest cache is disabled.
+_MAX_UNCACHED_HASH_SIZE = 1 * 1024 * 1024
+# Files are read this many bytes at a time when hashing them.
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Identifies .md5.stamp files written in the binary format. Bump the version
+# when changing the format.
+_STAMP_MAGIC = b'MD5STAMP'
+_STAMP_VERSION = 1
+# magic, version, files-md5, strings-md5.
+_STAMP_HEADER = struct.Struct('<8sB16s16s')
+_U32 = struct.Struct('<I')
+# subpath dirname index, subpath basename index, tag.
+_ZIP_ENTRY = struct.Struct('<IIQ')
+# Tag types for top-level files.
+_TAG_MD5 = 0
+_TAG_FLOAT = 1
+_TAG_STR = 2
+_TAG_INT = 3
+
 
 def CallAndWriteDepfileIfStale(on_stale_md5,
                                options,
@@ -109,19 +145,6 @@ def CallAndRecordIfStale(function,
       'record paths must end in \'.stamp\' so that they are easy to find '
       'and delete')
 
-  new_metadata = _Metadata(track_entries=pass_changes or PRINT_EXPLANATIONS)
-  new_metadata.AddStrings(input_strings)
-
-  zip_allowlist = set(track_subpaths_allowlist or [])
-  for path in input_paths:
-    # It's faster to md5 an entire zip file than it is to just locate & hash
-    # its central directory (which is what this used to do).
-    if path in zip_allowlist:
-      entries = _ExtractZipEntries(path)
-      new_metadata.AddZipFile(path, entries)
-    else:
-      new_metadata.AddFile(path, _ComputeTagForPath(path))
-
   old_metadata = None
   force = force or _FORCE_REBUILD
   missing_outputs = [x for x in output_paths if force or not os.path.exists(x)]
@@ -133,16 +156,66 @@ def CallAndRecordIfStale(function,
     # of the build, and should be considered stale.
     too_new = [x for x in output_paths if os.path.getmtime(x) > record_mtime]
     if not too_new:
-      with open(record_path, 'r') as jsonfile:
+      with open(record_path, 'rb') as stampfile:
         try:
-          old_metadata = _Metadata.FromFile(jsonfile)
+          old_metadata = _Metadata.FromFile(stampfile)
         except:  # pylint: disable=bare-except
           pass  # Not yet using new file format.
 
+  new_metadata = _Metadata(track_entries=pass_changes or PRINT_EXPLANATIONS)
+  new_metadata.AddStrings(input_strings)
   changes = Changes(old_metadata, new_metadata, force, missing_outputs, too_new)
-  if not changes.HasChanges():
-    return
 
+  # Without |pass_changes|, |function| can start as soon as any difference is
+  # found, while the remaining inputs are hashed in the background (their tags
+  # are still needed for the new record).
+  can_start_early = not pass_changes and not PRINT_EXPLANATIONS
+  is_stale = changes.HasStringChanges()
+  # Old stamps may not have per-file tags, in which case only the aggregate
+  # md5 is compared below.
+  compare_tags = can_start_early and old_metadata is not None
+  called = False
+
+  cache = _DigestCache.Create()
+  zip_allowlist = set(track_subpaths_allowlist or [])
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    futures = []
+    for path in input_paths:
+      # It's faster to md5 an entire zip file than it is to just locate & hash
+      # its central directory (which is what this used to do).
+      if path in zip_allowlist:
+        futures.append(executor.submit(_ExtractZipEntries, path, cache))
+      else:
+        futures.append(executor.submit(_ComputeTagForPath, path, cache))
+
+    # Results are consumed in input order so that metadata is deterministic.
+    for path, future in zip(input_paths, futures):
+      if is_stale and can_start_early and not called:
+        _CallFunction(function, changes, record_path, pass_changes)
+        called = True
+      if path in zip_allowlist:
+        tag = new_metadata.AddZipFile(path, future.result())
+      else:
+        tag = new_metadata.AddFile(path, future.result())
+      if compare_tags and not is_stale:
+        # Paths that are new may be temporary files with random names, which
+        # are covered by the aggregate check below.
+        old_tag = old_metadata.GetFileTag(path)
+        is_stale = old_tag is not None and old_tag != tag
+
+  if not called:
+    if not changes.HasChanges():
+      return
+    _CallFunction(function, changes, record_path, pass_changes)
+
+  with open(record_path, 'wb') as f:
+    new_metadata.ToFile(f)
+
+  if cache:
+    cache.MaybeTrim()
+
+
+def _CallFunction(function, changes, record_path, pass_changes):
   if PRINT_EXPLANATIONS:
     print('=' * 80)
     print('Target is stale: %s' % record_path)
@@ -152,9 +225,6 @@ def CallAndRecordIfStale(function,
   args = (changes,) if pass_changes else ()
   function(*args)
 
-  with open(record_path, 'w') as f:
-    new_metadata.ToFile(f)
-
 
 class Changes:
   """Provides and API for querying what changed between runs."""
@@ -299,7 +369,21 @@ class _Metadata:
     track_entries: Enables per-file change tracking. Slower, but required for
         Changes functionality.
   """
-  # Schema:
+  # Binary schema (all integers are little-endian):
+  #   Header: magic, version, files-md5, strings-md5 (see _STAMP_HEADER).
+  #   Body (strings and zip entries are empty unless track_entries=True):
+  #     String table: u32 count, u32 byte length of each, utf-8 data.
+  #     Input strings: u32 count, u32 string index of each.
+  #     Input files: u32 count, then for each:
+  #       u32 path index, u8 tag type, tag (see _EncodeTag()),
+  #       u32 entry count, entries (see _ZIP_ENTRY).
+  #
+  # Zip entry subpaths are interned as (dirname, basename) pairs, and their
+  # CRC-based tags stored as integers. The body is decoded only when a
+  # per-file query is made, so comparing FilesMd5() / StringsMd5() needs only
+  # the header.
+  #
+  # Stamps written by older versions are JSON with the schema:
   # {
   #   "files-md5": "VALUE",
   #   "strings-md5": "VALUE",
@@ -325,37 +409,62 @@ class _Metadata:
     self._strings = []
     # Map of (path, subpath) -> entry. Created upon first call to _GetEntry().
     self._file_map = None
+    # Map of path -> tag. Created upon first call to GetFileTag().
+    self._file_tags = None
+    # Undecoded body of a binary stamp file. Decoded by _Load().
+    self._body = None
 
   @classmethod
   def FromFile(cls, fileobj):
-    """Returns a _Metadata initialized from a file object."""
+    """Returns a _Metadata initialized from a binary file object."""
     ret = cls()
-    obj = json.load(fileobj)
-    ret._files_md5 = obj['files-md5']
-    ret._strings_md5 = obj['strings-md5']
-    ret._files = obj.get('input-files', [])
-    ret._strings = obj.get('input-strings', [])
+    data = fileobj.read()
+    if not data.startswith(_STAMP_MAGIC):
+      obj = json.loads(data)
+      ret._files_md5 = obj['files-md5']
+      ret._strings_md5 = obj['strings-md5']
+      ret._files = obj.get('input-files', [])
+      ret._strings = obj.get('input-strings', [])
+      return ret
+
+    _, version, files_md5, strings_md5 = _STAMP_HEADER.unpack_from(data)
+    if version != _STAMP_VERSION:
+      raise Exception('Unknown .md5.stamp version: %d' % version)
+    ret._files_md5 = files_md5.hex()
+    ret._strings_md5 = strings_md5.hex()
+    ret._body = memoryview(data)[_STAMP_HEADER.size:]
     return ret
 
   def ToFile(self, fileobj):
-    """Serializes metadata to the given file object."""
-    obj = {
-        'files-md5': self.FilesMd5(),
-        'strings-md5': self.StringsMd5(),
-    }
-    if self._track_entries:
-      obj['input-files'] = sorted(self._files, key=lambda e: e['path'])
-      obj['input-strings'] = self._strings
-
-    json.dump(obj, fileobj, indent=2)
-
-  def _AssertNotQueried(self):
+    """Serializes metadata to the given binary file object."""
+    fileobj.write(
+        _STAMP_HEADER.pack(_STAMP_MAGIC, _STAMP_VERSION,
+                           bytes.fromhex(self.FilesMd5()),
+                           bytes.fromhex(self.StringsMd5())))
+    self._Load()
+    files = sorted(self._files, key=lambda e: e['path'])
+    strings = self._strings
+    if not self._track_entries:
+      # Per-file tags are cheap, and let the next run notice staleness before
+      # it has hashed every input.
+      files = [{'path': e['path'], 'tag': e['tag']} for e in files]
+      strings = []
+    fileobj.write(_EncodeBody(files, strings))
+
+  def _Load(self):
+    """Decodes the body of a binary stamp file, if not yet done."""
+    if self._body is not None:
+      if self._body:
+        self._files, self._strings = _DecodeBody(self._body)
+      self._body = None
+
+  def _AssertFilesNotQueried(self):
     assert self._files_md5 is None
-    assert self._strings_md5 is None
     assert self._file_map is None
+    assert self._file_tags is None
 
   def AddStrings(self, values):
-    self._AssertNotQueried()
+    assert self._strings_md5 is None
     self._strings.extend(str(v) for v in values)
 
   def AddFile(self, path, tag):
@@ -365,11 +474,12 @@ class _Metadata:
       path: Path to the file.
       tag: A short string representative of the file contents.
     """
-    self._AssertNotQueried()
+    self._AssertFilesNotQueried()
     self._files.append({
         'path': path,
         'tag': tag,
     })
+    return tag
 
   def AddZipFile(self, path, entries):
     """Adds metadata for a zip file.
@@ -377,8 +487,11 @@ class _Metadata:
     Args:
       path: Path to the file.
       entries: List of (subpath, tag) tuples for entries within the zip.
+
+    Returns:
+      The tag computed for the zip file.
     """
-    self._AssertNotQueried()
+    self._AssertFilesNotQueried()
     tag = _ComputeInlineMd5(itertools.chain((e[0] for e in entries),
                                             (e[1] for e in entries)))
     self._files.append({
@@ -386,9 +499,11 @@ class _Metadata:
         'tag': tag,
         'entries': [{"path": e[0], "tag": e[1]} for e in entries],
     })
+    return tag
 
   def GetStrings(self):
     """Returns the list of input strings."""
+    self._Load()
     return self._strings
 
   def FilesMd5(self):
@@ -406,8 +521,9 @@ class _Metadata:
     return self._strings_md5
 
   def _GetEntry(self, path, subpath=None):
-    """Returns the JSON entry for the given path / subpath."""
+    """Returns the entry dict for the given path / subpath."""
     if self._file_map is None:
+      self._Load()
       self._file_map = {}
       for entry in self._files:
         self._file_map[(entry['path'], None)] = entry
@@ -420,8 +536,21 @@ class _Metadata:
     ret = self._GetEntry(path, subpath)
     return ret and ret['tag']
 
+  def GetFileTag(self, path):
+    """Returns the tag for the given top-level path.
+
+    Unlike GetTag(), does not decode the entries of zip files.
+    """
+    if self._file_tags is None:
+      if self._body is not None:
+        self._file_tags = _DecodeFileTags(self._body) if self._body else {}
+      else:
+        self._file_tags = {e['path']: e['tag'] for e in self._files}
+    return self._file_tags.get(path)
+
   def IterPaths(self):
     """Returns a generator for all top-level paths."""
+    self._Load()
     return (e['path'] for e in self._files)
 
   def IterSubpaths(self, path):
@@ -437,18 +566,275 @@ class _Metadata:
     return (entry['path'] for entry in subentries)
 
 
-def _ComputeTagForPath(path):
-  stat = os.stat(path)
-  if stat.st_size > 1 * 1024 * 1024:
-    # Fallback to mtime for large files so that md5_check does not take too long
-    # to run.
-    return stat.st_mtime
+class _StringTable:
+  """Assigns indices to strings, storing each distinct string once."""
+
+  def __init__(self):
+    self._index_by_string = {}
+
+  def Intern(self, value):
+    index = self._index_by_string.get(value)
+    if index is None:
+      index = len(self._index_by_string)
+      self._index_by_string[value] = index
+    return index
+
+  def Encode(self):
+    encoded = [s.encode('utf-8') for s in self._index_by_string]
+    return b''.join([
+        _U32.pack(len(encoded)),
+        struct.pack('<%dI' % len(encoded), *(len(e) for e in encoded)),
+    ] + encoded)
+
+
+def _EncodeTag(tag, table):
+  if isinstance(tag, str):
+    if len(tag) == 32:
+      try:
+        return struct.pack('<B16s', _TAG_MD5, bytes.fromhex(tag))
+      except ValueError:
+        pass
+    return struct.pack('<BI', _TAG_STR, table.Intern(tag))
+  if isinstance(tag, int):
+    return struct.pack('<Bq', _TAG_INT, tag)
+  return struct.pack('<Bd', _TAG_FLOAT, tag)
+
+
+def _EncodeBody(files, strings):
+  table = _StringTable()
+  parts = [_U32.pack(len(strings))]
+  parts.append(
+      struct.pack('<%dI' % len(strings), *(table.Intern(s) for s in strings)))
+  parts.append(_U32.pack(len(files)))
+  for entry in files:
+    parts.append(_U32.pack(table.Intern(entry['path'])))
+    parts.append(_EncodeTag(entry['tag'], table))
+    subentries = entry.get('entries', ())
+    parts.append(_U32.pack(len(subentries)))
+    for subentry in subentries:
+      dirname, basename = posixpath.split(subentry['path'])
+      parts.append(
+          _ZIP_ENTRY.pack(table.Intern(dirname), table.Intern(basename),
+                          subentry['tag']))
+  return table.Encode() + b''.join(parts)
+
+
+def _DecodeTag(body, offset, get_string):
+  """Returns (tag, offset after the tag) for the tag encoded at |offset|."""
+  tag_type = body[offset]
+  offset += 1
+  if tag_type == _TAG_MD5:
+    return bytes(body[offset:offset + 16]).hex(), offset + 16
+  if tag_type == _TAG_STR:
+    return get_string(_U32.unpack_from(body, offset)[0]), offset + _U32.size
+  if tag_type == _TAG_INT:
+    return struct.unpack_from('<q', body, offset)[0], offset + 8
+  if tag_type == _TAG_FLOAT:
+    return struct.unpack_from('<d', body, offset)[0], offset + 8
+  raise Exception('Unknown tag type: %d' % tag_type)
+
+
+def _DecodeFileTags(body):
+  """Returns a dict of path -> tag for the top-level files of |body|.
+
+  Zip entries are skipped over, and only the strings that are needed are
+  decoded, which makes this much cheaper than _DecodeBody() for large zips.
+  """
+  num_strings = _U32.unpack_from(body)[0]
+  lengths = struct.unpack_from('<%dI' % num_strings, body, _U32.size)
+  bounds = list(
+      itertools.accumulate(lengths, initial=_U32.size * (num_strings + 1)))
+
+  def get_string(index):
+    return str(body[bounds[index]:bounds[index + 1]], 'utf-8')
+
+  offset = bounds[-1]
+  offset += _U32.size * (_U32.unpack_from(body, offset)[0] + 1)
+  num_files = _U32.unpack_from(body, offset)[0]
+  offset += _U32.size
+
+  tags = {}
+  for _ in range(num_files):
+    path = get_string(_U32.unpack_from(body, offset)[0])
+    tag, offset = _DecodeTag(body, offset + _U32.size, get_string)
+    num_entries = _U32.unpack_from(body, offset)[0]
+    offset += _U32.size + num_entries * _ZIP_ENTRY.size
+    tags[path] = tag
+  return tags
+
+
+def _DecodeBody(body):
+  """Returns (files, strings) in the format used by _Metadata."""
+  offset = 0
+
+  def read_u32():
+    nonlocal offset
+    offset += _U32.size
+    return _U32.unpack_from(body, offset - _U32.size)[0]
+
+  def read_u32s(count):
+    nonlocal offset
+    ret = struct.unpack_from('<%dI' % count, body, offset)
+    offset += 4 * count
+    return ret
+
+  num_strings = read_u32()
+  table = []
+  start = offset + 4 * num_strings
+  for length in read_u32s(num_strings):
+    table.append(str(body[start:start + length], 'utf-8'))
+    start += length
+  offset = start
+
+  strings = [table[i] for i in read_u32s(read_u32())]
+
+  files = []
+  for _ in range(read_u32()):
+    path = table[read_u32()]
+    tag, offset = _DecodeTag(body, offset, table.__getitem__)
+    entry = {'path': path, 'tag': tag}
+
+    num_entries = read_u32()
+    if num_entries:
+      subentries = []
+      for dir_index, base_index, subtag in _ZIP_ENTRY.iter_unpack(
+          body[offset:offset + num_entries * _ZIP_ENTRY.size]):
+        dirname = table[dir_index]
+        basename = table[base_index]
+        subpath = dirname + '/' + basename if dirname else basename
+        subentries.append({'path': subpath, 'tag': subtag})
+      offset += num_entries * _ZIP_ENTRY.size
+      entry['entries'] = subentries
+    files.append(entry)
+  return files, strings
+
+
+class _DigestCache:
+  """An on-disk cache of file digests shared between actions.
+
+  Entries are keyed by (path, inode, size, mtime_ns), so a file is re-hashed
+  only when it is replaced or modified. Each entry is a separate file that is
+  written atomically, which makes the cache safe to use from concurrent
+  actions without locking. Hits refresh an entry's mtime, which is what
+  MaybeTrim() uses to evict the least-recently-used entries.
+  """
+
+  def __init__(self, cache_dir, max_bytes=_CACHE_MAX_BYTES):
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes
+
+  @classmethod
+  def Create(cls):
+    """Returns the shared cache, or None if it is disabled."""
+    # Do not create obj/ when not run from an output directory (e.g. tests).
+    if not _CACHE_DIR or not os.path.isdir(os.path.dirname(_CACHE_DIR) or '.'):
+      return None
+    try:
+      os.makedirs(_CACHE_DIR, exist_ok=True)
+    except OSError:
+      return None
+    return cls(_CACHE_DIR)
+
+  def _EntryPath(self, kind, path, stat):
+    key = '\0'.join((kind, os.path.abspath(path), str(stat.st_ino),
+                     str(stat.st_size), str(stat.st_mtime_ns)))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(self._cache_dir, digest[:2], digest[2:])
+
+  def Get(self, kind, path, stat):
+    """Returns the cached value for |path|, or None."""
+    entry_path = self._EntryPath(kind, path, stat)
+    try:
+      with open(entry_path) as f:
+        value = json.load(f)
+      os.utime(entry_path)
+    except (OSError, ValueError):
+      return None
+    return value
+
+  def Put(self, kind, path, stat, value):
+    """Stores |value| for |path| (with |stat| taken before computing it)."""
+    if stat.st_mtime_ns > (time.time() - _CACHE_RACY_SECS) * 1e9:
+      return
+    entry_path = self._EntryPath(kind, path, stat)
+    entry_dir = os.path.dirname(entry_path)
+    try:
+      os.makedirs(entry_dir, exist_ok=True)
+      with tempfile.NamedTemporaryFile('w', dir=entry_dir,
+                                       delete=False) as f:
+        json.dump(value, f, separators=(',', ':'))
+      os.replace(f.name, entry_path)
+    except OSError:
+      pass
+
+  def MaybeTrim(self):
+    """Evicts least-recently-used entries if the cache is over its size cap.
+
+    Only one action per _CACHE_TRIM_INTERVAL_SECS bothers to check.
+    """
+    stamp_path = os.path.join(self._cache_dir, 'last-trim.stamp')
+    try:
+      last_trim = os.path.getmtime(stamp_path)
+    except OSError:
+      last_trim = 0
+    if time.time() - last_trim < _CACHE_TRIM_INTERVAL_SECS:
+      return
+    build_utils.Touch(stamp_path)
+
+    entries = []
+    total_bytes = 0
+    for root, _, files in os.walk(self._cache_dir):
+      for name in files:
+        entry_path = os.path.join(root, name)
+        if entry_path == stamp_path:
+          continue
+        try:
+          stat = os.stat(entry_path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+        total_bytes += stat.st_size
+    if total_bytes <= self._max_bytes:
+      return
+
+    # Trim to below the cap so that the next trim is not immediately needed.
+    target_bytes = self._max_bytes * 3 // 4
+    for _, size, entry_path in sorted(entries):
+      if total_bytes <= target_bytes:
+        break
+      try:
+        os.unlink(entry_path)
+      except OSError:
+        pass
+      total_bytes -= size
+
+
+def _Md5File(path):
   md5 = hashlib.md5()
+  # Read in chunks since large inputs (e.g. .jar and .so files) are hashed too.
   with open(path, 'rb') as f:
-    md5.update(f.read())
+    for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+      md5.update(chunk)
   return md5.hexdigest()
 
 
+def _ComputeTagForPath(path, cache=None):
+  stat = os.stat(path)
+  if cache is None:
+    if stat.st_size > _MAX_UNCACHED_HASH_SIZE:
+      # Fallback to mtime for large files so that md5_check does not take too
+      # long to run.
+      return stat.st_mtime
+    return _Md5File(path)
+
+  # With a cache, even large files need only be hashed once.
+  tag = cache.Get('md5', path, stat)
+  if tag is None:
+    tag = _Md5File(path)
+    cache.Put('md5', path, stat, tag)
+  return tag
+
+
 def _ComputeInlineMd5(iterable):
   """Computes the md5 of the concatenated parameters."""
   md5 = hashlib.md5()
@@ -457,8 +843,15 @@ def _ComputeInlineMd5(iterable):
   return md5.hexdigest()
 
 
-def _ExtractZipEntries(path):
+def _ExtractZipEntries(path, cache=None):
   """Returns a list of (path, CRC32) of all files within |path|."""
+  stat = None
+  if cache:
+    stat = os.stat(path)
+    entries = cache.Get('zip', path, stat)
+    if entries is not None:
+      return [tuple(e) for e in entries]
+
   entries = []
   with zipfile.ZipFile(path) as zip_file:
     for zip_info in zip_file.infolist():
@@ -466,4 +859,7 @@ def _ExtractZipEntries(path):
       if zip_info.CRC:
         entries.append(
             (zip_info.filename, zip_info.CRC + zip_info.compress_type))
+
+  if cache:
+    cache.Put('zip', path, stat, entries)
   return entries
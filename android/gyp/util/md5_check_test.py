@@ -4,9 +4,13 @@
 # found in the LICENSE file.
 
 import fnmatch
+import hashlib
+import io
+import json
 import os
 import sys
 import tempfile
+import threading
 import unittest
 import zipfile
 
@@ -25,6 +29,11 @@ class TestMd5Check(unittest.TestCase):
   def setUp(self):
     self.called = False
     self.changes = None
+    self._orig_cache_dir = md5_check._CACHE_DIR
+    md5_check._CACHE_DIR = ''
+
+  def tearDown(self):
+    md5_check._CACHE_DIR = self._orig_cache_dir
 
   def testCallAndRecordIfStale(self):
     input_strings = ['string1', 'string2']
@@ -173,6 +182,137 @@ class TestMd5Check(unittest.TestCase):
                                         input_file2.name, 'path/1.txt'),
                        added_or_modified_only=False)
 
+  def testCallAndRecordIfStale_startsEarly(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      input_paths = []
+      for i in range(3):
+        input_paths.append(os.path.join(tmp_dir, '%d.txt' % i))
+        with open(input_paths[-1], 'w') as f:
+          f.write(str(i))
+      record_path = os.path.join(tmp_dir, 'out.md5.stamp')
+      calls = []
+      md5_check.CallAndRecordIfStale(lambda: calls.append(1),
+                                     record_path=record_path,
+                                     input_paths=input_paths)
+      self.assertEqual(1, len(calls))
+
+      with open(input_paths[0], 'w') as f:
+        f.write('changed')
+      called = threading.Event()
+      orig_compute_tag = md5_check._ComputeTagForPath
+
+      def compute_tag(path, cache):
+        # Inputs after the changed one are not needed to decide staleness.
+        if path == input_paths[-1]:
+          self.assertTrue(called.wait(10))
+        return orig_compute_tag(path, cache)
+
+      md5_check._ComputeTagForPath = compute_tag
+      try:
+        md5_check.CallAndRecordIfStale(called.set,
+                                       record_path=record_path,
+                                       input_paths=input_paths)
+      finally:
+        md5_check._ComputeTagForPath = orig_compute_tag
+      self.assertTrue(called.is_set())
+
+      # The record includes inputs hashed after the call.
+      md5_check.CallAndRecordIfStale(lambda: calls.append(1),
+                                     record_path=record_path,
+                                     input_paths=input_paths)
+      self.assertEqual(1, len(calls))
+
+  def testMetadataRoundTrip(self):
+    metadata = md5_check._Metadata(track_entries=True)
+    metadata.AddStrings(['a', 'b', 'a', ''])
+    metadata.AddFile('foo.txt', 'd41d8cd98f00b204e9800998ecf8427e')
+    metadata.AddFile('big.bin', 1234.5)
+    metadata.AddFile('other', 'not-an-md5')
+    metadata.AddZipFile('foo.jar', [('org/Foo.class', 2**32 + 8),
+                                    ('org/Bar.class', 5), ('top', 6)])
+    fileobj = io.BytesIO()
+    metadata.ToFile(fileobj)
+
+    fileobj.seek(0)
+    loaded = md5_check._Metadata.FromFile(fileobj)
+    self.assertEqual(metadata.FilesMd5(), loaded.FilesMd5())
+    self.assertEqual(metadata.StringsMd5(), loaded.StringsMd5())
+    # Body is decoded only when needed, and top-level tags do not need it.
+    for path in ('foo.txt', 'big.bin', 'other', 'foo.jar'):
+      self.assertEqual(metadata.GetTag(path), loaded.GetFileTag(path))
+    self.assertIsNone(loaded.GetFileTag('missing'))
+    self.assertIsNotNone(loaded._body)
+    self.assertEqual(metadata.GetStrings(), loaded.GetStrings())
+    self.assertIsNone(loaded._body)
+    for path in ('foo.txt', 'big.bin', 'other', 'foo.jar'):
+      self.assertEqual(metadata.GetTag(path), loaded.GetTag(path))
+    self.assertEqual(list(metadata.IterSubpaths('foo.jar')),
+                     list(loaded.IterSubpaths('foo.jar')))
+    self.assertEqual(2**32 + 8, loaded.GetTag('foo.jar', 'org/Foo.class'))
+
+  def testMetadataReadsJson(self):
+    obj = {
+        'files-md5': 'a' * 32,
+        'strings-md5': 'b' * 32,
+        'input-files': [{
+            'path': 'foo.jar',
+            'tag': 'c' * 32,
+            'entries': [{
+                'path': 'Foo.class',
+                'tag': 5
+            }]
+        }],
+        'input-strings': ['x'],
+    }
+    fileobj = io.BytesIO(json.dumps(obj, indent=2).encode('utf-8'))
+    loaded = md5_check._Metadata.FromFile(fileobj)
+    self.assertEqual('a' * 32, loaded.FilesMd5())
+    self.assertEqual(['x'], loaded.GetStrings())
+    self.assertEqual(5, loaded.GetTag('foo.jar', 'Foo.class'))
+
+  def testDigestCache(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      cache_dir = os.path.join(tmp_dir, 'cache')
+      os.mkdir(cache_dir)
+      cache = md5_check._DigestCache(cache_dir, max_bytes=0)
+      txt_path = os.path.join(tmp_dir, 'a.txt')
+      zip_path = os.path.join(tmp_dir, 'a.zip')
+      with open(txt_path, 'w') as f:
+        f.write('aaaa')
+      _WriteZipFile(zip_path, [('path/1.txt', '1')])
+      # Recently modified files are not cached.
+      tag = md5_check._ComputeTagForPath(txt_path, cache)
+      self.assertEqual([], os.listdir(cache_dir))
+      for path in (txt_path, zip_path):
+        os.utime(path, (1, 1))
+
+      tag = md5_check._ComputeTagForPath(txt_path, cache)
+      entries = md5_check._ExtractZipEntries(zip_path, cache)
+
+      # Rewrite with the same size and mtime. The cached values are expected
+      # since the file looks unchanged.
+      with open(txt_path, 'w') as f:
+        f.write('bbbb')
+      os.utime(txt_path, (1, 1))
+      self.assertEqual(tag, md5_check._ComputeTagForPath(txt_path, cache))
+      self.assertEqual(entries, md5_check._ExtractZipEntries(zip_path, cache))
+
+      # Any change to the mtime invalidates the entry.
+      os.utime(txt_path, (2, 2))
+      self.assertNotEqual(tag, md5_check._ComputeTagForPath(txt_path, cache))
+
+      # Large files are hashed (in several chunks) rather than falling back
+      # to mtime.
+      data = os.urandom(md5_check._HASH_CHUNK_SIZE * 2 + 1)
+      with open(txt_path, 'wb') as f:
+        f.write(data)
+      self.assertEqual(hashlib.md5(data).hexdigest(),
+                       md5_check._ComputeTagForPath(txt_path, cache))
+
+      cache.MaybeTrim()
+      remaining = [n for _, _, names in os.walk(cache_dir) for n in names]
+      self.assertEqual(['last-trim.stamp'], remaining)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -4,14 +4,23 @@
 """Helpers related to multiprocessing.
 
 Based on: //tools/binary_size/libsupersize/parallel.py
+
+Scripts run by ninja share the machine with other build actions. When a GNU
+make jobserver is advertised via MAKEFLAGS, process pools take a token from it
+for every process beyond the first. Otherwise, pools leave room for the
+current load average.
 """
 
 import atexit
+import fcntl
 import logging
 import multiprocessing
 import os
+import re
+import stat
 import sys
 import threading
+import time
 import traceback
 
 DISABLE_ASYNC = os.environ.get('DISABLE_ASYNC') == '1'
@@ -26,6 +35,97 @@ _silence_exceptions = False
 _fork_params = None
 _fork_kwargs = None
 
+# Map of pool -> (pool size, _Jobserver or None, tokens held for the pool).
+_pool_reservations = {}
+
+# E.g.: --jobserver-auth=3,4 or --jobserver-auth=fifo:/tmp/GMfifo123
+# --jobserver-fds is the name used before GNU make 4.2.
+_JOBSERVER_ARG_RE = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+
+
+class _Jobserver:
+  """A client of a GNU make jobserver.
+
+  Args:
+    read_fd: A non-blocking fd to read tokens from.
+    write_fd: An fd to return tokens to.
+    owned_fds: The fds that were opened for this client.
+  """
+
+  def __init__(self, read_fd, write_fd, owned_fds):
+    self._read_fd = read_fd
+    self._write_fd = write_fd
+    self._owned_fds = owned_fds
+
+  @staticmethod
+  def _CheckFd(fd, access_modes):
+    """Raises ValueError unless |fd| is a FIFO opened with |access_modes|.
+
+    Fds named in MAKEFLAGS may have been reused for unrelated files, e.g. when
+    a parent process did not pass the jobserver down but kept MAKEFLAGS.
+    """
+    if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+      raise ValueError('fd {} is not a FIFO'.format(fd))
+    if fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_ACCMODE not in access_modes:
+      raise ValueError('fd {} has the wrong access mode'.format(fd))
+
+  @staticmethod
+  def FromEnvironment():
+    """Returns a _Jobserver for the one in MAKEFLAGS, or None."""
+    matches = _JOBSERVER_ARG_RE.findall(os.environ.get('MAKEFLAGS', ''))
+    if not matches:
+      return None
+    # The last one wins when there are several.
+    auth = matches[-1]
+    owned_fds = []
+    try:
+      if auth.startswith('fifo:'):
+        path = auth[len('fifo:'):]
+        owned_fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+        # Checked before opening it for writing.
+        _Jobserver._CheckFd(owned_fds[0], (os.O_RDONLY, ))
+        owned_fds.append(os.open(path, os.O_WRONLY))
+        return _Jobserver(owned_fds[0], owned_fds[1], owned_fds)
+      read_fd, write_fd = (int(x) for x in auth.split(','))
+      _Jobserver._CheckFd(read_fd, (os.O_RDONLY, os.O_RDWR))
+      _Jobserver._CheckFd(write_fd, (os.O_WRONLY, os.O_RDWR))
+      # Make the read end non-blocking without affecting other processes, which
+      # share the inherited open file description.
+      owned_fds.append(
+          os.open('/proc/self/fd/{}'.format(read_fd),
+                  os.O_RDONLY | os.O_NONBLOCK))
+      return _Jobserver(owned_fds[0], write_fd, owned_fds)
+    except (OSError, ValueError):
+      # E.g. when the fds were not passed down to this process. Process pools
+      # then fall back to leaving room for the load average.
+      logging.debug('Ignoring unusable jobserver: %s', auth)
+      for fd in owned_fds:
+        os.close(fd)
+      return None
+
+  def TryAcquire(self, max_tokens):
+    """Returns up to |max_tokens| tokens that are available right away."""
+    tokens = b''
+    while len(tokens) < max_tokens:
+      try:
+        data = os.read(self._read_fd, max_tokens - len(tokens))
+      except BlockingIOError:
+        break
+      if not data:
+        break
+      tokens += data
+    return tokens
+
+  def Release(self, tokens):
+    """Returns |tokens| to the jobserver, and closes the fds of this client."""
+    try:
+      if tokens:
+        os.write(self._write_fd, tokens)
+    finally:
+      for fd in self._owned_fds:
+        os.close(fd)
+      self._owned_fds = []
+
 
 class _ImmediateResult:
   def __init__(self, value):
@@ -60,12 +160,20 @@ class _ExceptionWrapper:
 class _FuncWrapper:
   """Runs on the fork()'ed side to catch exceptions and spread *args."""
 
-  def __init__(self, func):
+  def __init__(self, func, timed=False):
     global _is_child_process
     _is_child_process = True
     self._func = func
+    self._timed = timed
 
   def __call__(self, index, _=None):
+    if not self._timed:
+      return self._Call(index)
+    start = time.time()
+    result = self._Call(index)
+    return time.time() - start, result
+
+  def _Call(self, index):
     global _fork_kwargs
     try:
       if _fork_kwargs is None:  # Clarifies _fork_kwargs is map for pylint.
@@ -104,7 +212,7 @@ class _WrappedResult:
   def wait(self):
     self._result.wait()
     if self._pool:
-      _all_pools.remove(self._pool)
+      _RemovePool(self._pool)
       self._pool = None
 
   def ready(self):
@@ -133,6 +241,10 @@ def _TerminatePools():
     except:  # pylint: disable=bare-except
       pass
 
+  # Tokens must be returned for the rest of the build to keep its parallelism.
+  for pool in list(_pool_reservations):
+    _ReleaseTokens(pool)
+
   for i, pool in enumerate(_all_pools):
     # Without calling terminate() on a separate thread, the call can block
     # forever.
@@ -153,22 +265,67 @@ def _CheckForException(value):
     sys.exit(1)
 
 
+def _GetLoadAverage():
+  try:
+    return os.getloadavg()[0]
+  except (AttributeError, OSError):  # Not available on Windows.
+    return 0
+
+
+def _ReserveProcesses(num_jobs):
+  """Returns the pool size to use for |num_jobs| jobs.
+
+  Returns:
+    A tuple of (pool_size, jobserver, tokens), where |tokens| were acquired
+    from |jobserver| (if any) and must be released once the pool is done.
+  """
+  cpu_count = multiprocessing.cpu_count()
+  max_size = min(num_jobs, cpu_count)
+  jobserver = _Jobserver.FromEnvironment()
+  if jobserver:
+    # This process holds an implicit token, which the first process uses.
+    tokens = jobserver.TryAcquire(max_size - 1)
+    return 1 + len(tokens), jobserver, tokens
+  # Leave room for the processes that are already running, e.g. other ninja
+  # actions. The load average includes this process.
+  available = cpu_count - int(_GetLoadAverage()) + 1
+  return max(1, min(max_size, available)), None, b''
+
+
+def _ReleaseTokens(pool):
+  _, jobserver, tokens = _pool_reservations.pop(pool)
+  if jobserver:
+    jobserver.Release(tokens)
+
+
+def _RemovePool(pool):
+  _all_pools.remove(pool)
+  _ReleaseTokens(pool)
+
+
 def _MakeProcessPool(job_params, **job_kwargs):
   global _all_pools
   global _fork_params
   global _fork_kwargs
   assert _fork_params is None
   assert _fork_kwargs is None
-  pool_size = min(len(job_params), multiprocessing.cpu_count())
+  reservation = _ReserveProcesses(len(job_params))
+  pool_size, jobserver, tokens = reservation
   _fork_params = job_params
   _fork_kwargs = job_kwargs
-  ret = multiprocessing.Pool(pool_size)
-  _fork_params = None
-  _fork_kwargs = None
+  ret = None
+  try:
+    ret = multiprocessing.Pool(pool_size)
+  finally:
+    _fork_params = None
+    _fork_kwargs = None
+    if ret is None and jobserver:
+      jobserver.Release(tokens)
   if _all_pools is None:
     _all_pools = []
     atexit.register(_TerminatePools)
   _all_pools.append(ret)
+  _pool_reservations[ret] = reservation
   return ret
 
 
@@ -206,12 +363,27 @@ def BulkForkAndCall(func, arg_tuples, **kwargs):
     return
 
   pool = _MakeProcessPool(arg_tuples, **kwargs)
-  wrapped_func = _FuncWrapper(func)
+  pool_size, _, tokens = _pool_reservations[pool]
+  wrapped_func = _FuncWrapper(func, timed=True)
+  # Send jobs in chunks to reduce IPC overhead, while keeping enough chunks
+  # to balance uneven jobs across processes.
+  chunksize = max(1, len(arg_tuples) // (pool_size * 4))
+  start = time.time()
+  busy_time = 0
   try:
-    for result in pool.imap(wrapped_func, range(len(arg_tuples))):
+    for job_time, result in pool.imap(wrapped_func,
+                                      range(len(arg_tuples)),
+                                      chunksize=chunksize):
       _CheckForException(result)
+      busy_time += job_time
       yield result
   finally:
     pool.close()
     pool.join()
-    _all_pools.remove(pool)
+    _RemovePool(pool)
+  elapsed = time.time() - start
+  logging.debug(
+      'Ran %d jobs of %s in %.2fs on %d processes (chunksize=%d, '
+      'jobserver tokens=%d, utilization=%d%%)', len(arg_tuples),
+      getattr(func, '__name__', func), elapsed, pool_size, chunksize, len(tokens),
+      100 * busy_time / max(elapsed * pool_size, 1e-9))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from util import parallel
+
+
+def _GetPid(value, offset=0):
+  # Give other processes a chance to pick up jobs.
+  time.sleep(0.01)
+  return value + offset, os.getpid()
+
+
+class ParallelTest(unittest.TestCase):
+  def setUp(self):
+    # Tests must not take part in the jobserver of whatever is running them.
+    patcher = mock.patch.dict(os.environ, {'MAKEFLAGS': ''})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _ReadTokens(self, read_fd):
+    os.set_blocking(read_fd, False)
+    try:
+      return os.read(read_fd, 100)
+    except BlockingIOError:
+      return b''
+
+  def testBulkForkAndCall(self):
+    results = list(
+        parallel.BulkForkAndCall(_GetPid, [(i, ) for i in range(20)],
+                                 offset=100))
+    self.assertEqual(list(range(100, 120)), [v for v, _ in results])
+
+  def testBulkForkAndCall_loadAverage(self):
+    with mock.patch.object(parallel.multiprocessing,
+                           'cpu_count',
+                           return_value=8), \
+        mock.patch.object(parallel, '_GetLoadAverage', return_value=7.5):
+      results = list(
+          parallel.BulkForkAndCall(_GetPid, [(i, ) for i in range(8)]))
+    # Only one CPU is left, besides the one this process is on.
+    self.assertLessEqual(len({pid for _, pid in results}), 2)
+
+  def testBulkForkAndCall_jobserverFds(self):
+    read_fd, write_fd = os.pipe()
+    self.addCleanup(os.close, read_fd)
+    self.addCleanup(os.close, write_fd)
+    os.write(write_fd, b'++')
+    os.environ['MAKEFLAGS'] = ' -j4 --jobserver-auth={},{}'.format(
+        read_fd, write_fd)
+    with mock.patch.object(parallel.multiprocessing,
+                           'cpu_count',
+                           return_value=8):
+      results = list(
+          parallel.BulkForkAndCall(_GetPid, [(i, ) for i in range(8)]))
+    self.assertEqual(list(range(8)), [v for v, _ in results])
+    # One process for the implicit token, plus one per token.
+    self.assertLessEqual(len({pid for _, pid in results}), 3)
+    # All tokens are returned.
+    self.assertEqual(b'++', self._ReadTokens(read_fd))
+
+  def testBulkForkAndCall_jobserverFifo(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      fifo_path = os.path.join(tmp_dir, 'fifo')
+      os.mkfifo(fifo_path)
+      read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+      self.addCleanup(os.close, read_fd)
+      write_fd = os.open(fifo_path, os.O_WRONLY)
+      self.addCleanup(os.close, write_fd)
+      os.write(write_fd, b'+')
+      os.environ['MAKEFLAGS'] = '--jobserver-auth=fifo:' + fifo_path
+      results = list(
+          parallel.BulkForkAndCall(_GetPid, [(i, ) for i in range(8)]))
+      self.assertEqual(list(range(8)), [v for v, _ in results])
+      self.assertLessEqual(len({pid for _, pid in results}), 2)
+      self.assertEqual(b'+', self._ReadTokens(read_fd))
+
+  def testBulkForkAndCall_unusableJobserver(self):
+    # E.g. when make did not pass the fds down to this process.
+    os.environ['MAKEFLAGS'] = '--jobserver-auth=1000,1001'
+    results = list(parallel.BulkForkAndCall(_GetPid, [(1, ), (2, )]))
+    self.assertEqual([1, 2], [v for v, _ in results])
+
+  def testBulkForkAndCall_jobserverFdsNotPipes(self):
+    # The fds may refer to unrelated files, which must not be read or written.
+    with tempfile.TemporaryFile() as f:
+      os.environ['MAKEFLAGS'] = '--jobserver-auth={0},{0}'.format(f.fileno())
+      self.assertIsNone(parallel._Jobserver.FromEnvironment())
+      with mock.patch.object(parallel, '_GetLoadAverage',
+                             return_value=0) as load_average_mock:
+        results = list(parallel.BulkForkAndCall(_GetPid, [(1, ), (2, )]))
+      self.assertEqual([1, 2], [v for v, _ in results])
+      load_average_mock.assert_called()
+      self.assertEqual(0, os.fstat(f.fileno()).st_size)
+
+  def testBulkForkAndCall_jobserverFdsSwapped(self):
+    read_fd, write_fd = os.pipe()
+    self.addCleanup(os.close, read_fd)
+    self.addCleanup(os.close, write_fd)
+    os.environ['MAKEFLAGS'] = '--jobserver-auth={},{}'.format(write_fd, read_fd)
+    self.assertIsNone(parallel._Jobserver.FromEnvironment())
+
+  def testBulkForkAndCall_jobserverFifoNotFifo(self):
+    with tempfile.NamedTemporaryFile() as f:
+      os.environ['MAKEFLAGS'] = '--jobserver-auth=fifo:' + f.name
+      self.assertIsNone(parallel._Jobserver.FromEnvironment())
+      self.assertEqual(0, os.fstat(f.fileno()).st_size)
+
+  def testForkAndCall(self):
+    self.assertEqual(3, parallel.ForkAndCall(_GetPid, (3, )).get()[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
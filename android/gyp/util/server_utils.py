@@ -13,6 +13,12 @@ import socket
 SOCKET_ADDRESS = '\0chromium_build_server_socket'
 BUILD_SERVER_ENV_VARIABLE = 'INVOKED_BY_BUILD_SERVER'
 
+# Values for the 'message_type' key of messages sent to the build server.
+# Messages without one are treated as ADD_TASK.
+ADD_TASK = 'add_task'
+QUERY_STATS = 'query_stats'
+STREAM_EVENTS = 'stream_events'
+
 
 def MaybeRunCommand(name, argv, stamp_file, force):
   """Returns True if the command was successfully sent to the build server."""
@@ -28,6 +34,7 @@ def MaybeRunCommand(name, argv, stamp_file, force):
       sock.connect(SOCKET_ADDRESS)
       sock.sendall(
           json.dumps({
+              'message_type': ADD_TASK,
               'name': name,
               'cmd': argv,
               'cwd': os.getcwd(),
@@ -51,3 +58,22 @@ def MaybeRunCommand(name, argv, stamp_file, force):
   # will delete the stamp file so that it will be run again next build.
   pathlib.Path(stamp_file).touch()
   return True
+
+
+def StreamEvents():
+  """Yields task lifecycle events from the build server as they happen.
+
+  Each event is a dict with 'event' set to 'queued', 'started' or 'finished'.
+  Events describing tasks already in progress come first, followed by a
+  'synced' event. 'finished' events include 'status' ('success', 'failed',
+  'terminated' or 'replaced'), 'exit_code' and 'duration' in seconds.
+
+  Raises socket.error if the build server is not running.
+  """
+  with contextlib.closing(socket.socket(socket.AF_UNIX)) as sock:
+    sock.connect(SOCKET_ADDRESS)
+    sock.sendall(json.dumps({'message_type': STREAM_EVENTS}).encode('utf8'))
+    sock.shutdown(socket.SHUT_WR)
+    with sock.makefile('rb') as f:
+      for line in f:
+        yield json.loads(line)
@@ -28,9 +28,7 @@ def _FindIllegalStaticLibraryReferences(static_lib_dex_files,
 
   static_lib_referenced_types = set()
   for dex_file in static_lib_dex_files:
-    for type_item in dex_file.type_item_list:
-      static_lib_referenced_types.add(
-          dex_file.GetString(type_item.descriptor_idx))
+    static_lib_referenced_types.update(dex_file.IterTypeStrings())
 
   return main_apk_defined_types.intersection(static_lib_referenced_types)
 
@@ -39,12 +37,11 @@ def _DexFilesFromPath(path):
   if zipfile.is_zipfile(path):
     with zipfile.ZipFile(path) as z:
       return [
-          dex_parser.DexFile(bytearray(z.read(name))) for name in z.namelist()
+          dex_parser.DexFile(z.read(name)) for name in z.namelist()
           if re.match(r'.*classes[0-9]*\.dex$', name)
       ]
   else:
-    with open(path) as f:
-      return dex_parser.DexFile(bytearray(f.read()))
+    return [dex_parser.DexFile.FromPath(path)]
 
 
 def main(args):
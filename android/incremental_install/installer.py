@@ -8,6 +8,7 @@
 
 import argparse
 import collections
+import concurrent.futures
 import functools
 import glob
 import hashlib
@@ -22,6 +23,7 @@ sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
 import devil_chromium
 from devil.android import apk_helper
+from devil.android import device_errors
 from devil.android import device_utils
 from devil.utils import reraiser_thread
 from devil.utils import run_tests_helper
@@ -38,6 +40,10 @@ sys.path = prev_sys_path
 _R8_PATH = os.path.join(build_utils.DIR_SOURCE_ROOT, 'third_party', 'r8',
                         'cipd', 'lib', 'r8.jar')
 _SHARD_JSON_FILENAME = 'shards.json'
+# Bump whenever the format of shards.json changes.
+_SHARD_JSON_VERSION = 2
+# Lists the digests of the dex shards on the device, as of the last push.
+_DEVICE_MANIFEST_FILENAME = 'dex-manifest.json'
 
 
 def _DeviceCachePath(device):
@@ -62,18 +68,42 @@ def _GetDeviceIncrementalDir(package):
   return '/data/local/tmp/incremental-app-%s' % package
 
 
-def _IsStale(src_paths, old_src_paths, dest_path):
-  """Returns if |dest| is older than any of |src_paths|, or missing."""
+def _ComputeDigest(path):
+  md5 = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(2**20), b''):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+def _ComputeFileDigests(paths, prev_file_digests):
+  """Returns a dict of path -> [mtime_ns, size, md5] for |paths|.
+
+  Digests in |prev_file_digests| are reused for files whose mtime and size
+  have not changed, so that only new and modified files are read.
+  """
+  ret = {}
+  for path in paths:
+    stat = os.stat(path)
+    entry = prev_file_digests.get(path)
+    if not entry or entry[:2] != [stat.st_mtime_ns, stat.st_size]:
+      entry = [stat.st_mtime_ns, stat.st_size, _ComputeDigest(path)]
+    ret[path] = entry
+  return ret
+
+
+def _IsStale(src_digests, old_src_digests, dest_path):
+  """Returns if the contents of any source changed since |dest| was created.
+
+  Args:
+    src_digests: Dict of source path -> digest of its contents.
+    old_src_digests: |src_digests| as of when |dest_path| was created.
+    dest_path: The file created from the sources.
+  """
   if not os.path.exists(dest_path):
     return True
-  # Always mark as stale if any paths were added or removed.
-  if set(src_paths) != set(old_src_paths):
-    return True
-  dest_time = os.path.getmtime(dest_path)
-  for path in src_paths:
-    if os.path.getmtime(path) > dest_time:
-      return True
-  return False
+  # Also stale if any paths were added or removed.
+  return src_digests != old_src_digests
 
 
 def _LoadPrevShards(dex_staging_dir):
@@ -81,7 +111,11 @@ def _LoadPrevShards(dex_staging_dir):
   if not os.path.exists(shards_json_path):
     return {}
   with open(shards_json_path) as f:
-    return json.load(f)
+    data = json.load(f)
+  # Files written in an older format are treated as missing.
+  if not isinstance(data, dict) or data.get('version') != _SHARD_JSON_VERSION:
+    return {}
+  return data
 
 
 def _SaveNewShards(shards, dex_staging_dir):
@@ -123,27 +157,117 @@ def _AllocateDexShards(dex_files):
 
 def _CreateDexFiles(shards, prev_shards, dex_staging_dir, min_api,
                     use_concurrency):
-  """Creates dex files within |dex_staging_dir| defined by |shards|."""
+  """Creates dex files within |dex_staging_dir| defined by |shards|.
+
+  Only shards whose sources changed in contents are merged again.
+
+  Args:
+    shards: Dict of shard name -> list of dex files to merge into it.
+    prev_shards: The result of _LoadPrevShards().
+    dex_staging_dir: Directory to create the dex files in.
+    min_api: The minSdkVersion of the apk.
+    use_concurrency: Whether to merge shards in parallel.
+
+  Returns:
+    The new state of |dex_staging_dir|, to be passed to _SaveNewShards().
+  """
+  prev_shard_infos = prev_shards.get('shards', {})
+  file_digests = _ComputeFileDigests(
+      [p for src_paths in shards.values() for p in src_paths],
+      prev_shards.get('files', {}))
+
+  shard_infos = {}
   tasks = []
   for name, src_paths in shards.items():
     dest_path = os.path.join(dex_staging_dir, name)
-    if _IsStale(src_paths=src_paths,
-                old_src_paths=prev_shards.get(name, []),
+    src_digests = {p: file_digests[p][2] for p in src_paths}
+    prev_shard_info = prev_shard_infos.get(name, {})
+    shard_infos[name] = {
+        'srcs': src_digests,
+        'digest': prev_shard_info.get('digest'),
+    }
+    if _IsStale(src_digests=src_digests,
+                old_src_digests=prev_shard_info.get('srcs'),
                 dest_path=dest_path):
+      shard_infos[name]['digest'] = None
       tasks.append(
           functools.partial(dex.MergeDexForIncrementalInstall, _R8_PATH,
                             src_paths, dest_path, min_api))
+  logging.info('Merging %d of %d dex shards', len(tasks), len(shards))
 
   # TODO(agrieve): It would be more performant to write a custom d8.jar
   #     wrapper in java that would process these in bulk, rather than spinning
   #     up a new process for each one.
-  _Execute(use_concurrency, *tasks)
+  if use_concurrency and len(tasks) > 1:
+    # Each merge runs its own JVM, so cap them at one per CPU.
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+      for future in [executor.submit(t) for t in tasks]:
+        future.result()
+  else:
+    _Execute(False, *tasks)
+
+  for name, shard_info in shard_infos.items():
+    if shard_info['digest'] is None:
+      shard_info['digest'] = _ComputeDigest(os.path.join(dex_staging_dir, name))
 
   # Remove any stale shards.
   for name in os.listdir(dex_staging_dir):
     if name not in shards:
       os.unlink(os.path.join(dex_staging_dir, name))
 
+  return {
+      'version': _SHARD_JSON_VERSION,
+      'shards': shard_infos,
+      'files': file_digests,
+  }
+
+
+def _ReadDeviceManifest(device, manifest_path, device_dex_dir):
+  """Returns the shard name -> digest dict last pushed to the device, or None.
+
+  Returns None when the manifest is missing, or does not match the files in
+  |device_dex_dir| (e.g. when they were modified by something else).
+  """
+  try:
+    manifest = json.loads(device.ReadFile(manifest_path))
+    device_files = device.ListDirectory(device_dex_dir)
+  except (device_errors.CommandFailedError, ValueError):
+    return None
+  # Full syncs push the staging dir as a whole, including its shards.json.
+  device_files = set(device_files) - {_SHARD_JSON_FILENAME}
+  if not isinstance(manifest, dict) or set(manifest) != device_files:
+    return None
+  return manifest
+
+
+def _PushDexFiles(device, shard_infos, dex_staging_dir, device_dex_dir,
+                  manifest_path):
+  """Pushes the dex shards whose digests differ from those on the device."""
+  digests = {name: info['digest'] for name, info in shard_infos.items()}
+  device_digests = _ReadDeviceManifest(device, manifest_path, device_dex_dir)
+  if device_digests is None:
+    logging.info('No usable dex manifest on device. Syncing all dex files.')
+    device.PushChangedFiles([(dex_staging_dir, device_dex_dir)],
+                            delete_device_stale=True)
+  else:
+    changed = sorted(n for n, d in digests.items()
+                     if device_digests.get(n) != d)
+    removed = sorted(set(device_digests) - set(digests))
+    logging.info('Pushing %d of %d dex shards, removing %d', len(changed),
+                 len(digests), len(removed))
+    if changed:
+      device.PushChangedFiles([(os.path.join(dex_staging_dir, n),
+                                posixpath.join(device_dex_dir, n))
+                               for n in changed])
+    if removed:
+      device.RemovePath([posixpath.join(device_dex_dir, n) for n in removed],
+                        force=True)
+    if not changed and not removed:
+      return
+  # Written last, so that an interrupted push leaves a manifest that still
+  # marks the shards that failed to push as changed.
+  device.WriteFile(manifest_path, json.dumps(digests))
+
 
 def Uninstall(device, package, enable_device_cache=False):
   """Uninstalls and removes all incremental files for the given package."""
@@ -200,6 +324,9 @@ def Install(device, install_json, apk=None, enable_device_cache=False,
                                  'incremental-install',
                                  install_dict['apk_path'])
   device_dex_dir = posixpath.join(device_incremental_dir, 'dex')
+  # Kept outside of |device_dex_dir|, since the app copies every file in it.
+  device_manifest_path = posixpath.join(device_incremental_dir,
+                                        _DEVICE_MANIFEST_FILENAME)
 
   # Install .apk(s) if any of them have changed.
   def do_install():
@@ -241,17 +368,18 @@ def Install(device, install_json, apk=None, enable_device_cache=False,
       prev_shards = _LoadPrevShards(dex_staging_dir)
       shards = _AllocateDexShards(dex_files)
       build_utils.MakeDirectory(dex_staging_dir)
-      _CreateDexFiles(shards, prev_shards, dex_staging_dir,
-                      apk.GetMinSdkVersion(), use_concurrency)
+      new_shards = _CreateDexFiles(shards, prev_shards, dex_staging_dir,
+                                   apk.GetMinSdkVersion(), use_concurrency)
       # New shard information must be saved after _CreateDexFiles since
       # _CreateDexFiles removes all non-dex files from the staging dir.
-      _SaveNewShards(shards, dex_staging_dir)
+      _SaveNewShards(new_shards, dex_staging_dir)
       merge_dex_timer.Stop(log=False)
 
     def do_push_dex():
       push_dex_timer.Start()
-      device.PushChangedFiles([(dex_staging_dir, device_dex_dir)],
-                              delete_device_stale=True)
+      shard_infos = _LoadPrevShards(dex_staging_dir).get('shards', {})
+      _PushDexFiles(device, shard_infos, dex_staging_dir, device_dex_dir,
+                    device_manifest_path)
       push_dex_timer.Stop(log=False)
 
     _Execute(use_concurrency, do_push_native, do_merge_dex)
@@ -0,0 +1,168 @@
+#!/usr/bin/env vpython3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import installer
+from devil.android import device_errors
+
+# pylint: disable=protected-access
+
+_DEVICE_DEX_DIR = '/data/local/tmp/incremental-app-org.chromium.foo/dex'
+_DEVICE_MANIFEST_PATH = posixpath.join(posixpath.dirname(_DEVICE_DEX_DIR),
+                                       installer._DEVICE_MANIFEST_FILENAME)
+
+
+class _FakeDevice:
+  """Stores the contents of files pushed to it in a dict."""
+
+  def __init__(self):
+    self.files = {}
+    self.pushed_paths = []
+
+  def ReadFile(self, device_path):
+    if device_path not in self.files:
+      raise device_errors.CommandFailedError('No such file: ' + device_path)
+    return self.files[device_path]
+
+  def WriteFile(self, device_path, contents):
+    self.files[device_path] = contents
+
+  def ListDirectory(self, device_dir):
+    prefix = device_dir + '/'
+    return [p[len(prefix):] for p in self.files if p.startswith(prefix)]
+
+  def PushChangedFiles(self, host_device_tuples, delete_device_stale=False):
+    for host_path, device_path in host_device_tuples:
+      if os.path.isdir(host_path):
+        if delete_device_stale:
+          for name in self.ListDirectory(device_path):
+            del self.files[posixpath.join(device_path, name)]
+        for name in os.listdir(host_path):
+          self._Push(os.path.join(host_path, name),
+                     posixpath.join(device_path, name))
+      else:
+        self._Push(host_path, device_path)
+
+  def _Push(self, host_path, device_path):
+    with open(host_path) as f:
+      self.files[device_path] = f.read()
+    self.pushed_paths.append(device_path)
+
+  def RemovePath(self, device_paths, force=False):
+    del force
+    for device_path in device_paths:
+      del self.files[device_path]
+
+
+def _FakeMergeDex(_r8_path, src_paths, dest_path, _min_api):
+  with open(dest_path, 'w') as dest:
+    for src_path in src_paths:
+      with open(src_path) as f:
+        dest.write(f.read())
+
+
+class InstallerTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp_dir = tempfile.mkdtemp()
+    self._staging_dir = os.path.join(self._tmp_dir, 'staging')
+    os.mkdir(self._staging_dir)
+    self._device = _FakeDevice()
+    self._shards = {}
+    for shard_name, dex_name in (('shard0.dex.jar', 'a.dex'),
+                                 ('shard1.dex.jar', 'b.dex')):
+      dex_path = os.path.join(self._tmp_dir, dex_name)
+      self._WriteDex(dex_path, dex_name)
+      self._shards[shard_name] = [dex_path]
+    self._Install()
+
+  def tearDown(self):
+    shutil.rmtree(self._tmp_dir)
+
+  def _WriteDex(self, path, contents):
+    with open(path, 'w') as f:
+      f.write(contents)
+    # Ensure that the mtime changes, regardless of timestamp granularity.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+  def _Install(self):
+    """Merges and pushes dex shards as Install() does.
+
+    Returns:
+      A tuple of (the paths of the merged shards, the pushed device paths).
+    """
+    self._device.pushed_paths = []
+    with mock.patch.object(installer.dex,
+                           'MergeDexForIncrementalInstall',
+                           side_effect=_FakeMergeDex) as merge:
+      new_shards = installer._CreateDexFiles(
+          self._shards, installer._LoadPrevShards(self._staging_dir),
+          self._staging_dir, 21, False)
+    installer._SaveNewShards(new_shards, self._staging_dir)
+    shard_infos = installer._LoadPrevShards(self._staging_dir)['shards']
+    installer._PushDexFiles(self._device, shard_infos, self._staging_dir,
+                            _DEVICE_DEX_DIR, _DEVICE_MANIFEST_PATH)
+    merged = sorted(c.args[2] for c in merge.call_args_list)
+    return merged, sorted(self._device.pushed_paths)
+
+  def _AssertDeviceUpToDate(self):
+    for shard_name, (dex_path, ) in self._shards.items():
+      with open(dex_path) as f:
+        self.assertEqual(
+            f.read(),
+            self._device.files[posixpath.join(_DEVICE_DEX_DIR, shard_name)])
+
+  def testInitialInstall(self):
+    self._AssertDeviceUpToDate()
+    manifest = json.loads(self._device.files[_DEVICE_MANIFEST_PATH])
+    self.assertEqual(sorted(self._shards), sorted(manifest))
+
+  def testTouchedWithoutChange(self):
+    dex_path = self._shards['shard0.dex.jar'][0]
+    stat = os.stat(dex_path)
+    os.utime(dex_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    self.assertEqual(([], []), self._Install())
+    self._AssertDeviceUpToDate()
+
+  def testContentChange(self):
+    self._WriteDex(self._shards['shard1.dex.jar'][0], 'b changed')
+
+    self.assertEqual(([os.path.join(self._staging_dir, 'shard1.dex.jar')],
+                      [posixpath.join(_DEVICE_DEX_DIR, 'shard1.dex.jar')]),
+                     self._Install())
+    self._AssertDeviceUpToDate()
+
+  def testMissingDeviceManifest(self):
+    del self._device.files[_DEVICE_MANIFEST_PATH]
+
+    merged, pushed = self._Install()
+    self.assertEqual([], merged)
+    self.assertEqual(
+        sorted(
+            posixpath.join(_DEVICE_DEX_DIR, n)
+            for n in os.listdir(self._staging_dir)), pushed)
+    self._AssertDeviceUpToDate()
+
+  def testMismatchedDeviceManifest(self):
+    # Something other than the installer removed a shard from the device.
+    del self._device.files[posixpath.join(_DEVICE_DEX_DIR, 'shard0.dex.jar')]
+
+    merged, pushed = self._Install()
+    self.assertEqual([], merged)
+    self.assertIn(posixpath.join(_DEVICE_DEX_DIR, 'shard0.dex.jar'), pushed)
+    self.assertIn(posixpath.join(_DEVICE_DEX_DIR, 'shard1.dex.jar'), pushed)
+    self._AssertDeviceUpToDate()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env vpython3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Measures how fast "apk_operations.py logcat" processes recorded logcat.
+
+Record logcat to replay with:
+  adb logcat -v threadtime -d > logcat.txt
+"""
+
+import argparse
+import collections
+import contextlib
+import os
+import sys
+import time
+
+import apk_operations
+
+_Process = collections.namedtuple('_Process', ['name', 'pid'])
+
+
+class _FakeDevice:
+  """Reports |pids| as the processes of |package_name|."""
+
+  def __init__(self, package_name, pids):
+    self._processes = [_Process(package_name, pid) for pid in pids]
+
+  def ListProcesses(self, _process_name):
+    return self._processes
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('logcat_file', help='Logcat in the "threadtime" format.')
+  parser.add_argument('--package-name',
+                      default='org.chromium.chrome',
+                      help='Package to filter logcat for.')
+  parser.add_argument('--pid',
+                      type=int,
+                      action='append',
+                      default=[],
+                      help='PID of a process of the package. Repeatable.')
+  parser.add_argument('--verbose',
+                      action='store_true',
+                      help='Process lines from all processes.')
+  parser.add_argument('--repeat',
+                      type=int,
+                      default=1,
+                      help='Number of times to replay the logcat file.')
+  parser.add_argument('--queue-size',
+                      type=int,
+                      default=apk_operations._LOGCAT_QUEUE_SIZE,
+                      help='Size of the queue of lines read ahead.')
+  parser.add_argument('--drop-when-behind',
+                      action='store_true',
+                      help='Drop lines when the queue is full. Since recorded '
+                      'lines arrive all at once, this shows how a burst of '
+                      'lines would be handled.')
+  parser.add_argument('--output-directory',
+                      help='Symbolize native stacks using this output '
+                      'directory.')
+  parser.add_argument('--apk-path', help='APK to symbolize native stacks for.')
+  args = parser.parse_args()
+
+  with open(args.logcat_file, errors='replace') as f:
+    lines = f.read().splitlines() * args.repeat
+
+  stack_script_context = None
+  if args.output_directory:
+    stack_script_context = apk_operations._StackScriptContext(
+        args.output_directory, args.apk_path, None, quiet=True)
+
+  device = _FakeDevice(args.package_name, args.pid)
+  processor = apk_operations._LogcatProcessor(device,
+                                              args.package_name,
+                                              stack_script_context,
+                                              verbose=args.verbose)
+  pipeline = apk_operations._LogcatPipeline(
+      lines,
+      queue_size=args.queue_size,
+      drop_when_behind=args.drop_when_behind)
+  try:
+    with open(os.devnull, 'w') as devnull, \
+        contextlib.redirect_stdout(devnull):
+      # Process the recorded lines as if they were logged by this run.
+      processor.ProcessLine(processor.nonce)
+      start = time.time()
+      for line in pipeline:
+        processor.ProcessLine(line)
+      processor.Close()
+      elapsed = time.time() - start
+  finally:
+    if stack_script_context:
+      stack_script_context.Close()
+
+  num_processed = len(lines) - pipeline.num_dropped
+  print('Processed {} lines in {:.2f}s ({:.0f} lines/sec), dropped {}.'.format(
+      num_processed, elapsed, num_processed / max(elapsed, 1e-9),
+      pipeline.num_dropped))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
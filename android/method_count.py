@@ -37,13 +37,12 @@ class DexStatsCollector:
       for subpath in z.namelist():
         if not re.match(r'.*classes\d*\.dex$', subpath):
           continue
-        dexfile = dex_parser.DexFile(bytearray(z.read(subpath)))
+        dexfile = dex_parser.DexFile(z.read(subpath))
         self._CollectFromDexfile('{}!{}'.format(label, subpath), dexfile)
 
   def CollectFromDex(self, label, path):
     """Add dex stats from a .dex file."""
-    with open(path, 'rb') as f:
-      dexfile = dex_parser.DexFile(bytearray(f.read()))
+    dexfile = dex_parser.DexFile.FromPath(path)
     self._CollectFromDexfile(label, dexfile)
 
   def MergeFrom(self, parent_label, other):
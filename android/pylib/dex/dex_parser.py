@@ -12,6 +12,8 @@ is provided, but it does not include error handling or validation.
 import argparse
 import collections
 import errno
+import functools
+import mmap
 import os
 import re
 import struct
@@ -48,10 +50,15 @@ _DEX_HEADER_FMT = (
 DexHeader = collections.namedtuple('DexHeader',
                                    ','.join(t[0] for t in _DEX_HEADER_FMT))
 
+# Maximum number of decoded strings to keep per DexFile.
+_STRING_CACHE_SIZE = 1 << 16
+
 # Simple memory items.
 _TypeIdItem = collections.namedtuple('TypeIdItem', 'descriptor_idx')
 _ProtoIdItem = collections.namedtuple(
     'ProtoIdItem', 'shorty_idx,return_type_idx,parameters_off')
+_FieldIdItem = collections.namedtuple('FieldIdItem',
+                                      'class_idx,type_idx,name_idx')
 _MethodIdItem = collections.namedtuple('MethodIdItem',
                                        'type_idx,proto_idx,name_idx')
 _TypeItem = collections.namedtuple('TypeItem', 'type_idx')
@@ -61,6 +68,51 @@ _ClassDefItem = collections.namedtuple(
     'class_idx,access_flags,superclass_idx,interfaces_off,source_file_idx,'
     'annotations_off,class_data_off,static_values_off')
 
+# Items referenced by offset from class_def_items.
+# https://source.android.com/devices/tech/dalvik/dex-format#class-data-item
+_EncodedField = collections.namedtuple('EncodedField', 'field_idx,access_flags')
+_EncodedMethod = collections.namedtuple('EncodedMethod',
+                                        'method_idx,access_flags,code_off')
+ClassDataItem = collections.namedtuple(
+    'ClassDataItem',
+    'static_fields,instance_fields,direct_methods,virtual_methods')
+# https://source.android.com/devices/tech/dalvik/dex-format#referencing-items
+# Maps of field / method indices to lists of Annotations. Parameter annotations
+# are not decoded.
+AnnotationsDirectoryItem = collections.namedtuple(
+    'AnnotationsDirectoryItem',
+    'class_annotations,field_annotations,method_annotations')
+# |type| is the annotation's type descriptor and |elements| maps element names
+# to decoded values. |visibility| is None for nested annotations.
+Annotation = collections.namedtuple('Annotation', 'visibility,type,elements')
+# Decoded VALUE_TYPE encoded_values, to tell them apart from VALUE_STRING.
+EncodedType = collections.namedtuple('EncodedType', 'descriptor')
+
+# https://source.android.com/devices/tech/dalvik/dex-format#visibility
+VISIBILITY_BUILD = 0x00
+VISIBILITY_RUNTIME = 0x01
+VISIBILITY_SYSTEM = 0x02
+
+# https://source.android.com/devices/tech/dalvik/dex-format#value-formats
+_VALUE_BYTE = 0x00
+_VALUE_SHORT = 0x02
+_VALUE_CHAR = 0x03
+_VALUE_INT = 0x04
+_VALUE_LONG = 0x06
+_VALUE_FLOAT = 0x10
+_VALUE_DOUBLE = 0x11
+_VALUE_METHOD_TYPE = 0x15
+_VALUE_METHOD_HANDLE = 0x16
+_VALUE_STRING = 0x17
+_VALUE_TYPE = 0x18
+_VALUE_FIELD = 0x19
+_VALUE_METHOD = 0x1a
+_VALUE_ENUM = 0x1b
+_VALUE_ARRAY = 0x1c
+_VALUE_ANNOTATION = 0x1d
+_VALUE_NULL = 0x1e
+_VALUE_BOOLEAN = 0x1f
+
 
 class _MemoryItemList:
   """Base class for repeated memory items."""
@@ -112,36 +164,112 @@ class _MemoryItemList:
         type(self).__name__, self.offset, self.size, item_type_part)
 
 
-class _TypeIdItemList(_MemoryItemList):
+class _StructItemList:
+  """Base class for repeated fixed-size memory items, decoded on access."""
+
+  def __init__(self, reader, offset, size, item_type, fmt):
+    """Creates a view of the item list.
+
+    Args:
+      reader: _DexReader whose data contains the memory items.
+      offset: Offset from start of the file to the item list.
+      size: Number of memory items in the list.
+      item_type: namedtuple type to decode each memory item into.
+      fmt: struct format (without byte order) of a single memory item.
+    """
+    self.offset = offset
+    self.size = size
+    self._data = reader.data
+    self._item_type = item_type
+    self._struct = struct.Struct('<' + fmt)
+
+  def __iter__(self):
+    return map(self._item_type._make, self.IterRaw())
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return [self[i] for i in range(*key.indices(self.size))]
+    if key < 0:
+      key += self.size
+    if not 0 <= key < self.size:
+      raise IndexError('{} index out of range: {}'.format(
+          type(self).__name__, key))
+    return self._item_type._make(
+        self._struct.unpack_from(self._data,
+                                 self.offset + key * self._struct.size))
+
+  def __len__(self):
+    return self.size
+
+  def IterRaw(self):
+    """Yields each memory item as a plain tuple of its fields."""
+    end = self.offset + self.size * self._struct.size
+    return self._struct.iter_unpack(memoryview(self._data)[self.offset:end])
+
+  def IterField(self, name):
+    """Yields a single field of each memory item."""
+    index = self._item_type._fields.index(name)
+    return (fields[index] for fields in self.IterRaw())
+
+  def __repr__(self):
+    item_type_part = ''
+    if self.size != 0:
+      item_type_part = ', item type={}'.format(self._item_type.__name__)
+
+    return '{}(offset={:#x}, size={}{})'.format(
+        type(self).__name__, self.offset, self.size, item_type_part)
+
+
+class _TypeIdItemList(_StructItemList):
   def __init__(self, reader, offset, size):
-    factory = lambda x: _TypeIdItem(x.ReadUInt())
-    super().__init__(reader, offset, size, factory)
+    super().__init__(reader, offset, size, _TypeIdItem, 'I')
 
 
-class _ProtoIdItemList(_MemoryItemList):
+class _ProtoIdItemList(_StructItemList):
   def __init__(self, reader, offset, size):
-    factory = lambda x: _ProtoIdItem(x.ReadUInt(), x.ReadUInt(), x.ReadUInt())
-    super().__init__(reader, offset, size, factory)
+    super().__init__(reader, offset, size, _ProtoIdItem, 'III')
 
 
-class _MethodIdItemList(_MemoryItemList):
+class _MethodIdItemList(_StructItemList):
   def __init__(self, reader, offset, size):
-    factory = (
-        lambda x: _MethodIdItem(x.ReadUShort(), x.ReadUShort(), x.ReadUInt()))
-    super().__init__(reader, offset, size, factory)
+    super().__init__(reader, offset, size, _MethodIdItem, 'HHI')
 
 
-class _StringItemList(_MemoryItemList):
+class _FieldIdItemList(_StructItemList):
   def __init__(self, reader, offset, size):
-    reader.Seek(offset)
-    string_item_offsets = iter([reader.ReadUInt() for _ in range(size)])
+    super().__init__(reader, offset, size, _FieldIdItem, 'HHI')
+
 
-    def factory(x):
-      data_offset = next(string_item_offsets)
-      string = x.ReadString(data_offset)
-      return _StringDataItem(len(string), string)
+class _StringItemList(_StructItemList):
+  """string_id_items, with string_data_items decoded on access.
+
+  Decoded strings are kept in a bounded cache, since strings such as type
+  descriptors are looked up repeatedly.
+  """
 
-    super().__init__(reader, offset, size, factory)
+  def __init__(self, reader, offset, size, cache_size=_STRING_CACHE_SIZE):
+    super().__init__(reader, offset, size, _StringDataItem, 'I')
+    self._reader = reader
+    self._decode = functools.lru_cache(maxsize=cache_size)(self._Decode)
+
+  def _Decode(self, index):
+    (data_offset, ) = self._struct.unpack_from(self._data,
+                                               self.offset + index * 4)
+    string = self._reader.ReadString(data_offset)
+    return _StringDataItem(len(string), string)
+
+  def __iter__(self):
+    return map(self.__getitem__, range(self.size))
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return [self[i] for i in range(*key.indices(self.size))]
+    if key < 0:
+      key += self.size
+    if not 0 <= key < self.size:
+      raise IndexError('{} index out of range: {}'.format(
+          type(self).__name__, key))
+    return self._decode(key)
 
 
 class _TypeListItem(_MemoryItemList):
@@ -165,15 +293,10 @@ class _TypeListItemList(_MemoryItemList):
     super().__init__(reader, offset, size, _TypeListItem)
 
 
-class _ClassDefItemList(_MemoryItemList):
+class _ClassDefItemList(_StructItemList):
   def __init__(self, reader, offset, size):
-    reader.Seek(offset)
-
-    def factory(x):
-      return _ClassDefItem(*(x.ReadUInt()
-                             for _ in range(len(_ClassDefItem._fields))))
-
-    super().__init__(reader, offset, size, factory)
+    super().__init__(reader, offset, size, _ClassDefItem,
+                     'I' * len(_ClassDefItem._fields))
 
 
 class _DexMapItem:
@@ -216,6 +339,10 @@ class _DexReader:
     self._data = data
     self._pos = 0
 
+  @property
+  def data(self):
+    return self._data
+
   def Seek(self, offset):
     self._pos = offset
 
@@ -231,9 +358,31 @@ class _DexReader:
   def ReadUInt(self):
     return self._ReadData('<I')
 
+  def ReadULeb128(self):
+    value, size = self._ReadULeb128(self._pos)
+    self._pos += size
+    return value
+
+  def ReadVarWidthInt(self, size, signed):
+    """Reads a little-endian integer of |size| bytes."""
+    ret = int.from_bytes(self._data[self._pos:self._pos + size],
+                         'little',
+                         signed=signed)
+    self._pos += size
+    return ret
+
   def ReadString(self, data_offset):
+    """Returns the string_data_item at |data_offset|.
+
+    Unlike the other Read methods, this does not move the read position.
+    """
     string_length, string_offset = self._ReadULeb128(data_offset)
     string_data_offset = string_offset + data_offset
+    # Fast path for ASCII strings, where MUTF-8 matches ASCII byte for byte.
+    end = string_data_offset + string_length
+    raw = self._data[string_data_offset:end]
+    if raw.isascii() and self._data[end:end + 1] == b'\0' and b'\0' not in raw:
+      return raw.decode('ascii')
     return self._DecodeMUtf8(string_length, string_data_offset)
 
   def AlignUpTo(self, align_unit):
@@ -283,36 +432,42 @@ class _DexReader:
       string_length: The length of the decoded string.
       offset: Offset to the beginning of the string.
     """
-    self.Seek(offset)
-    ret = ''
+    data = self._data
+    pos = offset
+    chars = []
+
+    def read_byte():
+      nonlocal pos
+      pos += 1
+      return data[pos - 1]
 
     for _ in range(string_length):
-      a = self.ReadUByte()
+      a = read_byte()
       if a == 0:
         raise _MUTf8DecodeError('Early string termination encountered',
                                 string_length, offset)
       if (a & 0x80) == 0x00:
         code = a
       elif (a & 0xe0) == 0xc0:
-        b = self.ReadUByte()
+        b = read_byte()
         if (b & 0xc0) != 0x80:
           raise _MUTf8DecodeError('Error in byte 2', string_length, offset)
         code = ((a & 0x1f) << 6) | (b & 0x3f)
       elif (a & 0xf0) == 0xe0:
-        b = self.ReadUByte()
-        c = self.ReadUByte()
+        b = read_byte()
+        c = read_byte()
         if (b & 0xc0) != 0x80 or (c & 0xc0) != 0x80:
           raise _MUTf8DecodeError('Error in byte 3 or 4', string_length, offset)
         code = ((a & 0x0f) << 12) | ((b & 0x3f) << 6) | (c & 0x3f)
       else:
         raise _MUTf8DecodeError('Bad byte', string_length, offset)
-      ret += chr(code)
+      chars.append(chr(code))
 
-    if self.ReadUByte() != 0x00:
+    if read_byte() != 0x00:
       raise _MUTf8DecodeError('Expected string termination', string_length,
                               offset)
 
-    return ret
+    return ''.join(chars)
 
 
 class _MUTf8DecodeError(Exception):
@@ -334,6 +489,7 @@ class DexFile:
     map_list: _DexMapList object containing list of dex file contents.
     type_item_list: _TypeIdItemList containing type_id_items.
     proto_item_list: _ProtoIdItemList containing proto_id_items.
+    field_item_list: _FieldIdItemList containing field_id_items.
     method_item_list: _MethodIdItemList containing method_id_items.
     string_item_list: _StringItemList containing string_data_items that are
       referenced by index in other sections.
@@ -357,8 +513,10 @@ class DexFile:
   def __init__(self, data):
     """Decodes dex file memory sections.
 
+    Items are decoded lazily, when they are first accessed.
+
     Args:
-      data: bytearray containing the contents of a dex file.
+      data: bytearray, bytes or mmap containing the contents of a dex file.
     """
     self.reader = _DexReader(data)
     self.header = self.reader.ReadHeader()
@@ -368,6 +526,9 @@ class DexFile:
     self.proto_item_list = _ProtoIdItemList(self.reader,
                                             self.header.proto_ids_off,
                                             self.header.proto_ids_size)
+    self.field_item_list = _FieldIdItemList(self.reader,
+                                            self.header.field_ids_off,
+                                            self.header.field_ids_size)
     self.method_item_list = _MethodIdItemList(self.reader,
                                               self.header.method_ids_off,
                                               self.header.method_ids_size)
@@ -377,19 +538,30 @@ class DexFile:
     self.class_def_item_list = _ClassDefItemList(self.reader,
                                                  self.header.class_defs_off,
                                                  self.header.class_defs_size)
+    self._type_list_item_list = None
 
-    type_list_key = _DexMapList.TYPE_TYPE_LIST
-    if type_list_key in self.map_list:
-      map_list_item = self.map_list[type_list_key]
-      self.type_list_item_list = _TypeListItemList(self.reader,
-                                                   map_list_item.offset,
-                                                   map_list_item.size)
-    else:
-      self.type_list_item_list = _TypeListItemList(self.reader, 0, 0)
-    self._type_lists_by_offset = {
-        type_list.offset: type_list
-        for type_list in self.type_list_item_list
-    }
+  @classmethod
+  def FromPath(cls, path):
+    """Returns a DexFile backed by a read-only memory map of the file at |path|.
+
+    Only the parts of the file that are accessed are paged in.
+    """
+    with open(path, 'rb') as f:
+      # The mapping stays valid after the file is closed.
+      return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+  @property
+  def type_list_item_list(self):
+    if self._type_list_item_list is None:
+      type_list_key = _DexMapList.TYPE_TYPE_LIST
+      if type_list_key in self.map_list:
+        map_list_item = self.map_list[type_list_key]
+        self._type_list_item_list = _TypeListItemList(self.reader,
+                                                      map_list_item.offset,
+                                                      map_list_item.size)
+      else:
+        self._type_list_item_list = _TypeListItemList(self.reader, 0, 0)
+    return self._type_list_item_list
 
   def GetString(self, string_item_idx):
     string_item = self.string_item_list[string_item_idx]
@@ -402,8 +574,134 @@ class DexFile:
   def GetTypeListStringsByOffset(self, offset):
     if not offset:
       return ()
-    type_list = self._type_lists_by_offset[offset]
-    return tuple(self.GetTypeString(item.type_idx) for item in type_list)
+    data = self.reader.data
+    (size, ) = struct.unpack_from('<I', data, offset)
+    type_idxs = struct.unpack_from('<{}H'.format(size), data, offset + 4)
+    return tuple(self.GetTypeString(type_idx) for type_idx in type_idxs)
+
+  def GetFieldName(self, field_item_idx):
+    return self.GetString(self.field_item_list[field_item_idx].name_idx)
+
+  def GetMethodName(self, method_item_idx):
+    return self.GetString(self.method_item_list[method_item_idx].name_idx)
+
+  def GetClassData(self, class_def_item):
+    """Returns the ClassDataItem of a class, or None if it has no data."""
+    if not class_def_item.class_data_off:
+      return None
+    reader = self.reader
+    reader.Seek(class_def_item.class_data_off)
+    sizes = [reader.ReadULeb128() for _ in range(4)]
+
+    def read_fields(size):
+      fields = []
+      field_idx = 0
+      for _ in range(size):
+        field_idx += reader.ReadULeb128()
+        fields.append(_EncodedField(field_idx, reader.ReadULeb128()))
+      return fields
+
+    def read_methods(size):
+      methods = []
+      method_idx = 0
+      for _ in range(size):
+        method_idx += reader.ReadULeb128()
+        methods.append(
+            _EncodedMethod(method_idx, reader.ReadULeb128(),
+                           reader.ReadULeb128()))
+      return methods
+
+    return ClassDataItem(read_fields(sizes[0]), read_fields(sizes[1]),
+                         read_methods(sizes[2]), read_methods(sizes[3]))
+
+  def GetAnnotationsDirectory(self, class_def_item):
+    """Returns the AnnotationsDirectoryItem of a class, or None."""
+    if not class_def_item.annotations_off:
+      return None
+    reader = self.reader
+    reader.Seek(class_def_item.annotations_off)
+    class_annotations_off = reader.ReadUInt()
+    fields_size = reader.ReadUInt()
+    methods_size = reader.ReadUInt()
+    reader.ReadUInt()  # annotated_parameters_size
+    field_offsets = [(reader.ReadUInt(), reader.ReadUInt())
+                     for _ in range(fields_size)]
+    method_offsets = [(reader.ReadUInt(), reader.ReadUInt())
+                      for _ in range(methods_size)]
+    return AnnotationsDirectoryItem(
+        self.GetAnnotationSet(class_annotations_off),
+        {idx: self.GetAnnotationSet(off)
+         for idx, off in field_offsets},
+        {idx: self.GetAnnotationSet(off)
+         for idx, off in method_offsets})
+
+  def GetAnnotationSet(self, offset):
+    """Returns the list of Annotations in the annotation_set_item at |offset|."""
+    if not offset:
+      return []
+    reader = self.reader
+    reader.Seek(offset)
+    annotation_offsets = [reader.ReadUInt() for _ in range(reader.ReadUInt())]
+    annotations = []
+    for annotation_off in annotation_offsets:
+      reader.Seek(annotation_off)
+      visibility = reader.ReadUByte()
+      annotations.append(self._ReadEncodedAnnotation(visibility))
+    return annotations
+
+  def _ReadEncodedAnnotation(self, visibility=None):
+    reader = self.reader
+    type_string = self.GetTypeString(reader.ReadULeb128())
+    elements = {}
+    for _ in range(reader.ReadULeb128()):
+      name = self.GetString(reader.ReadULeb128())
+      elements[name] = self._ReadEncodedValue()
+    return Annotation(visibility, type_string, elements)
+
+  def _ReadEncodedValue(self):
+    """Decodes an encoded_value into the closest Python type.
+
+    Strings, fields, methods and enums decode to their names, types to
+    EncodedTypes and annotations to Annotations. Method types and handles
+    decode to their indices.
+    """
+    reader = self.reader
+    header = reader.ReadUByte()
+    value_type = header & 0x1f
+    value_arg = header >> 5
+    if value_type in (_VALUE_BYTE, _VALUE_SHORT, _VALUE_INT, _VALUE_LONG):
+      return reader.ReadVarWidthInt(value_arg + 1, signed=True)
+    if value_type == _VALUE_FLOAT:
+      # Floats are zero-extended to the right.
+      raw = reader.ReadVarWidthInt(value_arg + 1, signed=False)
+      data = (raw << (8 * (3 - value_arg))).to_bytes(4, 'little')
+      return struct.unpack('<f', data)[0]
+    if value_type == _VALUE_DOUBLE:
+      raw = reader.ReadVarWidthInt(value_arg + 1, signed=False)
+      data = (raw << (8 * (7 - value_arg))).to_bytes(8, 'little')
+      return struct.unpack('<d', data)[0]
+    if value_type == _VALUE_BOOLEAN:
+      return bool(value_arg)
+    if value_type == _VALUE_NULL:
+      return None
+    if value_type == _VALUE_ARRAY:
+      return [self._ReadEncodedValue() for _ in range(reader.ReadULeb128())]
+    if value_type == _VALUE_ANNOTATION:
+      return self._ReadEncodedAnnotation()
+    idx = reader.ReadVarWidthInt(value_arg + 1, signed=False)
+    if value_type == _VALUE_CHAR:
+      return idx
+    if value_type == _VALUE_STRING:
+      return self.GetString(idx)
+    if value_type == _VALUE_TYPE:
+      return EncodedType(self.GetTypeString(idx))
+    if value_type in (_VALUE_FIELD, _VALUE_ENUM):
+      return self.GetFieldName(idx)
+    if value_type == _VALUE_METHOD:
+      return self.GetMethodName(idx)
+    if value_type in (_VALUE_METHOD_TYPE, _VALUE_METHOD_HANDLE):
+      return idx
+    raise ValueError('Unknown encoded_value type: {:#x}'.format(value_type))
 
   @staticmethod
   def ResolveClassAccessFlags(access_flags):
@@ -418,15 +716,20 @@ class DexFile:
       Tuples that look like:
         (class name, return type, method name, (parameter type, ...)).
     """
-    for method_item in self.method_item_list:
-      class_name_string = self.GetTypeString(method_item.type_idx)
-      method_name_string = self.GetString(method_item.name_idx)
-      proto_item = self.proto_item_list[method_item.proto_idx]
-      return_type_string = self.GetTypeString(proto_item.return_type_idx)
-      parameter_types = self.GetTypeListStringsByOffset(
-          proto_item.parameters_off)
-      yield (class_name_string, return_type_string, method_name_string,
-             parameter_types)
+    proto_parts = {}
+    for type_idx, proto_idx, name_idx in self.method_item_list.IterRaw():
+      parts = proto_parts.get(proto_idx)
+      if parts is None:
+        proto_item = self.proto_item_list[proto_idx]
+        parts = (self.GetTypeString(proto_item.return_type_idx),
+                 self.GetTypeListStringsByOffset(proto_item.parameters_off))
+        proto_parts[proto_idx] = parts
+      yield (self.GetTypeString(type_idx), parts[0], self.GetString(name_idx),
+             parts[1])
+
+  def IterTypeStrings(self):
+    """Yields the descriptor of each type_id_item, in order."""
+    return map(self.GetString, self.type_item_list.IterField('descriptor_idx'))
 
   def __repr__(self):
     items = [
@@ -482,8 +785,7 @@ class _DumpSummary(_DumpCommand):
     print(self._dexfile)
 
 
-def _DumpDexItems(dexfile_data, name, item):
-  dexfile = DexFile(bytearray(dexfile_data))
+def _DumpDexItems(dexfile, name, item):
   print('dex_parser: Dumping {} for {}'.format(item, name))
   cmds = {
       'summary': _DumpSummary,
@@ -521,11 +823,10 @@ def main():
         sys.exit(1)
 
       for path in dex_file_paths:
-        _DumpDexItems(z.read(path), path, args.item)
+        _DumpDexItems(DexFile(z.read(path)), path, args.item)
 
   else:
-    with open(args.input, 'rb') as f:
-      _DumpDexItems(f.read(), args.input, args.item)
+    _DumpDexItems(DexFile.FromPath(args.input), args.input, args.item)
 
 
 if __name__ == '__main__':
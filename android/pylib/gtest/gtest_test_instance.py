@@ -10,7 +10,6 @@ import logging
 import os
 import re
 import tempfile
-import threading
 import xml.etree.ElementTree
 
 from devil.android import apk_helper
@@ -21,9 +20,6 @@ from pylib.base import test_instance
 from pylib.symbols import stack_symbolizer
 from pylib.utils import test_filter
 
-with host_paths.SysPath(host_paths.BUILD_UTIL_PATH):
-  from lib.common import unittest_util
-
 BROWSER_TEST_SUITES = [
     'android_browsertests',
     'android_sync_integration_tests',
@@ -339,10 +335,10 @@ class GtestTestInstance(test_instance.TestInstance):
       raise ValueError('Platform mode currently supports only 1 gtest suite')
     self._additional_apks = []
     self._coverage_dir = args.coverage_dir
+    self._dynamic_device_dispatch = args.dynamic_device_dispatch
     self._exe_dist_dir = None
     self._external_shard_index = args.test_launcher_shard_index
     self._extract_test_list_from_filter = args.extract_test_list_from_filter
-    self._filter_tests_lock = threading.Lock()
     self._gs_test_artifacts_bucket = args.gs_test_artifacts_bucket
     self._isolated_script_test_output = args.isolated_script_test_output
     self._isolated_script_test_perf_output = (
@@ -352,6 +348,7 @@ class GtestTestInstance(test_instance.TestInstance):
     self._store_tombstones = args.store_tombstones
     self._suite = args.suite_name[0]
     self._symbolizer = stack_symbolizer.Symbolizer(None)
+    self._test_durations_file = args.test_durations_file
     self._total_external_shards = args.test_launcher_total_shards
     self._wait_for_java_debugger = args.wait_for_java_debugger
     self._use_existing_test_data = args.use_existing_test_data
@@ -476,6 +473,10 @@ class GtestTestInstance(test_instance.TestInstance):
   def coverage_dir(self):
     return self._coverage_dir
 
+  @property
+  def dynamic_device_dispatch(self):
+    return self._dynamic_device_dispatch
+
   @property
   def enable_xml_result_parsing(self):
     return self._enable_xml_result_parsing
@@ -556,6 +557,10 @@ class GtestTestInstance(test_instance.TestInstance):
   def test_launcher_batch_limit(self):
     return self._test_launcher_batch_limit
 
+  @property
+  def test_durations_file(self):
+    return self._test_durations_file
+
   @property
   def total_external_shards(self):
     return self._total_external_shards
@@ -612,26 +617,25 @@ class GtestTestInstance(test_instance.TestInstance):
     if self._gtest_filters:
       gtest_filter_strings.extend(self._gtest_filters)
 
-    filtered_test_list = test_list
-    # This lock is required because on older versions of Python
-    # |unittest_util.FilterTestNames| use of |fnmatch| is not threadsafe.
-    with self._filter_tests_lock:
-      for gtest_filter_string in gtest_filter_strings:
-        logging.debug('Filtering tests using: %s', gtest_filter_string)
-        filtered_test_list = unittest_util.FilterTestNames(
-            filtered_test_list, gtest_filter_string)
-
-      if self._run_disabled and self._gtest_filters:
-        out_filtered_test_list = list(set(test_list)-set(filtered_test_list))
-        for test in out_filtered_test_list:
-          test_name_no_disabled = TestNameWithoutDisabledPrefix(test)
-          if test_name_no_disabled == test:
-            continue
-          if all(
-              unittest_util.FilterTestNames([test_name_no_disabled],
-                                            gtest_filter)
-              for gtest_filter in self._gtest_filters):
-            filtered_test_list.append(test)
+    for gtest_filter_string in gtest_filter_strings:
+      logging.debug('Filtering tests using: %s', gtest_filter_string)
+    compiled_filters = test_filter.CompileFilters(gtest_filter_strings)
+    filtered_test_list = [
+        t for t in test_list if all(f.Matches(t) for f in compiled_filters)
+    ]
+
+    if self._run_disabled and self._gtest_filters:
+      compiled_gtest_filters = compiled_filters[1:]
+      filtered_tests = set(filtered_test_list)
+      for test in test_list:
+        if test in filtered_tests:
+          continue
+        test_name_no_disabled = TestNameWithoutDisabledPrefix(test)
+        if test_name_no_disabled == test:
+          continue
+        if all(
+            f.Matches(test_name_no_disabled) for f in compiled_gtest_filters):
+          filtered_test_list.append(test)
     return filtered_test_list
 
   def _GenerateDisabledFilterString(self, disabled_prefixes):
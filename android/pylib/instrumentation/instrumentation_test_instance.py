@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 
 
+import collections
 import copy
 import logging
 import os
@@ -13,7 +14,6 @@ from pylib import constants
 from pylib.base import base_test_result
 from pylib.base import test_exception
 from pylib.base import test_instance
-from pylib.constants import host_paths
 from pylib.instrumentation import instrumentation_parser
 from pylib.instrumentation import test_result
 from pylib.symbols import deobfuscator
@@ -22,9 +22,6 @@ from pylib.utils import dexdump
 from pylib.utils import gold_utils
 from pylib.utils import test_filter
 
-with host_paths.SysPath(host_paths.BUILD_UTIL_PATH):
-  from lib.common import unittest_util
-
 # Ref: http://developer.android.com/reference/android/app/Activity.html
 _ACTIVITY_RESULT_CANCELED = 0
 _ACTIVITY_RESULT_OK = -1
@@ -244,157 +241,43 @@ def FilterTests(tests,
     A list of filtered tests
   """
 
-  def test_names_from_pattern(combined_pattern, test_names):
-    patterns = combined_pattern.split(':')
-
-    hashable_patterns = set()
-    filename_patterns = []
-    for pattern in patterns:
-      if ('*' in pattern or '?' in pattern or '[' in pattern):
-        filename_patterns.append(pattern)
-      else:
-        hashable_patterns.add(pattern)
-
-    filter_test_names = set(
-        unittest_util.FilterTestNames(test_names, ':'.join(
-            filename_patterns))) if len(filename_patterns) > 0 else set()
-
-    for test_name in test_names:
-      if test_name in hashable_patterns:
-        filter_test_names.add(test_name)
-
-    return filter_test_names
-
   def get_test_names(test):
-    test_names = set()
     # Allow fully-qualified name as well as an omitted package.
     unqualified_class_test = {
         'class': test['class'].split('.')[-1],
         'method': test['method']
     }
+    return {
+        GetTestName(test, sep='.'),
+        GetTestName(unqualified_class_test, sep='.'),
+        GetUniqueTestName(test, sep='.'),
+        GetTestNameWithoutParameterSuffix(test, sep='.'),
+        GetTestNameWithoutParameterSuffix(unqualified_class_test, sep='.'),
+    }
 
-    test_name = GetTestName(test, sep='.')
-    test_names.add(test_name)
-
-    unqualified_class_test_name = GetTestName(unqualified_class_test, sep='.')
-    test_names.add(unqualified_class_test_name)
-
-    unique_test_name = GetUniqueTestName(test, sep='.')
-    test_names.add(unique_test_name)
-
-    junit4_test_name = GetTestNameWithoutParameterSuffix(test, sep='.')
-    test_names.add(junit4_test_name)
-
-    unqualified_junit4_test_name = GetTestNameWithoutParameterSuffix(
-        unqualified_class_test, sep='.')
-    test_names.add(unqualified_junit4_test_name)
-    return test_names
-
-  def get_tests_from_names(tests, test_names, tests_to_names):
-    ''' Returns the tests for which the given names apply
-
-    Args:
-      tests: a list of tests. e.g. [
-            {'annotations": {}, 'class': 'com.example.TestA', 'method':'test1'},
-            {'annotations": {}, 'class': 'com.example.TestB', 'method':'test2'}]
-      test_names: a collection of names determining tests to return.
-
-    Return:
-      A list of tests that match the given test names
-    '''
-    filtered_tests = []
-    for t in tests:
-      current_test_names = tests_to_names[id(t)]
-
-      for current_test_name in current_test_names:
-        if current_test_name in test_names:
-          filtered_tests.append(t)
-          break
-
-    return filtered_tests
-
-  def remove_tests_from_names(tests, remove_test_names, tests_to_names):
-    ''' Returns the tests from the given list with given names removed
-
-    Args:
-      tests: a list of tests. e.g. [
-            {'annotations": {}, 'class': 'com.example.TestA', 'method':'test1'},
-            {'annotations": {}, 'class': 'com.example.TestB', 'method':'test2'}]
-      remove_test_names: a collection of names determining tests to remove.
-      tests_to_names: a dcitionary of test ids to a collection of applicable
-            names for that test
-
-    Return:
-      A list of tests that don't match the given test names
-    '''
-    filtered_tests = []
-
-    for t in tests:
-      for name in tests_to_names[id(t)]:
-        if name in remove_test_names:
-          break
-      else:
-        filtered_tests.append(t)
-    return filtered_tests
-
-  def gtests_filter(tests, combined_filters):
-    ''' Returns the tests after the combined_filters have been applied
-
-    Args:
-      tests: a list of tests. e.g. [
-            {'annotations": {}, 'class': 'com.example.TestA', 'method':'test1'},
-            {'annotations": {}, 'class': 'com.example.TestB', 'method':'test2'}]
-      combined_filters: the filter string representing tests to exclude
-
-    Return:
-      A list of tests that should still be included after the combined_filters
-      are applied to their names
-    '''
-
-    if not combined_filters:
+  def gtests_filter(tests, compiled_filters):
+    if not compiled_filters:
       return tests
-
-    # Collect all test names
-    all_test_names = set()
-    tests_to_names = {}
-    for t in tests:
-      tests_to_names[id(t)] = get_test_names(t)
-      for name in tests_to_names[id(t)]:
-        all_test_names.add(name)
-
-    for combined_filter in combined_filters:
-      pattern_groups = combined_filter.split('-')
-      negative_pattern = pattern_groups[1] if len(pattern_groups) > 1 else None
-      positive_pattern = pattern_groups[0]
-      if positive_pattern:
-        # Only use the test names that match the positive pattern
-        positive_test_names = test_names_from_pattern(positive_pattern,
-                                                      all_test_names)
-        tests = get_tests_from_names(tests, positive_test_names, tests_to_names)
-
-      if negative_pattern:
-        # Remove any test the negative filter matches
-        remove_names = test_names_from_pattern(negative_pattern, all_test_names)
-        tests = remove_tests_from_names(tests, remove_names, tests_to_names)
-
-    return tests
-
-  def annotation_filter(all_annotations):
-    if not annotations:
-      return True
-    return any_annotation_matches(annotations, all_annotations)
-
-  def excluded_annotation_filter(all_annotations):
-    if not excluded_annotations:
-      return True
-    return not any_annotation_matches(excluded_annotations,
-                                      all_annotations)
-
-  def any_annotation_matches(filter_annotations, all_annotations):
-    return any(
-        ak in all_annotations
-        and annotation_value_matches(av, all_annotations[ak])
-        for ak, av in filter_annotations)
+    return [
+        t for t in tests
+        if all(f.MatchesAny(get_test_names(t)) for f in compiled_filters)
+    ]
+
+  def index_annotations(tests):
+    """Maps annotation names to (test position, annotation value) pairs."""
+    index = collections.defaultdict(list)
+    for i, t in enumerate(tests):
+      for name, value in t['annotations'].items():
+        index[name].append((i, value))
+    return index
+
+  def matching_tests(filter_annotations, index):
+    """Returns the positions of tests that match any of |filter_annotations|."""
+    matches = set()
+    for ak, av in filter_annotations:
+      matches.update(i for i, tav in index.get(ak, ())
+                     if annotation_value_matches(av, tav))
+    return matches
 
   def annotation_value_matches(filter_av, av):
     if filter_av is None:
@@ -410,22 +293,37 @@ def FilterTests(tests,
       return filter_av in av
     return filter_av == av
 
-  return_tests = []
-  for t in gtests_filter(tests, filter_strs):
+  tests = gtests_filter(tests, test_filter.CompileFilters(filter_strs))
+  for t in tests:
     # Enforce that all tests declare their size.
     if not any(a in _VALID_ANNOTATIONS for a in t['annotations']):
       raise MissingSizeAnnotationError(GetTestName(t))
 
-    if (not annotation_filter(t['annotations'])
-        or not excluded_annotation_filter(t['annotations'])):
-      continue
-    return_tests.append(t)
+  if not annotations and not excluded_annotations:
+    return tests
 
-  return return_tests
+  index = index_annotations(tests)
+  included = None
+  if annotations:
+    included = matching_tests(annotations, index)
+  excluded = set()
+  if excluded_annotations:
+    excluded = matching_tests(excluded_annotations, index)
 
+  return [
+      t for i, t in enumerate(tests)
+      if (included is None or i in included) and i not in excluded
+  ]
 
-def GetTestsFromDexdump(test_apk):
-  dex_dumps = dexdump.Dump(test_apk)
+
+def GetTestsFromDexdump(test_apk, cache_path=None):
+  """Lists the tests in |test_apk| by parsing its dex files.
+
+  Args:
+    test_apk: Path to the test APK.
+    cache_path: Optional path to a file used to cache parsed dex files.
+  """
+  dex_dumps = dexdump.DumpInProcess(test_apk, cache_path=cache_path)
   tests = []
 
   def get_test_methods(methods, annotations):
@@ -622,6 +520,7 @@ class InstrumentationTestInstance(test_instance.TestInstance):
 
     self._external_shard_index = args.test_launcher_shard_index
     self._total_external_shards = args.test_launcher_total_shards
+    self._test_durations_file = args.test_durations_file
 
     self._is_unit_test = False
     self._initializeUnitTestFlag(args)
@@ -1025,6 +924,10 @@ class InstrumentationTestInstance(test_instance.TestInstance):
   def timeout_scale(self):
     return self._timeout_scale
 
+  @property
+  def test_durations_file(self):
+    return self._test_durations_file
+
   @property
   def total_external_shards(self):
     return self._total_external_shards
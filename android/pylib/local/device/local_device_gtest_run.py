@@ -559,7 +559,11 @@ class LocalDeviceGtestRun(local_device_test_run.LocalDeviceTestRun):
 
     max_shard_size = self._test_instance.test_launcher_batch_limit
 
-    shards.extend(self._PartitionTests(tests, device_count, max_shard_size))
+    if self._test_instance.dynamic_device_dispatch:
+      shards.extend(
+          self._CreateDynamicShards(tests, device_count, max_shard_size))
+    else:
+      shards.extend(self._PartitionTests(tests, device_count, max_shard_size))
     return shards
 
   #override
@@ -758,6 +762,10 @@ class LocalDeviceGtestRun(local_device_test_run.LocalDeviceTestRun):
       if logcat_file and logcat_file.Link():
         logging.critical('Logcat saved to %s', logcat_file.Link())
 
+  #override
+  def _GetTestDurationsFile(self):
+    return self._test_instance.test_durations_file
+
   #override
   def _GetUniqueTestName(self, test):
     return gtest_test_instance.TestNameWithoutDisabledPrefix(test)
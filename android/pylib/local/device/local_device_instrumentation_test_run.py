@@ -323,6 +323,22 @@ def _ParseTestListOutputFromAndroidxListener(output):
   } for class_name, methods in tests_by_class.items()]
 
 
+def _DexTestsCachePath(test_apk_path):
+  """Returns where to cache tests parsed from dex files, or None.
+
+  The cache goes in the output directory rather than next to the APK, which
+  may be read-only.
+  """
+  try:
+    out_dir = constants.GetOutDirectory()
+  except EnvironmentError:
+    return None
+  if not os.path.isdir(out_dir):
+    return None
+  file_name = 'dextests_%s.json' % os.path.basename(test_apk_path)
+  return os.path.join(out_dir, file_name)
+
+
 class LocalDeviceInstrumentationTestRun(
     local_device_test_run.LocalDeviceTestRun):
   def __init__(self, env, test_instance):
@@ -809,25 +825,26 @@ class LocalDeviceInstrumentationTestRun(
     run_disabled = ti.GetRunDisabledFlag()
     # run_disabled effects test listing only when using AndroidJUnitRunner.
     use_androidx_runner = not use_dexdump and not ti.has_chromium_test_listener
-    pickle_extras = (use_dexdump, use_androidx_runner and run_disabled)
-    raw_tests, pickle_path = self._GetTestsFromPickle(pickle_extras)
-
-    if raw_tests is None:
-      if use_dexdump:
-        # This path is hit by CTS tests.
-        # Dexdump is not able to find parameterized tests, so some tests might
-        # be missed.
-        # We should consider using AndroidJunitRunner's "-e annotation Foo,Bar"
-        # and "-e notAnnotation Foo,Bar" to list tests when annotation filters
-        # exist instead.
-        logging.info('Getting tests from dexdump (due to annotation filters)')
-        raw_tests = instrumentation_test_instance.GetTestsFromDexdump(
-            ti.test_apk.path)
-      else:
+    if use_dexdump:
+      # This path is hit by CTS tests.
+      # Dexdump is not able to find parameterized tests, so some tests might
+      # be missed.
+      # We should consider using AndroidJunitRunner's "-e annotation Foo,Bar"
+      # and "-e notAnnotation Foo,Bar" to list tests when annotation filters
+      # exist instead.
+      # Parsed dex files are cached by checksum rather than in the test list
+      # pickle, so an mtime change alone does not force a re-parse.
+      logging.info('Getting tests from dex files (due to annotation filters)')
+      raw_tests = instrumentation_test_instance.GetTestsFromDexdump(
+          ti.test_apk.path, cache_path=_DexTestsCachePath(ti.test_apk.path))
+    else:
+      pickle_extras = (False, use_androidx_runner and run_disabled)
+      raw_tests, pickle_path = self._GetTestsFromPickle(pickle_extras)
+      if raw_tests is None:
         logging.info('Getting tests by having %s list them.',
                      ti.junit4_runner_class)
         raw_tests = self._GetTestsFromRunner(run_disabled=run_disabled)
-      _SaveTestsToPickle(pickle_path, raw_tests, pickle_extras)
+        _SaveTestsToPickle(pickle_path, raw_tests, pickle_extras)
 
     tests = ti.ProcessRawTests(raw_tests)
     tests = self._ApplyExternalSharding(tests, ti.external_shard_index,
@@ -918,6 +935,10 @@ class LocalDeviceInstrumentationTestRun(
     # TODO(crbug.com/40200835): Add sorting logic back to _PartitionTests.
     return self._SortTests(all_tests)
 
+  #override
+  def _GetTestDurationsFile(self):
+    return self._test_instance.test_durations_file
+
   #override
   def _GetUniqueTestName(self, test):
     return instrumentation_test_instance.GetUniqueTestName(test)
@@ -8,6 +8,8 @@
 # pylint: disable=protected-access
 
 
+import os
+import tempfile
 import unittest
 
 from pylib.base import base_test_result
@@ -15,6 +17,8 @@ from pylib.base import mock_environment
 from pylib.base import mock_test_instance
 from pylib.local.device import local_device_instrumentation_test_run
 
+import mock  # pylint: disable=import-error
+
 
 class LocalDeviceInstrumentationTestRunTest(unittest.TestCase):
 
@@ -155,6 +159,20 @@ class LocalDeviceInstrumentationTestRunTest(unittest.TestCase):
     with self.assertRaises(ValueError):
       local_device_instrumentation_test_run._ReplaceUncommonChars(original)
 
+  def testDexTestsCachePath(self):
+    with tempfile.TemporaryDirectory() as out_dir, mock.patch(
+        'pylib.constants.GetOutDirectory', return_value=out_dir):
+      self.assertEqual(
+          os.path.join(out_dir, 'dextests_FooTest.apk.json'),
+          local_device_instrumentation_test_run._DexTestsCachePath(
+              '/read/only/apks/FooTest.apk'))
+
+    with mock.patch('pylib.constants.GetOutDirectory',
+                    side_effect=EnvironmentError):
+      self.assertIsNone(
+          local_device_instrumentation_test_run._DexTestsCachePath(
+              '/read/only/apks/FooTest.apk'))
+
 
 if __name__ == '__main__':
   unittest.main(verbosity=2)
@@ -24,6 +24,7 @@ from pylib.base import test_collection
 from pylib.base import test_exception
 from pylib.base import test_run
 from pylib.utils import device_dependencies
+from pylib.utils import test_durations
 from pylib.local.device import local_device_environment
 
 from lib.proto import exception_recorder
@@ -33,6 +34,10 @@ _SIGTERM_TEST_LOG = (
   '  Suite execution terminated, probably due to swarming timeout.\n'
   '  Your test may not have run.')
 
+# With dynamic device dispatch, the number of shards created per device. More
+# shards balance devices better, but each shard has a fixed startup cost.
+_DYNAMIC_SHARDS_PER_DEVICE = 4
+
 
 class TestsTerminated(Exception):
   pass
@@ -44,6 +49,7 @@ class LocalDeviceTestRun(test_run.TestRun):
     super().__init__(env, test_instance)
     # This is intended to be filled by a child class.
     self._installed_packages = []
+    self._test_durations = None
     env.SetPreferredAbis(test_instance.GetPreferredAbis())
 
   #override
@@ -51,6 +57,10 @@ class LocalDeviceTestRun(test_run.TestRun):
     tests = self._GetTests()
 
     exit_now = threading.Event()
+    # Tests that were requeued because the device running them was lost. They
+    # are requeued only once per try so that a test that takes down devices
+    # cannot take down all of them.
+    requeued_tests = set()
 
     @local_device_environment.handle_shard_failures
     def run_tests_on_device(dev, tests, results):
@@ -111,8 +121,12 @@ class LocalDeviceTestRun(test_run.TestRun):
                     base_test_result.ResultType.TIMEOUT))
         except device_errors.DeviceUnreachableError as e:
           exception_recorder.register(e)
-          # If the device is no longer reachable then terminate this
-          # run_tests_on_device call.
+          # Hand the test over to the remaining devices, and terminate this
+          # run_tests_on_device call since the device is no longer reachable.
+          if (isinstance(tests, test_collection.TestCollection)
+              and id(test) not in requeued_tests):
+            requeued_tests.add(id(test))
+            rerun = test
           raise
         except base_error.BaseError as e:
           exception_recorder.register(e)
@@ -152,6 +166,7 @@ class LocalDeviceTestRun(test_run.TestRun):
         self._env.ResetCurrentTry()
         while self._env.current_try < self._env.max_tries and tests:
           tries = self._env.current_try
+          requeued_tests.clear()
           tests = self._SortTests(tests)
           grouped_tests = self._GroupTestsAfterSharding(tests)
           logging.info('STARTING TRY #%d/%d', tries + 1, self._env.max_tries)
@@ -297,7 +312,19 @@ class LocalDeviceTestRun(test_run.TestRun):
   # grouped (eg. batched tests), we cannot perfectly fill all paritions as that
   # would require breaking up groups.
   def _PartitionTests(self, tests, num_desired_partitions, max_partition_size):
-    # pylint: disable=no-self-use
+    durations = self._GetTestDurations()
+    if durations:
+      # With a history of test durations, balance partitions by expected
+      # duration instead. Groups (eg. batched tests and PRE_ tests) are kept
+      # intact.
+      return test_durations.PartitionByDuration(
+          tests, num_desired_partitions, max_partition_size,
+          lambda t: sum(
+              durations.GetDuration(self._GetUniqueTestName(x))
+              for x in (t if isinstance(t, list) else [t])),
+          lambda t: len(t) if self._CountTestsIndividually(t) else 1,
+          lambda t: self._GetUniqueTestName(t[0] if isinstance(t, list) else t))
+
     partitions = []
 
 
@@ -347,6 +374,32 @@ class LocalDeviceTestRun(test_run.TestRun):
       partitions.pop()
     return partitions
 
+  def _CreateDynamicShards(self, tests, num_devices, max_shard_size):
+    """Partitions |tests| into shards for devices to pull from a shared queue.
+
+    Creates several shards per device, so that devices that finish early take
+    over work that would otherwise have been left to slower devices.
+
+    Args:
+      tests: List containing tests or test groups. Groups are never split up.
+      num_devices: The number of devices tests will be run on.
+      max_shard_size: The maximum number of tests in a shard.
+
+    Returns:
+      A list of shards, in the order they should be handed out.
+    """
+    shards = self._PartitionTests(tests,
+                                  num_devices * _DYNAMIC_SHARDS_PER_DEVICE,
+                                  max_shard_size)
+    durations = self._GetTestDurations()
+    if durations:
+      # Hand out the longest shards first, so that no device is left running a
+      # long shard after the others have finished.
+      shards.sort(key=lambda s: -sum(
+          durations.GetDuration(self._GetUniqueTestName(t))
+          for t in FlattenTestList(s)))
+    return shards
+
   def _CountTestsIndividually(self, test):
     # pylint: disable=no-self-use
     if not isinstance(test, list):
@@ -357,6 +410,18 @@ class LocalDeviceTestRun(test_run.TestRun):
     return ('Batch' not in annotations
             or annotations['Batch']['value'] != 'UnitTests')
 
+  def _GetTestDurations(self):
+    """Returns a test_durations.TestDurationStore, or None if unavailable."""
+    if self._test_durations is None:
+      path = self._GetTestDurationsFile()
+      if path:
+        self._test_durations = test_durations.TestDurationStore(path)
+    return self._test_durations
+
+  def _GetTestDurationsFile(self):
+    # pylint: disable=no-self-use
+    return None
+
   def _CreateShardsForDevices(self, tests):
     raise NotImplementedError
 
@@ -6,10 +6,16 @@
 # pylint: disable=protected-access
 
 
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+from devil.android import device_errors
 from pylib.base import base_test_result
 from pylib.local.device import local_device_test_run
+from pylib.utils import test_durations
 
 import mock  # pylint: disable=import-error
 
@@ -34,6 +40,82 @@ class TestLocalDeviceNonStringTestRun(
     return test['name']
 
 
+class FakeDevice:
+  """A device that takes |seconds_per_test| to run each test."""
+
+  def __init__(self, name, seconds_per_test, unreachable=False):
+    self.name = name
+    self.seconds_per_test = seconds_per_test
+    self.unreachable = unreachable
+    self.busy_time = 0
+    self.tests_run = []
+
+  def RunTests(self, tests):
+    if self.unreachable:
+      raise device_errors.DeviceUnreachableError(self.name)
+    duration = self.seconds_per_test * len(tests)
+    time.sleep(duration)
+    self.busy_time += duration
+    self.tests_run.extend(tests)
+
+  def __str__(self):
+    return self.name
+
+
+class FakeParallelDevices:
+  """Runs a function on each device in its own thread, like DeviceUtils."""
+
+  def __init__(self, devices):
+    self._devices = devices
+
+  def pMap(self, f, *args):
+    threads = [
+        threading.Thread(target=f, args=(d, ) + args) for d in self._devices
+    ]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return mock.Mock()
+
+
+class FakeDeviceTestRun(local_device_test_run.LocalDeviceTestRun):
+  """Runs shards of string tests on FakeDevices."""
+
+  # pylint: disable=abstract-method
+
+  def __init__(self, tests, devices, dynamic):
+    env = mock.MagicMock()
+    env.devices = devices
+    env.parallel_devices = FakeParallelDevices(devices)
+    env.max_tries = 1
+    env.current_try = 0
+    env.IncrementCurrentTry.side_effect = (
+        lambda: setattr(env, 'current_try', env.current_try + 1))
+    super().__init__(env, mock.MagicMock())
+    self._tests = tests
+    self._dynamic = dynamic
+
+  def _GetTests(self):
+    return self._tests
+
+  def _ShouldShardTestsForDevices(self):
+    return True
+
+  def _CreateShardsForDevices(self, tests):
+    if self._dynamic:
+      return self._CreateDynamicShards(tests, len(self._env.devices),
+                                       float('inf'))
+    return self._PartitionTests(tests, len(self._env.devices), float('inf'))
+
+  def _RunTest(self, device, test):
+    device.RunTests(test)
+    return [
+        base_test_result.BaseTestResult(t, base_test_result.ResultType.PASS)
+        for t in test
+    ], None
+
+
 class LocalDeviceTestRunTest(unittest.TestCase):
 
   def testSortTests(self):
@@ -143,6 +225,121 @@ class LocalDeviceTestRunTest(unittest.TestCase):
     self.assertIsInstance(tests_to_retry[0], dict)
     self.assertEqual(tests[1], tests_to_retry[0])
 
+  def testPartitionTests_byCount(self):
+    test_run = TestLocalDeviceTestRun()
+    self.assertEqual(test_run._PartitionTests(['a', 'b', 'c', 'd'], 2,
+                                              float('inf')),
+                     [['a', 'b'], ['c', 'd']])
+
+  @staticmethod
+  def _ShardByDuration(tests, durations_file, output_file):
+    """Runs two external shards of |tests|, one after the other.
+
+    Once a shard has run, its durations are written to |output_file|, as
+    test_runner does for --test-durations-output-file.
+
+    Returns:
+      The tests of both shards.
+    """
+    sharded_tests = []
+    for shard_index in range(2):
+      test_run = TestLocalDeviceTestRun()
+      with mock.patch.object(test_run,
+                             '_GetTestDurationsFile',
+                             return_value=durations_file):
+        shard = test_run._ApplyExternalSharding(tests, shard_index, 2)
+      sharded_tests.extend(shard)
+      durations = test_durations.TestDurationStore(durations_file)
+      durations.UpdateFromResults(
+          base_test_result.BaseTestResult(
+              t, base_test_result.ResultType.PASS, duration=1000)
+          for t in shard)
+      durations.Save(output_file)
+    return sharded_tests
+
+  def testApplyExternalSharding_byDuration(self):
+    tests = ['Test%d' % i for i in range(20)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      durations_file = os.path.join(tmp_dir, 'durations.json')
+      output_file = os.path.join(tmp_dir, 'new_durations.json')
+      durations = test_durations.TestDurationStore(durations_file)
+      for i, test in enumerate(tests):
+        durations.AddDuration(test, 10 * (i % 7 + 1))
+      durations.Save()
+      with open(durations_file) as f:
+        initial_durations = f.read()
+
+      sharded_tests = self._ShardByDuration(tests, durations_file,
+                                            output_file)
+      # Each test runs on exactly one shard.
+      self.assertEqual(sorted(tests), sorted(sharded_tests))
+      with open(durations_file) as f:
+        self.assertEqual(initial_durations, f.read())
+      # The output has the durations of the last shard's tests.
+      self.assertGreater(
+          test_durations.TestDurationStore(output_file).GetDuration(
+              sharded_tests[-1]), 500)
+
+      # Had the first shard updated the file that shards read, the second
+      # would have partitioned tests differently.
+      sharded_tests = self._ShardByDuration(tests, durations_file,
+                                            durations_file)
+      self.assertNotEqual(sorted(tests), sorted(sharded_tests))
+
+  def testPartitionTests_byDuration(self):
+    test_run = TestLocalDeviceNonStringTestRun()
+    durations = test_durations.TestDurationStore()
+    tests = {}
+    for name, duration in (('a', 50), ('b', 10), ('c', 10), ('d', 30),
+                           ('e', 10)):
+      tests[name] = {'name': name, 'annotations': {}}
+      durations.AddDuration(name, duration)
+    with mock.patch.object(test_run,
+                           '_GetTestDurations',
+                           return_value=durations):
+      # Groups are kept together.
+      partitions = test_run._PartitionTests(
+          [tests['a'], [tests['b'], tests['c']], tests['d'], tests['e']], 2,
+          float('inf'))
+    self.assertEqual(
+        [[tests['a'], tests['e']], [[tests['b'], tests['c']], tests['d']]],
+        partitions)
+
+  def _RunOnFakeDevices(self, tests, devices, dynamic):
+    test_run = FakeDeviceTestRun(tests, devices, dynamic)
+    results = []
+    with mock.patch.object(local_device_test_run.crash_handler,
+                           'RetryOnSystemCrash',
+                           side_effect=lambda f, device: f(device)), \
+        mock.patch.object(local_device_test_run,
+                          'SetAppCompatibilityFlagsIfNecessary'):
+      test_run.RunTests(results)
+    self.assertEqual(1, len(results))
+    return results[0]
+
+  def testRunTests_dynamicDispatchBalancesSkewedDevices(self):
+    tests = ['Test%d' % i for i in range(16)]
+
+    def makespan(dynamic):
+      devices = [FakeDevice('fast', 0.005), FakeDevice('slow', 0.025)]
+      results = self._RunOnFakeDevices(tests, devices, dynamic)
+      self.assertEqual(len(tests), len(results.GetPass()))
+      return max(d.busy_time for d in devices)
+
+    # Split evenly, the slow device runs 8 tests while the fast device is
+    # idle for most of the run.
+    static_makespan = makespan(dynamic=False)
+    self.assertAlmostEqual(0.2, static_makespan)
+    self.assertLess(makespan(dynamic=True), static_makespan)
+
+  def testRunTests_unreachableDeviceWorkIsRequeued(self):
+    tests = ['Test%d' % i for i in range(8)]
+    healthy = FakeDevice('healthy', 0.001)
+    lost = FakeDevice('lost', 0, unreachable=True)
+    results = self._RunOnFakeDevices(tests, [lost, healthy], dynamic=True)
+    self.assertEqual(len(tests), len(results.GetPass()))
+    self.assertEqual(sorted(tests), sorted(healthy.tests_run))
+
 
 if __name__ == '__main__':
   unittest.main(verbosity=2)
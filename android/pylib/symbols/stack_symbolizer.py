@@ -135,3 +135,39 @@ class PassThroughSymbolizerPool(ExpensiveLineTransformerPool):
   @property
   def name(self):
     return "symbolizer-pool"
+
+
+class StackScriptSymbolizer(ExpensiveLineTransformer):
+  """Symbolizes stacks with a long-lived stack script process.
+
+  Args:
+    command: A stack script command that reads from stdin in pass-through
+      mode, and flushes its output after each line.
+  """
+
+  def __init__(self, command):
+    super().__init__(_PROCESS_START_TIMEOUT, _MINIMUM_TIMEOUT,
+                     _PER_LINE_TIMEOUT)
+    self._command = command
+    self.start()
+
+  @property
+  def name(self):
+    return "stack-script-symbolizer"
+
+  @property
+  def command(self):
+    return self._command
+
+
+class StackScriptSymbolizerPool(ExpensiveLineTransformerPool):
+  def __init__(self, command):
+    self._command = command
+    super().__init__(_MAX_RESTARTS, _POOL_SIZE, _PASSTHROUH_ON_FAILURE)
+
+  def CreateTransformer(self):
+    return StackScriptSymbolizer(self._command)
+
+  @property
+  def name(self):
+    return "stack-script-symbolizer-pool"
@@ -2,20 +2,27 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import fnmatch
+import json
+import logging
 import os
 import re
 import shutil
+import struct
 import sys
 import tempfile
+import zipfile
 from xml.etree import ElementTree
 from collections import namedtuple
 from typing import Dict
 
 from devil.utils import cmd_helper
 from pylib import constants
+from pylib.dex import dex_parser
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'gyp'))
 from util import build_utils
+from util import parallel
 
 DEXDUMP_PATH = os.path.join(constants.ANDROID_SDK_TOOLS, 'dexdump')
 
@@ -40,6 +47,13 @@ Annotations = namedtuple('Annotations',
 # Finds each space-separated "foo=..." (where ... can contain spaces).
 _ANNOTATION_VALUE_MATCHER = re.compile(r'\w+=.*?(?:$|(?= \w+=))')
 
+# Bump whenever the format of parsed dex files changes.
+_CACHE_VERSION = 2
+_ACC_PUBLIC = 0x1
+_ACC_ABSTRACT = 0x400
+_ACC_CONSTRUCTOR = 0x10000
+_NO_INDEX = 0xffffffff
+
 
 def Dump(apk_path):
   """Dumps class and method information from a APK into a dict via dexdump.
@@ -95,6 +109,169 @@ def Dump(apk_path):
     shutil.rmtree(dexfile_dir)
 
 
+def DumpInProcess(apk_path, cache_path=None):
+  """Like Dump(), but parses dex files with dex_parser rather than dexdump.
+
+  Dex files are parsed in parallel. Results are cached by dex checksum, so
+  only dex files that changed since the last call are parsed again.
+
+  Args:
+    apk_path: An absolute path to an APK file to dump.
+    cache_path: Optional path to a JSON file used to cache parsed dex files.
+  Returns:
+    A list of dicts in the format returned by Dump().
+  """
+  with zipfile.ZipFile(apk_path) as z:
+    dex_keys = {}
+    for info in z.infolist():
+      if fnmatch.fnmatch(info.filename, '*classes*.dex'):
+        with z.open(info) as f:
+          header = f.read(12)
+        # The header checksum is an adler32 of the rest of the file.
+        checksum = struct.unpack_from('<I', header, 8)[0]
+        dex_keys[info.filename] = '{:08x}-{}'.format(checksum, info.file_size)
+
+  cache = _LoadDexCache(cache_path)
+  missing = sorted(n for n, k in dex_keys.items() if k not in cache)
+  if missing:
+    logging.info('Parsing %d of %d dex files', len(missing), len(dex_keys))
+    results = parallel.BulkForkAndCall(_ParseDexFileInApk,
+                                       [(apk_path, n) for n in missing])
+    for name, parsed in zip(missing, results):
+      cache[dex_keys[name]] = parsed
+    if cache_path:
+      _SaveDexCache(cache_path, {k: cache[k] for k in dex_keys.values()})
+
+  return [_DecodeParsedDex(cache[dex_keys[n]]) for n in sorted(dex_keys)]
+
+
+def _LoadDexCache(cache_path):
+  if not cache_path or not os.path.exists(cache_path):
+    return {}
+  try:
+    with open(cache_path) as f:
+      data = json.load(f)
+  except ValueError:
+    logging.warning('Ignoring corrupt dex cache: %s', cache_path)
+    return {}
+  if data.get('version') != _CACHE_VERSION:
+    return {}
+  return data['dex_files']
+
+
+def _SaveDexCache(cache_path, dex_files):
+  tmp_path = cache_path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({'version': _CACHE_VERSION, 'dex_files': dex_files}, f)
+  os.replace(tmp_path, cache_path)
+
+
+def _DecodeParsedDex(parsed):
+  """Restores the Annotations tuples lost by round-tripping through JSON."""
+  for package_info in parsed.values():
+    for class_info in package_info['classes'].values():
+      class_info['annotations'] = Annotations(*class_info['annotations'])
+  return parsed
+
+
+def _ParseDexFileInApk(apk_path, dex_name):
+  with zipfile.ZipFile(apk_path) as z:
+    dexfile = dex_parser.DexFile(bytearray(z.read(dex_name)))
+  # Convert to JSON-friendly types so results can be cached as-is.
+  return json.loads(json.dumps(ParseDexFile(dexfile)))
+
+
+def ParseDexFile(dexfile):
+  """Extracts class and method information from a dex_parser.DexFile.
+
+  Returns:
+    A dict in the format of each element returned by Dump().
+  """
+  results = {}
+  for class_def in dexfile.class_def_item_list:
+    descriptor = dexfile.GetTypeString(class_def.class_idx)
+    package_name, _, class_name = _DescriptorToDot(descriptor).rpartition('.')
+    # Matches dexdump, which shows inner classes as Outer.Inner.
+    class_name = class_name.replace('$', '.')
+
+    methods = []
+    class_data = dexfile.GetClassData(class_def)
+    if class_data:
+      for method in class_data.direct_methods + class_data.virtual_methods:
+        if (method.access_flags & _ACC_PUBLIC
+            and not method.access_flags & _ACC_CONSTRUCTOR):
+          methods.append(dexfile.GetMethodName(method.method_idx))
+
+    class_annotations = {}
+    methods_annotations = {}
+    directory = dexfile.GetAnnotationsDirectory(class_def)
+    if directory:
+      class_annotations = _ConvertAnnotationSet(directory.class_annotations)
+      for method_idx, annotation_set in directory.method_annotations.items():
+        method_annotations = _ConvertAnnotationSet(annotation_set)
+        if method_annotations:
+          methods_annotations[dexfile.GetMethodName(
+              method_idx)] = method_annotations
+
+    superclass = None
+    if class_def.superclass_idx != _NO_INDEX:
+      superclass = _DescriptorToDot(
+          dexfile.GetTypeString(class_def.superclass_idx))
+
+    package = results.setdefault(package_name, {'classes': {}})
+    package['classes'][class_name] = {
+        'methods':
+        methods,
+        'superclass':
+        superclass,
+        'is_abstract':
+        bool(class_def.access_flags & _ACC_ABSTRACT),
+        'annotations':
+        Annotations(classAnnotations=class_annotations,
+                    methodsAnnotations=methods_annotations),
+    }
+  return results
+
+
+def _DescriptorToDot(descriptor):
+  if descriptor.startswith('L') and descriptor.endswith(';'):
+    descriptor = descriptor[1:-1]
+  return descriptor.replace('/', '.')
+
+
+def _ConvertAnnotationSet(annotation_set):
+  """Converts dex_parser.Annotations to the format parsed from dexdump."""
+  ret = {}
+  for annotation in annotation_set:
+    if annotation.visibility != dex_parser.VISIBILITY_RUNTIME:
+      continue
+    name = annotation.type[:-1].rsplit('/', 1)[-1]
+    ret[name] = {
+        k: _ConvertAnnotationValue(v)
+        for k, v in annotation.elements.items()
+    } or None
+  return ret
+
+
+def _ConvertAnnotationValue(value):
+  """Formats an annotation value the way dexdump does."""
+  if isinstance(value, list):
+    return [_ConvertAnnotationValue(v) for v in value]
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if value is None:
+    return 'null'
+  if isinstance(value, dex_parser.EncodedType):
+    return _DescriptorToDot(value.descriptor)
+  if isinstance(value, dex_parser.Annotation):
+    # E.g. @Restriction(@Feature("Foo")), which dexdump does not show either.
+    return {
+        k: _ConvertAnnotationValue(v)
+        for k, v in value.elements.items()
+    }
+  return str(value)
+
+
 def _ParseAnnotationValues(values_str):
   if not values_str:
     return None
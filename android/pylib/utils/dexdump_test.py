@@ -3,9 +3,15 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import os
+import struct
+import tempfile
 import unittest
+from unittest import mock
+import zipfile
 from xml.etree import ElementTree
 
+from pylib.dex import dex_parser
 from pylib.utils import dexdump
 
 # pylint: disable=protected-access
@@ -203,5 +209,300 @@ class DexdumpXMLParseTest(unittest.TestCase):
     self.assertEqual(expected, actual)
 
 
+
+def _ULeb128(value):
+  ret = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      ret.append(byte | 0x80)
+    else:
+      ret.append(byte)
+      return bytes(ret)
+
+
+class _DexBuilder:
+  """Writes minimal dex files containing classes, methods and annotations."""
+
+  def __init__(self):
+    self._strings = []
+    self._types = []
+    self._methods = []
+    self._classes = []
+
+  def _String(self, string):
+    if string not in self._strings:
+      self._strings.append(string)
+    return self._strings.index(string)
+
+  def _Type(self, descriptor):
+    string_idx = self._String(descriptor)
+    if string_idx not in self._types:
+      self._types.append(string_idx)
+    return self._types.index(string_idx)
+
+  def _Method(self, class_descriptor, name):
+    self._methods.append((self._Type(class_descriptor), self._String(name)))
+    return len(self._methods) - 1
+
+  def StringValue(self, string):
+    return bytes([0x17]) + struct.pack('<B', self._String(string))
+
+  def TypeValue(self, descriptor):
+    return bytes([0x18]) + struct.pack('<B', self._Type(descriptor))
+
+  @staticmethod
+  def IntValue(value):
+    return bytes([0x04 | (3 << 5)]) + struct.pack('<i', value)
+
+  @staticmethod
+  def ArrayValue(values):
+    return bytes([0x1c]) + _ULeb128(len(values)) + b''.join(values)
+
+  def Annotation(self, descriptor, visibility=1, **elements):
+    return bytes([visibility]) + self._EncodedAnnotation(descriptor, elements)
+
+  def AnnotationValue(self, descriptor, **elements):
+    return bytes([0x1d]) + self._EncodedAnnotation(descriptor, elements)
+
+  def _EncodedAnnotation(self, descriptor, elements):
+    ret = _ULeb128(self._Type(descriptor)) + _ULeb128(len(elements))
+    for name, value in elements.items():
+      ret += _ULeb128(self._String(name)) + value
+    return ret
+
+  def AddClass(self,
+               descriptor,
+               methods,
+               access_flags=0x1,
+               annotations=(),
+               method_annotations=None):
+    """Adds a class.
+
+    Args:
+      descriptor: Class descriptor, e.g. 'Lorg/Foo;'.
+      methods: List of (name, access_flags).
+      access_flags: Class access flags.
+      annotations: List of encoded class annotations.
+      method_annotations: Dict of method name to encoded annotations.
+    """
+    method_annotations = method_annotations or {}
+    class_idx = self._Type(descriptor)
+    superclass_idx = self._Type('Ljava/lang/Object;')
+    encoded_methods = []
+    annotated_methods = []
+    for name, flags in methods:
+      method_idx = self._Method(descriptor, name)
+      encoded_methods.append((method_idx, flags))
+      if name in method_annotations:
+        annotated_methods.append((method_idx, method_annotations[name]))
+    self._classes.append((class_idx, access_flags, superclass_idx,
+                          encoded_methods, list(annotations),
+                          annotated_methods))
+
+  def Build(self):
+    void_type = self._Type('V')
+    shorty = self._String('V')
+    out = bytearray(0x70)
+
+    def align():
+      out.extend(bytes(-len(out) % 4))
+
+    # Data items referenced from the id sections are written first.
+    def write_annotation_set(annotations):
+      annotation_offs = []
+      for annotation in annotations:
+        annotation_offs.append(len(out))
+        out.extend(annotation)
+      align()
+      off = len(out)
+      out.extend(struct.pack('<I', len(annotation_offs)))
+      for annotation_off in annotation_offs:
+        out.extend(struct.pack('<I', annotation_off))
+      return off
+
+    class_defs = []
+    for (class_idx, access_flags, superclass_idx, encoded_methods,
+         annotations, annotated_methods) in self._classes:
+      class_data_off = len(out)
+      out.extend(_ULeb128(0) + _ULeb128(0) + _ULeb128(0) +
+                 _ULeb128(len(encoded_methods)))
+      prev_idx = 0
+      for method_idx, flags in encoded_methods:
+        out.extend(
+            _ULeb128(method_idx - prev_idx) + _ULeb128(flags) + _ULeb128(0))
+        prev_idx = method_idx
+      align()
+      class_annotations_off = 0
+      if annotations:
+        class_annotations_off = write_annotation_set(annotations)
+      method_set_offs = [(idx, write_annotation_set(a))
+                         for idx, a in annotated_methods]
+      annotations_off = len(out)
+      out.extend(
+          struct.pack('<IIII', class_annotations_off, 0, len(method_set_offs),
+                      0))
+      for idx, off in method_set_offs:
+        out.extend(struct.pack('<II', idx, off))
+      class_defs.append((class_idx, access_flags, superclass_idx, 0, 0,
+                         annotations_off, class_data_off, 0))
+
+    string_data_offs = []
+    for string in self._strings:
+      string_data_offs.append(len(out))
+      out.extend(_ULeb128(len(string)) + string.encode('utf-8') + b'\0')
+    align()
+
+    def write_section(items, fmt):
+      off = len(out)
+      for item in items:
+        out.extend(struct.pack(fmt, *item))
+      return off
+
+    string_ids_off = write_section([(o, ) for o in string_data_offs], '<I')
+    type_ids_off = write_section([(t, ) for t in self._types], '<I')
+    proto_ids_off = write_section([(shorty, void_type, 0)], '<III')
+    method_ids_off = write_section(
+        [(class_idx, 0, name_idx) for class_idx, name_idx in self._methods],
+        '<HHI')
+    class_defs_off = write_section(class_defs, '<IIIIIIII')
+    map_off = write_section([(0, )], '<I')
+
+    header = [
+        b'dex\n035\0', 0, bytes(20),
+        len(out), 0x70, 0x12345678, 0, 0, map_off,
+        len(self._strings), string_ids_off,
+        len(self._types), type_ids_off, 1, proto_ids_off, 0, 0,
+        len(self._methods), method_ids_off,
+        len(class_defs), class_defs_off, 0, 0
+    ]
+    struct.pack_into('<8sI20sIIIIIIIIIIIIIIIIIIII', out, 0, *header)
+    return out
+
+
+class DexParserDumpTest(unittest.TestCase):
+
+  def _CreateDex(self):
+    builder = _DexBuilder()
+    builder.AddClass(
+        'Lorg/chromium/FooTest;', [('<init>', 0x10001), ('testOne', 0x1),
+                                   ('testTwo', 0x1), ('helper', 0x2)],
+        annotations=[
+            builder.Annotation('Lorg/chromium/Batch;',
+                               value=builder.StringValue('UnitTests')),
+            builder.Annotation('Ldalvik/annotation/Signature;',
+                               visibility=2,
+                               value=builder.StringValue('ignored')),
+        ],
+        method_annotations={
+            'testOne': [
+                builder.Annotation('Landroidx/test/filters/SmallTest;'),
+                builder.Annotation('Lorg/chromium/Feature;',
+                                   value=builder.ArrayValue([
+                                       builder.StringValue('Cronet'),
+                                       builder.StringValue('Two words'),
+                                   ])),
+            ],
+            'testTwo': [
+                builder.Annotation('Lorg/chromium/MinSdk;',
+                                   value=builder.IntValue(28),
+                                   runner=builder.TypeValue(
+                                       'Lorg/chromium/Runner;'),
+                                   nested=builder.AnnotationValue(
+                                       'Lorg/chromium/Nested;',
+                                       names=builder.ArrayValue([
+                                           builder.StringValue('a'),
+                                       ]))),
+            ],
+        })
+    builder.AddClass('Lorg/chromium/FooTest$BaseTest;', [('testBase', 0x1)],
+                     access_flags=0x401)
+    return bytes(builder.Build())
+
+  def testParseDexFile(self):
+    dexfile = dex_parser.DexFile(bytearray(self._CreateDex()))
+    actual = dexdump.ParseDexFile(dexfile)
+    expected = {
+        'org.chromium': {
+            'classes': {
+                'FooTest': {
+                    'methods': ['testOne', 'testTwo'],
+                    'superclass': 'java.lang.Object',
+                    'is_abstract': False,
+                    'annotations':
+                    dexdump.Annotations(
+                        classAnnotations={'Batch': {
+                            'value': 'UnitTests'
+                        }},
+                        methodsAnnotations={
+                            'testOne': {
+                                'SmallTest': None,
+                                'Feature': {
+                                    'value': ['Cronet', 'Two words']
+                                },
+                            },
+                            'testTwo': {
+                                'MinSdk': {
+                                    'value': '28',
+                                    'runner': 'org.chromium.Runner',
+                                    'nested': {
+                                        'names': ['a']
+                                    },
+                                },
+                            },
+                        }),
+                },
+                'FooTest.BaseTest': {
+                    'methods': ['testBase'],
+                    'superclass': 'java.lang.Object',
+                    'is_abstract': True,
+                    'annotations': emptyAnnotations,
+                },
+            }
+        }
+    }
+    self.assertEqual(expected, actual)
+
+  def testDumpInProcess_cachesByChecksum(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      apk_path = os.path.join(tmp_dir, 'test.apk')
+      cache_path = os.path.join(tmp_dir, 'cache.json')
+      with zipfile.ZipFile(apk_path, 'w') as z:
+        z.writestr('classes.dex', self._CreateDex())
+        z.writestr('classes2.dex', _DexBuilder().Build())
+      expected = [
+          dexdump.ParseDexFile(dex_parser.DexFile(bytearray(
+              self._CreateDex()))), {}
+      ]
+      self.assertEqual(expected,
+                       dexdump.DumpInProcess(apk_path, cache_path=cache_path))
+      self.assertTrue(os.path.exists(cache_path))
+
+      with mock.patch.object(dexdump,
+                                      '_ParseDexFileInApk') as mock_parse:
+        self.assertEqual(
+            expected, dexdump.DumpInProcess(apk_path, cache_path=cache_path))
+        mock_parse.assert_not_called()
+
+
+  def testDexFileFromPath(self):
+    builder = _DexBuilder()
+    builder.AddClass('Lorg/Caf\u00e9Test;', [('testCaf\u00e9', 0x1)])
+    with tempfile.NamedTemporaryFile(suffix='.dex') as f:
+      f.write(builder.Build())
+      f.flush()
+      dexfile = dex_parser.DexFile.FromPath(f.name)
+      self.assertEqual([('Lorg/Caf\u00e9Test;', 'V', 'testCaf\u00e9', ())],
+                       list(dexfile.IterMethodSignatureParts()))
+      self.assertEqual(['Lorg/Caf\u00e9Test;', 'Ljava/lang/Object;', 'V'],
+                       list(dexfile.IterTypeStrings()))
+      self.assertEqual('V', dexfile.string_item_list[-1].data)
+      self.assertEqual(dexfile.class_def_item_list[0],
+                       list(dexfile.class_def_item_list)[0])
+      with self.assertRaises(IndexError):
+        dexfile.method_item_list[1]  # pylint: disable=pointless-statement
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Historical test durations, and partitioning of tests by expected duration.
+
+Durations are kept in a local JSON file and fed from the --json-results-file
+output of previous runs. When external shards each partition the test list on
+their own, they must all read the same durations, or tests may be run twice or
+skipped. Shards must therefore not update the file they read while others may
+still be reading it.
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import os
+import statistics
+import sys
+
+# Bump whenever the format of the durations file changes.
+_FORMAT_VERSION = 1
+# Weight of the newest duration in the moving average of a test's duration.
+_NEW_DURATION_WEIGHT = 0.5
+# Expected duration of tests without history when no history exists at all.
+_DEFAULT_DURATION_MS = 1000
+
+
+class TestDurationStore:
+  """Expected test durations, keyed by test name."""
+
+  def __init__(self, path=None):
+    """Loads durations from |path|, if it exists.
+
+    Args:
+      path: Path of the JSON file durations are kept in.
+    """
+    self._path = path
+    self._durations = {}
+    self._default_duration = None
+    if path and os.path.exists(path):
+      try:
+        with open(path) as f:
+          data = json.load(f)
+        if data.get('version') == _FORMAT_VERSION:
+          self._durations = data['durations']
+      except ValueError:
+        logging.warning('Ignoring corrupt test durations file: %s', path)
+
+  def __len__(self):
+    return len(self._durations)
+
+  def __iter__(self):
+    return iter(self._durations)
+
+  def __contains__(self, test_name):
+    return test_name in self._durations
+
+  def GetDuration(self, test_name):
+    """Returns the expected duration of |test_name| in milliseconds.
+
+    Tests without history are expected to take the median known duration.
+    """
+    duration = self._durations.get(test_name)
+    if duration is not None:
+      return duration
+    if self._default_duration is None:
+      self._default_duration = (statistics.median(self._durations.values())
+                                if self._durations else _DEFAULT_DURATION_MS)
+    return self._default_duration
+
+  def AddDuration(self, test_name, duration_ms):
+    old_duration = self._durations.get(test_name)
+    if old_duration is not None:
+      duration_ms = (_NEW_DURATION_WEIGHT * duration_ms +
+                     (1 - _NEW_DURATION_WEIGHT) * old_duration)
+    self._durations[test_name] = duration_ms
+    self._default_duration = None
+
+  def _AddFastestDurations(self, named_durations):
+    """Adds the fastest non-zero duration given for each test.
+
+    Where a test ran several times in one iteration, the slower runs are
+    usually retries of a failure.
+
+    Args:
+      named_durations: An iterable of (test name, duration in ms) tuples.
+    """
+    fastest = {}
+    for test_name, duration in named_durations:
+      if duration:
+        fastest[test_name] = min(duration, fastest.get(test_name, duration))
+    for test_name, duration in fastest.items():
+      self.AddDuration(test_name, duration)
+
+  def UpdateFromResults(self, results):
+    """Adds the durations of one iteration's |results|.
+
+    Args:
+      results: An iterable of base_test_result.BaseTestResults, from all tries
+        of one iteration. The fastest run of each test is used.
+    """
+    self._AddFastestDurations((r.GetName(), r.GetDuration()) for r in results)
+
+  def UpdateFromJsonResults(self, json_results):
+    """Adds durations from a dict in the format of --json-results-file.
+
+    The fastest run of each test in each iteration is used.
+    """
+    for iteration in json_results['per_iteration_data']:
+      self._AddFastestDurations((test_name, r['elapsed_time_ms'])
+                                for test_name, test_runs in iteration.items()
+                                for r in test_runs)
+
+  def Save(self, path=None):
+    """Writes the durations to |path|, or to the file they were loaded from."""
+    path = path or self._path
+    if not path:
+      return
+    tmp_path = path + '.tmp'
+    data = {'version': _FORMAT_VERSION, 'durations': self._durations}
+    with open(tmp_path, 'w') as f:
+      json.dump(data, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def PartitionByDuration(tests, num_desired_partitions, max_partition_size,
+                        get_duration, get_count, get_name):
+  """Partitions |tests| so that partitions take about the same time to run.
+
+  Uses the longest-processing-time-first heuristic: the longest tests are
+  assigned first, each to the partition with the least expected duration.
+
+  Args:
+    tests: List of tests or test groups. Groups are never split up.
+    num_desired_partitions: Number of partitions to create.
+    max_partition_size: Maximum number of tests in a partition, as counted by
+      |get_count|. Extra partitions are created when needed.
+    get_duration: Returns the expected duration of an element of |tests|.
+    get_count: Returns the number of tests in an element of |tests|.
+    get_name: Returns a name for an element of |tests|, used to break ties
+      between tests with the same expected duration.
+
+  Returns:
+    A list of non-empty partitions. The elements of each partition keep their
+    relative order from |tests|.
+  """
+  if not tests:
+    return []
+
+  def sort_key(i):
+    tie_breaker = hashlib.sha256(get_name(tests[i]).encode()).hexdigest()
+    return (-get_duration(tests[i]), tie_breaker)
+
+  # Heap of (expected duration, partition index).
+  heap = [(0, i) for i in range(num_desired_partitions)]
+  partitions = [[] for _ in range(num_desired_partitions)]
+  sizes = [0] * num_desired_partitions
+  for i in sorted(range(len(tests)), key=sort_key):
+    count = get_count(tests[i])
+    full = []
+    while heap:
+      duration, index = heapq.heappop(heap)
+      # Groups larger than max_partition_size still go into an empty
+      # partition rather than being split up.
+      if sizes[index] == 0 or sizes[index] + count <= max_partition_size:
+        break
+      full.append((duration, index))
+    else:
+      duration, index = 0, len(partitions)
+      partitions.append([])
+      sizes.append(0)
+    partitions[index].append(i)
+    sizes[index] += count
+    heapq.heappush(heap, (duration + get_duration(tests[i]), index))
+    for item in full:
+      heapq.heappush(heap, item)
+
+  return [[tests[i] for i in sorted(p)] for p in partitions if p]
+
+
+def _Makespan(partitions, get_duration):
+  return max(sum(get_duration(t) for t in p) for p in partitions)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Updates a test durations file from json results, and '
+      'predicts how much shorter the slowest shard would be if tests were '
+      'partitioned by duration rather than by count.')
+  parser.add_argument('--durations-file',
+                      help='Test durations file to read and update.')
+  parser.add_argument('--num-shards',
+                      type=int,
+                      default=4,
+                      help='Number of shards to simulate.')
+  parser.add_argument('--update',
+                      action='store_true',
+                      help='Save durations read from json results.')
+  parser.add_argument('json_results',
+                      nargs='*',
+                      help='--json-results-file outputs of previous runs. The '
+                      'tests of the last one are used for the simulation.')
+  args = parser.parse_args()
+
+  store = TestDurationStore(args.durations_file)
+  tests = sorted(store)
+  for path in args.json_results:
+    with open(path) as f:
+      json_results = json.load(f)
+    store.UpdateFromJsonResults(json_results)
+    tests = sorted(json_results['all_tests'])
+  if args.update:
+    store.Save()
+  if not tests:
+    parser.error('No tests to simulate.')
+
+  # Mirrors the hash-sorted, count-based linear partitioning.
+  tests.sort(key=lambda t: hashlib.sha256(t.encode()).hexdigest())
+  by_count = [
+      tests[i * len(tests) // args.num_shards:(i + 1) * len(tests) //
+            args.num_shards] for i in range(args.num_shards)
+  ]
+  by_count = [p for p in by_count if p]
+  by_duration = PartitionByDuration(tests, args.num_shards, float('inf'),
+                                    store.GetDuration, lambda _: 1,
+                                    lambda t: t)
+  count_makespan = _Makespan(by_count, store.GetDuration)
+  duration_makespan = _Makespan(by_duration, store.GetDuration)
+  total = sum(store.GetDuration(t) for t in tests)
+  print('Tests: {} ({} with history)'.format(len(tests),
+                                             sum(1 for t in tests
+                                                 if t in store)))
+  print('Ideal slowest shard: {:.1f}s'.format(total / args.num_shards / 1000))
+  print('Slowest shard, partitioned by count: {:.1f}s'.format(count_makespan /
+                                                               1000))
+  print('Slowest shard, partitioned by duration: {:.1f}s'.format(
+      duration_makespan / 1000))
+  if duration_makespan:
+    print('Predicted speedup: {:.2f}x'.format(count_makespan /
+                                              duration_makespan))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env vpython3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import tempfile
+import unittest
+
+from pylib.base import base_test_result
+from pylib.utils import test_durations
+
+
+class TestDurationStoreTest(unittest.TestCase):
+
+  def testUpdateFromJsonResults(self):
+    store = test_durations.TestDurationStore()
+    store.UpdateFromJsonResults({
+        'per_iteration_data': [{
+            'A.a': [{
+                'elapsed_time_ms': 300
+            }, {
+                'elapsed_time_ms': 100
+            }],
+            'A.b': [{
+                'elapsed_time_ms': 0
+            }],
+        }, {
+            'A.a': [{
+                'elapsed_time_ms': 300
+            }],
+        }]
+    })
+    self.assertEqual(200, store.GetDuration('A.a'))
+    self.assertNotIn('A.b', store)
+    # Unknown tests take the median known duration.
+    self.assertEqual(200, store.GetDuration('A.c'))
+
+  def testUpdateFromResults(self):
+    store = test_durations.TestDurationStore()
+    pass_type = base_test_result.ResultType.PASS
+    fail_type = base_test_result.ResultType.FAIL
+    # The results of two tries, in which A.a was retried.
+    store.UpdateFromResults([
+        base_test_result.BaseTestResult('A.a', fail_type, duration=300),
+        base_test_result.BaseTestResult('A.b', pass_type, duration=0),
+        base_test_result.BaseTestResult('A.a', pass_type, duration=100),
+    ])
+    store.UpdateFromResults(
+        [base_test_result.BaseTestResult('A.a', pass_type, duration=300)])
+    self.assertEqual(200, store.GetDuration('A.a'))
+    self.assertNotIn('A.b', store)
+
+  def testSaveAndLoad(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, 'durations.json')
+      store = test_durations.TestDurationStore(path)
+      self.assertEqual(0, len(store))
+      store.AddDuration('A.a', 10)
+      store.Save()
+      self.assertEqual(10, test_durations.TestDurationStore(path).GetDuration(
+          'A.a'))
+
+      with open(path, 'w') as f:
+        f.write('not json')
+      self.assertEqual(0, len(test_durations.TestDurationStore(path)))
+
+
+class PartitionByDurationTest(unittest.TestCase):
+
+  @staticmethod
+  def _Partition(durations, num_partitions, max_partition_size=float('inf')):
+    return test_durations.PartitionByDuration(sorted(durations),
+                                              num_partitions,
+                                              max_partition_size,
+                                              durations.get, lambda _: 1,
+                                              lambda t: t)
+
+  def testBalancesByDuration(self):
+    durations = {'a': 90, 'b': 30, 'c': 30, 'd': 30, 'e': 10, 'f': 10}
+
+    def loads(partitions):
+      return sorted((sum(durations[t] for t in p) for p in partitions),
+                    reverse=True)
+
+    self.assertEqual([100, 100], loads(self._Partition(durations, 2)))
+    self.assertEqual([90, 60, 50], loads(self._Partition(durations, 3)))
+    # Tests keep their relative order within a partition.
+    for partition in self._Partition(durations, 2):
+      self.assertEqual(sorted(partition), partition)
+
+  def testMaxPartitionSize(self):
+    durations = {'a': 10, 'b': 10, 'c': 10, 'd': 10, 'e': 10}
+    partitions = self._Partition(durations, 2, max_partition_size=2)
+    self.assertEqual([2, 2, 1], sorted((len(p) for p in partitions),
+                                       reverse=True))
+
+  def testFewerTestsThanPartitions(self):
+    self.assertEqual([['a']], self._Partition({'a': 1}, 3))
+    self.assertEqual([], self._Partition({}, 3))
+
+  def testStableUnderSmallChanges(self):
+    durations = {chr(ord('a') + i): 10 + i for i in range(20)}
+    before = self._Partition(durations, 4)
+    durations['zz'] = 1
+    after = self._Partition(durations, 4)
+    self.assertEqual(before, [[t for t in p if t != 'zz'] for p in after])
+
+
+if __name__ == '__main__':
+  unittest.main()
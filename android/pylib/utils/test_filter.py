@@ -2,12 +2,14 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import fnmatch
 import os
 import re
 
 
 _CMDLINE_NAME_SEGMENT_RE = re.compile(
     r' with(?:out)? \{[^\}]*\}')
+_GLOB_CHARS_RE = re.compile(r'[*?\[]')
 
 
 def ParseFilterFile(input_lines):
@@ -143,3 +145,79 @@ def InitializeFiltersFromArgs(args):
         test_filters.append(filter_string)
 
   return test_filters
+
+
+class _PatternSet:
+  """A set of googletest-style patterns that can be matched in one pass.
+
+  Patterns without wildcards are looked up in a set, while the rest are
+  compiled into a single regular expression.
+  """
+
+  def __init__(self, patterns):
+    self._exact = set()
+    globs = []
+    for pattern in patterns:
+      if _GLOB_CHARS_RE.search(pattern):
+        globs.append(pattern)
+      else:
+        self._exact.add(pattern)
+    self._regex = None
+    if globs:
+      self._regex = re.compile('|'.join(fnmatch.translate(g) for g in globs))
+
+  def Matches(self, name):
+    return name in self._exact or bool(self._regex and self._regex.match(name))
+
+  def MatchesAny(self, names):
+    return any(self.Matches(n) for n in names)
+
+
+class CompiledFilter:
+  """A googletest-style filter string compiled for repeated matching.
+
+  Use this instead of calling unittest_util.FilterTestNames() once per filter
+  when filtering large numbers of tests.
+  """
+
+  def __init__(self, filter_str):
+    """Compiles |filter_str|.
+
+    Args:
+      filter_str: googletest-style filter string, e.g. 'Foo.*:Bar.*-*.baz'.
+    """
+    # Mirrors unittest_util.FilterTestNames().
+    pattern_groups = filter_str.split('-')
+    self._positive = None
+    if pattern_groups[0]:
+      self._positive = _PatternSet(pattern_groups[0].split(':'))
+    self._negative = None
+    if len(pattern_groups) > 1:
+      self._negative = _PatternSet(pattern_groups[1].split(':'))
+
+  def Matches(self, name):
+    """Returns whether the test called |name| passes the filter."""
+    return self.MatchesAny((name, ))
+
+  def MatchesAny(self, names):
+    """Returns whether a test known by several |names| passes the filter.
+
+    The test passes if any of its names matches a positive pattern and none of
+    them matches a negative pattern.
+    """
+    if self._positive and not self._positive.MatchesAny(names):
+      return False
+    return not (self._negative and self._negative.MatchesAny(names))
+
+  def Filter(self, names):
+    """Returns the subset of |names| that passes the filter, in order."""
+    return [n for n in names if self.Matches(n)]
+
+
+def CompileFilters(filter_strs):
+  """Returns a CompiledFilter for each of |filter_strs|.
+
+  Args:
+    filter_strs: A list of googletest-style filter strings, or None.
+  """
+  return [CompiledFilter(f) for f in filter_strs or []]
@@ -252,5 +252,55 @@ class HasPositivePatterns(unittest.TestCase):
     self.assertEqual(actual, expected)
 
 
+class CompiledFilterTest(unittest.TestCase):
+  def testEmpty(self):
+    compiled = test_filter.CompiledFilter('')
+    self.assertTrue(compiled.Matches('Foo.bar'))
+
+  def testExactAndWildcardPositive(self):
+    compiled = test_filter.CompiledFilter('Foo.bar:Baz.*:Qu?x.[ab]')
+    self.assertEqual(['Foo.bar', 'Baz.one', 'Quux.a'],
+                     compiled.Filter([
+                         'Foo.bar', 'Foo.barbar', 'Baz.one', 'Quux.a',
+                         'Quux.c', 'Other.test'
+                     ]))
+
+  def testNegative(self):
+    compiled = test_filter.CompiledFilter('Foo.*-Foo.skip:*.flaky*')
+    self.assertEqual(['Foo.run'],
+                     compiled.Filter(
+                         ['Foo.run', 'Foo.skip', 'Foo.flakyOne', 'Bar.run']))
+
+  def testOnlyNegative(self):
+    compiled = test_filter.CompiledFilter('-Foo.*')
+    self.assertEqual(['Bar.run'], compiled.Filter(['Foo.run', 'Bar.run']))
+
+  def testMatchesAny(self):
+    compiled = test_filter.CompiledFilter('Foo.run-org.Foo.run')
+    self.assertTrue(compiled.MatchesAny(['a.Foo.run', 'Foo.run']))
+    self.assertFalse(compiled.MatchesAny(['org.Foo.run', 'Foo.run']))
+    self.assertFalse(compiled.MatchesAny(['Bar.run']))
+
+  def testMultipleGroups(self):
+    names = ['A.a', 'A.b', 'B.a', 'B.b', 'C.DISABLED_a']
+    expectations = [
+        ('*-A.*', ['B.a', 'B.b', 'C.DISABLED_a']),
+        ('-*.DISABLED_*:A.b', ['A.a', 'B.a', 'B.b']),
+        ('*.a:B.b', ['A.a', 'B.a', 'B.b']),
+        ('*.?-B.[a]', ['A.a', 'A.b', 'B.b']),
+    ]
+    for filter_str, expected in expectations:
+      self.assertEqual(expected,
+                       test_filter.CompiledFilter(filter_str).Filter(names),
+                       filter_str)
+
+  def testCompileFilters(self):
+    self.assertEqual([], test_filter.CompileFilters(None))
+    compiled = test_filter.CompileFilters(['A.*', '-A.b'])
+    self.assertEqual(['A.a'],
+                     [n for n in ['A.a', 'A.b', 'B.a']
+                      if all(f.Matches(n) for f in compiled)])
+
+
 if __name__ == '__main__':
   sys.exit(unittest.main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Runs a python action via python_action_worker.py when it is running.
+
+Usage: python_action_client.py path/to/script.py [args...]
+
+This is a drop-in replacement for "python3 path/to/script.py [args...]". When
+a worker for the current directory is running, the script is run by a process
+forked from the worker (which already has common modules imported), with this
+process's stdin, stdout and stderr. Otherwise, or if the worker cannot run the
+script exactly as python3 would, this process execs python3 instead.
+
+Only the standard library modules needed to talk to the worker are imported
+here so that startup stays cheap.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import socket
+import sys
+
+# Environment variables read by modules that the worker imports ahead of time.
+# Requests are run by the worker only when these match.
+IMPORT_TIME_ENV_VARIABLES = (
+    'CHECKOUT_SOURCE_ROOT',
+    'FORCE_REBUILD',
+    'MD5_CHECK_CACHE_DIR',
+    'PRINT_BUILD_EXPLANATIONS',
+    'PYTHONHASHSEED',
+    'PYTHONPATH',
+)
+
+# Only scripts within this directory are run by the worker.
+ACTION_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'gyp')
+
+
+def socket_address(cwd):
+  """Returns the abstract socket address of the worker for |cwd|."""
+  # Modules imported by the worker compute paths relative to the working
+  # directory, so there is one worker per output directory.
+  digest = hashlib.sha1(os.path.realpath(cwd).encode('utf-8')).hexdigest()
+  return f'\0chromium_python_action_worker_{os.getuid()}_{digest[:16]}'
+
+
+def recv_json(sock):
+  """Reads one newline-terminated JSON message, or returns None on EOF."""
+  buf = b''
+  while not buf.endswith(b'\n'):
+    data = sock.recv(4096)
+    if not data:
+      return None
+    buf += data
+  return json.loads(buf)
+
+
+def _exec_python(argv):
+  os.execv(sys.executable, [sys.executable] + argv)
+
+
+def _run_in_worker(argv):
+  """Returns the exit code, or None if the worker did not run the script."""
+  sock = socket.socket(socket.AF_UNIX)
+  try:
+    sock.connect(socket_address(os.getcwd()))
+  except OSError:
+    sock.close()
+    return None
+
+  with sock:
+    request = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'python_version': sys.version,
+    }
+    payload = json.dumps(request).encode('utf-8') + b'\n'
+    # Pass our stdio so that output is written exactly where it would be.
+    num_sent = socket.send_fds(sock, [payload], [0, 1, 2])
+    sock.sendall(payload[num_sent:])
+    reply = recv_json(sock)
+    if reply is None or 'pid' not in reply:
+      return None
+
+    def forward_signal(signum, _):
+      try:
+        os.kill(reply['pid'], signum)
+      except ProcessLookupError:
+        pass
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+      signal.signal(signum, forward_signal)
+
+    result = recv_json(sock)
+
+  if result is None:
+    sys.stderr.write('python_action_client.py: Lost connection to worker.\n')
+    return 1
+  if 'signal' in result:
+    # Die the same way the script did.
+    signal.signal(result['signal'], signal.SIG_DFL)
+    os.kill(os.getpid(), result['signal'])
+  return result['exit_code']
+
+
+def main(argv):
+  if not argv:
+    sys.stderr.write(__doc__)
+    return 1
+  script = os.path.abspath(argv[0])
+  if os.path.dirname(script) == ACTION_SCRIPTS_DIR:
+    exit_code = _run_in_worker(argv)
+    if exit_code is not None:
+      return exit_code
+  _exec_python(argv)
+  return 1  # Not reached.
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
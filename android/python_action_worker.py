@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Keeps modules used by android/gyp actions imported between actions.
+
+Every android/gyp action otherwise pays for python startup plus importing
+build_utils, action_helpers, zip_helpers, jinja2, protobuf, etc. This worker
+imports them once, then runs each action in a process forked from itself.
+Modules from the source tree are dropped from sys.modules before an action
+runs, since print_python_deps would otherwise list them as the action's inputs.
+The action imports those that it uses again, but from warm bytecode caches and
+with their standard library dependencies already imported.
+
+To use, run this from the output directory in a separate terminal:
+  $ ../../build/android/python_action_worker.py
+and launch actions via python_action_client.py rather than python3, e.g. by
+setting script_executable to it in the .gn dotfile. Actions behave exactly as
+they would otherwise: they write to the client's stdin/stdout/stderr, and the
+client exits with the action's exit code. The client falls back to running
+python3 when no worker is running.
+"""
+
+import argparse
+import atexit
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+import types
+
+import python_action_client
+
+_GYP_DIR = python_action_client.ACTION_SCRIPTS_DIR
+_SRC_ROOT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+
+# Modules imported ahead of time. Each entry is (module, extra sys.path
+# entries needed to import it, relative to the source root).
+_PRELOAD_MODULES = (
+    ('util.build_utils', ()),
+    ('util.md5_check', ()),
+    ('util.parallel', ()),
+    ('util.resource_utils', ()),
+    ('action_helpers', ()),
+    ('zip_helpers', ()),
+    ('jinja2', ('third_party', )),
+    ('google.protobuf', ('third_party/protobuf/python', )),
+)
+
+
+def _is_outside_source_tree(module):
+  # Mirrors which modules print_python_deps ignores.
+  path = getattr(module, '__file__', None)
+  return bool(path) and not os.path.abspath(path).startswith(_SRC_ROOT)
+
+
+def _preload_modules():
+  """Imports _PRELOAD_MODULES.
+
+  sys.path is restored afterwards, since actions import the modules again.
+
+  Returns:
+    The names of the modules that actions must import themselves: those
+    imported here or by this script that are from the source tree.
+  """
+  initial_modules = set(sys.modules)
+  initial_path = list(sys.path)
+  sys.path.insert(0, _GYP_DIR)
+  for module, extra_paths in _PRELOAD_MODULES:
+    extra_paths = [os.path.join(_SRC_ROOT, p) for p in extra_paths]
+    sys.path[1:1] = extra_paths
+    try:
+      importlib.import_module(module)
+    except ImportError as e:
+      print(f'Not preloading {module}: {e}')
+    del sys.path[1:1 + len(extra_paths)]
+  sys.path[:] = initial_path
+
+  names = {n for n in sys.modules if n not in initial_modules}
+  # Imported by this script rather than above.
+  names.add(python_action_client.__name__)
+  return {n for n in names if not _is_outside_source_tree(sys.modules[n])}
+
+
+def _is_action_script(path, scripts_dir):
+  """Returns whether |path| resolves to a file within |scripts_dir|."""
+  path = os.path.realpath(path)
+  scripts_dir = os.path.realpath(scripts_dir)
+  return os.path.commonpath([path, scripts_dir]) == scripts_dir
+
+
+def _incompatibility(request, scripts_dir):
+  """Returns why |request| cannot be run exactly as python3 would, or None."""
+  if request['cwd'] != os.getcwd():
+    return 'different working directory'
+  # Checked after the working directory, which relative paths are resolved
+  # against.
+  if not _is_action_script(request['argv'][0], scripts_dir):
+    return f'not in {scripts_dir}'
+  if request['python_version'] != sys.version:
+    return 'different python version'
+  for name in python_action_client.IMPORT_TIME_ENV_VARIABLES:
+    if request['env'].get(name) != os.environ.get(name):
+      return f'different value for ${name}'
+  return None
+
+
+def _reopen_stdio():
+  """Points sys.std* at fds 0-2 with the settings python3 would use."""
+  sys.stdin = open(0, 'r', closefd=False, encoding=sys.stdin.encoding)
+  sys.stdout = io.TextIOWrapper(open(1, 'wb', closefd=False),
+                                encoding=sys.stdout.encoding,
+                                line_buffering=os.isatty(1))
+  sys.stderr = io.TextIOWrapper(open(2, 'wb', closefd=False),
+                                encoding=sys.stderr.encoding,
+                                errors='backslashreplace',
+                                line_buffering=True)
+
+
+def _exit_code_for(exc):
+  """Mirrors how the interpreter turns a SystemExit into an exit code."""
+  code = exc.code
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code
+  print(code, file=sys.stderr)
+  return 1
+
+
+def _run_action(request, fds, preloaded_modules):
+  """Runs the action's script. Called in a forked process. Does not return."""
+  try:
+    for target_fd, fd in enumerate(fds):
+      os.dup2(fd, target_fd)
+      os.close(fd)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP,
+                   signal.SIGCHLD):
+      signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    _reopen_stdio()
+    os.environ.clear()
+    os.environ.update(request['env'])
+
+    for name in preloaded_modules:
+      del sys.modules[name]
+
+    script = request['argv'][0]
+    sys.argv = list(request['argv'])
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    # Installed so that e.g. pickle can find classes that the script defines.
+    main_module = types.ModuleType('__main__')
+    main_module.__file__ = script
+    main_module.__builtins__ = __builtins__
+    sys.modules['__main__'] = main_module
+  except BaseException:  # pylint: disable=broad-except
+    traceback.print_exc()
+    os._exit(1)
+
+  exit_code = 0
+  try:
+    try:
+      with io.open_code(script) as f:
+        code = compile(f.read(), script, 'exec')
+      exec(code, main_module.__dict__)  # pylint: disable=exec-used
+    except SystemExit as e:
+      exit_code = _exit_code_for(e)
+    except BaseException as e:  # pylint: disable=broad-except
+      # Omit this function's frame, as the interpreter would.
+      e.__traceback__ = e.__traceback__.tb_next
+      sys.excepthook(type(e), e, e.__traceback__)
+      exit_code = 1
+      if isinstance(e, KeyboardInterrupt):
+        # The interpreter exits via SIGINT in this case.
+        exit_code = -signal.SIGINT
+    # Shut down as the interpreter would: wait for non-daemon threads, then
+    # run handlers that the action registered (e.g. by build_utils).
+    threading._shutdown()  # pylint: disable=protected-access
+    atexit._run_exitfuncs()  # pylint: disable=protected-access
+    sys.stdout.flush()
+    sys.stderr.flush()
+  finally:
+    if exit_code == -signal.SIGINT:
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      os.kill(os.getpid(), signal.SIGINT)
+    os._exit(exit_code)
+
+
+def _send_json(sock, obj):
+  sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+def _peer_uid(conn):
+  """Returns the uid of the process at the other end of |conn|."""
+  creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                          struct.calcsize('3i'))
+  return struct.unpack('3i', creds)[1]
+
+
+def _handle_connection(conn, scripts_dir, preloaded_modules):
+  """Runs one request. Called in a forked process. Does not return."""
+  exit_code = 0
+  try:
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    data, fds, _, _ = socket.recv_fds(conn, 1024 * 1024, 3)
+    while not data.endswith(b'\n'):
+      chunk = conn.recv(1024 * 1024)
+      if not chunk:
+        raise Exception('Incomplete request')
+      data += chunk
+    request = json.loads(data)
+
+    if len(fds) != 3:
+      reason = 'expected stdin, stdout and stderr'
+    else:
+      reason = _incompatibility(request, scripts_dir)
+    if reason:
+      print(f'Not running {request["argv"][0]}: {reason}')
+      _send_json(conn, {'error': reason})
+      return
+
+    pid = os.fork()
+    if pid == 0:
+      conn.close()
+      _run_action(request, fds, preloaded_modules)
+    for fd in fds:
+      os.close(fd)
+    _send_json(conn, {'pid': pid})
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+      _send_json(conn, {'signal': os.WTERMSIG(status)})
+    else:
+      _send_json(conn, {'exit_code': os.WEXITSTATUS(status)})
+  except Exception:  # pylint: disable=broad-except
+    traceback.print_exc()
+    exit_code = 1
+  finally:
+    conn.close()
+    os._exit(exit_code)
+
+
+def _serve(sock, scripts_dir, preloaded_modules):
+  # Handlers are never waited on.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  while True:
+    conn = sock.accept()[0]
+    # The abstract socket namespace has no permissions, so any user could
+    # otherwise run code as this one.
+    peer_uid = _peer_uid(conn)
+    if peer_uid != os.getuid():
+      print(f'Rejected connection from uid {peer_uid}')
+      conn.close()
+      continue
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() == 0:
+      sock.close()
+      _handle_connection(conn, scripts_dir, preloaded_modules)
+    conn.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--action-scripts-dir',
+                      default=python_action_client.ACTION_SCRIPTS_DIR,
+                      help='Only run scripts within this directory. For '
+                      'testing.')
+  args = parser.parse_args()
+
+  preloaded_modules = _preload_modules()
+  with socket.socket(socket.AF_UNIX) as sock:
+    sock.bind(python_action_client.socket_address(os.getcwd()))
+    sock.listen()
+    print(f'READY for actions run from {os.getcwd()}')
+    try:
+      _serve(sock, args.action_scripts_dir, preloaded_modules)
+    except KeyboardInterrupt:
+      print('STOPPED')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+import python_action_client
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+_WORKER = os.path.join(_DIR, 'python_action_worker.py')
+
+# Runs a script through the worker regardless of where the script lives.
+_CLIENT_SNIPPET = textwrap.dedent(f"""\
+    import sys
+    sys.path.insert(0, {_DIR!r})
+    import python_action_client
+    code = python_action_client._run_in_worker(sys.argv[1:])
+    sys.exit(99 if code is None else code)
+    """)
+
+
+class PythonActionWorkerTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self._cwd = self._tmp_dir.name
+    self._worker = subprocess.Popen(
+        [sys.executable, _WORKER, '--action-scripts-dir', self._cwd],
+        cwd=self._cwd,
+        stdout=subprocess.DEVNULL)
+    address = python_action_client.socket_address(self._cwd)
+    for _ in range(100):
+      with socket.socket(socket.AF_UNIX) as sock:
+        if sock.connect_ex(address) == 0:
+          # Send a complete request, which the worker turns down, so that it
+          # does not fail reading one.
+          sock.sendall(json.dumps({'argv': ['probe.py']}).encode() + b'\n')
+          self.assertIn('error', python_action_client.recv_json(sock))
+          break
+      time.sleep(0.05)
+
+  def tearDown(self):
+    self._worker.terminate()
+    self._worker.wait()
+    self._tmp_dir.cleanup()
+
+  def _Compare(self, script_contents):
+    script = os.path.join(self._cwd, 'script.py')
+    with open(script, 'w') as f:
+      f.write(textwrap.dedent(script_contents))
+    args = [script, 'arg1', 'arg2']
+    expected = subprocess.run([sys.executable] + args,
+                              cwd=self._cwd,
+                              capture_output=True,
+                              text=True,
+                              check=False)
+    actual = subprocess.run([sys.executable, '-c', _CLIENT_SNIPPET] + args,
+                            cwd=self._cwd,
+                            capture_output=True,
+                            text=True,
+                            check=False)
+    self.assertEqual(expected.stdout, actual.stdout)
+    self.assertEqual(expected.stderr, actual.stderr)
+    self.assertEqual(expected.returncode, actual.returncode)
+
+  def testSuccess(self):
+    self._Compare("""\
+        import os, sys
+        print(sys.argv[1:], os.getcwd(), os.path.dirname(__file__) in sys.path)
+        with open('depfile.d', 'w') as f:
+          f.write('out: in')
+        """)
+    with open(os.path.join(self._cwd, 'depfile.d')) as f:
+      self.assertEqual('out: in', f.read())
+
+  def testExitCodes(self):
+    self._Compare('import sys; sys.exit(3)')
+    self._Compare('import sys; sys.exit("message")')
+
+  def testException(self):
+    self._Compare("""\
+        import sys
+        print('partial output')
+        print('error output', file=sys.stderr)
+        raise ValueError('oops')
+        """)
+
+  def testNonDaemonThread(self):
+    self._Compare("""\
+        import atexit, threading, time
+        atexit.register(print, 'at exit')
+        threading.Thread(target=lambda: (time.sleep(0.1), print('thread'))
+                         ).start()
+        """)
+
+  def testScriptOutsideActionScriptsDir(self):
+    with tempfile.TemporaryDirectory() as other_dir:
+      script = os.path.join(other_dir, 'script.py')
+      with open(script, 'w') as f:
+        f.write('print("ran")')
+      # Symlinks are resolved.
+      os.symlink(script, os.path.join(self._cwd, 'link.py'))
+      for path in (script, 'link.py'):
+        actual = subprocess.run([sys.executable, '-c', _CLIENT_SNIPPET, path],
+                                cwd=self._cwd,
+                                capture_output=True,
+                                check=False)
+        self.assertEqual(b'', actual.stdout)
+        self.assertEqual(99, actual.returncode)
+
+  def testImports(self):
+    self._Compare(f"""\
+        import pickle, sys
+        sys.path.insert(0, {os.path.dirname(_DIR)!r})
+        sys.path.insert(0, {os.path.join(_DIR, 'gyp')!r})
+        from util import build_utils
+        import print_python_deps
+        print(sorted(p for p in print_python_deps.ComputePythonDependencies()
+                     if p.startswith({os.path.dirname(_DIR)!r})))
+        print(sys.path)
+
+        class Foo:
+          pass
+
+        print(type(pickle.loads(pickle.dumps(Foo()))).__name__)
+        """)
+
+  def testAtExit(self):
+    self._Compare("""\
+        import atexit
+        atexit.register(print, 'at exit')
+        """)
+
+
+if __name__ == '__main__':
+  unittest.main()
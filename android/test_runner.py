@@ -52,6 +52,7 @@ from pylib.results.presentation import test_results_presentation
 from pylib.utils import local_utils
 from pylib.utils import logdog_helper
 from pylib.utils import logging_utils
+from pylib.utils import test_durations
 from pylib.utils import test_filter
 
 from py_utils import contextlib_ext
@@ -103,6 +104,19 @@ def AddTestLauncherOptions(parser):
       '--test-launcher-total-shards',
       type=int, default=os.environ.get('GTEST_TOTAL_SHARDS', 1),
       help='Total number of external shards.')
+  parser.add_argument(
+      '--test-durations-file',
+      type=os.path.realpath,
+      help='JSON file of historical test durations. If set, tests are '
+           'partitioned across devices and external shards by expected '
+           'duration. All external shards must use the same file.')
+  parser.add_argument(
+      '--test-durations-output-file',
+      type=os.path.realpath,
+      help='Where to write the durations of --test-durations-file, updated '
+           'with the durations of this run. May be --test-durations-file '
+           'itself, except with multiple external shards, which would then '
+           'read different durations and partition tests differently.')
 
   test_filter.AddFilterOptions(parser)
 
@@ -413,6 +427,12 @@ def AddGTestOptions(parser):
       '--app-data-file-dir',
       help='Host directory to which app data files will be'
            ' saved. Used with --app-data-file.')
+  parser.add_argument(
+      '--dynamic-device-dispatch',
+      action='store_true',
+      help='Split tests into many small shards that devices pull from a '
+           'shared queue as they become free, rather than into one shard per '
+           'device. Keeps fast devices busy when others are slow or lost.')
   parser.add_argument(
       '--enable-xml-result-parsing',
       action='store_true', help=argparse.SUPPRESS)
@@ -1119,6 +1139,14 @@ def RunTestsInPlatformMode(args, result_sink_client=None):
             global_tags=list(global_results_tags),
             indent=2)
 
+      if getattr(args, 'test_durations_output_file', None):
+        durations = test_durations.TestDurationStore(args.test_durations_file)
+        for run in all_raw_results:
+          # Each run holds the results of every try of one iteration.
+          durations.UpdateFromResults(r for results in run
+                                      for r in results.GetAll())
+        durations.Save(args.test_durations_output_file)
+
       test_class_to_file_name_dict = {}
       # Test Location is only supported for instrumentation tests as it
       # requires the size-info file.
@@ -1500,15 +1528,26 @@ def main():
       and not getattr(args, 'coverage_dir', '')):
     parser.error('--coverage-on-the-fly requires --coverage-dir')
 
+  if (getattr(args, 'test_durations_output_file', None)
+      and args.test_durations_output_file == args.test_durations_file
+      and args.test_launcher_total_shards > 1):
+    parser.error('--test-durations-output-file must differ from '
+                 '--test-durations-file with multiple external shards')
+
   if (getattr(args, 'debug_socket', None)
       or getattr(args, 'wait_for_java_debugger', None)):
     args.num_retries = 0
 
   # Result-sink may not exist in the environment if rdb stream is not enabled.
-  result_sink_client = result_sink.TryInitClient()
+  result_sink_client = result_sink.TryInitClient(buffered=True)
 
   try:
-    return RunTestsCommand(args, result_sink_client)
+    try:
+      return RunTestsCommand(args, result_sink_client)
+    finally:
+      # Uploads any test results that are still buffered.
+      if result_sink_client:
+        result_sink_client.close()
   except base_error.BaseError as e:
     logging.exception('Error occurred.')
     if e.is_infra_error:
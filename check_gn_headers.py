@@ -19,6 +19,8 @@ import sys
 import tempfile
 from multiprocessing import Process, Queue
 
+import ninja_deps
+
 SRC_DIR = os.path.abspath(
     os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir))
 DEPOT_TOOLS_DIR = os.path.join(SRC_DIR, 'third_party', 'depot_tools')
@@ -27,11 +29,10 @@ DEPOT_TOOLS_DIR = os.path.join(SRC_DIR, 'third_party', 'depot_tools')
 def GetHeadersFromNinja(out_dir, skip_obj, q):
   """Return all the header files from ninja_deps"""
 
+  ninja_path = os.path.join(SRC_DIR, 'third_party', 'ninja', 'ninja')
+
   def NinjaSource():
-    cmd = [
-        os.path.join(SRC_DIR, 'third_party', 'ninja', 'ninja'), '-C', out_dir,
-        '-t', 'deps'
-    ]
+    cmd = [ninja_path, '-C', out_dir, '-t', 'deps']
     # A negative bufsize means to use the system default, which usually
     # means fully buffered.
     popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=-1)
@@ -45,7 +46,17 @@ def GetHeadersFromNinja(out_dir, skip_obj, q):
 
   ans, err = set(), None
   try:
-    ans = ParseNinjaDepsOutput(NinjaSource(), out_dir, skip_obj)
+    deps_log = None
+    if os.path.exists(os.path.join(out_dir, ninja_deps.DEPS_LOG_FILENAME)):
+      try:
+        deps_log = ninja_deps.ReadDepsLog(out_dir)
+      except ValueError as e:
+        print('%s Falling back to "ninja -t deps".' % e)
+    if deps_log:
+      live_outputs = ninja_deps.GetBuildGraphOutputs(out_dir, ninja_path)
+      ans = GetHeadersFromDepsLog(deps_log, live_outputs, out_dir, skip_obj)
+    else:
+      ans = ParseNinjaDepsOutput(NinjaSource(), out_dir, skip_obj)
   except Exception as e:
     err = str(e)
   q.put((ans, err))
@@ -55,28 +66,17 @@ def ParseNinjaDepsOutput(ninja_out, out_dir, skip_obj):
   """Parse ninja output and get the header files"""
   all_headers = {}
 
-  # Ninja always uses "/", even on Windows.
-  prefix = '../../'
-
   is_valid = False
   obj_file = ''
   for line in ninja_out:
     if line.startswith('    '):
       if not is_valid:
         continue
-      if line.endswith('.h') or line.endswith('.hh'):
-        f = line.strip()
-        if f.startswith(prefix):
-          f = f[6:]  # Remove the '../../' prefix
-          # build/ only contains build-specific files like build_config.h
-          # and buildflag.h, and system header files, so they should be
-          # skipped.
-          if f.startswith(out_dir) or f.startswith('out'):
-            continue
-          if not f.startswith('build'):
-            all_headers.setdefault(f, [])
-            if not skip_obj:
-              all_headers[f].append(obj_file)
+      f = GetSourceHeader(line.strip(), out_dir)
+      if f:
+        all_headers.setdefault(f, [])
+        if not skip_obj:
+          all_headers[f].append(obj_file)
     else:
       is_valid = line.endswith('(VALID)')
       obj_file = line.split(':')[0]
@@ -84,6 +84,55 @@ def ParseNinjaDepsOutput(ninja_out, out_dir, skip_obj):
   return all_headers
 
 
+def GetHeadersFromDepsLog(deps_log, live_outputs, out_dir, skip_obj):
+  """Get the header files from a ninja_deps.DepsLog.
+
+  Returns the same as ParseNinjaDepsOutput() does for "ninja -t deps", which
+  skips dead entries: those of outputs not in |live_outputs|, the outputs of
+  the build graph.
+  """
+  # Paths are interned, so each one only needs to be checked once.
+  headers_by_id = {}
+  for path_id, path in enumerate(deps_log.paths):
+    f = GetSourceHeader(path, out_dir)
+    if f:
+      headers_by_id[path_id] = f
+
+  all_headers = {}
+  for obj_id, _mtime, dep_ids in deps_log.IterDeps():
+    obj_file = deps_log.paths[obj_id]
+    if obj_file not in live_outputs or deps_log.IsStale(obj_id):
+      continue
+    for dep_id in dep_ids:
+      f = headers_by_id.get(dep_id)
+      if f:
+        all_headers.setdefault(f, [])
+        if not skip_obj:
+          all_headers[f].append(obj_file)
+
+  return all_headers
+
+
+def GetSourceHeader(dep, out_dir):
+  """Return the source-relative path of a header dependency, or None"""
+  # Ninja always uses "/", even on Windows.
+  prefix = '../../'
+
+  if not (dep.endswith('.h') or dep.endswith('.hh')):
+    return None
+  if not dep.startswith(prefix):
+    return None
+  f = dep[6:]  # Remove the '../../' prefix
+  # build/ only contains build-specific files like build_config.h
+  # and buildflag.h, and system header files, so they should be
+  # skipped.
+  if f.startswith(out_dir) or f.startswith('out'):
+    return None
+  if f.startswith('build'):
+    return None
+  return f
+
+
 def GetHeadersFromGN(out_dir, q):
   """Return all the header files from GN"""
 
@@ -5,8 +5,12 @@
 
 import logging
 import json
+import os
+import shutil
+import tempfile
 import unittest
 import check_gn_headers
+import ninja_deps
 
 
 ninja_input = r'''
@@ -73,6 +77,38 @@ class CheckGnHeadersTest(unittest.TestCase):
     }
     self.assertEqual(headers, expected)
 
+  def testDepsLog(self):
+    out_dir = tempfile.mkdtemp()
+    try:
+      entries = []
+      for block in ninja_input.strip().split('\n\n'):
+        lines = block.split('\n')
+        obj_file = lines[0].split(':')[0]
+        obj_path = os.path.join(out_dir, obj_file)
+        os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+        with open(obj_path, 'w'):
+          pass
+        mtime = ninja_deps._GetNinjaTimestamp(obj_path)
+        if lines[0].endswith('(STALE)'):
+          mtime -= 1
+        entries.append((obj_file, mtime, [l.strip() for l in lines[1:]]))
+      live_outputs = {obj_file for obj_file, _, _ in entries}
+      # A dead entry, for an output that is no longer in the build graph.
+      dead_path = os.path.join(out_dir, 'obj', 'dead.o')
+      with open(dead_path, 'w'):
+        pass
+      entries.append(('obj/dead.o', ninja_deps._GetNinjaTimestamp(dead_path),
+                      ['../../dead.cc', '../../dir/dead.h']))
+      ninja_deps.WriteDepsLog(out_dir, entries)
+
+      headers = check_gn_headers.GetHeadersFromDepsLog(
+          ninja_deps.ReadDepsLog(out_dir), live_outputs, 'out/Release', False)
+    finally:
+      shutil.rmtree(out_dir)
+    expected = check_gn_headers.ParseNinjaDepsOutput(ninja_input.split('\n'),
+                                                     'out/Release', False)
+    self.assertEqual(headers, expected)
+
   def testGn(self):
     headers = check_gn_headers.ParseGNProjectJSON(gn_input,
                                                   'out/Release', 'tmp')
@@ -17,11 +17,14 @@ import re
 import subprocess
 import sys
 
+import check_gn_headers
+import ninja_deps
+
 
 def GitGrep(pattern):
   p = subprocess.Popen(
       ['git', 'grep', '-En', pattern, '--', '*.gn', '*.gni'],
-      stdout=subprocess.PIPE)
+      stdout=subprocess.PIPE, universal_newlines=True)
   out, _ = p.communicate()
   return out, p.returncode
 
@@ -45,10 +48,43 @@ def ValidMatches(basename, cc, grep_lines):
   return matches
 
 
-def AddHeadersNextToCC(headers, skip_ambiguous=True):
+def GetIncludingSources(out_dir):
+  """Return a dict from each header to the sources whose objects include it.
+
+  Uses the ninja deps log of |out_dir|, in which the source of an object file
+  is its first dependency.
+  """
+  deps_log = ninja_deps.ReadDepsLog(out_dir)
+  live_outputs = ninja_deps.GetBuildGraphOutputs(out_dir)
+  headers = check_gn_headers.GetHeadersFromDepsLog(deps_log, live_outputs,
+                                                   out_dir, False)
+  sources = {}
+  for header, obj_files in headers.items():
+    for obj_file in obj_files:
+      deps = deps_log.GetDeps(obj_file)
+      if deps and deps[0].startswith('../../'):
+        sources.setdefault(header, set()).add(deps[0][6:])
+  return sources
+
+
+def GnSourcePath(grep_line):
+  """Return the source-relative path of the file named in a 'git grep' match."""
+  gnfile, _linenr, contents = grep_line.split(':', 2)
+  m = re.search(r'"([^"]+)"', contents)
+  if not m:
+    return None
+  path = m.group(1)
+  if path.startswith('//'):
+    return path[2:]
+  return os.path.normpath(os.path.join(os.path.dirname(gnfile), path))
+
+
+def AddHeadersNextToCC(headers, skip_ambiguous=True, including_sources=None):
   """Add header files next to the corresponding .cc files in GN files.
 
   When skip_ambiguous is True, skip if multiple .cc files are found.
+  When including_sources is given, as returned by GetIncludingSources(), only
+  .cc files that include the header are considered, if there are any.
   Returns unhandled headers.
 
   Manual cleaning up is likely required, especially if not skip_ambiguous.
@@ -67,7 +103,15 @@ def AddHeadersNextToCC(headers, skip_ambiguous=True):
       unhandled.append(filename)
       continue
 
-    matches = ValidMatches(basename, cc, out.splitlines())
+    grep_lines = out.splitlines()
+    if including_sources and filename in including_sources:
+      including = [
+          l for l in grep_lines
+          if GnSourcePath(l) in including_sources[filename]
+      ]
+      grep_lines = including or grep_lines
+
+    matches = ValidMatches(basename, cc, grep_lines)
 
     if len(matches) == 0:
       continue
@@ -200,6 +244,9 @@ def main():
                       help="only handle path name with this prefix")
   parser.add_argument('--remove', action='store_true',
                       help="treat input_file as non-existing headers")
+  parser.add_argument('--out-dir', metavar='OUT_DIR',
+                      help="use the ninja deps of this built output directory "
+                      "to pick among ambiguous .cc files")
 
   args, _extras = parser.parse_known_args()
 
@@ -211,7 +258,10 @@ def main():
   if args.remove:
     RemoveHeader(headers, False)
   else:
-    unhandled = AddHeadersNextToCC(headers)
+    including_sources = None
+    if args.out_dir:
+      including_sources = GetIncludingSources(args.out_dir)
+    unhandled = AddHeadersNextToCC(headers, including_sources=including_sources)
     AddHeadersToSources(unhandled)
 
 
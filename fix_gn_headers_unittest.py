@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import fix_gn_headers
+import ninja_deps
+
+
+_BUILD_GN = '''\
+source_set("foo") {
+  sources = [
+    "foo.cc",
+  ]
+}
+'''
+
+
+class FixGnHeadersTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._tmp_dir)
+
+  def testGetIncludingSources(self):
+    out_dir = os.path.join(self._tmp_dir, 'out')
+    entries = []
+    for obj_file, deps in [
+        ('obj/a/foo.o', ['../../a/foo.cc', '../../a/foo.h', '../../c/c.h']),
+        ('obj/b/foo.o', ['../../b/foo.cc', '../../a/foo.h']),
+        # Dead, since it is not in the build graph.
+        ('obj/d/foo.o', ['../../d/foo.cc', '../../a/foo.h']),
+    ]:
+      obj_path = os.path.join(out_dir, obj_file)
+      os.makedirs(os.path.dirname(obj_path))
+      with open(obj_path, 'w'):
+        pass
+      entries.append((obj_file, ninja_deps._GetNinjaTimestamp(obj_path), deps))
+    ninja_deps.WriteDepsLog(out_dir, entries)
+
+    live_outputs = {'obj/a/foo.o', 'obj/b/foo.o'}
+    with mock.patch.object(ninja_deps,
+                           'GetBuildGraphOutputs',
+                           return_value=live_outputs) as get_outputs:
+      sources = fix_gn_headers.GetIncludingSources(out_dir)
+
+    get_outputs.assert_called_once_with(out_dir)
+    self.assertEqual(sources, {
+        'a/foo.h': {'a/foo.cc', 'b/foo.cc'},
+        'c/c.h': {'a/foo.cc'},
+    })
+
+  def _AddHeadersNextToCC(self, including_sources):
+    for d in ('a', 'b'):
+      os.makedirs(os.path.join(self._tmp_dir, d), exist_ok=True)
+      with open(os.path.join(self._tmp_dir, d, 'BUILD.gn'), 'w') as f:
+        f.write(_BUILD_GN)
+    grep_output = 'a/BUILD.gn:3:    "foo.cc",\nb/BUILD.gn:3:    "foo.cc",\n'
+    cwd = os.getcwd()
+    os.chdir(self._tmp_dir)
+    try:
+      with mock.patch.object(fix_gn_headers,
+                             'GitGrep',
+                             return_value=(grep_output, 0)):
+        unhandled = fix_gn_headers.AddHeadersNextToCC(
+            ['x/foo.h\n'], including_sources=including_sources)
+    finally:
+      os.chdir(cwd)
+    self.assertEqual(unhandled, [])
+    gn_files = {}
+    for d in ('a', 'b'):
+      with open(os.path.join(self._tmp_dir, d, 'BUILD.gn')) as f:
+        gn_files[d] = f.read()
+    return gn_files
+
+  def testAddHeadersNextToCC_ambiguous(self):
+    gn_files = self._AddHeadersNextToCC(None)
+    self.assertEqual(gn_files, {'a': _BUILD_GN, 'b': _BUILD_GN})
+
+  def testAddHeadersNextToCC_includingSources(self):
+    gn_files = self._AddHeadersNextToCC({'x/foo.h': {'b/foo.cc'}})
+    self.assertEqual(gn_files['a'], _BUILD_GN)
+    self.assertEqual(
+        gn_files['b'],
+        _BUILD_GN.replace('"foo.cc",\n', '"foo.cc",\n    "foo.h",\n'))
+
+  def testAddHeadersNextToCC_includingSourcesWithoutMatch(self):
+    # Falls back to all .cc files when none of them include the header.
+    gn_files = self._AddHeadersNextToCC({'x/foo.h': {'c/foo.cc'}})
+    self.assertEqual(gn_files, {'a': _BUILD_GN, 'b': _BUILD_GN})
+
+
+if __name__ == '__main__':
+  unittest.main()
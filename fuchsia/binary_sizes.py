@@ -7,11 +7,14 @@
 
 import argparse
 import collections
+import concurrent.futures
+import io
 import json
 import math
 import os
 import re
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
@@ -26,6 +29,17 @@ from common import DIR_SRC_ROOT, SDK_ROOT, get_host_tool_path
 
 PACKAGES_BLOBS_FILE = 'package_blobs.json'
 PACKAGES_SIZES_FILE = 'package_sizes.json'
+# Compressed blob sizes from previous runs, stored in the build output dir.
+BLOB_SIZE_CACHE_FILE = 'binary_sizes_blob_cache.json'
+
+# Fuchsia archive (FAR) format, see
+# https://fuchsia.dev/fuchsia-src/development/source_code/archive_format
+FAR_MAGIC = b'\xc8\xbf\x0b\x48\xad\xab\xc5\x11'
+_FAR_HEADER = struct.Struct('<8sQ')
+_FAR_INDEX_ENTRY = struct.Struct('<8sQQ')
+_FAR_DIRECTORY_ENTRY = struct.Struct('<IHHQQQ')
+_FAR_DIR_CHUNK = b'DIR-----'
+_FAR_DIRNAMES_CHUNK = b'DIRNAMES'
 
 # Structure representing the compressed and uncompressed sizes for a Fuchsia
 # package.
@@ -37,6 +51,9 @@ PackageSizes = collections.namedtuple('PackageSizes',
 Blob = collections.namedtuple(
     'Blob', ['name', 'hash', 'compressed', 'uncompressed', 'is_counted'])
 
+# Structure representing the location of a file's contents in a FAR archive.
+FarEntry = collections.namedtuple('FarEntry', ['offset', 'length'])
+
 
 def CreateSizesExternalDiagnostic(sizes_guid):
   """Creates a histogram external sizes diagnostic."""
@@ -310,37 +327,138 @@ def GetCompressedSize(file_path):
   return int(math.ceil(blob_bytes / BLOBFS_BLOCK_SIZE)) * BLOBFS_BLOCK_SIZE
 
 
-def ExtractFarFile(file_path, extract_dir):
-  """Extracts contents of a Fuchsia archive file to the specified directory."""
+def ReadFarEntries(far_file):
+  """Returns a mapping from file names to FarEntry for an open FAR archive."""
+
+  far_file.seek(0)
+  magic, index_length = _FAR_HEADER.unpack(far_file.read(_FAR_HEADER.size))
+  if magic != FAR_MAGIC:
+    raise Exception('Not a FAR archive.')
+  chunks = {}
+  index = far_file.read(index_length)
+  for chunk_type, offset, length in _FAR_INDEX_ENTRY.iter_unpack(index):
+    chunks[chunk_type] = FarEntry(offset, length)
+
+  # An archive without files has no directory.
+  if _FAR_DIR_CHUNK not in chunks:
+    return {}
+  directory = ReadFarEntry(far_file, chunks[_FAR_DIR_CHUNK])
+  names = ReadFarEntry(far_file, chunks[_FAR_DIRNAMES_CHUNK])
+
+  entries = {}
+  for (name_offset, name_length, _, data_offset, data_length,
+       _) in _FAR_DIRECTORY_ENTRY.iter_unpack(directory):
+    name = names[name_offset:name_offset + name_length].decode('utf-8')
+    entries[name] = FarEntry(data_offset, data_length)
+  return entries
+
 
-  far_tool = get_host_tool_path('far')
+def ReadFarEntry(far_file, entry):
+  """Returns the contents of a FarEntry from an open FAR archive."""
 
-  if not os.path.isfile(far_tool):
-    raise Exception('Could not find FAR host tool "%s".' % far_tool)
-  if not os.path.isfile(file_path):
-    raise Exception('Could not find FAR file "%s".' % file_path)
+  far_file.seek(entry.offset)
+  data = far_file.read(entry.length)
+  if len(data) != entry.length:
+    raise Exception('Truncated FAR archive.')
+  return data
 
-  subprocess.check_call([
-      far_tool, 'extract',
-      '--archive=%s' % file_path,
-      '--output=%s' % extract_dir
-  ])
 
+def CopyFarEntry(far_file, entry, output_file):
+  """Copies the contents of a FarEntry to |output_file| in chunks."""
 
-def GetBlobNameHashes(meta_dir):
+  far_file.seek(entry.offset)
+  remaining = entry.length
+  while remaining:
+    data = far_file.read(min(remaining, 1024 * 1024))
+    if not data:
+      raise Exception('Truncated FAR archive.')
+    output_file.write(data)
+    remaining -= len(data)
+
+
+def GetBlobNameHashes(meta_far):
   """Returns mapping from Fuchsia pkgfs paths to blob hashes.  The mapping is
-  read from the extracted meta.far archive contained in an extracted package
-  archive."""
+  read from the contents of a package's meta.far archive."""
+
+  meta_far_file = io.BytesIO(meta_far)
+  contents_entry = ReadFarEntries(meta_far_file)['meta/contents']
+  contents = ReadFarEntry(meta_far_file, contents_entry).decode('utf-8')
 
   blob_name_hashes = {}
-  contents_path = os.path.join(meta_dir, 'meta', 'contents')
-  with open(contents_path) as lines:
-    for line in lines:
-      (pkgfs_path, blob_hash) = line.strip().split('=')
-      blob_name_hashes[pkgfs_path] = blob_hash
+  for line in contents.splitlines():
+    (pkgfs_path, blob_hash) = line.strip().split('=')
+    blob_name_hashes[pkgfs_path] = blob_hash
   return blob_name_hashes
 
 
+class BlobSizeCache:
+  """Compressed blob sizes keyed by blob Merkle hash.
+
+  Sizes are saved to |path| so that later runs only measure blobs that
+  changed. Saved sizes are discarded when blobfs-compression changes."""
+
+  def __init__(self, path):
+    self._path = path
+    self._compressor_id = _GetCompressorId()
+    self._sizes = {}
+    if path and os.path.exists(path):
+      try:
+        with open(path) as cache_file:
+          cache = json.load(cache_file)
+        if cache['compressor'] == self._compressor_id:
+          self._sizes = cache['sizes']
+      except (ValueError, KeyError):
+        pass
+
+  def Get(self, blob_hash):
+    return self._sizes.get(blob_hash)
+
+  def Set(self, blob_hash, compressed_size):
+    self._sizes[blob_hash] = compressed_size
+
+  def Save(self):
+    if not self._path:
+      return
+    temp_path = self._path + '.tmp'
+    with open(temp_path, 'w') as cache_file:
+      json.dump({'compressor': self._compressor_id, 'sizes': self._sizes},
+                cache_file)
+    os.replace(temp_path, self._path)
+
+
+def _GetCompressorId():
+  """Returns a string that changes when blobfs-compression is updated."""
+
+  compressor_path = get_host_tool_path('blobfs-compression')
+  try:
+    stat = os.stat(compressor_path)
+  except OSError:
+    return None
+  return '%s:%d:%d' % (compressor_path, stat.st_mtime_ns, stat.st_size)
+
+
+def _GetCompressedBlobSize(far_file_path, entry):
+  """Measures the compressed size of a blob stored in a FAR archive."""
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    blob_path = os.path.join(temp_dir, 'blob')
+    with open(far_file_path, 'rb') as far_file, \
+        open(blob_path, 'wb') as blob_file:
+      CopyFarEntry(far_file, entry, blob_file)
+    return GetCompressedSize(blob_path)
+
+
+def _MeasureMetaFar(meta_far):
+  """Returns the Merkle hash and compressed size of a meta.far archive."""
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    meta_far_path = os.path.join(temp_dir, 'meta.far')
+    with open(meta_far_path, 'wb') as meta_far_file:
+      meta_far_file.write(meta_far)
+    return (GetPackageMerkleRoot(meta_far_path),
+            GetCompressedSize(meta_far_path))
+
+
 # Compiled regular expression matching strings like *.so, *.so.1, *.so.2, ...
 SO_FILENAME_REGEXP = re.compile(r'\.so(\.\d+)?$')
 
@@ -380,67 +498,72 @@ def GetPackageMerkleRoot(far_file_path):
   # The digest is the first word on the first line of the merkle tool's output.
   merkle_tool = get_host_tool_path('merkleroot')
   output = subprocess.check_output([merkle_tool, far_file_path])
-  return output.splitlines()[0].split()[0]
-
-
-def GetBlobs(far_file, build_out_dir):
-  """Calculates compressed and uncompressed blob sizes for specified FAR file.
-  Marks ICU blobs and blobs from SDK libraries as not counted."""
+  return output.splitlines()[0].split()[0].decode('utf-8')
 
-  base_name = FarBaseName(far_file)
 
-  extract_dir = tempfile.mkdtemp()
+def GetPackageBlobs(far_files, build_out_dir, size_cache_path=None):
+  """Returns dictionary mapping package names to blobs contained in the package.
 
-  # Extract files and blobs from the specified Fuchsia archive.
-  far_file_path = os.path.join(build_out_dir, far_file)
-  far_extract_dir = os.path.join(extract_dir, base_name)
-  ExtractFarFile(far_file_path, far_extract_dir)
+  Blobs are read from the FAR files in place. Each blob's compressed size is
+  measured at most once, even when it is shared by several packages, and not at
+  all if |size_cache_path| already has it. Measurements are run in parallel.
+  ICU blobs and blobs from SDK libraries are marked as not counted.
 
-  # Extract the meta.far archive contained in the specified Fuchsia archive.
-  meta_far_file_path = os.path.join(far_extract_dir, 'meta.far')
-  meta_far_extract_dir = os.path.join(extract_dir, '%s_meta' % base_name)
-  ExtractFarFile(meta_far_file_path, meta_far_extract_dir)
+  Prints package blob size statistics."""
 
-  # Map Linux filesystem blob names to blob hashes.
-  blob_name_hashes = GetBlobNameHashes(meta_far_extract_dir)
+  size_cache = BlobSizeCache(size_cache_path)
 
   # "System" files whose sizes are not charged against component size budgets.
   # Fuchsia SDK modules and the ICU icudtl.dat file sizes are not counted.
   system_files = GetSdkModules() | set(['icudtl.dat'])
 
-  # Add the meta.far file blob.
-  blobs = {}
-  meta_name = 'meta.far'
-  meta_hash = GetPackageMerkleRoot(meta_far_file_path)
-  compressed = GetCompressedSize(meta_far_file_path)
-  uncompressed = os.path.getsize(meta_far_file_path)
-  blobs[meta_name] = Blob(meta_name, meta_hash, compressed, uncompressed, True)
-
-  # Add package blobs.
-  for blob_name, blob_hash in blob_name_hashes.items():
-    extracted_blob_path = os.path.join(far_extract_dir, blob_hash)
-    compressed = GetCompressedSize(extracted_blob_path)
-    uncompressed = os.path.getsize(extracted_blob_path)
-    is_counted = os.path.basename(blob_name) not in system_files
-    blobs[blob_name] = Blob(blob_name, blob_hash, compressed, uncompressed,
-                            is_counted)
-
-  shutil.rmtree(extract_dir)
-
-  return blobs
-
-
-def GetPackageBlobs(far_files, build_out_dir):
-  """Returns dictionary mapping package names to blobs contained in the package.
-
-  Prints package blob size statistics."""
-
   package_blobs = {}
-  for far_file in far_files:
-    package_name = FarBaseName(far_file)
-    if package_name in package_blobs:
-      raise Exception('Duplicate FAR file base name "%s".' % package_name)
-    package_blobs[package_name] = GetBlobs(far_file, build_out_dir)
+  with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+    # Maps package names to (meta.far measurement, FAR entries, blob hashes).
+    packages = {}
+    size_futures = {}
+    for far_file in far_files:
+      package_name = FarBaseName(far_file)
+      if package_name in packages:
+        raise Exception('Duplicate FAR file base name "%s".' % package_name)
+
+      far_file_path = os.path.join(build_out_dir, far_file)
+      with open(far_file_path, 'rb') as far:
+        far_entries = ReadFarEntries(far)
+        meta_far = ReadFarEntry(far, far_entries['meta.far'])
+      blob_name_hashes = GetBlobNameHashes(meta_far)
+
+      meta_future = executor.submit(_MeasureMetaFar, meta_far)
+      for blob_hash in blob_name_hashes.values():
+        if size_cache.Get(blob_hash) is None and blob_hash not in size_futures:
+          size_futures[blob_hash] = executor.submit(_GetCompressedBlobSize,
+                                                    far_file_path,
+                                                    far_entries[blob_hash])
+      packages[package_name] = (meta_future, far_entries, blob_name_hashes)
+
+    for blob_hash, future in size_futures.items():
+      size_cache.Set(blob_hash, future.result())
+
+    for package_name, (meta_future, far_entries,
+                       blob_name_hashes) in packages.items():
+      # Add the meta.far file blob.
+      blobs = {}
+      meta_name = 'meta.far'
+      meta_hash, compressed = meta_future.result()
+      uncompressed = far_entries[meta_name].length
+      blobs[meta_name] = Blob(meta_name, meta_hash, compressed, uncompressed,
+                              True)
+
+      # Add package blobs.
+      for blob_name, blob_hash in blob_name_hashes.items():
+        compressed = size_cache.Get(blob_hash)
+        uncompressed = far_entries[blob_hash].length
+        is_counted = os.path.basename(blob_name) not in system_files
+        blobs[blob_name] = Blob(blob_name, blob_hash, compressed, uncompressed,
+                                is_counted)
+      package_blobs[package_name] = blobs
+
+  size_cache.Save()
 
   # Print package blob sizes (does not count sharing).
   for package_name in sorted(package_blobs.keys()):
@@ -494,7 +617,9 @@ def GetBinarySizesAndBlobs(args, sizes_config):
   the aggregated sizes across all packages."""
 
   # Calculate compressed and uncompressed package sizes.
-  package_blobs = GetPackageBlobs(sizes_config['far_files'], args.build_out_dir)
+  package_blobs = GetPackageBlobs(
+      sizes_config['far_files'], args.build_out_dir,
+      os.path.join(args.build_out_dir, BLOB_SIZE_CACHE_FILE))
   package_sizes = GetPackageSizes(package_blobs)
 
   # Optionally calculate total compressed and uncompressed package sizes.
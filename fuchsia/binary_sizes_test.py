@@ -6,8 +6,10 @@
 import json
 import os
 import shutil
+import struct
 import tempfile
 import unittest
+from unittest import mock
 
 import binary_sizes
 
@@ -48,6 +50,47 @@ _EXAMPLE_BLOBS = """
 """
 
 
+def _CreateFar(files):
+  """Returns the contents of a FAR archive holding |files|."""
+  names = sorted(files)
+  dir_names = b''
+  name_offsets = []
+  for name in names:
+    name_offsets.append(len(dir_names))
+    dir_names += name.encode('utf-8')
+  dir_names += b'\0' * (-len(dir_names) % 8)
+
+  dir_offset = 16 + 2 * 24
+  names_offset = dir_offset + 32 * len(names)
+  data = b''
+  data_offset = names_offset + len(dir_names)
+  directory = b''
+  for name, name_offset in zip(names, name_offsets):
+    padding = -(data_offset + len(data)) % 4096
+    data += b'\0' * padding
+    directory += struct.pack('<IHHQQQ', name_offset, len(name), 0,
+                             data_offset + len(data), len(files[name]), 0)
+    data += files[name]
+  return b''.join([
+      binary_sizes.FAR_MAGIC,
+      struct.pack('<Q', 2 * 24),
+      struct.pack('<8sQQ', b'DIR-----', dir_offset, len(directory)),
+      struct.pack('<8sQQ', b'DIRNAMES', names_offset, len(dir_names)),
+      directory,
+      dir_names,
+      data,
+  ])
+
+
+def _CreatePackageFar(path, blobs):
+  """Writes a package FAR archive with |blobs|, a map of names to contents."""
+  contents = ''.join('%s=hash_%s\n' % (name, name) for name in sorted(blobs))
+  files = {'hash_' + name: data for name, data in blobs.items()}
+  files['meta.far'] = _CreateFar({'meta/contents': contents.encode('utf-8')})
+  with open(path, 'wb') as far_file:
+    far_file.write(_CreateFar(files))
+
+
 class TestBinarySizes(unittest.TestCase):
   tmpdir = None
 
@@ -127,6 +170,50 @@ class TestBinarySizes(unittest.TestCase):
 
     self.assertEqual(sizes['cast_runner'].compressed, last_blob['size'] / 2)
 
+  def testGetPackageBlobsReadsFarFilesInPlace(self):
+    out_dir = tempfile.mkdtemp(dir=self.tmpdir)
+    _CreatePackageFar(os.path.join(out_dir, 'a.far'), {
+        'lib/libfoo.so': b'foo' * 100,
+        'icudtl.dat': b'icu',
+    })
+    _CreatePackageFar(os.path.join(out_dir, 'b.far'), {
+        'lib/libfoo.so': b'foo' * 100,
+        'bin/b': b'b',
+    })
+    cache_path = os.path.join(out_dir, 'cache.json')
+
+    def get_compressed_size(path):
+      with open(path, 'rb') as f:
+        return 8192 * len(f.read())
+
+    with mock.patch.object(binary_sizes,
+                           'GetCompressedSize',
+                           side_effect=get_compressed_size) as mock_compress, \
+        mock.patch.object(binary_sizes,
+                          'GetPackageMerkleRoot',
+                          return_value='meta_hash'), \
+        mock.patch.object(binary_sizes, 'GetSdkModules', return_value=set()), \
+        mock.patch.object(binary_sizes, '_GetCompressorId', return_value='c1'):
+      package_blobs = binary_sizes.GetPackageBlobs(['a.far', 'b.far'],
+                                                   out_dir, cache_path)
+      # Each of the 3 distinct blobs, plus each meta.far.
+      self.assertEqual(mock_compress.call_count, 5)
+
+      self.assertEqual(
+          package_blobs['a']['lib/libfoo.so'],
+          binary_sizes.Blob('lib/libfoo.so', 'hash_lib/libfoo.so', 8192 * 300,
+                            300, True))
+      self.assertFalse(package_blobs['a']['icudtl.dat'].is_counted)
+      self.assertEqual(package_blobs['b']['bin/b'].compressed, 8192)
+      self.assertEqual(package_blobs['b']['meta.far'].hash, 'meta_hash')
+
+      # Sizes of blobs are cached across runs.
+      mock_compress.reset_mock()
+      self.assertEqual(
+          binary_sizes.GetPackageBlobs(['a.far', 'b.far'], out_dir,
+                                       cache_path), package_blobs)
+      self.assertEqual(mock_compress.call_count, 2)
+
 
 if __name__ == '__main__':
   unittest.main()
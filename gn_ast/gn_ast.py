@@ -9,23 +9,158 @@ AST implementation details:
 
 To dump an AST:
   gn format --dump-tree=json BUILD.gn > foo.json
+
+Dumped ASTs are cached on disk as JSON, keyed by the contents of the file and
+the version of gn. Entries unused for _CACHE_MAX_AGE_SECONDS are removed. Set
+GN_AST_CACHE_DIR to change where, or to an empty string to disable the cache.
 """
 
 from __future__ import annotations
 
 import dataclasses
 import functools
+import hashlib
 import json
+import logging
+import os
+import pathlib
 import subprocess
+import tempfile
+import time
 from typing import Callable, Dict, List, Optional, Tuple, TypeVar
 
 NODE_CHILD = 'child'
 NODE_TYPE = 'type'
 NODE_VALUE = 'value'
 
+CACHE_DIR_ENV = 'GN_AST_CACHE_DIR'
+
+# Cache entries that have not been used for this long are removed, at most once
+# per _CACHE_TRIM_INTERVAL_SECONDS.
+_CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+_CACHE_TRIM_INTERVAL_SECONDS = 24 * 60 * 60
+# Touched whenever the cache is trimmed.
+_CACHE_TRIM_STAMP = 'last_trim'
+
 _T = TypeVar('_T')
 
 
+def _get_cache_dir() -> Optional[pathlib.Path]:
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME',
+                                    os.path.expanduser('~/.cache'))
+        return pathlib.Path(cache_home) / 'gn_ast'
+    return pathlib.Path(cache_dir) if cache_dir else None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_gn_version() -> str:
+    return subprocess.check_output(['gn', '--version'], text=True).strip()
+
+
+def _get_cache_path(cache_dir: pathlib.Path, content: bytes) -> pathlib.Path:
+    # Different versions of gn may dump different trees for the same file.
+    key = hashlib.sha256(_get_gn_version().encode() + b'\0' +
+                         content).hexdigest()
+    return cache_dir / key[:2] / f'{key[2:]}.json'
+
+
+def load_tree(path: str) -> dict:
+    """Returns the AST of a GN file, as dumped by "gn format".
+
+    The AST is read from the cache when possible. Otherwise, it is dumped and
+    added to the cache, so that processes that load trees in parallel also
+    populate the cache in parallel.
+    """
+    cache_dir = _get_cache_dir()
+    if cache_dir is None:
+        return _dump_tree(path)
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    cache_path = _get_cache_path(cache_dir, content)
+    tree = _read_cache_file(cache_path)
+    if tree is not None:
+        return tree
+
+    tree = _dump_tree(path)
+    try:
+        _write_cache_file(cache_path, tree)
+        _maybe_trim_cache(cache_dir)
+    except OSError as e:
+        logging.warning('Failed to cache the AST of %s: %s', path, e)
+    return tree
+
+
+def _read_cache_file(cache_path: pathlib.Path) -> Optional[dict]:
+    """Returns the cached tree, or None if it is missing or unreadable."""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            tree = json.load(f)
+        # Mark the entry as recently used.
+        os.utime(cache_path)
+    except (OSError, ValueError):
+        # ValueError includes JSON and unicode decoding errors.
+        return None
+    return tree if isinstance(tree, dict) else None
+
+
+def _write_cache_file(cache_path: pathlib.Path, tree: dict) -> None:
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first since other processes may be reading.
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(tree, f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _maybe_trim_cache(cache_dir: pathlib.Path) -> None:
+    """Removes entries that have not been used for _CACHE_MAX_AGE_SECONDS."""
+    stamp_path = cache_dir / _CACHE_TRIM_STAMP
+    now = time.time()
+    try:
+        if now - stamp_path.stat().st_mtime < _CACHE_TRIM_INTERVAL_SECONDS:
+            return
+    except FileNotFoundError:
+        pass
+    # Touch the stamp first so that concurrent processes do not also trim.
+    stamp_path.touch()
+    num_removed = 0
+    for entry_path in cache_dir.glob('*/*.json'):
+        try:
+            if now - entry_path.stat().st_mtime > _CACHE_MAX_AGE_SECONDS:
+                entry_path.unlink()
+                num_removed += 1
+        except FileNotFoundError:
+            # Removed by a concurrent process.
+            pass
+    logging.debug('Removed %d ASTs from %s', num_removed, cache_dir)
+
+
+def invalidate_tree(path: str) -> None:
+    """Removes the cached AST of a GN file. Call before rewriting the file."""
+    cache_dir = _get_cache_dir()
+    if cache_dir is None or not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        content = f.read()
+    try:
+        _get_cache_path(cache_dir, content).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _dump_tree(path: str) -> dict:
+    output = subprocess.check_output(
+        ['gn', 'format', '--dump-tree=json', path], text=True)
+    return json.loads(output)
+
+
 def _create_location_node(begin_line=1):
     return {
         'begin_column': 1,
@@ -350,6 +485,7 @@ class BuildFile:
         new_content = json.dumps(self.block.node)
         if new_content == self._original_content:
             return False
+        invalidate_tree(self.path)
         output = subprocess.check_output(
             ['gn', 'format', '--read-tree=json', self.path],
             text=True,
@@ -368,6 +504,4 @@ class BuildFile:
 
     @staticmethod
     def from_file(path):
-        output = subprocess.check_output(
-            ['gn', 'format', '--dump-tree=json', path], text=True)
-        return BuildFile(path, json.loads(output))
+        return BuildFile(path, load_tree(path))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+import json
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import gn_ast
+
+_TREE = {
+    'child': [],
+    'location': {
+        'begin_column': 1,
+        'begin_line': 1,
+        'end_column': 1,
+        'end_line': 1,
+    },
+    'type': 'BLOCK',
+}
+
+
+class LoadTreeTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._cache_dir = os.path.join(self._tmp_dir.name, 'cache')
+        self._build_gn_path = os.path.join(self._tmp_dir.name, 'BUILD.gn')
+        self._write_build_gn('group("a") {}\n')
+        self._gn_version = '1234 (abcdef)'
+        self._dump_count = 0
+
+        def fake_check_output(cmd, **kwargs):
+            if cmd == ['gn', '--version']:
+                return self._gn_version + '\n'
+            self.assertEqual(['gn', 'format', '--dump-tree=json'], cmd[:-1])
+            self._dump_count += 1
+            return json.dumps(_TREE)
+
+        patchers = [
+            mock.patch.dict(os.environ,
+                            {gn_ast.CACHE_DIR_ENV: self._cache_dir}),
+            mock.patch('subprocess.check_output', fake_check_output),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        gn_ast._get_gn_version.cache_clear()
+        self.addCleanup(gn_ast._get_gn_version.cache_clear)
+        self.addCleanup(self._tmp_dir.cleanup)
+
+    def _write_build_gn(self, content):
+        with open(self._build_gn_path, 'w') as f:
+            f.write(content)
+
+    def test_cache_hit(self):
+        self.assertEqual(_TREE, gn_ast.load_tree(self._build_gn_path))
+        self.assertEqual(_TREE, gn_ast.load_tree(self._build_gn_path))
+        self.assertEqual(1, self._dump_count)
+
+    def test_cached_tree_is_a_copy(self):
+        gn_ast.load_tree(self._build_gn_path)['child'].append({})
+        self.assertEqual(_TREE, gn_ast.load_tree(self._build_gn_path))
+
+    def test_content_change_misses(self):
+        gn_ast.load_tree(self._build_gn_path)
+        self._write_build_gn('group("b") {}\n')
+        gn_ast.load_tree(self._build_gn_path)
+        self.assertEqual(2, self._dump_count)
+
+    def test_gn_version_change_misses(self):
+        gn_ast.load_tree(self._build_gn_path)
+        self._gn_version = '1235 (fedcba)'
+        gn_ast._get_gn_version.cache_clear()
+        gn_ast.load_tree(self._build_gn_path)
+        self.assertEqual(2, self._dump_count)
+
+    def test_invalidate_tree(self):
+        gn_ast.load_tree(self._build_gn_path)
+        gn_ast.invalidate_tree(self._build_gn_path)
+        gn_ast.load_tree(self._build_gn_path)
+        self.assertEqual(2, self._dump_count)
+
+    def test_corrupt_entry_is_replaced(self):
+        gn_ast.load_tree(self._build_gn_path)
+        for dirpath, _, filenames in os.walk(self._cache_dir):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'wb') as f:
+                    f.write(b'garbage')
+        self.assertEqual(_TREE, gn_ast.load_tree(self._build_gn_path))
+        self.assertEqual(_TREE, gn_ast.load_tree(self._build_gn_path))
+        self.assertEqual(2, self._dump_count)
+
+    def test_entries_are_compact_json(self):
+        gn_ast.load_tree(self._build_gn_path)
+        (entry_path, ) = pathlib.Path(self._cache_dir).glob('*/*.json')
+        self.assertEqual(json.dumps(_TREE, separators=(',', ':')),
+                         entry_path.read_text())
+
+    def test_non_tree_entry_is_replaced(self):
+        gn_ast.load_tree(self._build_gn_path)
+        (entry_path, ) = pathlib.Path(self._cache_dir).glob('*/*.json')
+        for content in (b'[]', b'\xff\xfe'):
+            entry_path.write_bytes(content)
+            self.assertEqual(_TREE, gn_ast.load_tree(self._build_gn_path))
+        self.assertEqual(3, self._dump_count)
+
+    def test_trim_removes_unused_entries(self):
+        gn_ast.load_tree(self._build_gn_path)
+        (old_path, ) = pathlib.Path(self._cache_dir).glob('*/*.json')
+        stamp_path = pathlib.Path(self._cache_dir) / gn_ast._CACHE_TRIM_STAMP
+        old = time.time() - gn_ast._CACHE_MAX_AGE_SECONDS - 60
+        os.utime(old_path, (old, old))
+
+        # Trims happen at most once per interval.
+        self._write_build_gn('group("b") {}\n')
+        gn_ast.load_tree(self._build_gn_path)
+        self.assertTrue(old_path.exists())
+
+        os.utime(stamp_path, (old, old))
+        self._write_build_gn('group("c") {}\n')
+        gn_ast.load_tree(self._build_gn_path)
+        self.assertFalse(old_path.exists())
+        self.assertEqual(
+            2, len(list(pathlib.Path(self._cache_dir).glob('*/*.json'))))
+
+    def test_hits_keep_entries(self):
+        gn_ast.load_tree(self._build_gn_path)
+        (entry_path, ) = pathlib.Path(self._cache_dir).glob('*/*.json')
+        old = time.time() - gn_ast._CACHE_MAX_AGE_SECONDS - 60
+        os.utime(entry_path, (old, old))
+        gn_ast.load_tree(self._build_gn_path)
+        self.assertGreater(entry_path.stat().st_mtime, old)
+
+    def test_cache_disabled(self):
+        with mock.patch.dict(os.environ, {gn_ast.CACHE_DIR_ENV: ''}):
+            gn_ast.load_tree(self._build_gn_path)
+            gn_ast.load_tree(self._build_gn_path)
+        self.assertEqual(2, self._dump_count)
+        self.assertFalse(os.path.exists(self._cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
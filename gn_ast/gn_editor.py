@@ -15,6 +15,7 @@ import subprocess
 import sys
 from typing import List, Optional, Set
 
+import gn_ast
 import json_gn_editor
 import utils
 
@@ -289,6 +290,11 @@ def main():
     common_args_parser.add_argument(
         '--resume-from',
         help='Skip files before this build file path (debugging).')
+    common_args_parser.add_argument(
+        '--no-ast-cache',
+        action='store_true',
+        help='Dump the AST of every build file again rather than using the '
+        'ASTs cached by previous runs.')
 
     subparsers = parser.add_subparsers(
         required=True, help='Use subcommand -h to see full usage.')
@@ -379,6 +385,10 @@ def main():
     logging.basicConfig(
         level=level, format='%(levelname).1s %(relativeCreated)7d %(message)s')
 
+    if args.no_ast_cache:
+        # Set in the environment so that it applies to worker processes.
+        os.environ[gn_ast.CACHE_DIR_ENV] = ''
+
     root = _SRC_PATH
     if args.file:
         build_filepaths = [os.path.relpath(args.file, root)]
@@ -28,6 +28,8 @@ if str(_BUILD_ANDROID_GYP_PATH) not in sys.path:
 
 from util import build_utils
 
+import gn_ast
+
 # Refer to parse_tree.cc for GN AST implementation details:
 # https://gn.googlesource.com/gn/+/refs/heads/main/src/gn/parse_tree.cc
 # These constants should match corresponding entries in parse_tree.cc.
@@ -131,9 +133,7 @@ class BuildFile:
         self._skip_write_content = dryrun
 
     def __enter__(self):
-        output = build_utils.CheckOutput(
-            ['gn', 'format', '--dump-tree=json', self._full_path])
-        self._content = json.loads(output)
+        self._content = gn_ast.load_tree(self._full_path)
         self._original_content = json.dumps(self._content)
         return self
 
@@ -556,6 +556,7 @@ class BuildFile:
     def write_content_to_file(self) -> None:
         current_content = json.dumps(self._content)
         if current_content != self._original_content:
+            gn_ast.invalidate_tree(self._full_path)
             subprocess.run(
                 ['gn', 'format', '--read-tree=json', self._full_path],
                 text=True,
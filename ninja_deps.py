@@ -0,0 +1,257 @@
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Reads and writes the deps log that ninja keeps in .ninja_deps.
+
+The deps log holds the dependencies that compilers report through depfiles,
+e.g. the headers that each object file includes. "ninja -t deps" prints it as
+hundreds of MB of text for a Chrome output directory; reading the binary log
+directly is much faster.
+
+To use in an arbitrary Python file in the build:
+
+  import os
+  import sys
+
+  sys.path.append(os.path.join(os.path.dirname(__file__),
+                               os.pardir, os.pardir, 'build'))
+  import ninja_deps
+
+  deps_log = ninja_deps.ReadDepsLog('out/Default')
+  for header in deps_log.GetDeps('obj/base/base/file_path.o'):
+    ...
+
+The format is defined by ninja's src/deps_log.cc. Only version 4, which ninja
+has written since 1.10, is supported.
+"""
+
+import array
+import mmap
+import os
+import struct
+import subprocess
+import sys
+
+DEPS_LOG_FILENAME = '.ninja_deps'
+
+_FILE_SIGNATURE = b'# ninjadeps\n'
+_FILE_VERSION = 4
+_HEADER = struct.Struct('=%dsi' % len(_FILE_SIGNATURE))
+# Each record starts with its size. The high bit is set for deps records.
+_RECORD_SIZE = struct.Struct('=I')
+_DEPS_RECORD_FLAG = 0x80000000
+# Larger records are treated as corrupt by ninja.
+_MAX_RECORD_SIZE = (1 << 19) - 1
+# Output id, then the low and high 32 bits of the output's mtime.
+_DEPS_RECORD_HEADER = struct.Struct('=iII')
+
+# Offset of ninja's timestamps on Windows, which count 100ns intervals since
+# 2001, from Unix timestamps.
+_WIN_EPOCH_OFFSET = 978307200 * 10**7
+
+
+class DepsLog:
+  """The dependencies recorded in a deps log.
+
+  Paths are interned: each one is stored once in |paths|, and the
+  dependencies of an output are an array of indices into |paths|. Paths are
+  relative to the output directory, as ninja records them.
+
+  Unlike "ninja -t deps", which consults the build graph, this also holds dead
+  entries: those of outputs that are no longer in the build graph, until ninja
+  drops them when it next recompacts the log. Use GetBuildGraphOutputs() to
+  skip them.
+  """
+
+  def __init__(self, out_dir, paths, deps):
+    """Initializes the log.
+
+    Args:
+      out_dir: The output directory the log belongs to.
+      paths: A list of all paths in the log, indexed by id.
+      deps: A dict from output id to (mtime, array of dependency ids).
+    """
+    self._out_dir = out_dir
+    self.paths = paths
+    self._deps = deps
+    self._ids = None
+
+  def __len__(self):
+    return len(self._deps)
+
+  def GetId(self, path):
+    """Returns the id of |path|, or None if it is not in the log."""
+    if self._ids is None:
+      self._ids = {p: i for i, p in enumerate(self.paths)}
+    return self._ids.get(path)
+
+  def IterDeps(self):
+    """Yields (output id, mtime, array of dependency ids) by output id."""
+    for output_id in sorted(self._deps):
+      mtime, dep_ids = self._deps[output_id]
+      yield output_id, mtime, dep_ids
+
+  def GetDeps(self, output):
+    """Returns the dependencies of |output|, or None if it has none recorded."""
+    entry = self._deps.get(self.GetId(output))
+    if entry is None:
+      return None
+    return [self.paths[i] for i in entry[1]]
+
+  def IsStale(self, output_id):
+    """Returns whether the output changed after its deps were recorded.
+
+    This is what "ninja -t deps" reports as STALE, rather than VALID.
+    """
+    mtime = _GetNinjaTimestamp(
+        os.path.join(self._out_dir, self.paths[output_id]))
+    return not mtime or mtime > self._deps[output_id][0]
+
+  def IterNinjaToolOutput(self, live_outputs=None):
+    """Yields the lines that "ninja -t deps" prints, without newlines.
+
+    Args:
+      live_outputs: If set, only outputs in this set are listed, as returned by
+        GetBuildGraphOutputs().
+    """
+    for output_id, mtime, dep_ids in self.IterDeps():
+      if live_outputs is not None and self.paths[output_id] not in live_outputs:
+        continue
+      yield '%s: #deps %d, deps mtime %d (%s)' % (
+          self.paths[output_id], len(dep_ids), mtime,
+          'STALE' if self.IsStale(output_id) else 'VALID')
+      for dep_id in dep_ids:
+        yield '    ' + self.paths[dep_id]
+      yield ''
+
+
+def _GetNinjaTimestamp(path):
+  """Returns the mtime of |path| in the units that ninja records."""
+  try:
+    mtime_ns = os.stat(path).st_mtime_ns
+  except FileNotFoundError:
+    return 0
+  if sys.platform == 'win32':
+    mtime = mtime_ns // 100 - _WIN_EPOCH_OFFSET
+  else:
+    mtime = mtime_ns
+  # Ninja uses 0 for files that do not exist.
+  return mtime or 1
+
+
+def GetBuildGraphOutputs(out_dir, ninja_path='ninja'):
+  """Returns the set of outputs in the build graph of |out_dir|.
+
+  Entries of a deps log for other outputs are dead.
+  """
+  output = subprocess.check_output(
+      [ninja_path, '-C', out_dir, '-t', 'targets', 'all'],
+      universal_newlines=True)
+  # Lines are "<output>: <rule>".
+  return {line.rsplit(': ', 1)[0] for line in output.splitlines() if line}
+
+
+def ReadDepsLog(out_dir):
+  """Reads the deps log of |out_dir|.
+
+  Like ninja, stops at the first truncated or corrupt record, which ninja
+  leaves behind when it is interrupted.
+
+  Raises:
+    ValueError: If the log is not a deps log of a supported version.
+  """
+  path = os.path.join(out_dir, DEPS_LOG_FILENAME)
+  with open(path, 'rb') as f:
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+      raise ValueError('%s is not a deps log.' % path)
+    signature, version = _HEADER.unpack(header)
+    if signature != _FILE_SIGNATURE:
+      raise ValueError('%s is not a deps log.' % path)
+    if version != _FILE_VERSION:
+      raise ValueError('%s has unsupported version %d.' % (path, version))
+    if os.fstat(f.fileno()).st_size == _HEADER.size:
+      return DepsLog(out_dir, [], {})
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      paths, deps = _ParseRecords(data)
+  return DepsLog(out_dir, paths, deps)
+
+
+def _ParseRecords(data):
+  paths = []
+  deps = {}
+  offset = _HEADER.size
+  end = len(data)
+  while offset + _RECORD_SIZE.size <= end:
+    (size, ) = _RECORD_SIZE.unpack_from(data, offset)
+    is_deps = size & _DEPS_RECORD_FLAG
+    size &= ~_DEPS_RECORD_FLAG
+    start = offset + _RECORD_SIZE.size
+    if size > _MAX_RECORD_SIZE or size % 4 or start + size > end:
+      break
+
+    if is_deps:
+      if size < _DEPS_RECORD_HEADER.size:
+        break
+      output_id, mtime_low, mtime_high = _DEPS_RECORD_HEADER.unpack_from(
+          data, start)
+      mtime = mtime_high << 32 | mtime_low
+      if mtime >= 1 << 63:
+        mtime -= 1 << 64
+      if not 0 <= output_id < len(paths):
+        break
+      # Ids are signed in ninja, but unsigned ones need a single bounds check.
+      dep_ids = array.array('I')
+      dep_ids.frombytes(data[start + _DEPS_RECORD_HEADER.size:start + size])
+      if dep_ids and max(dep_ids) >= len(paths):
+        break
+      # Later records replace earlier ones for the same output.
+      deps[output_id] = (mtime, dep_ids)
+    else:
+      if size < 4:
+        break
+      # The path is padded with up to 3 NULs, and followed by the bitwise
+      # complement of its id as a checksum.
+      (checksum, ) = _RECORD_SIZE.unpack_from(data, start + size - 4)
+      if checksum != ~len(paths) & 0xffffffff:
+        break
+      paths.append(os.fsdecode(data[start:start + size - 4].rstrip(b'\0')))
+    offset = start + size
+  return paths, deps
+
+
+def WriteDepsLog(out_dir, entries):
+  """Writes a deps log to |out_dir|.
+
+  Args:
+    out_dir: The output directory to write the log to.
+    entries: An iterable of (output, mtime, list of dependencies), with paths
+      relative to |out_dir|.
+  """
+  ids = {}
+  records = [_HEADER.pack(_FILE_SIGNATURE, _FILE_VERSION)]
+
+  def GetId(path):
+    if path not in ids:
+      ids[path] = len(ids)
+      encoded = os.fsencode(path)
+      encoded += b'\0' * (-len(encoded) % 4)
+      records.append(_RECORD_SIZE.pack(len(encoded) + 4))
+      records.append(encoded)
+      records.append(_RECORD_SIZE.pack(~ids[path] & 0xffffffff))
+    return ids[path]
+
+  for output, mtime, dependencies in entries:
+    # Like ninja, assign the output an id before its dependencies.
+    output_id = GetId(output)
+    dep_ids = array.array('I', [GetId(p) for p in dependencies])
+    records.append(
+        _RECORD_SIZE.pack((_DEPS_RECORD_HEADER.size + len(dep_ids) * 4)
+                          | _DEPS_RECORD_FLAG))
+    records.append(
+        _DEPS_RECORD_HEADER.pack(output_id, mtime & 0xffffffff,
+                                 (mtime >> 32) & 0xffffffff))
+    records.append(dep_ids.tobytes())
+
+  with open(os.path.join(out_dir, DEPS_LOG_FILENAME), 'wb') as f:
+    f.write(b''.join(records))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Copyright 2024 The Chromium Authors
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import ninja_deps
+
+_NINJA = shutil.which('ninja')
+
+# Writes the output and a depfile that lists the input and extra headers.
+_GEN_SCRIPT = textwrap.dedent('''\
+    import sys
+    out, src = sys.argv[1:3]
+    with open(out, 'w') as f:
+      f.write(src)
+    with open(out + '.d', 'w') as f:
+      f.write('%s: %s\\n' % (out, ' '.join([src] + sys.argv[3:])))
+    ''')
+
+
+class NinjaDepsTest(unittest.TestCase):
+  def setUp(self):
+    self._out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._out_dir)
+
+  def _Touch(self, path):
+    with open(os.path.join(self._out_dir, path), 'w'):
+      pass
+    return ninja_deps._GetNinjaTimestamp(os.path.join(self._out_dir, path))
+
+  def _DepsLogPath(self):
+    return os.path.join(self._out_dir, ninja_deps.DEPS_LOG_FILENAME)
+
+  def testRoundTrip(self):
+    ninja_deps.WriteDepsLog(self._out_dir, [
+        ('obj/a.o', 1, ['../../a.cc', '../../a.h', '../../common.h']),
+        ('obj/b.o', 2, ['../../b.cc', '../../common.h']),
+        ('obj/a.o', 3, ['../../a.cc', '../../common.h']),
+    ])
+    deps_log = ninja_deps.ReadDepsLog(self._out_dir)
+
+    self.assertEqual(2, len(deps_log))
+    self.assertEqual([
+        'obj/a.o', '../../a.cc', '../../a.h', '../../common.h', 'obj/b.o',
+        '../../b.cc'
+    ], deps_log.paths)
+    # The last record for an output wins.
+    self.assertEqual(['../../a.cc', '../../common.h'],
+                     deps_log.GetDeps('obj/a.o'))
+    self.assertEqual(['../../b.cc', '../../common.h'],
+                     deps_log.GetDeps('obj/b.o'))
+    self.assertIsNone(deps_log.GetDeps('../../a.h'))
+    self.assertIsNone(deps_log.GetDeps('obj/missing.o'))
+    self.assertEqual([(0, 3, [1, 3]), (4, 2, [5, 3])],
+                     [(i, mtime, list(dep_ids))
+                      for i, mtime, dep_ids in deps_log.IterDeps()])
+
+  def testNinjaToolOutput(self):
+    valid_mtime = self._Touch('valid.o')
+    stale_mtime = self._Touch('stale.o') - 1
+    ninja_deps.WriteDepsLog(self._out_dir, [
+        ('valid.o', valid_mtime, ['../../valid.cc', '../../a.h']),
+        ('stale.o', stale_mtime, ['../../stale.cc']),
+        ('missing.o', valid_mtime, []),
+    ])
+
+    expected = textwrap.dedent('''\
+        valid.o: #deps 2, deps mtime %d (VALID)
+            ../../valid.cc
+            ../../a.h
+
+        stale.o: #deps 1, deps mtime %d (STALE)
+            ../../stale.cc
+
+        missing.o: #deps 0, deps mtime %d (STALE)
+
+        ''') % (valid_mtime, stale_mtime, valid_mtime)
+    deps_log = ninja_deps.ReadDepsLog(self._out_dir)
+    self.assertEqual(
+        expected, ''.join(line + '\n'
+                          for line in deps_log.IterNinjaToolOutput()))
+    # Dead entries are skipped given the outputs of the build graph.
+    self.assertEqual(
+        expected.split('stale.o')[0], ''.join(
+            line + '\n'
+            for line in deps_log.IterNinjaToolOutput({'valid.o', 'other.o'})))
+
+  def testTruncatedRecordIgnored(self):
+    ninja_deps.WriteDepsLog(self._out_dir, [
+        ('obj/a.o', 1, ['../../a.cc']),
+        ('obj/b.o', 2, ['../../b.cc']),
+    ])
+    with open(self._DepsLogPath(), 'r+b') as f:
+      f.truncate(os.path.getsize(self._DepsLogPath()) - 2)
+    deps_log = ninja_deps.ReadDepsLog(self._out_dir)
+
+    self.assertEqual(['../../a.cc'], deps_log.GetDeps('obj/a.o'))
+    self.assertIsNone(deps_log.GetDeps('obj/b.o'))
+
+  def testCorruptRecordStopsReading(self):
+    ninja_deps.WriteDepsLog(self._out_dir, [
+        ('obj/a.o', 1, ['../../a.cc']),
+    ])
+    with open(self._DepsLogPath(), 'rb') as f:
+      data = f.read()
+    # The checksum of the first path record follows 'obj/a.o\0'.
+    checksum_offset = data.index(b'obj/a.o\0') + 8
+    with open(self._DepsLogPath(), 'wb') as f:
+      f.write(data[:checksum_offset] + b'\0\0\0\0' + data[checksum_offset + 4:])
+    deps_log = ninja_deps.ReadDepsLog(self._out_dir)
+
+    self.assertEqual([], deps_log.paths)
+    self.assertEqual(0, len(deps_log))
+
+  def testUnsupportedLog(self):
+    with open(self._DepsLogPath(), 'wb') as f:
+      f.write(ninja_deps._HEADER.pack(ninja_deps._FILE_SIGNATURE, 3))
+    with self.assertRaises(ValueError):
+      ninja_deps.ReadDepsLog(self._out_dir)
+
+    with open(self._DepsLogPath(), 'wb') as f:
+      f.write(b'# ninja log v5\n')
+    with self.assertRaises(ValueError):
+      ninja_deps.ReadDepsLog(self._out_dir)
+
+  def testEmptyLog(self):
+    ninja_deps.WriteDepsLog(self._out_dir, [])
+    deps_log = ninja_deps.ReadDepsLog(self._out_dir)
+
+    self.assertEqual([], deps_log.paths)
+    self.assertEqual([], list(deps_log.IterNinjaToolOutput()))
+
+  @unittest.skipUnless(_NINJA, 'ninja not found')
+  def testMatchesNinja(self):
+    src_dir = os.path.join(self._out_dir, 'src')
+    out_dir = os.path.join(self._out_dir, 'out')
+    os.mkdir(src_dir)
+    os.mkdir(out_dir)
+    for name in ('a.cc', 'b.cc', 'a.h', 'common.h', 'gen_script.py'):
+      with open(os.path.join(src_dir, name), 'w') as f:
+        f.write(_GEN_SCRIPT if name == 'gen_script.py' else name)
+    build_ninja = textwrap.dedent('''\
+        rule cc
+          command = "{python}" ../src/gen_script.py $out $in $headers
+          depfile = $out.d
+          deps = gcc
+        build obj_a.o: cc ../src/a.cc
+          headers = ../src/a.h ../src/common.h
+        build obj_b.o: cc ../src/b.cc
+          headers = ../src/common.h
+        ''').format(python=sys.executable)
+    dead_edge = textwrap.dedent('''\
+        build obj_dead.o: cc ../src/a.cc
+          headers = ../src/a.h
+        ''')
+    with open(os.path.join(out_dir, 'build.ninja'), 'w') as f:
+      f.write(build_ninja + dead_edge)
+    subprocess.check_call([_NINJA, '-C', out_dir], stdout=subprocess.DEVNULL)
+    # Leave a dead entry behind for obj_dead.o.
+    with open(os.path.join(out_dir, 'build.ninja'), 'w') as f:
+      f.write(build_ninja)
+    # Make one of the outputs stale.
+    os.utime(os.path.join(out_dir, 'obj_b.o'),
+             ns=(0, os.stat(os.path.join(out_dir, 'obj_b.o')).st_mtime_ns +
+                 10**9))
+    expected = subprocess.check_output([_NINJA, '-C', out_dir, '-t', 'deps'],
+                                       universal_newlines=True)
+    deps_log = ninja_deps.ReadDepsLog(out_dir)
+    live_outputs = ninja_deps.GetBuildGraphOutputs(out_dir, _NINJA)
+
+    self.assertIsNotNone(deps_log.GetDeps('obj_dead.o'))
+    self.assertNotIn('obj_dead.o', live_outputs)
+    self.assertEqual(
+        expected, ''.join(
+            line + '\n' for line in deps_log.IterNinjaToolOutput(live_outputs)))
+
+
+if __name__ == '__main__':
+  unittest.main()
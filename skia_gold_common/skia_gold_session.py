@@ -3,15 +3,21 @@
 # found in the LICENSE file.
 """Class for interacting with the Skia Gold image diffing service."""
 
+import concurrent.futures
 import enum
+import hashlib
+import json
 import logging
 import os
 import platform
+import queue
 import shutil
 import sys
 import tempfile
+import threading
 import time
-from typing import Any, Dict, List, Optional, Tuple
+import urllib.parse
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import dataclasses  # Built-in, but pylint gives an ordering false positive.
 
@@ -34,6 +40,76 @@ else:
 
 
 StepRetVal = Tuple[int, Optional[str]]
+# (name, png_file, optional_keys) for each image in a CompareBatch call.
+BatchComparison = Tuple[str, str, Optional[Dict[str, str]]]
+
+# Default number of goldctl processes CompareBatch runs at once.
+DEFAULT_MAX_PARALLEL_COMPARISONS = 4
+
+
+class DigestCache():
+  """Digests of images that Gold has already approved.
+
+  Used by CompareBatch to skip goldctl for images identical to ones that
+  previously passed. The cache is thread-safe so that it can be shared by all
+  sessions of a SkiaGoldSessionManager.
+  """
+
+  def __init__(self, cache_file: Optional[str] = None):
+    """
+    Args:
+      cache_file: An optional path to a JSON file in which to persist the cache
+          across runs. Read if it exists and written by Save().
+    """
+    self._cache_file = cache_file
+    self._lock = threading.Lock()
+    self._digests: Dict[str, Set[str]] = {}
+    if cache_file and os.path.exists(cache_file):
+      with open(cache_file) as f:
+        self._digests = {k: set(v) for k, v in json.load(f).items()}
+
+  @staticmethod
+  def MakeKey(instance: str, corpus: str, keys_digest: str, name: str,
+              inexact_matching_args: Optional[List[str]]) -> str:
+    """Returns the key under which digests for an image are stored.
+
+    |keys_digest| is the digest of the session's keys file, as computed by
+    ComputeKeysDigest(). Gold triages images separately for each set of keys
+    (e.g. per GPU), so an image approved for one set may not be for another.
+    Inexact matching arguments are part of the key since an image that passes
+    with them may not pass without them.
+    """
+    return json.dumps(
+        [instance, corpus, keys_digest, name, inexact_matching_args or []])
+
+  def Contains(self, key: str, digest: str) -> bool:
+    with self._lock:
+      return digest in self._digests.get(key, ())
+
+  def Add(self, key: str, digest: str) -> None:
+    with self._lock:
+      self._digests.setdefault(key, set()).add(digest)
+
+  def Save(self) -> None:
+    """Writes the cache to the cache file, if any."""
+    if not self._cache_file:
+      return
+    with self._lock:
+      contents = {k: sorted(v) for k, v in self._digests.items()}
+    with open(self._cache_file, 'w') as f:
+      json.dump(contents, f)
+
+
+def ComputeImageDigest(png_file: str) -> str:
+  """Returns the digest used by DigestCache for |png_file|."""
+  with open(png_file, 'rb') as f:
+    return hashlib.md5(f.read()).hexdigest()
+
+
+def ComputeKeysDigest(keys_file: str) -> str:
+  """Returns the digest used in DigestCache keys for |keys_file|."""
+  with open(keys_file, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
 
 
 class SkiaGoldSession():
@@ -64,7 +140,8 @@ class SkiaGoldSession():
                keys_file: str,
                corpus: str,
                instance: str,
-               bucket: Optional[str] = None):
+               bucket: Optional[str] = None,
+               digest_cache: Optional[DigestCache] = None):
     """Abstract class to handle all aspects of image comparison via Skia Gold.
 
     A single SkiaGoldSession is valid for a single instance/corpus/keys_file
@@ -81,6 +158,8 @@ class SkiaGoldSession():
       instance: The name of the Skia Gold instance to interact with.
       bucket: Overrides the formulaic Google Storage bucket name generated by
           goldctl
+      digest_cache: A DigestCache used by CompareBatch. If None, a cache local
+          to this session is used.
     """
     self._working_dir = working_dir
     self._gold_properties = gold_properties
@@ -95,6 +174,7 @@ class SkiaGoldSession():
       self._triage_link_file = triage_link_file.name
     # A map of image name to ComparisonResults for that image.
     self._comparison_results: Dict[str, SkiaGoldSession.ComparisonResults] = {}
+    self._digest_cache = digest_cache or DigestCache()
     self._authenticated = False
     self._initialized = False
 
@@ -102,6 +182,7 @@ class SkiaGoldSession():
     # getting deleted before we try to use it.
     self._keys_file = os.path.join(working_dir, 'gold_keys.json')
     shutil.copy(keys_file, self._keys_file)
+    self._keys_digest = ComputeKeysDigest(self._keys_file)
 
   def RunComparison(self,
                     name: str,
@@ -321,30 +402,9 @@ class SkiaGoldSession():
                       '--bypass-skia-gold-functionality being present.')
       return 0, None
 
-    compare_cmd = [
-        GOLDCTL_BINARY,
-        'imgtest',
-        'add',
-        '--test-name',
-        name,
-        '--png-file',
-        png_file,
-        '--work-dir',
-        self._working_dir,
-    ]
-    if self._gold_properties.local_pixel_tests or force_dryrun:
-      compare_cmd.append('--dryrun')
-    if inexact_matching_args:
-      logging.info('Using inexact matching arguments for image %s: %s', name,
-                   inexact_matching_args)
-      compare_cmd.extend(inexact_matching_args)
-
-    optional_keys = optional_keys or {}
-    for k, v in optional_keys.items():
-      compare_cmd.extend([
-          '--add-test-optional-key',
-          '%s:%s' % (k, v),
-      ])
+    compare_cmd = self._GetCompareCmd(name, png_file, self._working_dir,
+                                      inexact_matching_args, optional_keys,
+                                      force_dryrun)
 
     logging.info('Starting Gold triage link file clear')
     start_time = time.time()
@@ -356,40 +416,122 @@ class SkiaGoldSession():
     rc, stdout = self._RunCmdForRcAndOutput(compare_cmd)
     logging.info('Gold comparison command took %fs', time.time() - start_time)
 
-    self._comparison_results[name] = self.ComparisonResults()
-    if rc == 0:
-      self._comparison_results[name].triage_link_omission_reason = (
-          'Comparison succeeded, no triage link')
-    elif self._gold_properties.IsTryjobRun():
-      cl_triage_link = ('https://{instance}-gold.skia.org/cl/{crs}/{issue}')
-      cl_triage_link = cl_triage_link.format(
-          instance=self._instance,
-          crs=self._gold_properties.code_review_system,
-          issue=self._gold_properties.issue)
-      self._comparison_results[name].internal_triage_link = cl_triage_link
-      self._comparison_results[name].public_triage_link =\
-          self._GeneratePublicTriageLink(cl_triage_link)
+    def read_triage_link():
+      logging.info('Starting triage link file read')
+      start_time = time.time()
+      with open(self._triage_link_file) as tlf:
+        triage_link = tlf.read().strip()
+      logging.info('Triage link file read took %fs', time.time() - start_time)
+      return triage_link
+
+    self._StoreComparisonResults(name, rc, read_triage_link)
+    return rc, stdout
+
+  def CompareBatch(
+      self,
+      comparisons: Iterable[BatchComparison],
+      inexact_matching_args: Optional[List[str]] = None,
+      force_dryrun: bool = False,
+      max_parallel_comparisons: int = DEFAULT_MAX_PARALLEL_COMPARISONS,
+      result_callback: Optional[Callable[[str, StepRetVal], None]] = None
+  ) -> Dict[str, StepRetVal]:
+    """Compares many images to images known to Gold.
+
+    Equivalent to calling Compare() for each image, but faster. Images whose
+    digest previously passed a comparison for the same name are reported as
+    passing without running goldctl, and so are not uploaded again. The rest
+    are compared by up to |max_parallel_comparisons| goldctl processes at once.
+
+    Args:
+      comparisons: (name, png_file, optional_keys) tuples for each image. See
+          Compare() for what each of these is. |optional_keys| can be None.
+      inexact_matching_args: See Compare(). Used for every image.
+      force_dryrun: See Compare(). Used for every image.
+      max_parallel_comparisons: The maximum number of goldctl processes to run
+          at once.
+      result_callback: If set, called with (name, (return_code, output)) for
+          each image as soon as its comparison finishes.
+
+    Returns:
+      A dict mapping each image's name to a (return_code, output) tuple like
+      the one returned by Compare().
+    """
+    results: Dict[str, StepRetVal] = {}
+
+    def report(name, result):
+      results[name] = result
+      if result_callback:
+        result_callback(name, result)
+
+    comparisons = list(comparisons)
+    if self._gold_properties.bypass_skia_gold_functionality:
+      logging.warning('Not actually comparing with Gold due to '
+                      '--bypass-skia-gold-functionality being present.')
+      for name, _, _ in comparisons:
+        report(name, (0, None))
+      return results
+
+    unknown = []
+    for name, png_file, optional_keys in comparisons:
+      key = DigestCache.MakeKey(self._instance, self._corpus,
+                                self._keys_digest, name, inexact_matching_args)
+      digest = ComputeImageDigest(png_file)
+      if self._digest_cache.Contains(key, digest):
+        self._comparison_results[name] = self.ComparisonResults(
+            triage_link_omission_reason=(
+                'Image matched a previously approved image, no triage link'))
+        report(name, (0, None))
+      else:
+        unknown.append((name, png_file, optional_keys, key, digest))
+    if not unknown:
+      return results
+
+    # goldctl appends a link to this file for each failure. Links are matched
+    # to images by name below.
+    self._ClearTriageLinkFile()
+
+    # goldctl is not meant to be run multiple times at once in the same working
+    # directory, so give each concurrent process a copy of it.
+    num_workers = max(1, min(max_parallel_comparisons, len(unknown)))
+    work_dirs: queue.SimpleQueue = queue.SimpleQueue()
+    temp_dir = None
+    if num_workers == 1:
+      work_dirs.put(self._working_dir)
     else:
+      temp_dir = tempfile.mkdtemp()
+      for i in range(num_workers):
+        work_dir = os.path.join(temp_dir, str(i))
+        shutil.copytree(self._working_dir, work_dir)
+        work_dirs.put(work_dir)
+
+    def compare(name, png_file, optional_keys):
+      work_dir = work_dirs.get()
       try:
-        logging.info('Starting triage link file read')
-        start_time = time.time()
-        with open(self._triage_link_file) as tlf:
-          triage_link = tlf.read().strip()
-        logging.info('Triage link file read took %fs', time.time() - start_time)
-        if not triage_link:
-          self._comparison_results[name].triage_link_omission_reason = (
-              'Gold did not provide a triage link. This is likely a bug on '
-              "Gold's end.")
-          self._comparison_results[name].internal_triage_link = None
-          self._comparison_results[name].public_triage_link = None
-        else:
-          self._comparison_results[name].internal_triage_link = triage_link
-          self._comparison_results[name].public_triage_link =\
-              self._GeneratePublicTriageLink(triage_link)
-      except IOError:
-        self._comparison_results[name].triage_link_omission_reason = (
-            'Failed to read triage link from file')
-    return rc, stdout
+        return self._RunCmdForRcAndOutput(
+            self._GetCompareCmd(name, png_file, work_dir, inexact_matching_args,
+                                optional_keys, force_dryrun))
+      finally:
+        work_dirs.put(work_dir)
+
+    try:
+      with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        futures = {
+            executor.submit(compare, name, png_file, optional_keys):
+            (name, key, digest)
+            for name, png_file, optional_keys, key, digest in unknown
+        }
+        for future in concurrent.futures.as_completed(futures):
+          name, key, digest = futures[future]
+          rc, stdout = future.result()
+          if rc == 0:
+            self._digest_cache.Add(key, digest)
+          self._StoreComparisonResults(
+              name, rc, lambda name=name: self._ReadTriageLinkForImage(name))
+          report(name, (rc, stdout))
+    finally:
+      if temp_dir:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
 
   def Diff(self, name: str, png_file: str, output_manager: Any) -> StepRetVal:
     """Performs a local image diff against the closest known positive in Gold.
@@ -530,6 +672,90 @@ class SkiaGoldSession():
     assert name in self._comparison_results
     return self._comparison_results[name].local_diff_diff_image
 
+  def _GetCompareCmd(self, name: str, png_file: str, work_dir: str,
+                     inexact_matching_args: Optional[List[str]],
+                     optional_keys: Optional[Dict[str, str]],
+                     force_dryrun: bool) -> List[str]:
+    """Returns the goldctl command to compare an image. See Compare()."""
+    compare_cmd = [
+        GOLDCTL_BINARY,
+        'imgtest',
+        'add',
+        '--test-name',
+        name,
+        '--png-file',
+        png_file,
+        '--work-dir',
+        work_dir,
+    ]
+    if self._gold_properties.local_pixel_tests or force_dryrun:
+      compare_cmd.append('--dryrun')
+    if inexact_matching_args:
+      logging.info('Using inexact matching arguments for image %s: %s', name,
+                   inexact_matching_args)
+      compare_cmd.extend(inexact_matching_args)
+
+    optional_keys = optional_keys or {}
+    for k, v in optional_keys.items():
+      compare_cmd.extend([
+          '--add-test-optional-key',
+          '%s:%s' % (k, v),
+      ])
+    return compare_cmd
+
+  def _StoreComparisonResults(self, name: str, rc: int,
+                              read_triage_link: Callable[[], str]) -> None:
+    """Stores the ComparisonResults for a finished comparison.
+
+    Args:
+      name: The name of the image that was compared.
+      rc: The return code of the comparison.
+      read_triage_link: Returns the triage link written by goldctl for the
+          image, or an empty string. May raise IOError.
+    """
+    self._comparison_results[name] = self.ComparisonResults()
+    if rc == 0:
+      self._comparison_results[name].triage_link_omission_reason = (
+          'Comparison succeeded, no triage link')
+    elif self._gold_properties.IsTryjobRun():
+      cl_triage_link = ('https://{instance}-gold.skia.org/cl/{crs}/{issue}')
+      cl_triage_link = cl_triage_link.format(
+          instance=self._instance,
+          crs=self._gold_properties.code_review_system,
+          issue=self._gold_properties.issue)
+      self._comparison_results[name].internal_triage_link = cl_triage_link
+      self._comparison_results[name].public_triage_link =\
+          self._GeneratePublicTriageLink(cl_triage_link)
+    else:
+      try:
+        triage_link = read_triage_link()
+        if not triage_link:
+          self._comparison_results[name].triage_link_omission_reason = (
+              'Gold did not provide a triage link. This is likely a bug on '
+              "Gold's end.")
+          self._comparison_results[name].internal_triage_link = None
+          self._comparison_results[name].public_triage_link = None
+        else:
+          self._comparison_results[name].internal_triage_link = triage_link
+          self._comparison_results[name].public_triage_link =\
+              self._GeneratePublicTriageLink(triage_link)
+      except IOError:
+        self._comparison_results[name].triage_link_omission_reason = (
+            'Failed to read triage link from file')
+
+  def _ReadTriageLinkForImage(self, name: str) -> str:
+    """Returns the triage link for |name| from the triage link file, or ''.
+
+    Used when the file contains links for multiple images.
+    """
+    with open(self._triage_link_file) as tlf:
+      for line in tlf:
+        line = line.strip()
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(line).query)
+        if name in query.get('test', []):
+          return line
+    return ''
+
   def _GeneratePublicTriageLink(self, internal_link: str) -> str:
     """Generates a public triage link given an internal one.
 
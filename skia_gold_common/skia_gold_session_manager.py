@@ -24,8 +24,10 @@ SessionMapType = Dict[str, Dict[str, Dict[str,
 
 
 class SkiaGoldSessionManager():
-  def __init__(self, working_dir: str,
-               gold_properties: skia_gold_properties.SkiaGoldProperties):
+  def __init__(self,
+               working_dir: str,
+               gold_properties: skia_gold_properties.SkiaGoldProperties,
+               digest_cache_file: Optional[str] = None):
     """Class to manage one or more skia_gold_session.SkiaGoldSessions.
 
     A separate session is required for each instance/corpus/keys_file
@@ -39,10 +41,16 @@ class SkiaGoldSessionManager():
           SkiaGoldSessions' working directory will be created.
       gold_properties: A SkiaGoldProperties instance that will be used to create
           any SkiaGoldSessions.
+      digest_cache_file: An optional path to a file in which to persist digests
+          of approved images across runs. See SaveDigestCache().
     """
     self._working_dir = working_dir
     self._gold_properties = gold_properties
     self._sessions: SessionMapType = {}
+    # Shared by all sessions so that the cache file holds digests for all of
+    # them. Digests are cached separately for each instance/corpus/keys
+    # combination.
+    self._digest_cache = skia_gold_session.DigestCache(digest_cache_file)
 
   def GetSkiaGoldSession(
       self,
@@ -79,11 +87,20 @@ class SkiaGoldSessionManager():
     if not session:
       working_dir = tempfile.mkdtemp(dir=self._working_dir)
       keys_file = _GetKeysAsJson(keys_input, working_dir)
-      session = self.GetSessionClass()(working_dir, self._gold_properties,
-                                       keys_file, corpus, instance, bucket)
+      session = self.GetSessionClass()(working_dir,
+                                       self._gold_properties,
+                                       keys_file,
+                                       corpus,
+                                       instance,
+                                       bucket,
+                                       digest_cache=self._digest_cache)
       self._sessions[instance][corpus][keys_string] = session
     return session
 
+  def SaveDigestCache(self) -> None:
+    """Writes digests of approved images to the digest cache file, if any."""
+    self._digest_cache.Save()
+
   @staticmethod
   def _GetDefaultInstance() -> str:
     """Gets the default Skia Gold instance.
@@ -723,6 +723,161 @@ class SkiaGoldSessionCompareTest(fake_filesystem_unittest.TestCase):
                   '--add-test-optional-key', 'foo:bar')
 
 
+class SkiaGoldSessionCompareBatchTest(fake_filesystem_unittest.TestCase):
+  """Tests the functionality of SkiaGoldSession.CompareBatch."""
+
+  def setUp(self) -> None:
+    self.setUpPyfakefs()
+    self._working_dir = tempfile.mkdtemp()
+    self._json_keys = tempfile.NamedTemporaryFile(delete=False).name
+    self._pngs = {}
+    for name in ('a', 'b', 'c'):
+      png_file = os.path.join(self._working_dir, '%s.png' % name)
+      with open(png_file, 'w') as f:
+        f.write('image %s' % name)
+      self._pngs[name] = png_file
+
+    self.cmd_patcher = mock.patch.object(skia_gold_session.SkiaGoldSession,
+                                         '_RunCmdForRcAndOutput')
+    self.cmd_mock = self.cmd_patcher.start()
+    self.addCleanup(self.cmd_patcher.stop)
+
+  def _CreateSession(self, digest_cache=None, **kwargs):
+    args = createSkiaGoldArgs(git_revision='a', **kwargs)
+    sgp = skia_gold_properties.SkiaGoldProperties(args)
+    return skia_gold_session.SkiaGoldSession(self._working_dir,
+                                             sgp,
+                                             self._json_keys,
+                                             'corpus',
+                                             'instance',
+                                             digest_cache=digest_cache)
+
+  def _Comparisons(self, names):
+    return [(n, self._pngs[n], {'k': n}) for n in names]
+
+  @staticmethod
+  def _TestName(cmd):
+    return cmd[cmd.index('--test-name') + 1]
+
+  def test_resultsReportedPerImage(self) -> None:
+    self.cmd_mock.side_effect = lambda cmd: (
+        (1, 'failed') if self._TestName(cmd) == 'b' else (0, 'passed'))
+    session = self._CreateSession()
+    callback = mock.Mock()
+    results = session.CompareBatch(self._Comparisons(['a', 'b', 'c']),
+                                   result_callback=callback)
+    self.assertEqual(results, {
+        'a': (0, 'passed'),
+        'b': (1, 'failed'),
+        'c': (0, 'passed'),
+    })
+    self.assertEqual(sorted(c[0] for c in callback.call_args_list),
+                     [('a', (0, 'passed')), ('b', (1, 'failed')),
+                      ('c', (0, 'passed'))])
+    self.assertEqual(self.cmd_mock.call_count, 3)
+    for call in self.cmd_mock.call_args_list:
+      cmd = call[0][0]
+      name = self._TestName(cmd)
+      assertArgWith(self, cmd, '--png-file', self._pngs[name])
+      assertArgWith(self, cmd, '--add-test-optional-key', 'k:%s' % name)
+      # Each concurrent goldctl process gets its own copy of the work dir.
+      work_dir = cmd[cmd.index('--work-dir') + 1]
+      self.assertNotEqual(work_dir, self._working_dir)
+
+  def test_singleComparisonUsesWorkingDir(self) -> None:
+    self.cmd_mock.return_value = (0, None)
+    session = self._CreateSession()
+    session.CompareBatch(self._Comparisons(['a', 'b']),
+                         max_parallel_comparisons=1)
+    for call in self.cmd_mock.call_args_list:
+      assertArgWith(self, call[0][0], '--work-dir', self._working_dir)
+
+  def test_knownDigestsSkipGoldctl(self) -> None:
+    self.cmd_mock.return_value = (0, None)
+    digest_cache = skia_gold_session.DigestCache()
+    session = self._CreateSession(digest_cache)
+    session.CompareBatch(self._Comparisons(['a', 'b']))
+    self.assertEqual(self.cmd_mock.call_count, 2)
+
+    # Another session sharing the cache only compares the unknown image.
+    self.cmd_mock.reset_mock()
+    session = self._CreateSession(digest_cache)
+    results = session.CompareBatch(self._Comparisons(['a', 'b', 'c']))
+    self.assertEqual(self.cmd_mock.call_count, 1)
+    self.assertEqual(self._TestName(self.cmd_mock.call_args[0][0]), 'c')
+    self.assertEqual(results['a'], (0, None))
+    self.assertEqual(session.GetTriageLinks('a'), (None, None))
+
+    # Changed images are compared again.
+    with open(self._pngs['a'], 'w') as f:
+      f.write('new image a')
+    self.cmd_mock.reset_mock()
+    session.CompareBatch(self._Comparisons(['a']))
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+  def test_digestsCachedPerKeys(self) -> None:
+    self.cmd_mock.return_value = (0, None)
+    digest_cache = skia_gold_session.DigestCache()
+    with open(self._json_keys, 'w') as f:
+      json.dump({'gpu': 'first'}, f)
+    session = self._CreateSession(digest_cache)
+    session.CompareBatch(self._Comparisons(['a']))
+    self.assertEqual(self.cmd_mock.call_count, 1)
+
+    # A session for other keys compares the same image again.
+    with open(self._json_keys, 'w') as f:
+      json.dump({'gpu': 'second'}, f)
+    session = self._CreateSession(digest_cache)
+    session.CompareBatch(self._Comparisons(['a']))
+    self.assertEqual(self.cmd_mock.call_count, 2)
+
+  def test_failedDigestsNotCached(self) -> None:
+    self.cmd_mock.return_value = (1, None)
+    session = self._CreateSession()
+    session.CompareBatch(self._Comparisons(['a']))
+    session.CompareBatch(self._Comparisons(['a']))
+    self.assertEqual(self.cmd_mock.call_count, 2)
+
+  def test_triageLinksMatchedByName(self) -> None:
+
+    def run_cmd(cmd):
+      name = self._TestName(cmd)
+      with open(session._triage_link_file, 'a') as f:
+        f.write('https://instance-gold.skia.org/detail?test=%s&digest=1\n' %
+                name)
+      return 1, None
+
+    self.cmd_mock.side_effect = run_cmd
+    session = self._CreateSession()
+    session.CompareBatch(self._Comparisons(['a', 'b']))
+    for name in ('a', 'b'):
+      public_link, internal_link = session.GetTriageLinks(name)
+      self.assertEqual(
+          internal_link,
+          'https://instance-gold.skia.org/detail?test=%s&digest=1' % name)
+      self.assertEqual(
+          public_link,
+          'https://instance-public-gold.skia.org/detail?test=%s&digest=1' %
+          name)
+
+  def test_bypassSkiaGoldFunctionality(self) -> None:
+    session = self._CreateSession(bypass_skia_gold_functionality=True)
+    results = session.CompareBatch(self._Comparisons(['a']))
+    self.assertEqual(results, {'a': (0, None)})
+    self.cmd_mock.assert_not_called()
+
+  def test_digestCachePersisted(self) -> None:
+    cache_file = os.path.join(self._working_dir, 'digests.json')
+    digest_cache = skia_gold_session.DigestCache(cache_file)
+    key = skia_gold_session.DigestCache.MakeKey('instance', 'corpus', 'keys',
+                                                'a', None)
+    digest_cache.Add(key, 'digest')
+    digest_cache.Save()
+    digest_cache = skia_gold_session.DigestCache(cache_file)
+    self.assertTrue(digest_cache.Contains(key, 'digest'))
+    self.assertFalse(digest_cache.Contains(key, 'other_digest'))
+
+
 class SkiaGoldSessionDiffTest(fake_filesystem_unittest.TestCase):
   """Tests the functionality of SkiaGoldSession.Diff."""
 
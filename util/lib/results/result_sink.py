@@ -3,15 +3,30 @@
 # found in the LICENSE file.
 from __future__ import absolute_import
 import base64
+import collections
 import json
 import logging
 import os
+import threading
+import time
 
 import requests  # pylint: disable=import-error
 from lib.results import result_types
 
 HTML_SUMMARY_MAX = 4096
 
+# Limits for each ReportTestResults request sent in buffered mode. A batch is
+# sent once it reaches either size, or once its oldest result has waited for
+# _BATCH_MAX_DELAY_SECS.
+_BATCH_MAX_RESULTS = 500
+_BATCH_MAX_BYTES = 8 * 1024 * 1024
+_BATCH_MAX_DELAY_SECS = 5
+# Post() blocks while this many bytes of results are waiting to be sent.
+_BUFFER_MAX_BYTES = 64 * 1024 * 1024
+# Attempts made to send each batch, with exponential backoff in between.
+_BATCH_MAX_ATTEMPTS = 3
+_BATCH_RETRY_DELAY_SECS = 1
+
 _HTML_SUMMARY_ARTIFACT = '<text-artifact artifact-id="HTML Summary" />'
 _TEST_LOG_ARTIFACT = '<text-artifact artifact-id="Test Log" />'
 
@@ -28,18 +43,22 @@ RESULT_MAP = {
 }
 
 
-def TryInitClient():
+def TryInitClient(buffered=False):
   """Tries to initialize a result_sink_client object.
 
   Assumes that rdb stream is already running.
 
+  Args:
+    buffered: Whether the client should upload test results in batches. See
+        ResultSinkClient.
+
   Returns:
     A ResultSinkClient for the result_sink server else returns None.
   """
   try:
     with open(os.environ['LUCI_CONTEXT']) as f:
       sink = json.load(f)['result_sink']
-      return ResultSinkClient(sink)
+      return ResultSinkClient(sink, buffered=buffered)
   except KeyError:
     return None
 
@@ -49,9 +68,14 @@ class ResultSinkClient(object):
 
   This assumes that the rdb stream has been called already and that the
   server is listening.
+
+  By default, Post() uploads each test result before returning. In buffered
+  mode, Post() queues the result instead and a background thread uploads
+  queued results in batches. Upload errors are then raised by a later Post() or
+  by close(), which uploads any remaining results.
   """
 
-  def __init__(self, context):
+  def __init__(self, context, buffered=False):
     base_url = 'http://%s/prpc/luci.resultsink.v1.Sink' % context['address']
     self.test_results_url = base_url + '/ReportTestResults'
     self.report_artifacts_url = base_url + '/ReportInvocationLevelArtifacts'
@@ -64,6 +88,7 @@ class ResultSinkClient(object):
     }
     self.session = requests.Session()
     self.session.headers.update(headers)
+    self._uploader = _BatchUploader(self._PostBatch) if buffered else None
 
   def __enter__(self):
     return self
@@ -72,8 +97,12 @@ class ResultSinkClient(object):
     self.close()
 
   def close(self):
-    """Closes the session backing the sink."""
-    self.session.close()
+    """Uploads any buffered test results and closes the session."""
+    try:
+      if self._uploader:
+        self._uploader.Close()
+    finally:
+      self.session.close()
 
   def Post(self,
            test_id,
@@ -185,10 +214,29 @@ class ResultSinkClient(object):
           'repo': 'https://chromium.googlesource.com/chromium/src',
       }
 
+    if self._uploader:
+      self._uploader.Add(json.dumps(tr))
+      return
     res = self.session.post(url=self.test_results_url,
                             data=json.dumps({'testResults': [tr]}))
     res.raise_for_status()
 
+  def _PostBatch(self, serialized_results):
+    """Uploads already serialized test results in a single request."""
+    data = '{"testResults": [%s]}' % ', '.join(serialized_results)
+    for attempt in range(_BATCH_MAX_ATTEMPTS):
+      try:
+        res = self.session.post(url=self.test_results_url, data=data)
+        res.raise_for_status()
+        return
+      except requests.exceptions.RequestException:
+        if attempt + 1 == _BATCH_MAX_ATTEMPTS:
+          raise
+        logging.warning('Failed to upload %d test results, retrying.',
+                        len(serialized_results),
+                        exc_info=True)
+        time.sleep(_BATCH_RETRY_DELAY_SECS * 2**attempt)
+
   def ReportInvocationLevelArtifacts(self, artifacts):
     """Uploads invocation-level artifacts to the ResultSink server.
 
@@ -242,6 +290,111 @@ class ResultSinkClient(object):
     self.UpdateInvocation(invocation, update_mask)
 
 
+class _BatchUploader(object):
+  """Uploads serialized test results in batches on a background thread."""
+
+  def __init__(self, post_batch):
+    self._post_batch = post_batch
+    self._cond = threading.Condition()
+    # (time queued, serialized result) for results waiting to be uploaded.
+    self._pending = collections.deque()
+    self._pending_bytes = 0
+    # Bytes of results that are pending or being uploaded.
+    self._buffered_bytes = 0
+    # Number of Add() calls waiting for buffered results to be uploaded.
+    self._num_blocked = 0
+    self._closed = False
+    self._error = None
+    self._thread = threading.Thread(target=self._Run,
+                                    name='result_sink_uploader')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Add(self, serialized_result):
+    """Queues a result, blocking while too many bytes are waiting."""
+    size = len(serialized_result)
+    with self._cond:
+      assert not self._closed
+      # Always accept a result when nothing is buffered so that an oversized
+      # result does not block forever.
+      while (not self._error and self._buffered_bytes
+             and self._buffered_bytes + size > _BUFFER_MAX_BYTES):
+        self._num_blocked += 1
+        self._cond.notify_all()
+        self._cond.wait()
+        self._num_blocked -= 1
+      self._RaiseIfFailed()
+      self._pending.append((time.time(), serialized_result))
+      self._pending_bytes += size
+      self._buffered_bytes += size
+      self._cond.notify_all()
+
+  def Close(self):
+    """Uploads all queued results and stops the background thread."""
+    with self._cond:
+      if self._closed:
+        return
+      self._closed = True
+      self._cond.notify_all()
+    self._thread.join()
+    self._RaiseIfFailed()
+
+  def _RaiseIfFailed(self):
+    if self._error:
+      raise self._error
+
+  def _SecondsUntilDue(self):
+    """Returns how long until the pending results should be sent."""
+    if (self._closed or self._num_blocked
+        or len(self._pending) >= _BATCH_MAX_RESULTS
+        or self._pending_bytes >= _BATCH_MAX_BYTES):
+      return 0
+    return self._pending[0][0] + _BATCH_MAX_DELAY_SECS - time.time()
+
+  def _TakeBatch(self):
+    batch = []
+    batch_bytes = 0
+    while (self._pending and len(batch) < _BATCH_MAX_RESULTS
+           and (not batch or
+                batch_bytes + len(self._pending[0][1]) <= _BATCH_MAX_BYTES)):
+      batch.append(self._pending.popleft()[1])
+      batch_bytes += len(batch[-1])
+    self._pending_bytes -= batch_bytes
+    return batch, batch_bytes
+
+  def _Run(self):
+    while True:
+      with self._cond:
+        while True:
+          if not self._pending:
+            if self._closed:
+              return
+            self._cond.wait()
+            continue
+          timeout = self._SecondsUntilDue()
+          if timeout <= 0:
+            break
+          self._cond.wait(timeout)
+        batch, batch_bytes = self._TakeBatch()
+
+      try:
+        self._post_batch(batch)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Failed to upload %d test results.', len(batch))
+        with self._cond:
+          self._error = e
+          # Drop the rest, since nothing will upload it.
+          self._pending.clear()
+          self._pending_bytes = 0
+          self._buffered_bytes = 0
+          self._cond.notify_all()
+        return
+
+      with self._cond:
+        self._buffered_bytes -= batch_bytes
+        self._cond.notify_all()
+
+
 def _TruncateToUTF8Bytes(s, length):
   """ Truncates a string to a given number of bytes when encoded as UTF-8.
 
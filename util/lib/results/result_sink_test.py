@@ -3,9 +3,11 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import http.server
 import json
 import os
 import sys
+import threading
 import unittest
 
 from unittest import mock
@@ -186,5 +188,107 @@ class ClientTest(unittest.TestCase):
     }, data['testResults'][0]['tags'])
 
 
+class _FakeSinkHandler(http.server.BaseHTTPRequestHandler):
+  def do_POST(self):  # pylint: disable=invalid-name
+    server = self.server
+    body = self.rfile.read(int(self.headers['Content-Length']))
+    with server.lock:
+      fail = server.failures_remaining > 0
+      if fail:
+        server.failures_remaining -= 1
+      else:
+        server.requests.append((self.path, json.loads(body)))
+    self.send_response(500 if fail else 200)
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write(b'{}')
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+
+class BufferedClientTest(unittest.TestCase):
+  def setUp(self):
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  _FakeSinkHandler)
+    self.server.lock = threading.Lock()
+    self.server.requests = []
+    self.server.failures_remaining = 0
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.start()
+    self.context = {
+        'address': '127.0.0.1:%d' % self.server.server_address[1],
+        'auth_token': 'some-auth-token',
+    }
+    for name, value in (('_BATCH_MAX_RESULTS', 3),
+                        ('_BATCH_RETRY_DELAY_SECS', 0)):
+      patcher = mock.patch.object(result_sink, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server_thread.join()
+    self.server.server_close()
+
+  def _BatchedTestIds(self):
+    for path, data in self.server.requests:
+      self.assertEqual(path, '/prpc/luci.resultsink.v1.Sink/ReportTestResults')
+    return [[tr['testId'] for tr in data['testResults']]
+            for _, data in self.server.requests]
+
+  def testBatchesByCount(self):
+    with result_sink.ResultSinkClient(self.context, buffered=True) as client:
+      for i in range(7):
+        client.Post('test%d' % i, result_types.PASS, 0, 'log', None)
+    self.assertEqual(self._BatchedTestIds(),
+                     [['test0', 'test1', 'test2'],
+                      ['test3', 'test4', 'test5'], ['test6']])
+    test_result = self.server.requests[0][1]['testResults'][0]
+    self.assertEqual(test_result['status'], 'PASS')
+    self.assertIn('Test Log', test_result['artifacts'])
+
+  def testBatchesByBytes(self):
+    with mock.patch.object(result_sink, '_BATCH_MAX_BYTES', 1):
+      with result_sink.ResultSinkClient(self.context, buffered=True) as client:
+        for i in range(3):
+          client.Post('test%d' % i, result_types.PASS, 0, 'log', None)
+    self.assertEqual(self._BatchedTestIds(), [['test0'], ['test1'], ['test2']])
+
+  def testBatchesByTime(self):
+    with mock.patch.object(result_sink, '_BATCH_MAX_DELAY_SECS', 0):
+      client = result_sink.ResultSinkClient(self.context, buffered=True)
+      client.Post('test0', result_types.PASS, 0, 'log', None)
+      for _ in range(100):
+        with self.server.lock:
+          if self.server.requests:
+            break
+        threading.Event().wait(0.05)
+      self.assertEqual(self._BatchedTestIds(), [['test0']])
+      client.close()
+
+  def testBackPressure(self):
+    with mock.patch.object(result_sink, '_BUFFER_MAX_BYTES', 1):
+      with result_sink.ResultSinkClient(self.context, buffered=True) as client:
+        for i in range(4):
+          client.Post('test%d' % i, result_types.PASS, 0, 'log', None)
+    self.assertEqual(sum(self._BatchedTestIds(), []),
+                     ['test0', 'test1', 'test2', 'test3'])
+
+  def testRetries(self):
+    self.server.failures_remaining = 1
+    with result_sink.ResultSinkClient(self.context, buffered=True) as client:
+      client.Post('test0', result_types.PASS, 0, 'log', None)
+    self.assertEqual(self._BatchedTestIds(), [['test0']])
+
+  def testErrorRaisedOnClose(self):
+    self.server.failures_remaining = result_sink._BATCH_MAX_ATTEMPTS
+    client = result_sink.ResultSinkClient(self.context, buffered=True)
+    client.Post('test0', result_types.PASS, 0, 'log', None)
+    with self.assertRaises(result_sink.requests.exceptions.HTTPError):
+      client.close()
+    self.assertEqual(self.server.requests, [])
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -3,26 +3,32 @@
 # found in the LICENSE file.
 """Helper functions for dealing with .zip files."""
 
+import collections
+import concurrent.futures
 import os
 import pathlib
 import posixpath
 import stat
+import struct
 import time
 import zipfile
+import zlib
 
 _FIXED_ZIP_HEADER_LEN = 30
+# Entries below this size are always stored since deflate tends to grow them.
+_MIN_COMPRESS_SIZE = 16
 
 
-def _set_alignment(zip_obj, zip_info, alignment):
+def _set_alignment(offset, zip_info, alignment):
   """Sets a ZipInfo's extra field such that the file will be aligned.
 
   Args:
-    zip_obj: The ZipFile object that is being written.
+    offset: The offset at which the entry's local file header will be written.
     zip_info: The ZipInfo object about to be written.
     alignment: The amount of alignment (e.g. 4, or 4*1024).
   """
   header_size = _FIXED_ZIP_HEADER_LEN + len(zip_info.filename)
-  pos = zip_obj.fp.tell() + header_size
+  pos = offset + header_size
   padding_needed = (alignment - (pos % alignment)) % alignment
 
   # Python writes |extra| to both the local file header and the central
@@ -39,6 +45,319 @@ def _hermetic_date_time(timestamp=None):
           utc_time.tm_min, utc_time.tm_sec)
 
 
+def _get_compress_type(zip_file, data_len, compress):
+  # zipfile will deflate even when it makes the file bigger. To avoid
+  # growing files, disable compression at an arbitrary cut off point.
+  if data_len < _MIN_COMPRESS_SIZE:
+    compress = False
+
+  # None converts to ZIP_STORED, when passed explicitly rather than the
+  # default passed to the ZipFile constructor.
+  if compress is None:
+    return zip_file.compression
+  return zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+
+def _read_raw_entry(zip_file, info):
+  """Returns the still-compressed bytes of |info| from |zip_file|."""
+  fp = zip_file.fp
+  fp.seek(info.header_offset)
+  header = fp.read(_FIXED_ZIP_HEADER_LEN)
+  name_len, extra_len = struct.unpack('<HH', header[26:30])
+  fp.seek(info.header_offset + _FIXED_ZIP_HEADER_LEN + name_len + extra_len)
+  return fp.read(info.compress_size)
+
+
+def _write_raw_entry(zip_file, zipinfo, raw_data):
+  """Appends an already-compressed entry to |zip_file|.
+
+  Mirrors what ZipFile.writestr() writes for a seekable output, minus the
+  compression step, so that the output is byte-identical.
+  """
+  zipinfo.flag_bits = 0
+  zip64 = zipinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+  zip_file.fp.seek(zip_file.start_dir)
+  zipinfo.header_offset = zip_file.fp.tell()
+  zip_file._writecheck(zipinfo)  # pylint: disable=protected-access
+  zip_file._didModify = True  # pylint: disable=protected-access
+  zip_file.fp.write(zipinfo.FileHeader(zip64))
+  zip_file.fp.write(raw_data)
+  zip_file.start_dir = zip_file.fp.tell()
+  zip_file.filelist.append(zipinfo)
+  zip_file.NameToInfo[zipinfo.filename] = zipinfo
+
+
+def _read_src_path(src_path):
+  """Returns (data, mode_bits, is_symlink) for a file to be zipped."""
+  if os.path.islink(src_path):
+    # Mark as a symlink.
+    return os.readlink(src_path), stat.S_IFLNK << 16, True
+
+  # Maintain the executable bit.
+  mode_bits = 0
+  st = os.stat(src_path)
+  for mode in (stat.S_IXUSR, stat.S_IXGRP, stat.S_IXOTH):
+    if st.st_mode & mode:
+      mode_bits |= mode << 16
+
+  with open(src_path, 'rb') as f:
+    return f.read(), mode_bits, False
+
+
+_PreparedEntry = collections.namedtuple(
+    '_PreparedEntry',
+    ['data', 'mode_bits', 'compress_type', 'raw_data', 'crc', 'file_size'])
+
+
+def _prepare_entry(zip_file, src_path, compress, level):
+  """Reads and compresses a file. Runs on a worker thread.
+
+  zlib and file I/O release the GIL, so this parallelizes well. When
+  |raw_data| is None, the entry must be written by ZipFile.writestr().
+  """
+  data, mode_bits, is_symlink = _read_src_path(src_path)
+  if is_symlink:
+    # ZipFile.writestr() stores symlinks using the ZipInfo's compress_type.
+    return _PreparedEntry(data, mode_bits, None, None, None, None)
+
+  compress_type = _get_compress_type(zip_file, len(data), compress)
+  if (compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+      or len(data) * 1.05 > zipfile.ZIP64_LIMIT):
+    return _PreparedEntry(data, mode_bits, compress_type, None, None, None)
+
+  if compress_type == zipfile.ZIP_DEFLATED:
+    # Matches the compressor that ZipFile.writestr() would use.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    raw_data = compressor.compress(data) + compressor.flush()
+  else:
+    raw_data = data
+  return _PreparedEntry(None, mode_bits, compress_type, raw_data,
+                        zlib.crc32(data), len(data))
+
+
+def _can_copy_raw(zip_file, src_info, compress_type, reuse_deflated):
+  # Zips do not record the level entries were deflated at, so recompressing
+  # a deflated entry can produce different bytes than copying it.
+  if compress_type == zipfile.ZIP_DEFLATED and not reuse_deflated:
+    return False
+  return (src_info.compress_type == compress_type
+          # Encrypted entries cannot be copied without the key.
+          and not src_info.flag_bits & 0x1
+          # Non-seekable outputs need data descriptors.
+          and zip_file._seekable  # pylint: disable=protected-access
+          and not zip_file._writing  # pylint: disable=protected-access
+          and src_info.file_size <= zipfile.ZIP64_LIMIT
+          and src_info.compress_size <= zipfile.ZIP64_LIMIT)
+
+
+class HermeticZipWriter:
+  """Adds entries to a ZipFile with hard-coded modified times.
+
+  Tracks entry names in a set and the offset of the next local file header,
+  so adding an entry is O(1) rather than rebuilding ZipFile.namelist() for
+  each duplicate check.
+
+  Example:
+    with zipfile.ZipFile(path, 'w') as z:
+      writer = zip_helpers.HermeticZipWriter(z)
+      writer.add('foo.txt', data='foo')
+  """
+
+  def __init__(self, zip_file):
+    """Wraps |zip_file|, which must be open for writing or appending."""
+    self.zip_file = zip_file
+    self._names = set()
+    self._num_entries = 0
+    self._offset = 0
+    self._sync()
+
+  def __contains__(self, zip_path):
+    self._sync()
+    return zip_path in self._names
+
+  def _sync(self):
+    # Picks up entries that were written to |zip_file| directly.
+    filelist = self.zip_file.filelist
+    if len(filelist) != self._num_entries:
+      self._names = {i.filename for i in filelist}
+      self._num_entries = len(filelist)
+    self._offset = self.zip_file.start_dir
+
+  def _record(self, zip_path):
+    self._names.add(zip_path)
+    self._num_entries += 1
+    self._offset = self.zip_file.start_dir
+
+  def _check_zip_path(self, zip_path):
+    # Filenames can contain backslashes, but it is more likely that we've
+    # forgotten to use forward slashes as a directory separator.
+    assert '\\' not in zip_path, 'zip_path should not contain \\: ' + zip_path
+    assert not posixpath.isabs(zip_path), 'Absolute zip path: ' + zip_path
+    assert not zip_path.startswith('..'), 'Should not start with ..: ' + zip_path
+    assert posixpath.normpath(zip_path) == zip_path, (
+        f'Non-canonical zip_path: {zip_path} vs: {posixpath.normpath(zip_path)}')
+    assert zip_path not in self._names, (
+        'Tried to add a duplicate zip entry: ' + zip_path)
+
+  def add(self,
+          zip_path,
+          *,
+          src_path=None,
+          data=None,
+          compress=None,
+          alignment=None,
+          timestamp=None):
+    """Adds a file. See add_to_zip_hermetic() for a description of Args."""
+    assert (src_path is None) != (data is None), (
+        '|src_path| and |data| are mutually exclusive.')
+    self._sync()
+    if isinstance(zip_path, zipfile.ZipInfo):
+      zipinfo = zip_path
+      zip_path = zipinfo.filename
+    else:
+      zipinfo = zipfile.ZipInfo(filename=zip_path)
+      zipinfo.external_attr = 0o644 << 16
+
+    zipinfo.date_time = _hermetic_date_time(timestamp)
+
+    if alignment:
+      _set_alignment(self._offset, zipinfo, alignment)
+
+    self._check_zip_path(zip_path)
+
+    if src_path:
+      data, mode_bits, is_symlink = _read_src_path(src_path)
+      zipinfo.external_attr |= mode_bits
+      if is_symlink:
+        self.zip_file.writestr(zipinfo, data)
+        self._record(zip_path)
+        return
+
+    compress_type = _get_compress_type(self.zip_file, len(data), compress)
+    self.zip_file.writestr(zipinfo, data, compress_type)
+    self._record(zip_path)
+
+  def add_files(self, entries, *, num_workers=None, timestamp=None):
+    """Adds files from disk, optionally deflating them on a thread pool.
+
+    Entries are always written in the given order by the calling thread, and
+    the output is identical to calling add() for each entry.
+
+    Args:
+      entries: Iterable of (zip_path, src_path, compress, alignment) tuples.
+      num_workers: Number of threads to read and deflate entries on. Entries
+          are added serially when this is not greater than 1.
+      timestamp: The last modification date and time for the archive members.
+    """
+    # Outputs that are not seekable need data descriptors, which only
+    # ZipFile.writestr() knows how to write.
+    if (not num_workers or num_workers <= 1
+        or not self.zip_file._seekable):  # pylint: disable=protected-access
+      for zip_path, src_path, compress, alignment in entries:
+        self.add(zip_path,
+                 src_path=src_path,
+                 compress=compress,
+                 alignment=alignment,
+                 timestamp=timestamp)
+      return
+
+    # Look this up now rather than in the workers, since callers (e.g.
+    # apkbuilder.py) change it to select a compression level.
+    level = zlib.Z_DEFAULT_COMPRESSION
+    # Bounds how many prepared entries are held in memory at once.
+    max_pending = num_workers * 4
+    pending = collections.deque()
+
+    def write_next():
+      zip_path, alignment, future = pending.popleft()
+      self._add_prepared(zip_path, future.result(), alignment, timestamp)
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+      for zip_path, src_path, compress, alignment in entries:
+        if len(pending) >= max_pending:
+          write_next()
+        future = executor.submit(_prepare_entry, self.zip_file, src_path,
+                                 compress, level)
+        pending.append((zip_path, alignment, future))
+      while pending:
+        write_next()
+
+  def _add_prepared(self, zip_path, entry, alignment, timestamp):
+    self._sync()
+    zipinfo = zipfile.ZipInfo(filename=zip_path)
+    zipinfo.external_attr = 0o644 << 16 | entry.mode_bits
+    zipinfo.date_time = _hermetic_date_time(timestamp)
+
+    if alignment:
+      _set_alignment(self._offset, zipinfo, alignment)
+
+    self._check_zip_path(zip_path)
+
+    if entry.raw_data is None:
+      self.zip_file.writestr(zipinfo, entry.data, entry.compress_type)
+    else:
+      zipinfo.compress_type = entry.compress_type
+      zipinfo.CRC = entry.crc
+      zipinfo.file_size = entry.file_size
+      zipinfo.compress_size = len(entry.raw_data)
+      _write_raw_entry(self.zip_file, zipinfo, entry.raw_data)
+    self._record(zip_path)
+
+  def copy(self,
+           zip_path,
+           src_zip,
+           src_info,
+           *,
+           compress=None,
+           alignment=None,
+           timestamp=None,
+           reuse_deflated=False):
+    """Copies an entry. See copy_zip_entry() for a description of Args."""
+    compress_type = _get_compress_type(self.zip_file, src_info.file_size,
+                                       compress)
+    if not _can_copy_raw(self.zip_file, src_info, compress_type,
+                         reuse_deflated):
+      self.add(zip_path,
+               data=src_zip.read(src_info),
+               compress=compress_type != zipfile.ZIP_STORED,
+               alignment=alignment,
+               timestamp=timestamp)
+      return
+
+    self._sync()
+    zipinfo = zipfile.ZipInfo(filename=zip_path)
+    zipinfo.external_attr = 0o644 << 16
+    zipinfo.date_time = _hermetic_date_time(timestamp)
+    zipinfo.compress_type = compress_type
+    zipinfo.CRC = src_info.CRC
+    zipinfo.file_size = src_info.file_size
+    zipinfo.compress_size = src_info.compress_size
+
+    if alignment:
+      _set_alignment(self._offset, zipinfo, alignment)
+
+    self._check_zip_path(zip_path)
+
+    _write_raw_entry(self.zip_file, zipinfo,
+                     _read_raw_entry(src_zip, src_info))
+    self._record(zip_path)
+
+
+def _get_writer(zip_file):
+  """Returns the HermeticZipWriter to use for |zip_file|.
+
+  A ZipFile gets a single writer for its lifetime so that repeated calls to
+  the module-level helpers do not each rebuild the set of names.
+  """
+  if isinstance(zip_file, HermeticZipWriter):
+    return zip_file
+  writer = getattr(zip_file, '_hermetic_writer', None)
+  if writer is None:
+    writer = HermeticZipWriter(zip_file)
+    zip_file._hermetic_writer = writer  # pylint: disable=protected-access
+  return writer
+
+
 def add_to_zip_hermetic(zip_file,
                         zip_path,
                         *,
@@ -50,7 +369,7 @@ def add_to_zip_hermetic(zip_file,
   """Adds a file to the given ZipFile with a hard-coded modified time.
 
   Args:
-    zip_file: ZipFile instance to add the file to.
+    zip_file: ZipFile (or HermeticZipWriter) instance to add the file to.
     zip_path: Destination path within the zip file (or ZipInfo instance).
     src_path: Path of the source file. Mutually exclusive with |data|.
     data: File data as a string.
@@ -59,57 +378,49 @@ def add_to_zip_hermetic(zip_file,
     alignment: If set, align the data of the entry to this many bytes.
     timestamp: The last modification date and time for the archive member.
   """
-  assert (src_path is None) != (data is None), (
-      '|src_path| and |data| are mutually exclusive.')
-  if isinstance(zip_path, zipfile.ZipInfo):
-    zipinfo = zip_path
-    zip_path = zipinfo.filename
-  else:
-    zipinfo = zipfile.ZipInfo(filename=zip_path)
-    zipinfo.external_attr = 0o644 << 16
-
-  zipinfo.date_time = _hermetic_date_time(timestamp)
-
-  if alignment:
-    _set_alignment(zip_file, zipinfo, alignment)
-
-  # Filenames can contain backslashes, but it is more likely that we've
-  # forgotten to use forward slashes as a directory separator.
-  assert '\\' not in zip_path, 'zip_path should not contain \\: ' + zip_path
-  assert not posixpath.isabs(zip_path), 'Absolute zip path: ' + zip_path
-  assert not zip_path.startswith('..'), 'Should not start with ..: ' + zip_path
-  assert posixpath.normpath(zip_path) == zip_path, (
-      f'Non-canonical zip_path: {zip_path} vs: {posixpath.normpath(zip_path)}')
-  assert zip_path not in zip_file.namelist(), (
-      'Tried to add a duplicate zip entry: ' + zip_path)
-
-  if src_path and os.path.islink(src_path):
-    zipinfo.external_attr |= stat.S_IFLNK << 16  # mark as a symlink
-    zip_file.writestr(zipinfo, os.readlink(src_path))
-    return
-
-  # Maintain the executable bit.
-  if src_path:
-    st = os.stat(src_path)
-    for mode in (stat.S_IXUSR, stat.S_IXGRP, stat.S_IXOTH):
-      if st.st_mode & mode:
-        zipinfo.external_attr |= mode << 16
-
-  if src_path:
-    with open(src_path, 'rb') as f:
-      data = f.read()
+  _get_writer(zip_file).add(zip_path,
+                            src_path=src_path,
+                            data=data,
+                            compress=compress,
+                            alignment=alignment,
+                            timestamp=timestamp)
+
+
+def copy_zip_entry(zip_file,
+                   zip_path,
+                   src_zip,
+                   src_info,
+                   *,
+                   compress=None,
+                   alignment=None,
+                   timestamp=None,
+                   reuse_deflated=False):
+  """Copies an entry from another ZipFile with a hard-coded modified time.
+
+  Stored entries that remain stored are copied as-is, which gives the same
+  result as add_to_zip_hermetic(data=src_zip.read(src_info)). Deflated entries
+  are inflated and deflated again unless |reuse_deflated| is set.
 
-  # zipfile will deflate even when it makes the file bigger. To avoid
-  # growing files, disable compression at an arbitrary cut off point.
-  if len(data) < 16:
-    compress = False
-
-  # None converts to ZIP_STORED, when passed explicitly rather than the
-  # default passed to the ZipFile constructor.
-  compress_type = zip_file.compression
-  if compress is not None:
-    compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
-  zip_file.writestr(zipinfo, data, compress_type)
+  Args:
+    zip_file: ZipFile (or HermeticZipWriter) instance to add the file to.
+    zip_path: Destination path within the zip file.
+    src_zip: ZipFile instance (opened for reading) to copy from.
+    src_info: ZipInfo of the entry within |src_zip|.
+    compress: Whether to enable compression. Default is taken from ZipFile
+        constructor.
+    alignment: If set, align the data of the entry to this many bytes.
+    timestamp: The last modification date and time for the archive member.
+    reuse_deflated: Copy the compressed bytes of entries that remain deflated
+        rather than deflating them again. The output then depends on the level
+        that the source entry was deflated at rather than on zlib's settings.
+  """
+  _get_writer(zip_file).copy(zip_path,
+                             src_zip,
+                             src_info,
+                             compress=compress,
+                             alignment=alignment,
+                             timestamp=timestamp,
+                             reuse_deflated=reuse_deflated)
 
 
 def add_files_to_zip(inputs,
@@ -118,16 +429,20 @@ def add_files_to_zip(inputs,
                      base_dir=None,
                      compress=None,
                      zip_prefix_path=None,
-                     timestamp=None):
+                     timestamp=None,
+                     num_workers=None):
   """Creates a zip file from a list of files.
 
   Args:
     inputs: A list of paths to zip, or a list of (zip_path, fs_path) tuples.
-    output: Path, fileobj, or ZipFile instance to add files to.
+    output: Path, fileobj, ZipFile, or HermeticZipWriter instance to add files
+        to.
     base_dir: Prefix to strip from inputs.
     compress: Whether to compress
     zip_prefix_path: Path prepended to file path in zip file.
     timestamp: Unix timestamp to use for files in the archive.
+    num_workers: If greater than 1, read and deflate files on this many
+        threads. The output is the same as when done serially.
   """
   if base_dir is None:
     base_dir = '.'
@@ -146,18 +461,18 @@ def add_files_to_zip(inputs,
   input_tuples.sort(key=lambda tup: tup[0])
 
   out_zip = output
-  if not isinstance(output, zipfile.ZipFile):
+  if not isinstance(output, (zipfile.ZipFile, HermeticZipWriter)):
     out_zip = zipfile.ZipFile(output, 'w')
 
   try:
+    entries = []
     for zip_path, fs_path in input_tuples:
       if zip_prefix_path:
         zip_path = posixpath.join(zip_prefix_path, zip_path)
-      add_to_zip_hermetic(out_zip,
-                          zip_path,
-                          src_path=fs_path,
-                          compress=compress,
-                          timestamp=timestamp)
+      entries.append((zip_path, fs_path, compress, None))
+    _get_writer(out_zip).add_files(entries,
+                                   num_workers=num_workers,
+                                   timestamp=timestamp)
   finally:
     if output is not out_zip:
       out_zip.close()
@@ -176,20 +491,25 @@ def zip_directory(output, base_dir, **kwargs):
 def merge_zips(output, input_zips, path_transform=None, compress=None):
   """Combines all files from |input_zips| into |output|.
 
+  Entries that keep their compression method are copied without being
+  recompressed, so deflated entries retain the level they were deflated at.
+
   Args:
-    output: Path, fileobj, or ZipFile instance to add files to.
+    output: Path, ZipFile, or HermeticZipWriter instance to add files to.
     input_zips: Iterable of paths to zip files to merge.
     path_transform: Called for each entry path. Returns a new path, or None to
         skip the file.
     compress: Overrides compression setting from origin zip entries.
   """
   assert not isinstance(input_zips, str)  # Easy mistake to make.
-  if isinstance(output, zipfile.ZipFile):
-    out_zip = output
-    out_filename = output.filename
+  if isinstance(output, (zipfile.ZipFile, HermeticZipWriter)):
+    writer = _get_writer(output)
+    out_zip = writer.zip_file
+    out_filename = out_zip.filename
   else:
     assert isinstance(output, str), 'Was: ' + repr(output)
     out_zip = zipfile.ZipFile(output, 'w')
+    writer = _get_writer(out_zip)
     out_filename = output
 
   # Include paths in the existing zip here to avoid adding duplicate files.
@@ -209,14 +529,11 @@ def merge_zips(output, input_zips, path_transform=None, compress=None):
           else:
             dst_name = info.filename
 
-          data = in_zip.read(info)
-
           # If there's a duplicate file, ensure contents is the same and skip
           # adding it multiple times.
           if dst_name in crc_by_name:
             orig_filename, orig_crc = crc_by_name[dst_name]
-            new_crc = zipfile.crc32(data)
-            if new_crc == orig_crc:
+            if info.CRC == orig_crc:
               continue
             msg = f"""File appeared in multiple inputs with differing contents.
 File: {dst_name}
@@ -228,11 +545,12 @@ Input2: {in_file}"""
             compress_entry = compress
           else:
             compress_entry = info.compress_type != zipfile.ZIP_STORED
-          add_to_zip_hermetic(out_zip,
-                              dst_name,
-                              data=data,
-                              compress=compress_entry)
-          crc_by_name[dst_name] = (in_file, out_zip.getinfo(dst_name).CRC)
+          writer.copy(dst_name,
+                      in_zip,
+                      info,
+                      compress=compress_entry,
+                      reuse_deflated=True)
+          crc_by_name[dst_name] = (in_file, info.CRC)
   finally:
-    if output is not out_zip:
+    if isinstance(output, str):
       out_zip.close()
@@ -8,8 +8,11 @@ import pathlib
 import shutil
 import sys
 import tempfile
+import time
 import unittest
+from unittest import mock
 import zipfile
+import zlib
 
 import zip_helpers
 
@@ -26,6 +29,31 @@ def _make_test_zips(tmp_dir, create_conflct=False):
   return zip1, zip2
 
 
+def _make_mixed_zip(path):
+  with zipfile.ZipFile(path, 'w') as z:
+    zip_helpers.add_to_zip_hermetic(z, 'a/stored', data=b'S' * 1000,
+                                    compress=False)
+    zip_helpers.add_to_zip_hermetic(z, 'a/deflated', data=b'D' * 1000,
+                                    compress=True)
+    zip_helpers.add_to_zip_hermetic(z, 'tiny', data=b'T', compress=True)
+    zip_helpers.add_to_zip_hermetic(z, 'b/empty', data=b'')
+
+
+def _make_test_tree(root, num_files, file_size):
+  """Writes |num_files| semi-compressible files of |file_size| bytes."""
+  chunk = os.urandom(256)
+  for i in range(num_files):
+    path = os.path.join(root, 'd%d' % (i % 50), 'f%d' % i)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(((b'%d' % i) * 64 + chunk)[:file_size] * (file_size // 256 + 1))
+      f.truncate(file_size)
+  os.chmod(os.path.join(root, 'd0', 'f0'), 0o755)
+  os.symlink('f0', os.path.join(root, 'd0', 'link'))
+  with open(os.path.join(root, 'd1', 'tiny'), 'wb') as f:
+    f.write(b'tiny')
+
+
 class ZipHelpersTest(unittest.TestCase):
   def test_merge_zips__identical_file(self):
     with tempfile.TemporaryDirectory() as tmp_dir:
@@ -53,6 +81,162 @@ class ZipHelpersTest(unittest.TestCase):
         with zipfile.ZipFile(zip1, 'a') as dst_zip:
           zip_helpers.merge_zips(dst_zip, [zip2])
 
+  def test_merge_zips__raw_copy_matches_recompress(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_zip = os.path.join(tmp_dir, 'src.zip')
+      _make_mixed_zip(src_zip)
+
+      for compress in (None, True, False):
+        merged_zip = os.path.join(tmp_dir, 'merged.zip')
+        zip_helpers.merge_zips(merged_zip, [src_zip], compress=compress)
+
+        expected_zip = os.path.join(tmp_dir, 'expected.zip')
+        with zipfile.ZipFile(src_zip) as in_zip, \
+             zipfile.ZipFile(expected_zip, 'w') as out_zip:
+          for info in in_zip.infolist():
+            compress_entry = compress
+            if compress_entry is None:
+              compress_entry = info.compress_type != zipfile.ZIP_STORED
+            zip_helpers.add_to_zip_hermetic(out_zip,
+                                            info.filename,
+                                            data=in_zip.read(info),
+                                            compress=compress_entry)
+
+        self.assertEqual(pathlib.Path(merged_zip).read_bytes(),
+                         pathlib.Path(expected_zip).read_bytes())
+
+  def test_copy_zip_entry__recompresses_at_writer_level(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_zip = os.path.join(tmp_dir, 'src.zip')
+      data = bytes(range(256)) * 8 + b'repeated text ' * 500
+      with mock.patch.object(zlib, 'Z_DEFAULT_COMPRESSION', 9), \
+           zipfile.ZipFile(src_zip, 'w') as z:
+        zip_helpers.add_to_zip_hermetic(z, 'stored', data=data, compress=False)
+        zip_helpers.add_to_zip_hermetic(z, 'deflated', data=data, compress=True)
+
+      # apkbuilder.py sets the level for the whole process this way.
+      with mock.patch.object(zlib, 'Z_DEFAULT_COMPRESSION', 1):
+        copied_zip = os.path.join(tmp_dir, 'copied.zip')
+        expected_zip = os.path.join(tmp_dir, 'expected.zip')
+        with zipfile.ZipFile(src_zip) as in_zip:
+          with zipfile.ZipFile(copied_zip, 'w') as out_zip:
+            for info in in_zip.infolist():
+              zip_helpers.copy_zip_entry(
+                  out_zip,
+                  info.filename,
+                  in_zip,
+                  info,
+                  compress=info.compress_type != zipfile.ZIP_STORED)
+          with zipfile.ZipFile(expected_zip, 'w') as out_zip:
+            for info in in_zip.infolist():
+              zip_helpers.add_to_zip_hermetic(
+                  out_zip,
+                  info.filename,
+                  data=in_zip.read(info),
+                  compress=info.compress_type != zipfile.ZIP_STORED)
+
+      self.assertEqual(pathlib.Path(copied_zip).read_bytes(),
+                       pathlib.Path(expected_zip).read_bytes())
+
+  def test_copy_zip_entry__alignment(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_zip = os.path.join(tmp_dir, 'src.zip')
+      _make_mixed_zip(src_zip)
+
+      out_path = os.path.join(tmp_dir, 'out.zip')
+      with zipfile.ZipFile(src_zip) as in_zip, \
+           zipfile.ZipFile(out_path, 'w') as out_zip:
+        for info in in_zip.infolist():
+          zip_helpers.copy_zip_entry(out_zip,
+                                     'x/' + info.filename,
+                                     in_zip,
+                                     info,
+                                     compress=False,
+                                     alignment=4096)
+
+      with zipfile.ZipFile(out_path) as z:
+        self.assertIsNone(z.testzip())
+        self.assertEqual(z.read('x/a/deflated'), b'D' * 1000)
+        for info in z.infolist():
+          self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+          data_offset = (info.header_offset + 30 + len(info.filename) +
+                         len(info.extra))
+          self.assertEqual(data_offset % 4096, 0)
+
+  def test_hermetic_zip_writer__duplicate(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      with zipfile.ZipFile(os.path.join(tmp_dir, 'out.zip'), 'w') as z:
+        z.writestr('direct', 'X')
+        writer = zip_helpers.HermeticZipWriter(z)
+        writer.add('foo', data='foo')
+        self.assertIn('foo', writer)
+        self.assertIn('direct', writer)
+        with self.assertRaises(AssertionError):
+          writer.add('foo', data='bar')
+        with self.assertRaises(AssertionError):
+          zip_helpers.add_to_zip_hermetic(z, 'direct', data='bar')
+        # Entries written around the writer are still noticed.
+        z.writestr('direct2', 'X')
+        with self.assertRaises(AssertionError):
+          writer.add('direct2', data='bar')
+        with self.assertRaises(AssertionError):
+          writer.add('a/../b', data='bar')
+
+  def test_zip_directory__parallel_matches_serial(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_dir = os.path.join(tmp_dir, 'src')
+      _make_test_tree(src_dir, 200, 3000)
+
+      for compress in (None, True, False):
+        serial_zip = os.path.join(tmp_dir, 'serial.zip')
+        parallel_zip = os.path.join(tmp_dir, 'parallel.zip')
+        zip_helpers.zip_directory(serial_zip, src_dir, compress=compress)
+        zip_helpers.zip_directory(parallel_zip,
+                                  src_dir,
+                                  compress=compress,
+                                  num_workers=4)
+        self.assertEqual(pathlib.Path(serial_zip).read_bytes(),
+                         pathlib.Path(parallel_zip).read_bytes())
+
+  def test_add_files__parallel_alignment(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_dir = os.path.join(tmp_dir, 'src')
+      _make_test_tree(src_dir, 20, 1000)
+      entries = [('a/%d' % i, os.path.join(src_dir, 'd%d' % i, 'f%d' % i),
+                  i % 2 == 0, 4096 if i % 2 else 4) for i in range(20)]
+
+      outputs = []
+      for num_workers in (None, 3):
+        out_path = os.path.join(tmp_dir, 'out%s.zip' % num_workers)
+        with zipfile.ZipFile(out_path, 'w') as z:
+          zip_helpers.HermeticZipWriter(z).add_files(entries,
+                                                     num_workers=num_workers)
+        outputs.append(pathlib.Path(out_path).read_bytes())
+      self.assertEqual(outputs[0], outputs[1])
+
+  @unittest.skipUnless(os.environ.get('ZIP_HELPERS_BENCHMARK'),
+                       'Set ZIP_HELPERS_BENCHMARK=1 to run.')
+  def test_zip_directory__benchmark(self):
+    # 20k files totalling 500MB.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_dir = os.path.join(tmp_dir, 'src')
+      _make_test_tree(src_dir, 20000, 25 * 1024)
+
+      timings = {}
+      for num_workers in (None, os.cpu_count()):
+        out_path = os.path.join(tmp_dir, 'out.zip')
+        start = time.monotonic()
+        zip_helpers.zip_directory(out_path, src_dir, num_workers=num_workers)
+        timings[num_workers] = time.monotonic() - start
+        os.unlink(out_path)
+
+      serial = timings[None]
+      parallel = timings[os.cpu_count()]
+      sys.stderr.write(f'\nserial: {serial:.2f}s, {os.cpu_count()} workers: '
+                       f'{parallel:.2f}s ({serial / parallel:.1f}x)\n')
+      if os.cpu_count() > 1:
+        self.assertLess(parallel, serial)
+
 
 if __name__ == '__main__':
   unittest.main()